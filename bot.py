@@ -2,9 +2,20 @@ import os
 import logging
 import re
 import time
+import math
+import mmap
+import struct
+import sys
 import json
 import random
 import threading
+import queue
+import asyncio
+import atexit
+import hmac
+import functools
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from datetime import datetime
 from dotenv import load_dotenv
 import requests
@@ -22,12 +33,32 @@ from selenium.webdriver.support.ui import WebDriverWait, Select
 from selenium.webdriver.support import expected_conditions as EC
 from webdriver_manager.chrome import ChromeDriverManager
 import psycopg2
+import psycopg2.pool
 from psycopg2.extras import RealDictCursor
 import uuid
+import tempfile
+import hashlib
+import sqlite3
+from urllib.parse import urljoin
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from collections import deque
+from io import BytesIO
 import json
 import threading
 import random
 
+# Thư viện cho chế độ asyncio (BOT_RUNTIME=async), chỉ cần cài khi dùng chế độ này
+try:
+    import aiohttp
+    import asyncpg
+    from telebot.async_telebot import AsyncTeleBot
+except ImportError:
+    aiohttp = None
+    asyncpg = None
+    AsyncTeleBot = None
+
 # Tải biến môi trường từ file .env
 load_dotenv()
 
@@ -44,6 +75,23 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 YESCALE_API_KEY = os.getenv('YESCALE_API_KEY')
 AIROUTER_API_KEY = os.getenv('AIROUTER_API_KEY', 'sk-9lA2bexmmJOs5hU-nkc8gg')
 
+# Địa chỉ API và model của từng nhà cung cấp AI (có thể trỏ về server giả lập khi thử nghiệm)
+AIROUTER_API_BASE = os.getenv('AIROUTER_API_BASE', 'https://api.airouter.io')
+OPENAI_API_BASE = os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1')
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+YESCALE_API_BASE = os.getenv('YESCALE_API_BASE', 'https://api.yescale.io/v1')
+YESCALE_MODEL = os.getenv('YESCALE_MODEL', 'gpt-4o-mini')
+# Định tuyến AI: thời gian chờ mỗi yêu cầu (giây), mốc gửi yêu cầu dự phòng khi chưa đủ dữ liệu
+# và mốc tối thiểu (giây), số yêu cầu dự phòng tối đa, số mẫu độ trễ tối thiểu để tính p95,
+# số lỗi liên tiếp trước khi tạm ngưng một nhà cung cấp và thời gian tạm ngưng (giây)
+LLM_REQUEST_TIMEOUT = int(os.getenv('LLM_REQUEST_TIMEOUT', '120'))
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv('LLM_HEDGE_DEFAULT_DELAY', '20'))
+LLM_HEDGE_MIN_DELAY = float(os.getenv('LLM_HEDGE_MIN_DELAY', '2'))
+LLM_MAX_HEDGES = int(os.getenv('LLM_MAX_HEDGES', '1'))
+LLM_MIN_SAMPLES = int(os.getenv('LLM_MIN_SAMPLES', '5'))
+LLM_PROVIDER_MAX_ERRORS = int(os.getenv('LLM_PROVIDER_MAX_ERRORS', '3'))
+LLM_PROVIDER_COOLDOWN = int(os.getenv('LLM_PROVIDER_COOLDOWN', '60'))
+
 # Thêm vào phần biến môi trường
 SUPABASE_DB_HOST = os.getenv('SUPABASE_DB_HOST')
 SUPABASE_DB_PORT = os.getenv('SUPABASE_DB_PORT')
@@ -56,26 +104,644 @@ SUPABASE_POOLER_HOST = os.getenv('SUPABASE_POOLER_HOST', 'aws-0-ap-southeast-1.p
 SUPABASE_POOLER_PORT = os.getenv('SUPABASE_POOLER_PORT', '6543')
 SUPABASE_POOLER_USER = os.getenv('SUPABASE_POOLER_USER', 'postgres.nscsnynjuzebwtmicukk')
 
-# Khởi tạo bot
-bot = telebot.TeleBot(TELEGRAM_TOKEN)
+# Pool kết nối cơ sở dữ liệu: số kết nối tối thiểu/tối đa, thời gian chờ kết nối rảnh (giây),
+# thời gian rảnh trước khi phải kiểm tra lại kết nối (giây), số lỗi liên tiếp trước khi đổi endpoint
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_HEALTH_CHECK_IDLE = int(os.getenv('DB_HEALTH_CHECK_IDLE', '60'))
+DB_FAILOVER_ERRORS = int(os.getenv('DB_FAILOVER_ERRORS', '3'))
+
+# Chuyển ảnh base64 cũ sang dạng nhị phân: số dòng mỗi đợt và thời gian nghỉ giữa các đợt (giây)
+CHART_MIGRATION_BATCH_SIZE = int(os.getenv('CHART_MIGRATION_BATCH_SIZE', '100'))
+CHART_MIGRATION_PAUSE = float(os.getenv('CHART_MIGRATION_PAUSE', '0.5'))
+
+# Cách lập lá số: 'native' (an sao bằng Python) hoặc 'selenium' (lấy từ tuvivietnam.vn)
+CHART_ENGINE = os.getenv('CHART_ENGINE', 'native')
+# Font dùng để vẽ lá số (cần hỗ trợ tiếng Việt)
+CHART_FONT_PATH = os.getenv('CHART_FONT_PATH')
+# Định dạng ảnh lá số: 'JPEG' hoặc 'WEBP'
+CHART_IMAGE_FORMAT = os.getenv('CHART_IMAGE_FORMAT', 'JPEG').upper()
+# Bảng âm lịch tính sẵn (1900-2100)
+LUNAR_TABLE_PATH = os.getenv('LUNAR_TABLE_PATH', 'data/lunar_table.bin')
+# Thư mục kho ảnh lưu theo nội dung (SHA-256)
+ASSET_STORE_DIR = os.getenv('ASSET_STORE_DIR', 'assets/store')
+# Pool trình duyệt Chrome: số trình duyệt tối đa, số lần dùng trước khi thay mới, thời gian chờ (giây)
+DRIVER_POOL_SIZE = int(os.getenv('DRIVER_POOL_SIZE', '2'))
+DRIVER_MAX_USES = int(os.getenv('DRIVER_MAX_USES', '50'))
+DRIVER_POOL_TIMEOUT = int(os.getenv('DRIVER_POOL_TIMEOUT', '60'))
+# Đường dẫn chromedriver có sẵn (chế độ offline), để trống thì tự tải bằng webdriver_manager
+CHROMEDRIVER_PATH = os.getenv('CHROMEDRIVER_PATH')
+# Cách lấy lá số từ web: 'selenium' (trình duyệt) hoặc 'http' (POST form trực tiếp)
+CHART_SCRAPER = os.getenv('CHART_SCRAPER', 'selenium')
+# Trang có form an sao (có thể trỏ về server giả lập khi thử nghiệm). Tên trường và địa chỉ gửi
+# form được đọc từ chính trang này, giống như trình duyệt gửi form
+TUVI_FORM_URL = os.getenv('TUVI_FORM_URL', 'https://tuvivietnam.vn/lasotuvi/')
+HTTP_TIMEOUT = int(os.getenv('HTTP_TIMEOUT', '30'))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))
+# Số lá số giữ trong cache bộ nhớ (dùng chung cho mọi người dùng)
+CHART_CACHE_SIZE = int(os.getenv('CHART_CACHE_SIZE', '128'))
+# Số file_id Telegram của ảnh lá số giữ trong bộ nhớ (phần còn lại đọc từ cơ sở dữ liệu)
+TELEGRAM_FILE_ID_CACHE_SIZE = int(os.getenv('TELEGRAM_FILE_ID_CACHE_SIZE', '1024'))
+# Thời gian tối đa (giây) chờ một yêu cầu khác đang lập cùng lá số
+CHART_FLIGHT_TIMEOUT = int(os.getenv('CHART_FLIGHT_TIMEOUT', '120'))
+# Số worker lập lá số chạy nền và số yêu cầu tối đa được xếp hàng
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', '4'))
+CHART_QUEUE_SIZE = int(os.getenv('CHART_QUEUE_SIZE', '20'))
+# Cách nhận update: 'polling' (khi phát triển) hoặc 'webhook' (server HTTP nhận update từ Telegram)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Webhook: địa chỉ công khai (để trống khi thử local), địa chỉ lắng nghe, đường dẫn, secret token
+# (bắt buộc), số update tối đa chờ xử lý mỗi tiến trình và số tiến trình xử lý update
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '100'))
+WEBHOOK_PROCESSES = int(os.getenv('WEBHOOK_PROCESSES', '1'))
+# Số update được xử lý cùng lúc mỗi tiến trình: số luồng (BOT_RUNTIME=threads) hoặc số task (async).
+# Update chỉ được lấy khỏi hàng đợi khi còn chỗ, nên hàng đợi đầy thì webhook trả 503
+WEBHOOK_HANDLERS = int(os.getenv('WEBHOOK_HANDLERS', '8'))
+WEBHOOK_ASYNC_HANDLERS = int(os.getenv('WEBHOOK_ASYNC_HANDLERS', '200'))
+# Cách xử lý update: 'threads' (TeleBot đồng bộ, mỗi update một luồng) hoặc 'async' (AsyncTeleBot, aiohttp, asyncpg)
+BOT_RUNTIME = os.getenv('BOT_RUNTIME', 'threads')
+# Model dùng để phân tích lá số ('auto' để AIRouter tự chọn) và số phân tích giữ trong cache bộ nhớ
+ANALYSIS_MODEL = os.getenv('ANALYSIS_MODEL', 'auto')
+ANALYSIS_CACHE_SIZE = int(os.getenv('ANALYSIS_CACHE_SIZE', '256'))
+# Nhận phân tích theo từng phần (stream) và khoảng cách tối thiểu (giây) giữa hai lần sửa tin nhắn
+ANALYSIS_STREAM = os.getenv('ANALYSIS_STREAM', '1') == '1'
+ANALYSIS_EDIT_INTERVAL = float(os.getenv('ANALYSIS_EDIT_INTERVAL', '1.0'))
+# Cách phân tích: 'lazy' (tổng quan trước, từng cung khi người dùng mở), 'parallel' (tổng quan trước,
+# rồi phân tích song song tất cả các cung) hoặc 'full' (12 cung trong một lần gọi)
+ANALYSIS_MODE = os.getenv('ANALYSIS_MODE', 'lazy')
+# Số yêu cầu phân tích cung chạy cùng lúc (toàn bot) và số lần thử lại khi một cung bị lỗi
+ANALYSIS_CONCURRENCY = int(os.getenv('ANALYSIS_CONCURRENCY', '6'))
+ANALYSIS_CUNG_RETRIES = int(os.getenv('ANALYSIS_CUNG_RETRIES', '1'))
+# Dữ liệu gửi cho AI: 'text' (JSON các sao theo từng cung) hoặc 'image' (ảnh lá số)
+ANALYSIS_INPUT = os.getenv('ANALYSIS_INPUT', 'text')
+
+# Phiên hội thoại: 'memory' (mất khi khởi động lại), 'sqlite' hoặc 'postgres' (giữ qua lần khởi động lại, dùng chung giữa các tiến trình)
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'memory')
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', 'sessions.db')
+# Phiên không dùng quá thời gian này (giây) sẽ bị xóa
+SESSION_TTL = int(os.getenv('SESSION_TTL', '86400'))
+# Giới hạn số phiên và dung lượng (byte) giữ trong bộ nhớ
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', '10000'))
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_BYTES', str(64 * 1024 * 1024)))
+# Chu kỳ (giây) ghi phiên xuống cơ sở dữ liệu và dọn phiên hết hạn
+SESSION_FLUSH_INTERVAL = int(os.getenv('SESSION_FLUSH_INTERVAL', '30'))
+# Số khóa dùng chung cho tất cả các chat (mỗi chat luôn dùng cùng một khóa)
+CHAT_LOCK_STRIPES = int(os.getenv('CHAT_LOCK_STRIPES', '256'))
+# Chu kỳ (giây) kiểm tra yêu cầu hủy khi đang chờ AI trả lời
+JOB_CANCEL_POLL_INTERVAL = float(os.getenv('JOB_CANCEL_POLL_INTERVAL', '0.5'))
+
+# Khởi tạo bot. Ở chế độ webhook, handler chạy ngay trong luồng lấy update (xem dispatch_updates)
+# thay vì hàng đợi không giới hạn của TeleBot
+bot = telebot.TeleBot(TELEGRAM_TOKEN, threaded=BOT_MODE != 'webhook')
 
 # Lưu trữ trạng thái người dùng
-user_states = {}
+class SessionStore(MutableMapping):
+    """
+    Trạng thái hội thoại theo ID chat, dùng như dict.
+
+    Phiên không được dùng quá SESSION_TTL giây sẽ bị xóa. Khi vượt SESSION_MAX_ENTRIES phiên
+    hoặc SESSION_MAX_BYTES byte, phiên lâu không dùng nhất bị bỏ khỏi bộ nhớ (LRU). Với backend
+    'sqlite' hoặc 'postgres', phiên được ghi định kỳ xuống cơ sở dữ liệu nên giữ được qua lần
+    khởi động lại, dùng chung giữa các tiến trình, và phiên bị bỏ khỏi bộ nhớ vẫn đọc lại được.
+    """
+
+    def __init__(self, backend='memory', ttl=SESSION_TTL, max_entries=SESSION_MAX_ENTRIES, max_bytes=SESSION_MAX_BYTES):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # chat_id -> [trạng thái, thời điểm dùng gần nhất, dung lượng bản ghi gọn (byte)]
+        self.sessions = OrderedDict()
+        # Phiên có thể đã thay đổi từ lần ghi gần nhất (trạng thái là dict, được sửa trực tiếp)
+        self.dirty = set()
+        # Bản ghi đã bỏ khỏi bộ nhớ nhưng chưa ghi xuống cơ sở dữ liệu: chat_id -> bản ghi JSON
+        self.pending = {}
+        self.lock = threading.RLock()
+        # Chỉ một luồng ghi self.pending xuống cơ sở dữ liệu tại một thời điểm, để bản ghi cũ
+        # không ghi đè bản ghi mới hơn
+        self.flush_lock = threading.Lock()
+        self.sqlite_conn = None
+        self.sqlite_lock = threading.Lock()
+
+    def __getitem__(self, chat_id):
+        with self.lock:
+            entry = self.sessions.get(chat_id)
+            if entry is not None:
+                if time.time() - entry[1] <= self.ttl:
+                    entry[1] = time.time()
+                    self.sessions.move_to_end(chat_id)
+                    if isinstance(entry[0], dict):
+                        self.dirty.add(chat_id)
+                    return entry[0]
+                self.drop(chat_id)
+                session_stats['expired'] += 1
+            # Phiên vừa bị bỏ khỏi bộ nhớ nhưng chưa kịp ghi xuống cơ sở dữ liệu
+            record = self.pending.get(chat_id)
+
+        state = json.loads(record) if record is not None else self.load_persisted(chat_id)
+        if state is None:
+            raise KeyError(chat_id)
+        with self.lock:
+            # Luồng khác có thể vừa tạo phiên mới trong lúc đọc cơ sở dữ liệu
+            if chat_id in self.sessions:
+                return self.sessions[chat_id][0]
+            self.sessions[chat_id] = [state, time.time(), 0]
+            session_stats['loaded'] += 1
+            self.evict_overflow()
+        self.flush_pending()
+        return state
+
+    def __setitem__(self, chat_id, state):
+        with self.lock:
+            self.sessions[chat_id] = [state, time.time(), 0]
+            self.sessions.move_to_end(chat_id)
+            self.dirty.add(chat_id)
+            self.pending.pop(chat_id, None)
+            self.evict_overflow()
+        self.flush_pending()
+
+    def __delitem__(self, chat_id):
+        with self.lock:
+            if chat_id not in self.sessions:
+                raise KeyError(chat_id)
+            self.drop(chat_id)
+            self.pending.pop(chat_id, None)
+        # Chờ lần ghi đang chạy xong để nó không ghi lại phiên vừa xóa
+        with self.flush_lock:
+            self.delete_persisted(chat_id)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.sessions))
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def drop(self, chat_id):
+        """Bỏ phiên khỏi bộ nhớ (gọi khi đang giữ self.lock)."""
+        self.sessions.pop(chat_id, None)
+        self.dirty.discard(chat_id)
+
+    def evict(self, chat_id):
+        """
+        Bỏ một phiên khỏi bộ nhớ để giải phóng chỗ (gọi khi đang giữ self.lock). Với backend lưu trữ,
+        phiên đã thay đổi được đưa vào self.pending để ghi xuống cơ sở dữ liệu sau khi nhả khóa.
+
+        Returns:
+            bool: False nếu phiên đang được handler sửa dở nên chưa bỏ được
+        """
+        if self.backend != 'memory' and chat_id in self.dirty:
+            try:
+                self.pending[chat_id] = compact_session(self.sessions[chat_id][0])
+            except RuntimeError:
+                return False
+        self.drop(chat_id)
+        session_stats['evicted'] += 1
+        return True
+
+    def evict_overflow(self):
+        """
+        Bỏ các phiên lâu không dùng nhất khi vượt số phiên tối đa (gọi khi đang giữ self.lock).
+        Không ghi cơ sở dữ liệu ở đây: người gọi gọi flush_pending sau khi nhả khóa.
+        """
+        for chat_id in list(self.sessions):
+            if len(self.sessions) <= self.max_entries:
+                break
+            self.evict(chat_id)
+
+    def flush_pending(self):
+        """Ghi các phiên đã bỏ khỏi bộ nhớ xuống cơ sở dữ liệu (gọi khi không giữ self.lock)."""
+        if not self.pending:
+            return
+        with self.flush_lock:
+            with self.lock:
+                records = dict(self.pending)
+            self.persist_sessions(records)
+            with self.lock:
+                for chat_id, record in records.items():
+                    if self.pending.get(chat_id) is record:
+                        del self.pending[chat_id]
+
+    def maintain(self):
+        """
+        Dọn dẹp định kỳ: ghi các phiên đã thay đổi, xóa phiên hết hạn và bỏ bớt phiên khi vượt dung lượng.
+
+        Returns:
+            int: Số phiên đã bỏ khỏi bộ nhớ
+        """
+        now = time.time()
+        removed = 0
+        with self.lock:
+            records = {}
+            retry = set()
+            for chat_id in self.dirty:
+                entry = self.sessions.get(chat_id)
+                if entry is None:
+                    continue
+                try:
+                    records[chat_id] = compact_session(entry[0])
+                except RuntimeError:
+                    # Handler đang sửa dở dữ liệu lồng trong phiên, ghi lại ở lần dọn dẹp sau
+                    retry.add(chat_id)
+                    continue
+                entry[2] = len(records[chat_id])
+            self.dirty = retry
+
+            for chat_id, entry in list(self.sessions.items()):
+                if now - entry[1] > self.ttl:
+                    self.drop(chat_id)
+                    records.pop(chat_id, None)
+                    session_stats['expired'] += 1
+                    removed += 1
+
+            total_bytes = sum(entry[2] for entry in self.sessions.values())
+            for chat_id, entry in list(self.sessions.items()):
+                if total_bytes <= self.max_bytes:
+                    break
+                if self.evict(chat_id):
+                    total_bytes -= entry[2]
+                    removed += 1
+            session_stats['bytes'] = total_bytes
+
+            if self.backend != 'memory':
+                # Ghi qua self.pending để phiên vừa bỏ khỏi bộ nhớ vẫn đọc lại được trước khi ghi xong
+                self.pending.update(records)
+
+        if self.backend != 'memory':
+            self.flush_pending()
+            self.expire_persisted()
+        return removed
+
+    def get_sqlite_connection(self):
+        """Mở file SQLite lưu phiên (một lần), gọi khi đang giữ self.sqlite_lock."""
+        if self.sqlite_conn is None:
+            self.sqlite_conn = sqlite3.connect(SESSION_DB_PATH, timeout=10, check_same_thread=False, isolation_level=None)
+            # WAL cho phép nhiều tiến trình đọc trong lúc một tiến trình ghi
+            self.sqlite_conn.execute("PRAGMA journal_mode=WAL")
+            self.sqlite_conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    chat_id INTEGER PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+        return self.sqlite_conn
+
+    def load_persisted(self, chat_id):
+        """Đọc phiên chưa hết hạn từ cơ sở dữ liệu, trả về None nếu không có."""
+        if self.backend == 'sqlite':
+            try:
+                with self.sqlite_lock:
+                    row = self.get_sqlite_connection().execute(
+                        "SELECT data FROM sessions WHERE chat_id = ? AND updated_at > ?",
+                        (chat_id, time.time() - self.ttl)
+                    ).fetchone()
+            except Exception as e:
+                logger.error(f"Lỗi khi đọc phiên {chat_id} từ SQLite: {e}")
+                return None
+        elif self.backend == 'postgres':
+            conn = get_db_connection()
+            if not conn:
+                return None
+            try:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT data::text FROM sessions
+                    WHERE chat_id = %s AND updated_at > NOW() - %s * INTERVAL '1 second'
+                """, (chat_id, self.ttl))
+                row = cursor.fetchone()
+                cursor.close()
+            except Exception as e:
+                logger.error(f"Lỗi khi đọc phiên {chat_id} từ cơ sở dữ liệu: {e}")
+                return None
+            finally:
+                release_db_connection(conn)
+        else:
+            return None
+        return json.loads(row[0]) if row else None
+
+    def persist_sessions(self, records):
+        """
+        Ghi các phiên xuống cơ sở dữ liệu.
+
+        Args:
+            records (dict): chat_id -> bản ghi JSON gọn (xem compact_session)
+        """
+        if not records:
+            return
+        if self.backend == 'sqlite':
+            try:
+                with self.sqlite_lock:
+                    self.get_sqlite_connection().executemany(
+                        "INSERT OR REPLACE INTO sessions (chat_id, data, updated_at) VALUES (?, ?, ?)",
+                        [(chat_id, data, time.time()) for chat_id, data in records.items()]
+                    )
+            except Exception as e:
+                logger.error(f"Lỗi khi ghi phiên xuống SQLite: {e}")
+        elif self.backend == 'postgres':
+            conn = get_db_connection()
+            if not conn:
+                return
+            try:
+                cursor = conn.cursor()
+                cursor.executemany("""
+                    INSERT INTO sessions (chat_id, data, updated_at)
+                    VALUES (%s, %s, CURRENT_TIMESTAMP)
+                    ON CONFLICT (chat_id) DO UPDATE
+                    SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at
+                """, list(records.items()))
+                cursor.close()
+            except Exception as e:
+                logger.error(f"Lỗi khi ghi phiên xuống cơ sở dữ liệu: {e}")
+            finally:
+                release_db_connection(conn)
+
+    def delete_persisted(self, chat_id):
+        """Xóa phiên khỏi cơ sở dữ liệu."""
+        if self.backend == 'sqlite':
+            try:
+                with self.sqlite_lock:
+                    self.get_sqlite_connection().execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+            except Exception as e:
+                logger.error(f"Lỗi khi xóa phiên {chat_id} khỏi SQLite: {e}")
+        elif self.backend == 'postgres':
+            conn = get_db_connection()
+            if not conn:
+                return
+            try:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM sessions WHERE chat_id = %s", (chat_id,))
+                cursor.close()
+            except Exception as e:
+                logger.error(f"Lỗi khi xóa phiên {chat_id} khỏi cơ sở dữ liệu: {e}")
+            finally:
+                release_db_connection(conn)
+
+    def expire_persisted(self):
+        """Xóa các phiên đã hết hạn trong cơ sở dữ liệu."""
+        if self.backend == 'sqlite':
+            try:
+                with self.sqlite_lock:
+                    self.get_sqlite_connection().execute(
+                        "DELETE FROM sessions WHERE updated_at <= ?", (time.time() - self.ttl,))
+            except Exception as e:
+                logger.error(f"Lỗi khi xóa phiên hết hạn trong SQLite: {e}")
+        elif self.backend == 'postgres':
+            conn = get_db_connection()
+            if not conn:
+                return
+            try:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM sessions WHERE updated_at <= NOW() - %s * INTERVAL '1 second'", (self.ttl,))
+                cursor.close()
+            except Exception as e:
+                logger.error(f"Lỗi khi xóa phiên hết hạn trong cơ sở dữ liệu: {e}")
+            finally:
+                release_db_connection(conn)
+
+# Các trường tính lại được từ ngày sinh, không cần giữ trong bản ghi phiên
+SESSION_DERIVED_KEYS = ('chart_data', 'chart_stars')
+
+def compact_session(state):
+    """
+    Tạo bản ghi gọn (JSON) của một phiên để lưu và ước lượng dung lượng.
+    Chỉ đọc bản sao của phiên, không sửa dict mà handler có thể đang dùng.
+
+    Args:
+        state: Trạng thái hội thoại (số trạng thái hoặc dict)
+
+    Returns:
+        str: Chuỗi JSON của phiên
+    """
+    if not isinstance(state, dict):
+        return json.dumps(state)
+    record = {key: value for key, value in dict(state).items() if key not in SESSION_DERIVED_KEYS}
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=str)
+
+session_stats = {
+    'expired': 0,
+    'evicted': 0,
+    'loaded': 0,
+    'bytes': 0
+}
+
+user_states = SessionStore(SESSION_BACKEND)
+
+def start_session_maintenance(interval=SESSION_FLUSH_INTERVAL):
+    """Chạy việc dọn dẹp và ghi phiên định kỳ trong luồng nền, ghi lần cuối khi tắt bot."""
+    def run_maintenance():
+        while True:
+            time.sleep(interval)
+            try:
+                removed = user_states.maintain()
+                if removed:
+                    logger.info(f"Đã bỏ {removed} phiên hội thoại hết hạn hoặc vượt dung lượng")
+            except Exception as e:
+                logger.error(f"Lỗi khi dọn dẹp phiên hội thoại: {e}")
+
+    thread = threading.Thread(target=run_maintenance, name="session-maintenance", daemon=True)
+    thread.start()
+    atexit.register(user_states.maintain)
 
 # Enum trạng thái
 WAITING_FOR_BIRTH_DATE = 1
 WAITING_FOR_BIRTH_TIME = 2
 
+# Tin nhắn dùng chung cho handler của cả hai chế độ chạy bot (threads và async)
+WELCOME_MESSAGE = (
+    "🌟 *Chào mừng bạn đến với Bot Tử Vi!* 🌟\n\n"
+    "Bot sẽ giúp bạn lập và phân tích lá số tử vi dựa trên thông tin ngày sinh của bạn.\n\n"
+    "👉 Vui lòng nhập ngày tháng năm sinh của bạn theo định dạng DD/MM/YYYY (ví dụ: 15/08/1990):"
+)
+EXPIRED_REQUEST_MESSAGE = "Yêu cầu không hợp lệ hoặc đã hết hạn. Vui lòng thử lại."
+GENDER_PROMPT_MESSAGE = "👫 *Vui lòng chọn giới tính:*"
+CHART_DUPLICATE_MESSAGE = "⏳ Lá số đang được lập, vui lòng chờ trong giây lát."
+CHART_OVERLOADED_MESSAGE = "🙏 *Hệ thống đang quá tải*\n\nHiện có quá nhiều người đang lập lá số, bạn vui lòng thử lại sau ít phút nhé."
+CHART_NOT_FOUND_MESSAGE = "❌ *Không tìm thấy lá số tử vi*\n\nVui lòng gõ /start để bắt đầu lại."
+ANALYSIS_DUPLICATE_MESSAGE = "⏳ Lá số đang được phân tích, vui lòng chờ trong giây lát."
+ANALYSIS_PROCESSING_MESSAGE = "⏳ *Đang xem tử vi cho bạn...*\n\nChờ mình một chút nhé, mình đang xem lá số của bạn..."
+ANALYSIS_CANCELLED_MESSAGE = "✅ Đã hủy phân tích. Bạn có thể gõ /start để lập lá số tử vi mới."
+CUNG_MENU_MESSAGE = "👇 *Chọn một cung để xem chi tiết:*"
+CUNG_NOT_FOUND_MESSAGE = "Không tìm thấy dữ liệu phân tích. Vui lòng tạo lá số mới."
+CUNG_PENDING_MESSAGE = "Cung này đang được phân tích, bạn chờ chút nhé."
+CUNG_PROCESSING_MESSAGE = "Đang xem cung này cho bạn..."
+CUNG_FAILED_MESSAGE = "❌ *Chưa xem được cung này*\n\nBạn thử bấm lại sau nhé."
+HISTORY_EMPTY_MESSAGE = "🔍 *Bạn chưa có lá số tử vi nào*\n\nGõ /start để bắt đầu lập lá số mới."
+HISTORY_PROCESSING_MESSAGE = "⏳ *Đang phân tích lá số tử vi...*\n\nVui lòng đợi trong giây lát, quá trình này có thể mất 30-60 giây."
+HISTORY_NOT_FOUND_MESSAGE = "❌ *Không tìm thấy lá số tử vi*"
+HISTORY_ERROR_MESSAGE = "❌ *Đã xảy ra lỗi khi phân tích lá số tử vi*\n\nVui lòng thử lại sau."
+
 # Tạo thư mục assets nếu chưa tồn tại
 if not os.path.exists('assets'):
     os.makedirs('assets')
 
-# Dictionary lưu trữ số lượng lá số đã tạo cho mỗi người dùng
-user_chart_counts = {}
+# Cache lá số dùng chung theo thông tin ngày sinh (LRU trong bộ nhớ)
+chart_cache = OrderedDict()
+chart_cache_lock = threading.Lock()
+
+# Các lá số đang được lập, để gom yêu cầu trùng thông tin ngày sinh
+inflight_charts = {}
+inflight_charts_lock = threading.Lock()
+
+# Các chat đang chờ lập lá số, để bỏ qua khi người dùng bấm chọn giới tính nhiều lần
+charts_in_progress = set()
+charts_in_progress_lock = threading.Lock()
+
+# file_id Telegram của ảnh lá số đã gửi, theo ID lá số hoặc khóa cache dùng chung (LRU trong bộ nhớ)
+telegram_file_ids = OrderedDict()
+telegram_file_ids_lock = threading.Lock()
+
+# Hàng đợi job lập lá số và trạng thái các job đang chờ/đang chạy. Số job chờ được giới hạn
+# theo chart_jobs (không theo kích thước hàng đợi) để job bị hủy trả chỗ ngay, kể cả khi
+# worker chưa lấy nó ra khỏi hàng đợi
+chart_job_queue = queue.Queue()
+chart_jobs = {}
+chart_jobs_lock = threading.Lock()
+
+# Công việc đang chạy theo chat (lập lá số, phân tích), dùng để hủy giữa chừng khi người dùng /cancel
+chat_tasks = {}
+chat_tasks_lock = threading.Lock()
+# Công việc mà luồng hiện tại đang làm
+chat_task_context = threading.local()
+
+# Hàng đợi update nhận từ webhook (mỗi tiến trình xử lý một hàng đợi) và thống kê của server
+webhook_queues = []
+webhook_stats = {
+    'received': 0,
+    'rejected': 0,
+    'unauthorized': 0
+}
+
+# Cache phân tích lá số theo (mã băm ảnh, phiên bản prompt, model), LRU trong bộ nhớ
+analysis_cache = OrderedDict()
+analysis_cache_lock = threading.Lock()
+
+# Các cung đang được phân tích riêng (chế độ 'lazy'), để bỏ qua khi người dùng bấm nhiều lần
+cung_requests_in_progress = set()
+cung_requests_lock = threading.Lock()
+
+# Giới hạn số yêu cầu phân tích cung gửi đến AI cùng lúc
+analysis_slots = threading.BoundedSemaphore(ANALYSIS_CONCURRENCY)
+
+# Các chat đang được phân tích lá số, tránh phân tích lặp khi người dùng bấm nhiều lần
+analyses_in_progress = set()
+analyses_in_progress_lock = threading.Lock()
+
+# Khóa theo chat chia sọc: số khóa cố định nên bộ nhớ không tăng theo số chat
+chat_locks = [threading.RLock() for _ in range(CHAT_LOCK_STRIPES)]
+
+def get_chat_lock(chat_id):
+    """Trả về khóa dùng để đổi trạng thái hội thoại của một chat."""
+    return chat_locks[chat_id % len(chat_locks)]
+
+def serialize_chat(handler):
+    """
+    Chạy handler khi đang giữ khóa của chat, để các update của cùng một chat đổi trạng thái
+    lần lượt trong khi các chat khác vẫn chạy song song.
+
+    Chỉ dùng cho handler chạy nhanh. Việc lâu (lập lá số, gọi AI) chạy ngoài khóa trên
+    dict trạng thái đã lấy ra, nên /cancel hay /start trong lúc đó không làm job lỗi.
+    """
+    @functools.wraps(handler)
+    def wrapper(update):
+        chat = update.message.chat if isinstance(update, types.CallbackQuery) else update.chat
+        with get_chat_lock(chat.id):
+            return handler(update)
+    return wrapper
+
+def new_session_state(**fields):
+    """
+    Tạo trạng thái hội thoại mới (dict) kèm 'session_id' riêng.
+
+    Job chạy lâu so phiên theo 'session_id' chứ không so đối tượng dict, vì SessionStore có thể
+    bỏ phiên khỏi bộ nhớ rồi tải lại thành dict mới mà người dùng không hề bắt đầu lại.
+    """
+    return dict(fields, session_id=uuid.uuid4().hex)
+
+def is_current_session(chat_id, user_data):
+    """Kiểm tra user_data có còn là phiên hiện tại của chat không (cùng dict hoặc cùng session_id)."""
+    current = user_states.get(chat_id)
+    if current is user_data:
+        return True
+    session_id = user_data.get('session_id') if isinstance(user_data, dict) else None
+    return bool(session_id) and isinstance(current, dict) and current.get('session_id') == session_id
+
+def resume_session(chat_id, user_data):
+    """
+    Kiểm tra phiên mà job đang làm việc còn hiệu lực trước khi hiện kết quả hoặc ghi vào phiên.
+
+    Nếu SessionStore đã bỏ phiên khỏi bộ nhớ (LRU, TTL, giới hạn dung lượng) hoặc tải lại từ cơ sở
+    dữ liệu, user_data của job được đặt lại làm phiên hiện tại để thay đổi của job không bị mất.
+
+    Args:
+        chat_id (int): ID cuộc trò chuyện
+        user_data (dict): Trạng thái hội thoại mà job đã lấy ra
+
+    Returns:
+        bool: False nếu người dùng đã hủy hoặc bắt đầu phiên mới
+    """
+    if not isinstance(user_data, dict) or is_task_cancelled():
+        return False
+    with get_chat_lock(chat_id):
+        current = user_states.get(chat_id)
+        if current is user_data:
+            return True
+        # Phiên bị bỏ khỏi bộ nhớ (hủy thật thì job đã bị đánh dấu hủy ở trên) hoặc được tải lại
+        if current is None or is_current_session(chat_id, user_data):
+            user_states[chat_id] = user_data
+            return True
+        return False
+
+def get_session(chat_id):
+    """
+    Đọc trạng thái hội thoại của chat khi đang giữ khóa của chat.
+    Có thể phải đọc cơ sở dữ liệu nếu phiên không còn trong bộ nhớ, nên chế độ asyncio gọi hàm
+    này (và set_session, clear_session) trong luồng riêng.
+    """
+    with get_chat_lock(chat_id):
+        return user_states.get(chat_id)
+
+def set_session(chat_id, state):
+    """Đặt trạng thái hội thoại của chat khi đang giữ khóa của chat."""
+    with get_chat_lock(chat_id):
+        user_states[chat_id] = state
+
+def clear_session(chat_id):
+    """Xóa trạng thái hội thoại của chat khi đang giữ khóa của chat."""
+    with get_chat_lock(chat_id):
+        user_states.pop(chat_id, None)
 
 # Khởi tạo OpenAI client với AIRouter
 openai.api_key = AIROUTER_API_KEY
-openai.api_base = "https://api.airouter.io"
+openai.api_base = AIROUTER_API_BASE
+
+# Các nhà cung cấp AI theo thứ tự ưu tiên ban đầu, kèm độ trễ gần đây và tình trạng lỗi
+def create_llm_provider(name, api_base, api_key, model):
+    """Tạo thông tin theo dõi cho một nhà cung cấp AI tương thích API OpenAI."""
+    return {
+        'name': name,
+        'api_base': api_base,
+        'api_key': api_key,
+        'model': model,
+        'latencies': {'full': deque(maxlen=50), 'stream': deque(maxlen=50)},
+        'requests': 0,
+        'errors': 0,
+        'consecutive_errors': 0,
+        'disabled_until': 0
+    }
+
+llm_providers = [
+    create_llm_provider('AIRouter', AIROUTER_API_BASE, AIROUTER_API_KEY, ANALYSIS_MODEL),
+    create_llm_provider('OpenAI', OPENAI_API_BASE, OPENAI_API_KEY, OPENAI_MODEL),
+    create_llm_provider('YesCale', YESCALE_API_BASE, YESCALE_API_KEY, YESCALE_MODEL)
+]
+llm_providers_lock = threading.Lock()
+llm_executor = ThreadPoolExecutor(max_workers=ANALYSIS_CONCURRENCY * 2 + 4, thread_name_prefix="llm")
 
 # Thêm biến toàn cục để theo dõi thống kê
 bot_stats = {
@@ -83,6 +749,20 @@ bot_stats = {
     'charts_created': 0,
     'charts_reused': 0,
     'analyses_performed': 0,
+    'chart_cache_hits': 0,
+    'chart_cache_misses': 0,
+    'charts_coalesced': 0,
+    'chart_jobs_rejected': 0,
+    'photos_uploaded': 0,
+    'photos_resent': 0,
+    'analysis_cache_hits': 0,
+    'analysis_cache_misses': 0,
+    'llm_hedges': 0,
+    'llm_hedge_wins': 0,
+    'jobs_cancelled': 0,
+    'browsers_aborted': 0,
+    'llm_calls_cancelled': 0,
+    'llm_tokens_saved': 0,
     'errors': 0
 }
 
@@ -105,14 +785,53 @@ def send_stats_to_admin(admin_id):
         # Định dạng thời gian hoạt động
         uptime_str = f"{days} ngày, {hours} giờ, {minutes} phút, {seconds} giây"
         
+        # Tỷ lệ lấy lá số từ cache dùng chung
+        cache_lookups = bot_stats['chart_cache_hits'] + bot_stats['chart_cache_misses']
+        cache_hit_ratio = bot_stats['chart_cache_hits'] / cache_lookups * 100 if cache_lookups else 0
+        analysis_lookups = bot_stats['analysis_cache_hits'] + bot_stats['analysis_cache_misses']
+        
+        # Tình trạng các nhà cung cấp AI
+        provider_lines = []
+        for provider in llm_providers:
+            if not provider['api_key']:
+                continue
+            p50 = get_provider_latency(provider, 'full', 0.5)
+            p95 = get_provider_latency(provider, 'full', 0.95)
+            latency_str = f"p50 {p50:.1f}s, p95 {p95:.1f}s" if p50 is not None else "chưa đủ dữ liệu"
+            paused = " (tạm ngưng)" if provider['disabled_until'] > time.time() else ""
+            provider_lines.append(f"  • {provider['name']}: {provider['requests']} lượt, {provider['errors']} lỗi, {latency_str}{paused}\n")
+        
         # Tạo thông báo thống kê
         stats_message = (
             "📊 *THỐNG KÊ BOT TỬ VI*\n\n"
             f"⏱ *Thời gian hoạt động*: {uptime_str}\n"
             f"📈 *Lá số đã tạo*: {bot_stats['charts_created']}\n"
             f"♻️ *Lá số tái sử dụng*: {bot_stats['charts_reused']}\n"
-            f"🔮 *Phân tích đã thực hiện*: {bot_stats['analyses_performed']}\n"
-            f"❌ *Lỗi đã gặp*: {bot_stats['errors']}\n\n"
+            f"🗂 *Cache lá số*: {bot_stats['chart_cache_hits']}/{cache_lookups} lượt trúng ({cache_hit_ratio:.1f}%)\n"
+            f"🔗 *Yêu cầu lá số được gộp*: {bot_stats['charts_coalesced']}\n"
+            f"📤 *Ảnh lá số*: {bot_stats['photos_uploaded']} lần upload, {bot_stats['photos_resent']} lần gửi lại không cần upload\n"
+            f"🗄 *Pool cơ sở dữ liệu*: {db_pool_stats['in_use']}/{DB_POOL_MAX} đang dùng, "
+            f"{db_pool_stats['checkouts']} lượt mượn, chờ tổng {db_pool_stats['wait_time']:.1f}s "
+            f"(lâu nhất {db_pool_stats['max_wait']:.1f}s), {db_pool_stats['errors']} lỗi, "
+            f"{db_pool_stats['failovers']} lần đổi endpoint\n"
+            f"📋 *Hàng đợi lá số*: {count_queued_chart_jobs()}/{CHART_QUEUE_SIZE} đang chờ, "
+            f"{bot_stats['chart_jobs_rejected']} yêu cầu bị từ chối do quá tải\n"
+            f"🔮 *Phân tích đã thực hiện*: {bot_stats['analyses_performed']} "
+            f"({bot_stats['analysis_cache_hits']}/{analysis_lookups} lấy từ cache)\n"
+            f"🤖 *Nhà cung cấp AI*: {bot_stats['llm_hedges']} yêu cầu dự phòng, "
+            f"{bot_stats['llm_hedge_wins']} lần bên dự phòng về trước\n"
+            f"{''.join(provider_lines)}"
+            f"🛑 *Hủy giữa chừng*: {bot_stats['jobs_cancelled']} việc, đóng {bot_stats['browsers_aborted']} trình duyệt, "
+            f"dừng {bot_stats['llm_calls_cancelled']} yêu cầu AI (tiết kiệm ~{bot_stats['llm_tokens_saved']} token)\n"
+            f"💬 *Phiên hội thoại*: {len(user_states)}/{SESSION_MAX_ENTRIES} trong bộ nhớ "
+            f"({session_stats['bytes'] / 1024 / 1024:.1f} MB), {session_stats['expired']} hết hạn, "
+            f"{session_stats['evicted']} bị bỏ do đầy, {session_stats['loaded']} đọc lại từ {SESSION_BACKEND}\n"
+            f"❌ *Lỗi đã gặp*: {bot_stats['errors']}\n"
+            f"🌐 *Pool trình duyệt*: {driver_pool_stats['in_use']}/{driver_pool_stats['total']} đang dùng, "
+            f"{driver_pool_stats['leases']} lượt mượn, {driver_pool_stats['waits']} lượt chờ "
+            f"({driver_pool_stats['wait_time']:.1f}s), tạo {driver_pool_stats['created']}, "
+            f"thay mới {driver_pool_stats['recycled']}, lỗi {driver_pool_stats['crashed']}, "
+            f"đóng do hủy {driver_pool_stats['aborted']}\n\n"
             f"🖥 *Thời điểm khởi động*: {bot_stats['start_time'].strftime('%d/%m/%Y %H:%M:%S')}\n"
             f"🕒 *Thời điểm hiện tại*: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}"
         )
@@ -129,10 +848,10 @@ def send_stats_to_admin(admin_id):
     except Exception as e:
         logger.error(f"Lỗi khi gửi thống kê cho admin: {e}")
 
-# Hàm kết nối đến Supabase với nhiều phương thức thử khác nhau
-def get_db_connection():
-    # Danh sách các cấu hình kết nối để thử
-    connection_configs = [
+# Danh sách các cấu hình kết nối, thử theo thứ tự khi cần chọn endpoint
+def get_db_connection_configs():
+    """Trả về các cấu hình kết nối đến Supabase theo thứ tự ưu tiên."""
+    return [
         # Kết nối trực tiếp (Direct connection)
         {
             'host': SUPABASE_DB_HOST,
@@ -158,31 +877,244 @@ def get_db_connection():
             'password': SUPABASE_DB_PASSWORD
         }
     ]
-    
-    # Thử từng cấu hình kết nối cho đến khi thành công
-    last_error = None
-    for config in connection_configs:
+
+# Pool kết nối dùng chung, gắn với endpoint đã kết nối thành công
+db_pool = None
+db_pool_lock = threading.Lock()
+# Chỉ một luồng kết nối đến endpoint mới tại một thời điểm (không giữ db_pool_lock khi kết nối)
+db_connect_lock = threading.RLock()
+db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+db_endpoint_index = 0
+db_consecutive_errors = 0
+db_failover_running = False
+db_connection_info = {}
+# Số kết nối đang được mượn theo từng pool, và các pool cũ chờ trả hết kết nối để đóng sau failover
+db_pool_leases = {}
+retired_db_pools = set()
+db_pool_stats = {
+    'endpoint': None,
+    'checkouts': 0,
+    'in_use': 0,
+    'wait_time': 0.0,
+    'max_wait': 0.0,
+    'health_check_failures': 0,
+    'errors': 0,
+    'failovers': 0
+}
+
+def init_db_pool(start_index=0):
+    """
+    Thử các endpoint từ start_index và tạo pool kết nối cho endpoint đầu tiên kết nối được.
+
+    Args:
+        start_index (int): Vị trí endpoint bắt đầu thử
+
+    Returns:
+        bool: True nếu tạo được pool
+    """
+    global db_pool, db_endpoint_index, db_consecutive_errors
+    configs = get_db_connection_configs()
+
+    # Chỉ một luồng thử kết nối tại một thời điểm, không giữ db_pool_lock trong lúc chờ kết nối
+    with db_connect_lock:
+        # Thử từng cấu hình kết nối cho đến khi thành công
+        last_error = None
+        for offset in range(len(configs)):
+            index = (start_index + offset) % len(configs)
+            config = configs[index]
+            try:
+                logger.info(f"Đang thử kết nối đến cơ sở dữ liệu với host: {config['host']} và port: {config['port']}")
+                new_pool = psycopg2.pool.ThreadedConnectionPool(
+                    DB_POOL_MIN,
+                    DB_POOL_MAX,
+                    host=config['host'],
+                    port=config['port'],
+                    database=config['database'],
+                    user=config['user'],
+                    password=config['password'],
+                    connect_timeout=10  # Thêm timeout để không đợi quá lâu
+                )
+            except Exception as e:
+                last_error = e
+                logger.warning(f"Không thể kết nối đến cơ sở dữ liệu với cấu hình: {config['host']}:{config['port']} - Lỗi: {e}")
+                continue
+
+            # Đổi sang pool mới, pool cũ chỉ đóng khi các luồng khác đã trả hết kết nối đang mượn
+            with db_pool_lock:
+                old_pool = db_pool
+                db_pool = new_pool
+                db_endpoint_index = index
+                db_consecutive_errors = 0
+                db_pool_stats['endpoint'] = f"{config['host']}:{config['port']}"
+                if old_pool:
+                    retire_db_pool(old_pool)
+            logger.info(f"Kết nối thành công đến cơ sở dữ liệu với host: {config['host']}, pool tối đa {DB_POOL_MAX} kết nối")
+            return True
+
+        # Nếu tất cả đều thất bại
+        logger.error(f"Tất cả các phương thức kết nối đều thất bại. Lỗi cuối cùng: {last_error}")
+        return False
+
+def close_db_pool(pool):
+    """Đóng mọi kết nối của pool, bỏ qua lỗi."""
+    try:
+        pool.closeall()
+    except Exception:
+        pass
+
+def retire_db_pool(pool):
+    """
+    Ngừng dùng pool cũ sau failover (gọi khi đang giữ db_pool_lock).
+    Pool không còn kết nối nào đang mượn thì đóng ngay, nếu không thì đóng khi kết nối cuối được trả.
+    """
+    if db_pool_leases.get(pool, 0) > 0:
+        retired_db_pools.add(pool)
+        return
+    db_pool_leases.pop(pool, None)
+    close_db_pool(pool)
+
+def end_db_pool_lease(pool):
+    """Bớt một kết nối đang mượn của pool, đóng pool cũ khi kết nối cuối cùng được trả."""
+    with db_pool_lock:
+        db_pool_leases[pool] = db_pool_leases.get(pool, 0) - 1
+        if db_pool_leases[pool] > 0:
+            return
+        db_pool_leases.pop(pool, None)
+        if pool not in retired_db_pools:
+            return
+        retired_db_pools.discard(pool)
+    close_db_pool(pool)
+    logger.info("Đã đóng pool kết nối của endpoint cũ sau khi các kết nối được trả hết")
+
+def report_db_error():
+    """Ghi nhận lỗi kết nối, chuyển sang endpoint tiếp theo khi lỗi liên tiếp quá nhiều."""
+    global db_consecutive_errors, db_failover_running
+    with db_pool_lock:
+        db_pool_stats['errors'] += 1
+        db_consecutive_errors += 1
+        # Luồng khác đang chuyển endpoint thì không chuyển thêm lần nữa
+        if db_consecutive_errors < DB_FAILOVER_ERRORS or db_failover_running:
+            return
+        db_failover_running = True
+        start_index = db_endpoint_index + 1
+        logger.warning(f"Gặp {db_consecutive_errors} lỗi kết nối liên tiếp, chuyển sang endpoint khác")
+        db_pool_stats['failovers'] += 1
+
+    # Kết nối endpoint mới ngoài db_pool_lock, các luồng khác vẫn dùng pool hiện tại trong lúc chờ
+    try:
+        init_db_pool(start_index)
+    finally:
+        with db_pool_lock:
+            db_failover_running = False
+
+def check_db_connection(conn):
+    """Kiểm tra kết nối còn dùng được không bằng một truy vấn nhỏ."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchone()
+        cursor.close()
+        return True
+    except Exception:
+        return False
+
+# Hàm lấy kết nối đến Supabase từ pool dùng chung
+def get_db_connection():
+    """
+    Mượn một kết nối từ pool, chờ nếu pool đang dùng hết.
+    Kết nối phải được trả lại bằng release_db_connection.
+
+    Returns:
+        connection: Kết nối psycopg2 (autocommit), hoặc None nếu không kết nối được
+    """
+    wait_start = time.time()
+    if not db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        logger.error("Hết thời gian chờ kết nối cơ sở dữ liệu rảnh trong pool")
+        return None
+    wait_time = time.time() - wait_start
+
+    # Lần đầu dùng thì tạo pool (chỉ một luồng kết nối, các luồng khác chờ kết quả)
+    if db_pool is None:
+        with db_connect_lock:
+            if db_pool is None and not init_db_pool(db_endpoint_index):
+                db_pool_slots.release()
+                return None
+
+    with db_pool_lock:
+        db_pool_stats['wait_time'] += wait_time
+        db_pool_stats['max_wait'] = max(db_pool_stats['max_wait'], wait_time)
+        pool = db_pool
+        db_pool_leases[pool] = db_pool_leases.get(pool, 0) + 1
+
+    for _ in range(2):
         try:
-            logger.info(f"Đang thử kết nối đến cơ sở dữ liệu với host: {config['host']} và port: {config['port']}")
-            conn = psycopg2.connect(
-                host=config['host'],
-                port=config['port'],
-                database=config['database'],
-                user=config['user'],
-                password=config['password'],
-                connect_timeout=10  # Thêm timeout để không đợi quá lâu
-            )
-            conn.autocommit = True
-            logger.info(f"Kết nối thành công đến cơ sở dữ liệu với host: {config['host']}")
-            return conn
+            conn = pool.getconn()
         except Exception as e:
-            last_error = e
-            logger.warning(f"Không thể kết nối đến cơ sở dữ liệu với cấu hình: {config['host']}:{config['port']} - Lỗi: {e}")
-    
-    # Nếu tất cả đều thất bại
-    logger.error(f"Tất cả các phương thức kết nối đều thất bại. Lỗi cuối cùng: {last_error}")
+            logger.warning(f"Không thể lấy kết nối từ pool: {e}")
+            end_db_pool_lease(pool)
+            db_pool_slots.release()
+            report_db_error()
+            return None
+
+        # Kiểm tra lại kết nối đã rảnh quá lâu trước khi dùng
+        info = db_connection_info.get(id(conn))
+        idle_too_long = info and time.time() - info['released_at'] > DB_HEALTH_CHECK_IDLE
+        if conn.closed or (idle_too_long and not check_db_connection(conn)):
+            db_pool_stats['health_check_failures'] += 1
+            pool.putconn(conn, close=True)
+            continue
+
+        conn.autocommit = True
+        db_connection_info[id(conn)] = {'pool': pool, 'released_at': None}
+        with db_pool_lock:
+            db_pool_stats['checkouts'] += 1
+            db_pool_stats['in_use'] += 1
+        return conn
+
+    end_db_pool_lease(pool)
+    db_pool_slots.release()
+    report_db_error()
     return None
 
+def release_db_connection(conn):
+    """
+    Trả kết nối về pool, đóng hẳn nếu kết nối đã hỏng.
+
+    Args:
+        conn: Kết nối lấy từ get_db_connection
+    """
+    global db_consecutive_errors
+    if conn is None:
+        return
+
+    info = db_connection_info.get(id(conn))
+    pool = info['pool'] if info else db_pool
+    broken = bool(conn.closed)
+    # Kết nối của pool cũ (đã failover) được đóng luôn thay vì trả về pool
+    retired = pool in retired_db_pools
+    try:
+        if pool:
+            pool.putconn(conn, close=broken or retired)
+        else:
+            conn.close()
+    except Exception as e:
+        logger.warning(f"Lỗi khi trả kết nối về pool: {e}")
+    finally:
+        if info and not broken and not retired:
+            info['released_at'] = time.time()
+        else:
+            db_connection_info.pop(id(conn), None)
+        with db_pool_lock:
+            db_pool_stats['in_use'] -= 1
+            if not broken:
+                db_consecutive_errors = 0
+        if pool:
+            end_db_pool_lease(pool)
+        db_pool_slots.release()
+
+    if broken:
+        report_db_error()
+
 # Hàm khởi tạo các bảng trong database
 def init_database():
     conn = get_db_connection()
@@ -220,82 +1152,112 @@ def init_database():
             )
         """)
         
+        # Tạo bảng chart_cache (lá số dùng chung theo thông tin ngày sinh)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS chart_cache (
+                cache_key CHAR(64) PRIMARY KEY,
+                chart_image TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Lưu file_id Telegram để gửi lại ảnh lá số mà không cần upload
+        cursor.execute("ALTER TABLE charts ADD COLUMN IF NOT EXISTS telegram_file_id TEXT")
+        cursor.execute("ALTER TABLE chart_cache ADD COLUMN IF NOT EXISTS telegram_file_id TEXT")
+        
+        # Lưu ảnh dạng nhị phân kèm thông tin ảnh thay cho chuỗi base64
+        for table in ('charts', 'chart_cache'):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS chart_blob BYTEA")
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS chart_meta JSONB")
+        cursor.execute("ALTER TABLE chart_cache ALTER COLUMN chart_image DROP NOT NULL")
+        
+        # Mã băm thông tin ngày sinh và index bao phủ cho việc kiểm tra lá số đã tồn tại
+        cursor.execute("ALTER TABLE charts ADD COLUMN IF NOT EXISTS birth_hash CHAR(64)")
+        
+        # Dữ liệu sao theo từng cung, dùng để phân tích bằng văn bản thay cho ảnh
+        cursor.execute("ALTER TABLE charts ADD COLUMN IF NOT EXISTS chart_stars JSONB")
+        
+        # Lá số lấy từ cache dùng chung chỉ giữ khóa tới ảnh trong chart_cache, không chép lại ảnh
+        cursor.execute("ALTER TABLE charts ADD COLUMN IF NOT EXISTS cache_key CHAR(64)")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_charts_user_birth_hash
+            ON charts (user_id, birth_hash, created_at DESC)
+            INCLUDE (id, telegram_file_id)
+        """)
+        
+        # Cache kết quả phân tích lá số
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS analyses (
+                image_hash CHAR(64) NOT NULL,
+                prompt_version VARCHAR(16) NOT NULL,
+                model VARCHAR(100) NOT NULL,
+                analysis JSONB NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (image_hash, prompt_version, model)
+            )
+        """)
+        
+        # Phiên hội thoại (khi SESSION_BACKEND = 'postgres')
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                chat_id BIGINT PRIMARY KEY,
+                data JSONB NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
         logger.info("Đã khởi tạo cơ sở dữ liệu thành công")
     except Exception as e:
         logger.error(f"Lỗi khi khởi tạo cơ sở dữ liệu: {e}")
     finally:
         cursor.close()
-        conn.close()
+        release_db_connection(conn)
 
-@bot.message_handler(commands=['start'])
-def start(message):
-    """Bắt đầu hội thoại."""
-    chat_id = message.chat.id
-    
-    # Clear any existing state for this user
-    if chat_id in user_states:
-        del user_states[chat_id]
-    
-    # Lưu thông tin người dùng vào cơ sở dữ liệu
-    save_user(message.from_user)
-    
-    # Lời chào thân thiện hơn
-    welcome_message = (
-        "🌟 *Chào mừng bạn đến với Bot Tử Vi!* 🌟\n\n"
-        "Bot sẽ giúp bạn lập và phân tích lá số tử vi dựa trên thông tin ngày sinh của bạn.\n\n"
-        "👉 Vui lòng nhập ngày tháng năm sinh của bạn theo định dạng DD/MM/YYYY (ví dụ: 15/08/1990):"
-    )
-    
-    bot.send_message(
-        chat_id,
-        welcome_message,
-        parse_mode='Markdown'
-    )
-    user_states[chat_id] = WAITING_FOR_BIRTH_DATE
+def parse_birth_date(text):
+    """
+    Kiểm tra ngày sinh người dùng nhập theo định dạng DD/MM/YYYY.
 
-@bot.message_handler(func=lambda message: user_states.get(message.chat.id) == WAITING_FOR_BIRTH_DATE)
-def get_birth_date(message):
-    """Nhận ngày tháng năm sinh và yêu cầu giờ sinh."""
-    chat_id = message.chat.id
-    birth_date = message.text.strip()
-    
+    Args:
+        text (str): Nội dung tin nhắn
+
+    Returns:
+        tuple: ((ngày, tháng, năm), None) nếu hợp lệ, hoặc (None, thông báo lỗi)
+    """
     # Kiểm tra định dạng ngày tháng
     pattern = r'^(\d{1,2})/(\d{1,2})/(\d{4})$'
-    match = re.match(pattern, birth_date)
+    match = re.match(pattern, (text or '').strip())
     
     if not match:
-        bot.send_message(
-            chat_id,
+        return None, (
             "⚠️ *Định dạng ngày tháng không đúng*\n\n"
             "Vui lòng nhập theo định dạng DD/MM/YYYY\n"
-            "Ví dụ: 15/08/1990 hoặc 5/4/1985",
-            parse_mode='Markdown'
+            "Ví dụ: 15/08/1990 hoặc 5/4/1985"
         )
-        return
     
     day, month, year = match.groups()
     day, month, year = int(day), int(month), int(year)
     
     # Kiểm tra tính hợp lệ của ngày tháng
     if not (1 <= day <= 31 and 1 <= month <= 12 and 1900 <= year <= 2100):
-        bot.send_message(
-            chat_id,
+        return None, (
             "⚠️ *Ngày tháng không hợp lệ*\n\n"
-            "Vui lòng kiểm tra lại ngày, tháng, năm sinh của bạn và nhập lại.",
-            parse_mode='Markdown'
+            "Vui lòng kiểm tra lại ngày, tháng, năm sinh của bạn và nhập lại."
         )
-        return
     
-    # Lưu thông tin vào user_states
-    user_states[chat_id] = {
-        'state': WAITING_FOR_BIRTH_TIME,
-        'day': day,
-        'month': month,
-        'year': year
-    }
-    
-    # Tạo bàn phím inline để chọn giờ sinh với emoji
-    markup = types.InlineKeyboardMarkup(row_width=3)
+    return (day, month, year), None
+
+# Giờ sinh theo callback_data của bàn phím chọn giờ sinh
+BIRTH_TIME_MAPPING = {
+    "ty": "Tý", "suu": "Sửu", "dan": "Dần", "mao": "Mão", 
+    "thin": "Thìn", "ty_hora": "Tỵ", "ngo": "Ngọ", "mui": "Mùi", 
+    "than": "Thân", "dau": "Dậu", "tuat": "Tuất", "hoi": "Hợi",
+    "unknown": "Không rõ"
+}
+
+def create_birth_time_markup():
+    """Tạo bàn phím chọn giờ sinh theo 12 con giáp."""
+    # Tạo bàn phím inline để chọn giờ sinh với emoji
+    markup = types.InlineKeyboardMarkup(row_width=3)
     
     # Hàng 1
     btn_ty = types.InlineKeyboardButton("🕛 Tý (23h-1h)", callback_data="ty")
@@ -325,9 +1287,142 @@ def get_birth_date(message):
     btn_unknown = types.InlineKeyboardButton("❓ Không rõ giờ sinh", callback_data="unknown")
     markup.add(btn_unknown)
     
+    return markup
+
+def create_gender_markup():
+    """Tạo bàn phím chọn giới tính."""
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    btn_male = types.InlineKeyboardButton("👨 Nam", callback_data="male")
+    btn_female = types.InlineKeyboardButton("👩 Nữ", callback_data="female")
+    markup.add(btn_male, btn_female)
+    return markup
+
+def start_birth_time_session(chat_id, text):
+    """
+    Đọc ngày sinh người dùng nhập và chuyển hội thoại sang bước chọn giờ sinh.
+
+    Args:
+        chat_id (int): ID cuộc trò chuyện
+        text (str): Nội dung tin nhắn
+
+    Returns:
+        tuple: (tin nhắn gửi lại người dùng, bàn phím chọn giờ sinh hoặc None nếu ngày sinh không hợp lệ)
+    """
+    birth_date, error_message = parse_birth_date(text)
+    if error_message:
+        return error_message, None
+    day, month, year = birth_date
+    set_session(chat_id, new_session_state(
+        state=WAITING_FOR_BIRTH_TIME,
+        day=day,
+        month=month,
+        year=year
+    ))
+    return f"🕐 *Chọn giờ sinh của bạn:*\n\nNgày sinh: {day}/{month}/{year}", create_birth_time_markup()
+
+def get_birth_time_state(chat_id):
+    """Trả về trạng thái đang chờ chọn giờ sinh/giới tính của chat, hoặc None nếu yêu cầu đã hết hạn."""
+    user_state = get_session(chat_id)
+    if isinstance(user_state, dict) and user_state.get('state') == WAITING_FOR_BIRTH_TIME:
+        return user_state
+    return None
+
+def select_birth_time(chat_id, call_data):
+    """
+    Ghi giờ sinh người dùng chọn vào trạng thái hội thoại.
+
+    Returns:
+        str: Giờ sinh đã chọn, hoặc None nếu yêu cầu đã hết hạn
+    """
+    user_state = get_birth_time_state(chat_id)
+    if user_state is None:
+        return None
+    birth_time = BIRTH_TIME_MAPPING.get(call_data, "Không rõ")
+    user_state['birth_time'] = birth_time
+    return birth_time
+
+def submit_chart_request(chat_id, call_data):
+    """
+    Ghi giới tính người dùng chọn và đưa yêu cầu lập lá số vào hàng đợi.
+
+    Args:
+        chat_id (int): ID cuộc trò chuyện
+        call_data (str): 'male' hoặc 'female'
+
+    Returns:
+        tuple: (kết quả: 'expired', 'duplicate', 'overloaded' hoặc 'queued', job nếu đã vào hàng đợi)
+    """
+    user_state = get_birth_time_state(chat_id)
+    if user_state is None:
+        return 'expired', None
+
+    # Bỏ qua nếu người dùng bấm nhiều lần khi lá số đang được lập
+    with charts_in_progress_lock:
+        if chat_id in charts_in_progress:
+            return 'duplicate', None
+        charts_in_progress.add(chat_id)
+
+    user_state['gender'] = "Nam" if call_data == "male" else "Nữ"
+
+    job = enqueue_chart_job(chat_id)
+    if not job:
+        with charts_in_progress_lock:
+            charts_in_progress.discard(chat_id)
+        return 'overloaded', None
+    return 'queued', job
+
+def format_queue_position(job):
+    """Tin nhắn báo vị trí trong hàng đợi, hoặc None nếu còn worker rảnh."""
+    if job['workers_busy'] < CHART_WORKERS:
+        return None
+    return f"📋 *Bạn đang ở vị trí thứ {job['position']} trong hàng đợi*\n\nLá số sẽ được lập ngay khi đến lượt, vui lòng chờ trong giây lát."
+
+def claim_chat_analysis(chat_id):
+    """Đánh dấu chat đang được phân tích, trả về False nếu đã có phân tích đang chạy (người dùng bấm nhiều lần)."""
+    with analyses_in_progress_lock:
+        if chat_id in analyses_in_progress:
+            return False
+        analyses_in_progress.add(chat_id)
+        return True
+
+def release_chat_analysis(chat_id):
+    """Bỏ đánh dấu chat đang được phân tích."""
+    with analyses_in_progress_lock:
+        analyses_in_progress.discard(chat_id)
+
+def cancel_chat_analysis(chat_id):
+    """Dừng phân tích đang chạy (đóng luồng stream, bỏ các yêu cầu AI đang chờ) và xóa trạng thái hội thoại."""
+    cancel_chat_tasks(chat_id)
+    clear_session(chat_id)
+
+@bot.message_handler(commands=['start'])
+@serialize_chat
+def start(message):
+    """Bắt đầu hội thoại."""
+    chat_id = message.chat.id
+    
+    # Clear any existing state for this user
+    clear_session(chat_id)
+    
+    # Lưu thông tin người dùng vào cơ sở dữ liệu
+    save_user(message.from_user)
+    
+    bot.send_message(
+        chat_id,
+        WELCOME_MESSAGE,
+        parse_mode='Markdown'
+    )
+    set_session(chat_id, WAITING_FOR_BIRTH_DATE)
+
+@bot.message_handler(func=lambda message: user_states.get(message.chat.id) == WAITING_FOR_BIRTH_DATE)
+@serialize_chat
+def get_birth_date(message):
+    """Nhận ngày tháng năm sinh và yêu cầu giờ sinh."""
+    chat_id = message.chat.id
+    reply, markup = start_birth_time_session(chat_id, message.text)
     bot.send_message(
         chat_id, 
-        f"🕐 *Chọn giờ sinh của bạn:*\n\nNgày sinh: {day}/{month}/{year}", 
+        reply, 
         reply_markup=markup,
         parse_mode='Markdown'
     )
@@ -338,17 +1433,26 @@ def handle_analysis_callbacks(call):
     chat_id = call.message.chat.id
     
     if call.data == "analyze":
-        # Process chart analysis
-        process_analysis(chat_id)
+        # Bỏ qua nếu người dùng bấm nhiều lần khi lá số đang được phân tích
+        if not claim_chat_analysis(chat_id):
+            try:
+                bot.answer_callback_query(call.id, ANALYSIS_DUPLICATE_MESSAGE)
+            except Exception as e:
+                logger.warning(f"Không thể trả lời callback query: {e}")
+            return
+        task = begin_chat_task(chat_id, 'analysis')
+        try:
+            process_analysis(chat_id)
+        finally:
+            end_chat_task(task)
+            release_chat_analysis(chat_id)
     elif call.data == "cancel_analysis":
+        cancel_chat_analysis(chat_id)
         bot.send_message(
             chat_id, 
-            "✅ Đã hủy phân tích. Bạn có thể gõ /start để lập lá số tử vi mới.",
+            ANALYSIS_CANCELLED_MESSAGE,
             parse_mode='Markdown'
         )
-        # Clear user state
-        if chat_id in user_states:
-            del user_states[chat_id]
     
     # Acknowledge the callback
     try:
@@ -357,55 +1461,42 @@ def handle_analysis_callbacks(call):
         logger.warning(f"Không thể trả lời callback query: {e}")
 
 @bot.callback_query_handler(func=lambda call: call.data in ["male", "female"])
+@serialize_chat
 def handle_gender_selection(call):
     """Handle gender selection callbacks."""
     chat_id = call.message.chat.id
     
-    # Verify the user is in the correct state
-    if chat_id not in user_states or 'state' not in user_states[chat_id] or user_states[chat_id]['state'] != WAITING_FOR_BIRTH_TIME:
-        try:
-            bot.answer_callback_query(call.id, "Yêu cầu không hợp lệ hoặc đã hết hạn. Vui lòng thử lại.")
-        except Exception as e:
-            logger.warning(f"Không thể trả lời callback query: {e}")
-        return
-    
-    if call.data == "male":
-        user_states[chat_id]['gender'] = "Nam"
-    else:  # female
-        user_states[chat_id]['gender'] = "Nữ"
-    
-    # Process the chart
-    process_tuvi_chart(chat_id)
-    
-    # Acknowledge the callback
+    # Đưa vào hàng đợi lập lá số, trả lời ngay nếu yêu cầu hết hạn, bị trùng hoặc hàng đợi đã đầy
+    status, job = submit_chart_request(chat_id, call.data)
+    answer = {'expired': EXPIRED_REQUEST_MESSAGE, 'duplicate': CHART_DUPLICATE_MESSAGE}.get(status)
     try:
-        bot.answer_callback_query(call.id)
+        bot.answer_callback_query(call.id, answer)
     except Exception as e:
         logger.warning(f"Không thể trả lời callback query: {e}")
+    
+    if status == 'overloaded':
+        bot.send_message(chat_id, CHART_OVERLOADED_MESSAGE, parse_mode='Markdown')
+    elif status == 'queued':
+        # Báo vị trí trong hàng đợi nếu tất cả worker đang bận
+        position_message = format_queue_position(job)
+        if position_message:
+            bot.send_message(chat_id, position_message, parse_mode='Markdown')
 
-@bot.callback_query_handler(func=lambda call: call.data in ["ty", "suu", "dan", "mao", "thin", "ty_hora", "ngo", "mui", "than", "dau", "tuat", "hoi", "unknown"])
+@bot.callback_query_handler(func=lambda call: call.data in BIRTH_TIME_MAPPING)
+@serialize_chat
 def handle_birth_time(call):
     """Handle birth time selection callbacks."""
     chat_id = call.message.chat.id
     
     # Verify the user is in the correct state
-    if chat_id not in user_states or 'state' not in user_states[chat_id] or user_states[chat_id]['state'] != WAITING_FOR_BIRTH_TIME:
+    birth_time = select_birth_time(chat_id, call.data)
+    if birth_time is None:
         try:
-            bot.answer_callback_query(call.id, "Yêu cầu không hợp lệ hoặc đã hết hạn. Vui lòng thử lại.")
+            bot.answer_callback_query(call.id, EXPIRED_REQUEST_MESSAGE)
         except Exception as e:
             logger.warning(f"Không thể trả lời callback query: {e}")
         return
     
-    time_mapping = {
-        "ty": "Tý", "suu": "Sửu", "dan": "Dần", "mao": "Mão", 
-        "thin": "Thìn", "ty_hora": "Tỵ", "ngo": "Ngọ", "mui": "Mùi", 
-        "than": "Thân", "dau": "Dậu", "tuat": "Tuất", "hoi": "Hợi",
-        "unknown": "Không rõ"
-    }
-    
-    birth_time = time_mapping.get(call.data, "Không rõ")
-    user_states[chat_id]['birth_time'] = birth_time
-    
     # Thông báo đã chọn giờ sinh
     try:
         bot.edit_message_text(
@@ -426,16 +1517,10 @@ def handle_birth_time(call):
         except Exception as e2:
             logger.error(f"Không thể gửi tin nhắn xác nhận giờ sinh: {e2}")
     
-    # Tạo bàn phím inline để chọn giới tính
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    btn_male = types.InlineKeyboardButton("👨 Nam", callback_data="male")
-    btn_female = types.InlineKeyboardButton("👩 Nữ", callback_data="female")
-    markup.add(btn_male, btn_female)
-    
     bot.send_message(
         chat_id,
-        "👫 *Vui lòng chọn giới tính:*",
-        reply_markup=markup,
+        GENDER_PROMPT_MESSAGE,
+        reply_markup=create_gender_markup(),
         parse_mode='Markdown'
     )
     
@@ -446,7 +1531,8 @@ def handle_birth_time(call):
         logger.warning(f"Không thể trả lời callback query: {e}")
 
 # Replace the old catch-all callback handler with a fallback handler
-@bot.callback_query_handler(func=lambda call: True)
+# (được đăng ký ở cuối file để không chặn các handler view_chart_, analyze_chart_, cung_)
+@serialize_chat
 def handle_other_callbacks(call):
     """Handle any other callbacks that weren't caught by specific handlers."""
     chat_id = call.message.chat.id
@@ -471,8 +1557,237 @@ def handle_other_callbacks(call):
     except Exception as e:
         logger.warning(f"Không thể trả lời callback query: {e}")
 
-def process_tuvi_chart(chat_id):
-    """Xử lý lá số tử vi."""
+class ChatTaskCancelled(Exception):
+    """Công việc đã bị hủy vì người dùng /cancel hoặc bấm hủy phân tích."""
+
+def begin_chat_task(chat_id, kind, async_task=None):
+    """
+    Đăng ký một công việc đang chạy của chat để có thể hủy giữa chừng.
+
+    Args:
+        chat_id (int): ID cuộc trò chuyện
+        kind (str): Loại công việc ('chart', 'analysis', 'cung')
+        async_task (asyncio.Task, optional): Task của công việc ở chế độ asyncio,
+            nếu không có thì công việc gắn với luồng hiện tại
+
+    Returns:
+        dict: Thông tin công việc, truyền cho end_chat_task khi xong
+    """
+    task = {
+        'chat_id': chat_id,
+        'kind': kind,
+        'cancelled': threading.Event(),
+        'cleanups': [],
+        'async_task': async_task,
+        'loop': asyncio.get_running_loop() if async_task else None,
+        'started_at': time.time()
+    }
+    with chat_tasks_lock:
+        chat_tasks.setdefault(chat_id, []).append(task)
+    if not async_task:
+        chat_task_context.task = task
+    return task
+
+def end_chat_task(task):
+    """Bỏ đăng ký công việc khi đã xong (kể cả khi bị hủy hoặc lỗi)."""
+    with chat_tasks_lock:
+        tasks = [other for other in chat_tasks.get(task['chat_id'], []) if other is not task]
+        if tasks:
+            chat_tasks[task['chat_id']] = tasks
+        else:
+            chat_tasks.pop(task['chat_id'], None)
+        task['cleanups'] = []
+    if get_current_task() is task:
+        chat_task_context.task = None
+
+def get_current_task():
+    """Trả về công việc mà luồng hiện tại đang làm, hoặc None."""
+    return getattr(chat_task_context, 'task', None)
+
+def set_current_task(task):
+    """Gắn công việc cho luồng hiện tại (dùng trong các luồng phụ của một công việc)."""
+    chat_task_context.task = task
+
+def is_task_cancelled():
+    """Kiểm tra công việc của luồng hiện tại đã bị hủy chưa."""
+    task = get_current_task()
+    return bool(task and task['cancelled'].is_set())
+
+def check_task_cancelled():
+    """Dừng công việc của luồng hiện tại nếu người dùng đã hủy."""
+    if is_task_cancelled():
+        raise ChatTaskCancelled()
+
+def add_task_cleanup(callback):
+    """
+    Đăng ký hàm giải phóng tài nguyên (đóng trình duyệt...) được gọi ngay khi công việc
+    của luồng hiện tại bị hủy.
+
+    Args:
+        callback (callable): Hàm giải phóng tài nguyên
+
+    Returns:
+        callable: Hàm bỏ đăng ký, gọi khi tài nguyên đã được trả lại bình thường
+    """
+    task = get_current_task()
+    if not task:
+        return lambda: None
+
+    def remove_cleanup():
+        with chat_tasks_lock:
+            if callback in task['cleanups']:
+                task['cleanups'].remove(callback)
+
+    with chat_tasks_lock:
+        cancelled = task['cancelled'].is_set()
+        if not cancelled:
+            task['cleanups'].append(callback)
+    if cancelled:
+        callback()
+    return remove_cleanup
+
+def cancel_chat_tasks(chat_id):
+    """
+    Hủy mọi công việc đang chạy hoặc đang chờ của chat: job lập lá số trong hàng đợi bị bỏ,
+    trình duyệt đang dùng bị đóng, yêu cầu AI đang chờ bị bỏ và luồng stream bị đóng.
+
+    Args:
+        chat_id (int): ID cuộc trò chuyện
+
+    Returns:
+        int: Số công việc đã hủy
+    """
+    with chat_tasks_lock:
+        tasks = chat_tasks.pop(chat_id, [])
+        cleanups = []
+        for task in tasks:
+            task['cancelled'].set()
+            cleanups.extend(task['cleanups'])
+            task['cleanups'] = []
+    cancelled_count = len(tasks)
+
+    # Job lập lá số còn trong hàng đợi trả chỗ ngay, worker sẽ bỏ qua khi lấy ra
+    with chart_jobs_lock:
+        for job_id, job in list(chart_jobs.items()):
+            if job['chat_id'] == chat_id and not job.get('cancelled'):
+                job['cancelled'] = True
+                if job['state'] == 'queued':
+                    job['state'] = 'cancelled'
+                    del chart_jobs[job_id]
+                    cancelled_count += 1
+    # Cho phép người dùng lập lá số mới ngay
+    with charts_in_progress_lock:
+        charts_in_progress.discard(chat_id)
+
+    for callback in cleanups:
+        try:
+            callback()
+        except Exception as e:
+            logger.warning(f"Lỗi khi giải phóng tài nguyên của công việc bị hủy: {e}")
+    for task in tasks:
+        if task['async_task']:
+            task['loop'].call_soon_threadsafe(task['async_task'].cancel)
+
+    if cancelled_count:
+        bot_stats['jobs_cancelled'] += cancelled_count
+        logger.info(f"Đã hủy {cancelled_count} công việc của chat {chat_id}")
+    return cancelled_count
+
+def enqueue_chart_job(chat_id):
+    """
+    Đưa yêu cầu lập lá số vào hàng đợi để worker xử lý.
+
+    Args:
+        chat_id (int): ID cuộc trò chuyện
+
+    Returns:
+        dict: Thông tin job kèm vị trí trong hàng đợi, hoặc None nếu hàng đợi đã đầy
+    """
+    job = {
+        'id': uuid.uuid4().hex,
+        'chat_id': chat_id,
+        # Trạng thái hội thoại lúc đặt job, job bị bỏ qua nếu người dùng đã bắt đầu lại
+        'user_data': user_states.get(chat_id),
+        'state': 'queued',
+        'created_at': time.time(),
+        'started_at': None,
+        'finished_at': None
+    }
+    with chart_jobs_lock:
+        queued = sum(1 for j in chart_jobs.values() if j['state'] == 'queued')
+        if queued >= CHART_QUEUE_SIZE:
+            bot_stats['chart_jobs_rejected'] += 1
+            return None
+        chart_jobs[job['id']] = job
+        chart_job_queue.put_nowait(job)
+        job['position'] = queued + 1
+        job['workers_busy'] = sum(1 for j in chart_jobs.values() if j['state'] == 'running')
+    logger.info(f"Đã đưa job lập lá số {job['id'][:8]} của chat {chat_id} vào hàng đợi, vị trí {job['position']}")
+    return job
+
+def count_queued_chart_jobs():
+    """Đếm số job lập lá số đang chờ worker (không tính job đã bị hủy)."""
+    with chart_jobs_lock:
+        return sum(1 for job in chart_jobs.values() if job['state'] == 'queued')
+
+def chart_worker():
+    """Worker lấy job lập lá số từ hàng đợi và xử lý tuần tự."""
+    while True:
+        job = chart_job_queue.get()
+        chat_id = job['chat_id']
+        task = begin_chat_task(chat_id, 'chart')
+        with chart_jobs_lock:
+            skipped = job['state'] == 'cancelled'
+            if not skipped:
+                job['state'] = 'running'
+                job['started_at'] = time.time()
+                if job.get('cancelled'):
+                    task['cancelled'].set()
+        if skipped:
+            # Job bị hủy khi còn trong hàng đợi, chỗ của nó đã được trả lúc hủy
+            end_chat_task(task)
+            logger.info(f"Bỏ qua job lập lá số {job['id'][:8]} đã bị hủy khi còn trong hàng đợi")
+            chart_job_queue.task_done()
+            continue
+        try:
+            if not task['cancelled'].is_set():
+                process_tuvi_chart(chat_id, job['user_data'])
+            job['state'] = 'cancelled' if task['cancelled'].is_set() else 'done'
+        except Exception as e:
+            job['state'] = 'failed'
+            logger.error(f"Lỗi trong job lập lá số {job['id'][:8]}: {e}")
+        finally:
+            end_chat_task(task)
+            job['finished_at'] = time.time()
+            with chart_jobs_lock:
+                chart_jobs.pop(job['id'], None)
+            # Job bị hủy đã được bỏ khỏi danh sách khi hủy, người dùng có thể đã đặt job mới
+            if not job.get('cancelled'):
+                with charts_in_progress_lock:
+                    charts_in_progress.discard(chat_id)
+            logger.info(f"Job lập lá số {job['id'][:8]} kết thúc ({job['state']}) sau {job['finished_at'] - job['created_at']:.1f}s")
+            chart_job_queue.task_done()
+
+def start_chart_workers(count=CHART_WORKERS):
+    """Khởi động các worker lập lá số chạy nền."""
+    for index in range(count):
+        worker = threading.Thread(target=chart_worker, name=f"chart-worker-{index + 1}", daemon=True)
+        worker.start()
+    logger.info(f"Đã khởi động {count} worker lập lá số, hàng đợi tối đa {CHART_QUEUE_SIZE} yêu cầu")
+
+def process_tuvi_chart(chat_id, user_data):
+    """
+    Xử lý lá số tử vi.
+
+    Args:
+        chat_id (int): ID cuộc trò chuyện
+        user_data (dict): Trạng thái hội thoại lúc đặt job. Job chỉ làm việc trên dict này,
+            người dùng /cancel hay /start lại trong lúc lập lá số không làm job lỗi
+    """
+    if not resume_session(chat_id, user_data):
+        logger.info(f"Bỏ qua job lập lá số của chat {chat_id} vì người dùng đã hủy hoặc bắt đầu lại")
+        return
+    
     # Gửi thông báo đang xử lý
     processing_msg = bot.send_message(
         chat_id, 
@@ -482,7 +1797,6 @@ def process_tuvi_chart(chat_id):
     
     try:
         # Lấy thông tin từ trạng thái người dùng
-        user_data = user_states[chat_id]
         day = user_data['day']
         month = user_data['month']
         year = user_data['year']
@@ -491,6 +1805,7 @@ def process_tuvi_chart(chat_id):
         
         # Lấy lá số tử vi và truyền thêm user_id
         result_path, is_existing = get_tuvi_chart(day, month, year, birth_time, gender, chat_id, user_data)
+        check_task_cancelled()
         
         # Xóa thông báo đang xử lý
         try:
@@ -500,13 +1815,15 @@ def process_tuvi_chart(chat_id):
         
         # Lưu đường dẫn kết quả vào trạng thái người dùng
         # Xóa trạng thái WAITING_FOR_BIRTH_TIME vì đã hoàn thành bước này
-        if 'state' in user_states[chat_id]:
-            del user_states[chat_id]['state']
-            
-        if result_path.endswith('.html'):
-            user_states[chat_id]['chart_html_path'] = result_path
-        else:
-            user_states[chat_id]['chart_image_path'] = result_path
+        with get_chat_lock(chat_id):
+            if not resume_session(chat_id, user_data):
+                logger.info(f"Không gửi lá số cho chat {chat_id} vì người dùng đã hủy hoặc bắt đầu lại")
+                return
+            user_data.pop('state', None)
+            if result_path and result_path.endswith('.html'):
+                user_data['chart_html_path'] = result_path
+            elif result_path:
+                user_data['chart_image_path'] = result_path
         
         # Chuẩn bị caption với thông tin chi tiết
         caption = f"✨ *Lá số tử vi của bạn*\n\n• Ngày sinh: {day}/{month}/{year}\n• Giờ sinh: {birth_time}\n• Giới tính: {gender}"
@@ -515,36 +1832,38 @@ def process_tuvi_chart(chat_id):
         if is_existing:
             caption += "\n\n📝 *Ghi chú: Lá số này đã tồn tại trong hệ thống và được tái sử dụng.*"
         
+        reply_markup = types.InlineKeyboardMarkup().add(
+            types.InlineKeyboardButton("🔮 Phân tích lá số", callback_data="analyze"),
+            types.InlineKeyboardButton("❌ Hủy", callback_data="cancel_analysis")
+        )
+        
         # Gửi kết quả cho người dùng
-        if result_path.endswith('.jpg') or result_path.endswith('.png'):
-            # Nếu là ảnh, gửi trực tiếp
-            with open(result_path, 'rb') as photo:
-                bot.send_photo(
-                    chat_id,
-                    photo,
-                    caption=caption,
-                    reply_markup=types.InlineKeyboardMarkup().add(
-                        types.InlineKeyboardButton("🔮 Phân tích lá số", callback_data="analyze"),
-                        types.InlineKeyboardButton("❌ Hủy", callback_data="cancel_analysis")
-                    ),
-                    parse_mode='Markdown'
-                )
+        if not result_path:
+            # Lá số cũ đã có file_id, chỉ đọc ảnh từ cơ sở dữ liệu nếu Telegram không nhận file_id
+            chart_id = user_data.get('chart_id')
+            send_chart_photo(chat_id, lambda: materialize_chart_image(chart_id), caption, reply_markup, chart_id=chart_id)
+        elif not result_path.endswith('.html'):
+            # Nếu là ảnh, gửi lại bằng file_id nếu lá số đã từng được gửi
+            send_chart_photo(
+                chat_id, result_path, caption, reply_markup,
+                chart_id=user_data.get('chart_id'),
+                cache_key=make_chart_cache_key(day, month, year, birth_time, gender)
+            )
         else:
-            # Nếu là HTML, chuyển đổi thành ảnh
-            screenshot_path = html_to_image(result_path, chat_id)
-            with open(screenshot_path, 'rb') as photo:
-                bot.send_photo(
-                    chat_id,
-                    photo,
-                    caption=caption,
-                    reply_markup=types.InlineKeyboardMarkup().add(
-                        types.InlineKeyboardButton("🔮 Phân tích lá số", callback_data="analyze"),
-                        types.InlineKeyboardButton("❌ Hủy", callback_data="cancel_analysis")
-                    ),
-                    parse_mode='Markdown'
-                )
+            # Nếu là HTML không trích được ảnh, vẽ lại lá số bằng Pillow
+            screenshot_path = create_native_chart(day, month, year, birth_time, gender, chat_id, user_data)
+            send_chart_photo(chat_id, screenshot_path, caption, reply_markup, chart_id=user_data.get('chart_id'))
             # Lưu đường dẫn ảnh
-            user_states[chat_id]['chart_image_path'] = screenshot_path
+            with get_chat_lock(chat_id):
+                if resume_session(chat_id, user_data):
+                    user_data['chart_image_path'] = screenshot_path
+        
+    except ChatTaskCancelled:
+        logger.info(f"Đã dừng lập lá số cho chat {chat_id} theo yêu cầu hủy")
+        try:
+            bot.delete_message(chat_id, processing_msg.message_id)
+        except Exception:
+            pass
         
     except Exception as e:
         logger.error(f"Lỗi khi xử lý lá số tử vi: {e}")
@@ -562,8 +1881,10 @@ def process_tuvi_chart(chat_id):
             ),
             parse_mode='Markdown'
         )
-        # Xóa trạng thái người dùng
-        del user_states[chat_id]
+        # Xóa trạng thái người dùng (nếu người dùng chưa bắt đầu lại)
+        with get_chat_lock(chat_id):
+            if is_current_session(chat_id, user_data):
+                del user_states[chat_id]
 
 def send_progress_update(chat_id, message_id, progress_text, progress_percent=None):
     """
@@ -597,868 +1918,4385 @@ def send_progress_update(chat_id, message_id, progress_text, progress_percent=No
     except Exception as e:
         logger.warning(f"Không thể cập nhật thông báo tiến trình: {e}")
 
-def get_tuvi_chart(day, month, year, birth_time, gender, user_id, user_data):
+# ==================== BỘ AN SAO TỬ VI (NATIVE) ====================
+# Lập lá số trực tiếp bằng Python thay vì mở trình duyệt điền form trên
+# tuvivietnam.vn. Quy tắc an sao được đối chiếu với các lá số mẫu trong assets/
+# (xem tests/test_chart_engine.py).
+
+CAN = ["Giáp", "Ất", "Bính", "Đinh", "Mậu", "Kỷ", "Canh", "Tân", "Nhâm", "Quý"]
+CHI = ["Tý", "Sửu", "Dần", "Mão", "Thìn", "Tỵ", "Ngọ", "Mùi", "Thân", "Dậu", "Tuất", "Hợi"]
+
+# Tên 12 cung, tính thuận từ cung Mệnh
+CUNG_NAMES = [
+    "Mệnh", "Phụ Mẫu", "Phúc Đức", "Điền Trạch", "Quan Lộc", "Nô Bộc",
+    "Thiên Di", "Tật Ách", "Tài Bạch", "Tử Tức", "Phu Thê", "Huynh Đệ"
+]
+
+# Khóa phân tích tương ứng với từng cung (trùng với khóa trong analyze_chart_with_gpt)
+CUNG_KEYS = {
+    "Mệnh": "cung_menh", "Phụ Mẫu": "cung_phu_mau", "Phúc Đức": "cung_phuc_duc",
+    "Điền Trạch": "cung_dien_trach", "Quan Lộc": "cung_quan_loc", "Nô Bộc": "cung_no_boc",
+    "Thiên Di": "cung_thien_di", "Tật Ách": "cung_tat_ach", "Tài Bạch": "cung_tai_bach",
+    "Tử Tức": "cung_tu_tuc", "Phu Thê": "cung_phu_the", "Huynh Đệ": "cung_huynh_de"
+}
+
+# Nạp âm theo từng cặp trong lục thập hoa giáp (Giáp Tý - Ất Sửu, Bính Dần - Đinh Mão, ...)
+NAP_AM = [
+    "Hải Trung Kim", "Lư Trung Hỏa", "Đại Lâm Mộc", "Lộ Bàng Thổ", "Kiếm Phong Kim",
+    "Sơn Đầu Hỏa", "Giản Hạ Thủy", "Thành Đầu Thổ", "Bạch Lạp Kim", "Dương Liễu Mộc",
+    "Tuyền Trung Thủy", "Ốc Thượng Thổ", "Tích Lịch Hỏa", "Tùng Bách Mộc", "Trường Lưu Thủy",
+    "Sa Trung Kim", "Sơn Hạ Hỏa", "Bình Địa Mộc", "Bích Thượng Thổ", "Kim Bạch Kim",
+    "Phúc Đăng Hỏa", "Thiên Hà Thủy", "Đại Trạch Thổ", "Thoa Xuyến Kim", "Tang Đố Mộc",
+    "Đại Khê Thủy", "Sa Trung Thổ", "Thiên Thượng Hỏa", "Thạch Lựu Mộc", "Đại Hải Thủy"
+]
+
+CUC_NAMES = {2: "Thủy nhị cục", 3: "Mộc tam cục", 4: "Kim tứ cục", 5: "Thổ ngũ cục", 6: "Hỏa lục cục"}
+CUC_BY_ELEMENT = {"Thủy": 2, "Mộc": 3, "Kim": 4, "Thổ": 5, "Hỏa": 6}
+
+# Ngũ hành tương sinh / tương khắc
+ELEMENT_SINH = {"Mộc": "Hỏa", "Hỏa": "Thổ", "Thổ": "Kim", "Kim": "Thủy", "Thủy": "Mộc"}
+ELEMENT_KHAC = {"Mộc": "Thổ", "Thổ": "Thủy", "Thủy": "Hỏa", "Hỏa": "Kim", "Kim": "Mộc"}
+
+TRANG_SINH = [
+    "Trường Sinh", "Mộc Dục", "Quan Đới", "Lâm Quan", "Đế Vượng", "Suy",
+    "Bệnh", "Tử", "Mộ", "Tuyệt", "Thai", "Dưỡng"
+]
+VONG_BAC_SY = [
+    "Bác Sỹ", "Lực Sĩ", "Thanh Long", "Tiểu Hao", "Tướng Quân", "Tấu Thư",
+    "Phi Liêm", "Hỉ Thần", "Bệnh Phù", "Đại Hao", "Phục Binh", "Quan Phủ"
+]
+VONG_THAI_TUE = [
+    "Thái Tuế", "Thiếu Dương", "Tang Môn", "Thiếu Âm", "Quan Phủ", "Tử Phù",
+    "Tuế Phá", "Long Đức", "Bạch Hổ", "Phúc Đức", "Điếu Khách", "Trực Phù"
+]
+
+# Tứ hóa theo can năm sinh: (Hóa Lộc, Hóa Quyền, Hóa Khoa, Hóa Kị)
+TU_HOA = [
+    ("Liêm Trinh", "Phá Quân", "Vũ Khúc", "Thái Dương"),
+    ("Thiên Cơ", "Thiên Lương", "Tử Vi", "Thái Âm"),
+    ("Thiên Đồng", "Thiên Cơ", "Văn Xương", "Liêm Trinh"),
+    ("Thái Âm", "Thiên Đồng", "Thiên Cơ", "Cự Môn"),
+    ("Tham Lang", "Thái Âm", "Hữu Bật", "Thiên Cơ"),
+    ("Vũ Khúc", "Tham Lang", "Thiên Lương", "Văn Khúc"),
+    ("Thái Dương", "Vũ Khúc", "Thái Âm", "Thiên Đồng"),
+    ("Cự Môn", "Thái Dương", "Văn Khúc", "Văn Xương"),
+    ("Thiên Lương", "Tử Vi", "Tả Phù", "Vũ Khúc"),
+    ("Phá Quân", "Cự Môn", "Thái Âm", "Tham Lang")
+]
+
+# Các sao an theo can năm sinh (vị trí địa chi theo thứ tự Giáp -> Quý)
+SAO_THEO_CAN = {
+    "Lộc Tồn": [2, 3, 5, 6, 5, 6, 8, 9, 11, 0],
+    "Thiên Khôi": [1, 0, 11, 11, 1, 0, 6, 6, 3, 3],
+    "Thiên Việt": [7, 8, 9, 9, 7, 8, 2, 2, 5, 5],
+    "Thiên Quan": [7, 4, 5, 2, 3, 9, 11, 9, 10, 6],
+    "Thiên Phúc": [9, 8, 0, 11, 3, 2, 6, 5, 6, 5],
+    "Lưu Hà": [9, 10, 7, 8, 5, 6, 4, 3, 11, 2],
+    "Thiên Trù": [5, 6, 0, 5, 6, 8, 2, 6, 9, 10],
+    "LN Văn Tinh": [5, 6, 8, 9, 8, 9, 11, 0, 2, 3]
+}
+
+# Triệt theo can năm sinh (Giáp Kỷ -> Thân Dậu, Ất Canh -> Ngọ Mùi, ...)
+TRIET_THEO_CAN = [(8, 9), (6, 7), (4, 5), (2, 3), (0, 1)]
+
+# Chủ Mệnh theo chi cung Mệnh, Chủ Thân theo chi năm sinh
+CHU_MENH = [
+    "Tham Lang", "Cự Môn", "Lộc Tồn", "Văn Khúc", "Liêm Trinh", "Vũ Khúc",
+    "Phá Quân", "Vũ Khúc", "Liêm Trinh", "Văn Khúc", "Lộc Tồn", "Cự Môn"
+]
+CHU_THAN = [
+    "Linh Tinh", "Thiên Tướng", "Thiên Lương", "Thiên Đồng", "Văn Xương", "Thiên Cơ",
+    "Linh Tinh", "Thiên Tướng", "Thiên Lương", "Thiên Đồng", "Văn Xương", "Thiên Cơ"
+]
+
+# Đắc tính (Miếu/Vượng/Đắc/Bình/Hãm) của sao tại 12 cung, theo thứ tự Tý -> Hợi
+DAC_TINH = {
+    "Tử Vi": "B Đ M B V M M Đ M B V B",
+    "Liêm Trinh": "V Đ V H M H V Đ V H M H",
+    "Thiên Đồng": "V H M Đ H Đ H H M H H Đ",
+    "Vũ Khúc": "V M V Đ M H V M V Đ M H",
+    "Thái Dương": "H Đ V V V M M Đ H H H H",
+    "Thiên Cơ": "Đ Đ H M M V Đ Đ V M M H",
+    "Thiên Phủ": "M B M B V Đ M Đ M B V Đ",
+    "Thái Âm": "V Đ H H H H H Đ V M M M",
+    "Tham Lang": "H M Đ H V H H M Đ H V H",
+    "Cự Môn": "V H V M H H V H Đ M H Đ",
+    "Thiên Tướng": "V Đ M H V Đ V Đ M H V Đ",
+    "Thiên Lương": "V Đ V V M H M Đ V H M H",
+    "Thất Sát": "M Đ M H H V M Đ M H H V",
+    "Phá Quân": "M V H H Đ H M V H H Đ H",
+    "Văn Xương": "H Đ H H Đ M H Đ Đ M H Đ",
+    "Văn Khúc": "H Đ H H Đ M H Đ Đ M Đ Đ",
+    "Lộc Tồn": "M - Đ M - Đ M - Đ M - Đ",
+    "Kình Dương": "H Đ - H Đ - H Đ - H Đ -",
+    "Đà La": "- Đ H - Đ H - Đ H - Đ H",
+    "Địa Không": "H H Đ H H Đ H H Đ H H Đ",
+    "Địa Kiếp": "H H Đ H H Đ H H Đ H H Đ",
+    "Hỏa Tinh": "H H Đ Đ Đ Đ Đ H H H H H",
+    "Linh Tinh": "H H Đ Đ Đ Đ Đ H H H H H",
+    "Thiên Mã": "- - Đ - - Đ - - H - - H",
+    "Tang Môn": "H H Đ Đ H H H H Đ Đ H H",
+    "Bạch Hổ": "H H Đ Đ H H Đ H Đ Đ H H",
+    "Thiên Khốc": "Đ Đ H Đ H H Đ Đ H Đ H H",
+    "Thiên Hư": "Đ Đ H Đ H H Đ Đ H Đ H H",
+    "Đại Hao": "H H Đ Đ H H H H Đ Đ H H",
+    "Tiểu Hao": "H H Đ Đ H H H H Đ Đ H H",
+    "Thiên Hình": "H H Đ Đ H H H H Đ Đ H H",
+    "Thiên Diêu": "H H Đ Đ H H H H H Đ Đ H",
+    "Hóa Lộc": "H B B B B H H B B B B H",
+    "Hóa Quyền": "V V V V V V V V V V V V",
+    "Hóa Khoa": "Đ Đ V V V Đ Đ V V V V Đ",
+    "Hóa Kị": "H Đ H H Đ H H Đ H H Đ H"
+}
+
+# Thứ tự hiển thị sao phụ trong một cung (cát tinh cột trái, hung tinh cột phải)
+CAT_TINH_ORDER = [
+    "Văn Xương", "Văn Khúc", "Hữu Bật", "Thiên Việt", "Thiên Khôi", "Hóa Lộc", "Hóa Quyền",
+    "Hóa Khoa", "Tả Phù", "Lộc Tồn", "Đào Hoa", "Hồng Loan", "Thiên Hỷ", "Thiên Giải",
+    "Địa Giải", "Tam Thai", "Bát Tọa", "Thiên Y", "Thai Phụ", "Phong Cáo", "Ân Quang",
+    "Thiên Quý", "Quốc Ấn", "LN Văn Tinh", "Bác Sỹ", "Lực Sĩ", "Thanh Long", "Tấu Thư",
+    "Hỉ Thần", "Thiên Trù", "Đường Phù", "Thiên Quan", "Thiên Phúc", "Thiên Mã",
+    "Giải Thần", "Phượng Các", "Hoa Cái", "Long Trì", "Nguyệt Đức", "Thiếu Dương",
+    "Thiếu Âm", "Phúc Đức", "Long Đức", "Thiên Đức", "Thiên Tài", "Thiên Thọ",
+    "L.Lộc Tồn", "L.Thiên Mã"
+]
+HUNG_TINH_ORDER = [
+    "Địa Không", "Địa Kiếp", "Hỏa Tinh", "Linh Tinh", "Kình Dương", "Đà La", "Hóa Kị",
+    "Thiên Hình", "Thiên Diêu", "Thiên Không", "Cô Thần", "Quả Tú", "Lưu Hà",
+    "Tiểu Hao", "Tướng Quân", "Phi Liêm", "Bệnh Phù", "Đại Hao", "Phục Binh", "Quan Phủ",
+    "Thái Tuế", "Tang Môn", "Tử Phù", "Tuế Phá", "Bạch Hổ", "Điếu Khách", "Trực Phù",
+    "Thiên Khốc", "Thiên Hư", "Kiếp Sát", "Phá Toái", "Đẩu Quân", "Thiên La", "Địa Võng",
+    "Thiên Thương", "Thiên Sứ", "L.Thái Tuế", "L.Tang Môn", "L.Bạch Hổ", "L.Thiên Khốc",
+    "L.Thiên Hư", "L.Kình Dương", "L.Đà La"
+]
+
+def jd_from_date(dd, mm, yy):
+    """Đổi ngày dương lịch sang số ngày Julius."""
+    a = (14 - mm) // 12
+    y = yy + 4800 - a
+    m = mm + 12 * a - 3
+    jd = dd + (153 * m + 2) // 5 + 365 * y + y // 4 - y // 100 + y // 400 - 32045
+    if jd < 2299161:
+        jd = dd + (153 * m + 2) // 5 + 365 * y + y // 4 - 32083
+    return jd
+
+def get_new_moon_day(k, time_zone=7):
+    """Tính ngày Julius của điểm sóc (trăng mới) thứ k kể từ 1/1/1900."""
+    T = k / 1236.85
+    T2 = T * T
+    T3 = T2 * T
+    dr = math.pi / 180
+    jd1 = 2415020.75933 + 29.53058868 * k + 0.0001178 * T2 - 0.000000155 * T3
+    jd1 = jd1 + 0.00033 * math.sin((166.56 + 132.87 * T - 0.009173 * T2) * dr)
+    M = 359.2242 + 29.10535608 * k - 0.0000333 * T2 - 0.00000347 * T3
+    Mpr = 306.0253 + 385.81691806 * k + 0.0107306 * T2 + 0.00001236 * T3
+    F = 21.2964 + 390.67050646 * k - 0.0016528 * T2 - 0.00000239 * T3
+    C1 = (0.1734 - 0.000393 * T) * math.sin(M * dr) + 0.0021 * math.sin(2 * dr * M)
+    C1 = C1 - 0.4068 * math.sin(Mpr * dr) + 0.0161 * math.sin(dr * 2 * Mpr)
+    C1 = C1 - 0.0004 * math.sin(dr * 3 * Mpr)
+    C1 = C1 + 0.0104 * math.sin(dr * 2 * F) - 0.0051 * math.sin(dr * (M + Mpr))
+    C1 = C1 - 0.0074 * math.sin(dr * (M - Mpr)) + 0.0004 * math.sin(dr * (2 * F + M))
+    C1 = C1 - 0.0004 * math.sin(dr * (2 * F - M)) - 0.0006 * math.sin(dr * (2 * F + Mpr))
+    C1 = C1 + 0.0010 * math.sin(dr * (2 * F - Mpr)) + 0.0005 * math.sin(dr * (2 * Mpr + M))
+    if T < -11:
+        deltat = 0.001 + 0.000839 * T + 0.0002261 * T2 - 0.00000845 * T3 - 0.000000081 * T * T3
+    else:
+        deltat = -0.000278 + 0.000265 * T + 0.000262 * T2
+    jd_new = jd1 + C1 - deltat
+    return math.floor(jd_new + 0.5 + time_zone / 24)
+
+def get_sun_longitude(jdn, time_zone=7):
+    """Tính vị trí mặt trời (theo 12 khoảng 30 độ) lúc 0h ngày jdn."""
+    T = (jdn - 2451545.5 - time_zone / 24) / 36525
+    T2 = T * T
+    dr = math.pi / 180
+    M = 357.52910 + 35999.05030 * T - 0.0001559 * T2 - 0.00000048 * T * T2
+    L0 = 280.46645 + 36000.76983 * T + 0.0003032 * T2
+    DL = (1.914600 - 0.004817 * T - 0.000014 * T2) * math.sin(dr * M)
+    DL = DL + (0.019993 - 0.000101 * T) * math.sin(dr * 2 * M) + 0.000290 * math.sin(dr * 3 * M)
+    L = (L0 + DL) * dr
+    L = L - math.pi * 2 * math.floor(L / (math.pi * 2))
+    return math.floor(L / math.pi * 6)
+
+def get_lunar_month_11(yy, time_zone=7):
+    """Tìm ngày bắt đầu tháng 11 âm lịch của năm yy."""
+    off = jd_from_date(31, 12, yy) - 2415021
+    k = math.floor(off / 29.530588853)
+    nm = get_new_moon_day(k, time_zone)
+    if get_sun_longitude(nm, time_zone) >= 9:
+        nm = get_new_moon_day(k - 1, time_zone)
+    return nm
+
+def get_leap_month_offset(a11, time_zone=7):
+    """Xác định vị trí tháng nhuận tính từ tháng 11 âm lịch."""
+    k = math.floor((a11 - 2415021.076998695) / 29.530588853 + 0.5)
+    i = 1
+    arc = get_sun_longitude(get_new_moon_day(k + i, time_zone), time_zone)
+    while True:
+        last = arc
+        i += 1
+        arc = get_sun_longitude(get_new_moon_day(k + i, time_zone), time_zone)
+        if arc == last or i >= 14:
+            break
+    return i - 1
+
+def calculate_solar_to_lunar(dd, mm, yy, time_zone=7):
     """
-    Lấy lá số tử vi dựa trên thông tin ngày sinh.
-    Kiểm tra xem lá số đã tồn tại chưa, nếu có thì tái sử dụng.
+    Tính ngày âm lịch từ ngày dương lịch bằng công thức thiên văn (múi giờ Việt Nam).
+
+    Returns:
+        tuple: (ngày âm, tháng âm, năm âm, có phải tháng nhuận không)
+    """
+    day_number = jd_from_date(dd, mm, yy)
+    k = math.floor((day_number - 2415021.076998695) / 29.530588853)
+    month_start = get_new_moon_day(k + 1, time_zone)
+    if month_start > day_number:
+        month_start = get_new_moon_day(k, time_zone)
+    a11 = get_lunar_month_11(yy, time_zone)
+    b11 = a11
+    if a11 >= month_start:
+        lunar_year = yy
+        a11 = get_lunar_month_11(yy - 1, time_zone)
+    else:
+        lunar_year = yy + 1
+        b11 = get_lunar_month_11(yy + 1, time_zone)
+    lunar_day = day_number - month_start + 1
+    diff = math.floor((month_start - a11) / 29)
+    lunar_leap = False
+    lunar_month = diff + 11
+    if b11 - a11 > 365:
+        leap_month_diff = get_leap_month_offset(a11, time_zone)
+        if diff >= leap_month_diff:
+            lunar_month = diff + 10
+            if diff == leap_month_diff:
+                lunar_leap = True
+    if lunar_month > 12:
+        lunar_month = lunar_month - 12
+    if lunar_month >= 11 and diff < 4:
+        lunar_year -= 1
+    return lunar_day, lunar_month, lunar_year, lunar_leap
+
+# Bảng âm lịch tính sẵn: mỗi ngày dương lịch từ 1/1/1900 đến 31/12/2100 là một
+# số nguyên 32 bit gồm ngày âm (5 bit), tháng âm (4 bit), cờ nhuận (1 bit) và
+# năm âm tính từ 1899 (8 bit). Các bit còn lại bằng 0: can chi của ngày tính thẳng
+# từ ngày Julius (xem compute_tuvi_chart) nên không cần lưu
+LUNAR_TABLE_MAGIC = b'TVLT'
+LUNAR_TABLE_VERSION = 1
+LUNAR_TABLE_HEADER = struct.Struct('<4sHHII')
+LUNAR_TABLE_START_YEAR = 1900
+LUNAR_TABLE_END_YEAR = 2100
+
+# Bảng âm lịch đã nạp (memoryview trên file mmap) và ngày Julius đầu tiên của bảng
+lunar_table = None
+lunar_table_start_jd = None
+
+def pack_lunar_record(lunar_day, lunar_month, lunar_year, lunar_leap):
+    """Gói thông tin âm lịch của một ngày thành số nguyên 32 bit."""
+    return (lunar_day
+            | (lunar_month << 5)
+            | (int(lunar_leap) << 9)
+            | ((lunar_year - LUNAR_TABLE_START_YEAR + 1) << 10))
+
+def unpack_lunar_record(record):
+    """
+    Giải nén một bản ghi của bảng âm lịch.
+
+    Returns:
+        tuple: (ngày âm, tháng âm, năm âm, có phải tháng nhuận không)
+    """
+    return (record & 0x1F,
+            (record >> 5) & 0xF,
+            ((record >> 10) & 0xFF) + LUNAR_TABLE_START_YEAR - 1,
+            bool((record >> 9) & 1))
+
+def build_lunar_table(path=LUNAR_TABLE_PATH):
+    """
+    Tính trước âm lịch cho toàn bộ khoảng 1900-2100 và ghi ra file nhị phân.
+
+    Chỉ tính điểm sóc và tháng nhuận một lần cho mỗi tháng âm, các ngày
+    trong tháng được suy ra bằng phép cộng.
+
+    Args:
+        path (str): Đường dẫn file bảng âm lịch
+
+    Returns:
+        str: Đường dẫn file đã ghi
+    """
+    start_jd = jd_from_date(1, 1, LUNAR_TABLE_START_YEAR)
+    end_jd = jd_from_date(31, 12, LUNAR_TABLE_END_YEAR)
+    records = bytearray()
+
+    jd = start_jd
+    while jd <= end_jd:
+        # Đổi ngày đầu tiên chưa có trong bảng, rồi điền tiếp đến hết tháng âm đó
+        a = jd + 32044
+        b = (4 * a + 3) // 146097
+        c = a - b * 146097 // 4
+        d = (4 * c + 3) // 1461
+        e = c - 1461 * d // 4
+        m = (5 * e + 2) // 153
+        dd = e - (153 * m + 2) // 5 + 1
+        mm = m + 3 - 12 * (m // 10)
+        yy = b * 100 + d - 4800 + m // 10
+
+        lunar_day, lunar_month, lunar_year, lunar_leap = calculate_solar_to_lunar(dd, mm, yy)
+        k = math.floor((jd - 2415021.076998695) / 29.530588853)
+        next_month_start = get_new_moon_day(k + 1)
+        if next_month_start <= jd:
+            next_month_start = get_new_moon_day(k + 2)
+
+        while jd < next_month_start and jd <= end_jd:
+            records += struct.pack('<I', pack_lunar_record(lunar_day, lunar_month, lunar_year, lunar_leap))
+            lunar_day += 1
+            jd += 1
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    # Ghi ra file tạm rồi đổi tên để không bao giờ để lại file dở dang
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(LUNAR_TABLE_HEADER.pack(LUNAR_TABLE_MAGIC, LUNAR_TABLE_VERSION, 0, start_jd, len(records) // 4))
+        f.write(records)
+    os.replace(temp_path, path)
+
+    logger.info(f"Đã tạo bảng âm lịch {path} với {len(records) // 4} ngày")
+    return path
+
+def load_lunar_table(path=LUNAR_TABLE_PATH):
+    """
+    Nạp bảng âm lịch bằng mmap, tự tạo bảng nếu chưa có file.
+
+    Args:
+        path (str): Đường dẫn file bảng âm lịch
+
+    Returns:
+        bool: True nếu nạp thành công
     """
+    global lunar_table, lunar_table_start_jd
     try:
-        # Kiểm tra xem lá số đã tồn tại chưa
-        chart_exists, existing_chart_path, chart_id = check_existing_chart(
-            user_id, day, month, year, birth_time, gender
-        )
-        
-        if chart_exists and existing_chart_path:
-            logger.info(f"Tái sử dụng lá số đã tồn tại cho user {user_id}: {existing_chart_path}")
-            # Cập nhật thống kê
-            bot_stats['charts_reused'] += 1
-            return existing_chart_path, True  # True để đánh dấu đây là lá số tái sử dụng
-        
-        # Nếu không tìm thấy lá số tồn tại, tạo mới
-        logger.info(f"Tạo lá số mới cho user {user_id} với thông tin: {day}/{month}/{year}, {birth_time}, {gender}")
-        
-        # Thông báo đang xử lý
-        logger.info(f"Đang lấy lá số tử vi cho {day}/{month}/{year}, giờ {birth_time}, giới tính {gender}")
-        
-        # Chuyển đổi giờ sinh theo định dạng giờ (lấy giá trị trung bình của khoảng giờ)
-        hour_mapping = {
-            "Tý": "00", "Sửu": "02", "Dần": "04", "Mão": "06", 
-            "Thìn": "08", "Tỵ": "10", "Ngọ": "12", "Mùi": "14", 
-            "Thân": "16", "Dậu": "18", "Tuất": "20", "Hợi": "22",
-            "Không rõ": "12"  # Mặc định là 12 giờ trưa nếu không rõ
-        }
-        
-        hour = hour_mapping.get(birth_time, "12")
-        
-        # Thiết lập Chrome options
-        chrome_options = Options()
-        chrome_options.add_argument("--headless")  # Chạy ẩn
-        chrome_options.add_argument("--no-sandbox")
-        chrome_options.add_argument("--disable-dev-shm-usage")
-        chrome_options.add_argument("--window-size=1920,1080")
-        
-        # Gửi thông báo tiến trình
-        processing_msg = bot.send_message(
-            user_id, 
-            "⏳ *Đang lập lá số tử vi...*\n\nĐang khởi tạo trình duyệt...",
-            parse_mode='Markdown'
-        )
-        
-        # Khởi tạo trình duyệt
-        service = Service(ChromeDriverManager().install())
-        driver = webdriver.Chrome(service=service, options=chrome_options)
-        
-        # Cập nhật tiến trình
-        send_progress_update(user_id, processing_msg.message_id, "Đang truy cập trang web lập lá số...", 10)
-        
-        # Truy cập trang web
-        driver.get("https://tuvivietnam.vn/lasotuvi/")
-        
-        # Đợi trang web tải xong
-        WebDriverWait(driver, 10).until(
-            EC.presence_of_element_located((By.ID, "txtHoTen"))
-        )
-        
-        # Cập nhật tiến trình
-        send_progress_update(user_id, processing_msg.message_id, "Đang điền thông tin vào form...", 30)
-        
-        # Điền thông tin vào form
-        # Họ tên
-        name_input = driver.find_element(By.ID, "txtHoTen")
-        name_input.send_keys("Học Tử Vi Bot")
-        
+        if not os.path.exists(path):
+            logger.info(f"Chưa có bảng âm lịch {path}, đang tạo mới...")
+            build_lunar_table(path)
+
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, start_jd, count = LUNAR_TABLE_HEADER.unpack_from(mapped, 0)
+        if magic != LUNAR_TABLE_MAGIC or version != LUNAR_TABLE_VERSION:
+            logger.warning(f"File bảng âm lịch {path} không hợp lệ, dùng công thức thiên văn")
+            return False
+        if len(mapped) < LUNAR_TABLE_HEADER.size + count * 4:
+            logger.warning(f"File bảng âm lịch {path} bị thiếu dữ liệu, dùng công thức thiên văn")
+            return False
+
+        data = memoryview(mapped)[LUNAR_TABLE_HEADER.size:LUNAR_TABLE_HEADER.size + count * 4]
+        if sys.byteorder == 'little':
+            lunar_table = data.cast('I')
+        else:
+            lunar_table = [value for (value,) in struct.iter_unpack('<I', data)]
+        lunar_table_start_jd = start_jd
+
+        logger.info(f"Đã nạp bảng âm lịch với {count} ngày")
+        return True
+    except Exception as e:
+        logger.error(f"Lỗi khi nạp bảng âm lịch: {e}")
+        return False
+
+def convert_solar_to_lunar(dd, mm, yy, time_zone=7):
+    """
+    Đổi ngày dương lịch sang âm lịch (múi giờ Việt Nam).
+
+    Tra bảng tính sẵn nếu ngày nằm trong khoảng 1900-2100, ngoài ra tính bằng công thức.
+
+    Returns:
+        tuple: (ngày âm, tháng âm, năm âm, có phải tháng nhuận không)
+    """
+    if lunar_table is not None and time_zone == 7:
+        index = jd_from_date(dd, mm, yy) - lunar_table_start_jd
+        if 0 <= index < len(lunar_table):
+            return unpack_lunar_record(lunar_table[index])
+    return calculate_solar_to_lunar(dd, mm, yy, time_zone)
+
+def convert_solar_to_lunar_bulk(dates):
+    """
+    Đổi hàng loạt ngày dương lịch sang âm lịch, dùng khi cần backfill dữ liệu cũ.
+
+    Args:
+        dates (iterable): Danh sách ngày dạng (ngày, tháng, năm) hoặc datetime/date
+
+    Returns:
+        list: Danh sách (ngày âm, tháng âm, năm âm, có phải tháng nhuận không) theo đúng thứ tự
+    """
+    days = [(d.day, d.month, d.year) if hasattr(d, 'year') else tuple(d) for d in dates]
+    if lunar_table is None:
+        return [calculate_solar_to_lunar(dd, mm, yy) for dd, mm, yy in days]
+
+    table = lunar_table
+    start_jd = lunar_table_start_jd
+    size = len(table)
+    results = []
+    for dd, mm, yy in days:
+        index = jd_from_date(dd, mm, yy) - start_jd
+        if 0 <= index < size:
+            results.append(unpack_lunar_record(table[index]))
+        else:
+            results.append(calculate_solar_to_lunar(dd, mm, yy))
+    return results
+
+def get_nap_am(can_index, chi_index):
+    """Trả về tên nạp âm của một cặp can chi."""
+    position = (6 * can_index - 5 * chi_index) % 60
+    return NAP_AM[position // 2]
+
+def get_dac_tinh(star_name, position):
+    """Trả về đắc tính của sao tại vị trí địa chi, hoặc chuỗi rỗng nếu không có."""
+    table = DAC_TINH.get(star_name)
+    if not table:
+        return ""
+    value = table.split()[position]
+    return "" if value == "-" else value
+
+def compute_tuvi_chart(day, month, year, birth_time, gender, view_year=None):
+    """
+    An sao lá số tử vi từ ngày sinh dương lịch, không cần trình duyệt.
+
+    Args:
+        day (int): Ngày sinh (dương lịch)
+        month (int): Tháng sinh (dương lịch)
+        year (int): Năm sinh (dương lịch)
+        birth_time (str): Giờ sinh theo 12 con giáp ("Tý", "Sửu", ..., "Không rõ")
+        gender (str): "Nam" hoặc "Nữ"
+        view_year (int, optional): Năm xem hạn, mặc định là năm hiện tại
+
+    Returns:
+        dict: Dữ liệu lá số gồm thông tin chung và 12 cung (đánh số theo địa chi, Tý = 0)
+    """
+    if view_year is None:
+        view_year = datetime.now().year
+
+    # Giờ không rõ được lập như giờ Ngọ (12h), giống cách lấy lá số trên web
+    hour_chi = CHI.index(birth_time) if birth_time in CHI else 6
+    is_male = gender == "Nam"
+
+    # Đổi sang âm lịch
+    lunar_day, lunar_month, lunar_year, lunar_leap = convert_solar_to_lunar(day, month, year)
+    jd = jd_from_date(day, month, year)
+
+    year_can = (lunar_year + 6) % 10
+    year_chi = (lunar_year + 8) % 12
+    month_can = (lunar_year * 12 + lunar_month + 3) % 10
+    month_chi = (lunar_month + 1) % 12
+    day_can = (jd + 9) % 10
+    day_chi = (jd + 1) % 12
+    hour_can = ((jd - 1) * 2 + hour_chi) % 10
+    view_can = (view_year + 6) % 10
+    view_chi = (view_year + 8) % 12
+
+    # Âm dương nam nữ quyết định chiều thuận / nghịch
+    is_duong = year_can % 2 == 0
+    thuan = is_duong == is_male
+    direction = 1 if thuan else -1
+
+    # An cung Mệnh, cung Thân
+    month_position = 2 + lunar_month - 1
+    menh = (month_position - hour_chi) % 12
+    than = (month_position + hour_chi) % 12
+
+    # Can của 12 cung theo ngũ hổ độn
+    can_dan = ((year_can % 5) * 2 + 2) % 10
+    cung_can = [(can_dan + (chi - 2) % 12) % 10 for chi in range(12)]
+
+    # Nạp âm bản mệnh và Cục
+    ban_menh = get_nap_am(year_can, year_chi)
+    menh_element = ban_menh.split()[-1]
+    cuc_element = get_nap_am(cung_can[menh], menh).split()[-1]
+    cuc = CUC_BY_ELEMENT[cuc_element]
+
+    stars = {position: [] for position in range(12)}
+
+    def add_star(name, position, kind):
+        stars[position % 12].append({
+            'ten': name,
+            'loai': kind,
+            'dac_tinh': get_dac_tinh(name, position % 12) if not name.startswith("L.") else ""
+        })
+
+    # Vị trí sao Tử Vi theo Cục và ngày âm
+    extra = 0
+    while (lunar_day + extra) % cuc != 0:
+        extra += 1
+    quotient = (lunar_day + extra) // cuc
+    tu_vi = 2 + quotient - 1
+    tu_vi = tu_vi - extra if extra % 2 == 1 else tu_vi + extra
+    tu_vi %= 12
+
+    # Chòm Tử Vi (đi nghịch) và chòm Thiên Phủ (đi thuận)
+    for name, offset in [("Tử Vi", 0), ("Thiên Cơ", -1), ("Thái Dương", -3),
+                         ("Vũ Khúc", -4), ("Thiên Đồng", -5), ("Liêm Trinh", -8)]:
+        add_star(name, tu_vi + offset, 'chinh')
+    thien_phu = (4 - tu_vi) % 12
+    for name, offset in [("Thiên Phủ", 0), ("Thái Âm", 1), ("Tham Lang", 2), ("Cự Môn", 3),
+                         ("Thiên Tướng", 4), ("Thiên Lương", 5), ("Thất Sát", 6), ("Phá Quân", 10)]:
+        add_star(name, thien_phu + offset, 'chinh')
+
+    main_positions = {}
+    for position, items in stars.items():
+        for star in items:
+            main_positions[star['ten']] = position
+
+    # Sao theo giờ sinh
+    van_xuong = (10 - hour_chi) % 12
+    van_khuc = (4 + hour_chi) % 12
+    add_star("Văn Xương", van_xuong, 'cat')
+    add_star("Văn Khúc", van_khuc, 'cat')
+    add_star("Địa Không", 11 - hour_chi, 'hung')
+    add_star("Địa Kiếp", 11 + hour_chi, 'hung')
+    add_star("Thai Phụ", 6 + hour_chi, 'cat')
+    add_star("Phong Cáo", 2 + hour_chi, 'cat')
+
+    # Sao theo tháng sinh
+    ta_phu = (4 + lunar_month - 1) % 12
+    huu_bat = (10 - lunar_month + 1) % 12
+    add_star("Tả Phù", ta_phu, 'cat')
+    add_star("Hữu Bật", huu_bat, 'cat')
+    add_star("Thiên Hình", 9 + lunar_month - 1, 'hung')
+    add_star("Thiên Diêu", 1 + lunar_month - 1, 'hung')
+    add_star("Thiên Y", 1 + lunar_month - 1, 'cat')
+    add_star("Thiên Giải", 8 + lunar_month - 1, 'cat')
+    add_star("Địa Giải", 7 + lunar_month - 1, 'cat')
+
+    # Sao theo ngày sinh
+    add_star("Tam Thai", ta_phu + lunar_day - 1, 'cat')
+    add_star("Bát Tọa", huu_bat - lunar_day + 1, 'cat')
+    add_star("Ân Quang", van_xuong + lunar_day - 2, 'cat')
+    add_star("Thiên Quý", van_khuc - lunar_day + 2, 'cat')
+
+    # Hỏa Tinh, Linh Tinh theo chi năm và giờ sinh
+    tam_hop = year_chi % 4  # 0: Thân Tý Thìn, 1: Tỵ Dậu Sửu, 2: Dần Ngọ Tuất, 3: Hợi Mão Mùi
+    hoa_start = {0: 2, 1: 3, 2: 1, 3: 9}[tam_hop]
+    linh_start = {0: 10, 1: 10, 2: 3, 3: 10}[tam_hop]
+    add_star("Hỏa Tinh", hoa_start + direction * hour_chi, 'hung')
+    add_star("Linh Tinh", linh_start - direction * hour_chi, 'hung')
+
+    # Sao theo can năm sinh
+    loc_ton = SAO_THEO_CAN["Lộc Tồn"][year_can]
+    add_star("Lộc Tồn", loc_ton, 'cat')
+    add_star("Kình Dương", loc_ton + 1, 'hung')
+    add_star("Đà La", loc_ton - 1, 'hung')
+    add_star("Quốc Ấn", loc_ton + 8, 'cat')
+    add_star("Đường Phù", loc_ton + 5, 'cat')
+    for name in ["Thiên Khôi", "Thiên Việt", "Thiên Quan", "Thiên Phúc", "Thiên Trù", "LN Văn Tinh"]:
+        add_star(name, SAO_THEO_CAN[name][year_can], 'cat')
+    add_star("Lưu Hà", SAO_THEO_CAN["Lưu Hà"][year_can], 'hung')
+
+    # Vòng Bác Sỹ khởi từ Lộc Tồn
+    for index, name in enumerate(VONG_BAC_SY):
+        kind = 'hung' if name in HUNG_TINH_ORDER else 'cat'
+        add_star(name, loc_ton + direction * index, kind)
+
+    # Tứ hóa
+    positions = dict(main_positions)
+    positions.update({"Văn Xương": van_xuong, "Văn Khúc": van_khuc, "Tả Phù": ta_phu, "Hữu Bật": huu_bat})
+    for name, target in zip(["Hóa Lộc", "Hóa Quyền", "Hóa Khoa", "Hóa Kị"], TU_HOA[year_can]):
+        add_star(name, positions[target], 'hung' if name == "Hóa Kị" else 'cat')
+
+    # Vòng Thái Tuế khởi từ chi năm sinh
+    for index, name in enumerate(VONG_THAI_TUE):
+        kind = 'hung' if name in HUNG_TINH_ORDER else 'cat'
+        add_star(name, year_chi + index, kind)
+
+    # Sao theo chi năm sinh
+    add_star("Thiên Đức", 9 + year_chi, 'cat')
+    add_star("Nguyệt Đức", 5 + year_chi, 'cat')
+    add_star("Long Trì", 4 + year_chi, 'cat')
+    add_star("Phượng Các", 10 - year_chi, 'cat')
+    add_star("Giải Thần", 10 - year_chi, 'cat')
+    add_star("Thiên Khốc", 6 - year_chi, 'hung')
+    add_star("Thiên Hư", 6 + year_chi, 'hung')
+    add_star("Hồng Loan", 3 - year_chi, 'cat')
+    add_star("Thiên Hỷ", 9 - year_chi, 'cat')
+    add_star("Thiên Không", year_chi + 1, 'hung')
+    add_star("Cô Thần", {0: 2, 1: 2, 2: 5, 3: 5, 4: 5, 5: 8, 6: 8, 7: 8, 8: 11, 9: 11, 10: 11, 11: 2}[year_chi], 'hung')
+    add_star("Quả Tú", {0: 10, 1: 10, 2: 1, 3: 1, 4: 1, 5: 4, 6: 4, 7: 4, 8: 7, 9: 7, 10: 7, 11: 10}[year_chi], 'hung')
+    add_star("Thiên Mã", {0: 2, 1: 11, 2: 8, 3: 5}[tam_hop], 'cat')
+    add_star("Hoa Cái", {0: 4, 1: 1, 2: 10, 3: 7}[tam_hop], 'cat')
+    add_star("Đào Hoa", {0: 9, 1: 6, 2: 3, 3: 0}[tam_hop], 'cat')
+    add_star("Kiếp Sát", {0: 5, 1: 2, 2: 11, 3: 8}[tam_hop], 'hung')
+    add_star("Phá Toái", {0: 5, 1: 1, 2: 9}[year_chi % 3], 'hung')
+    add_star("Thiên Tài", menh + year_chi, 'cat')
+    add_star("Thiên Thọ", than + year_chi, 'cat')
+    add_star("Đẩu Quân", year_chi - lunar_month + 1 + hour_chi, 'hung')
+
+    # Sao cố định
+    add_star("Thiên La", 4, 'hung')
+    add_star("Địa Võng", 10, 'hung')
+    add_star("Thiên Thương", menh + 5, 'hung')
+    add_star("Thiên Sứ", menh + 7, 'hung')
+
+    # Sao lưu theo năm xem hạn
+    luu_loc_ton = SAO_THEO_CAN["Lộc Tồn"][view_can]
+    add_star("L.Thái Tuế", view_chi, 'hung')
+    add_star("L.Tang Môn", view_chi + 2, 'hung')
+    add_star("L.Bạch Hổ", view_chi + 8, 'hung')
+    add_star("L.Thiên Khốc", 6 - view_chi, 'hung')
+    add_star("L.Thiên Hư", 6 + view_chi, 'hung')
+    add_star("L.Lộc Tồn", luu_loc_ton, 'cat')
+    add_star("L.Kình Dương", luu_loc_ton + 1, 'hung')
+    add_star("L.Đà La", luu_loc_ton - 1, 'hung')
+    add_star("L.Thiên Mã", {0: 2, 1: 11, 2: 8, 3: 5}[view_chi % 4], 'cat')
+
+    # Tuần, Triệt
+    tuan_start = (year_chi - year_can + 10) % 12
+    tuan = [tuan_start, (tuan_start + 1) % 12]
+    triet = list(TRIET_THEO_CAN[year_can % 5])
+
+    # Vòng Tràng Sinh theo Cục
+    trang_sinh_start = {2: 8, 5: 8, 3: 11, 4: 5, 6: 2}[cuc]
+
+    # Tiểu hạn: chi năm ứng với mỗi cung
+    tieu_han_start = {0: 10, 1: 7, 2: 4, 3: 1}[tam_hop]
+    tieu_han_direction = 1 if is_male else -1
+
+    # Lưu nguyệt: tháng Giêng của năm xem khởi từ cung tiểu hạn năm đó
+    tieu_han_view = (tieu_han_start + tieu_han_direction * (view_chi - year_chi)) % 12
+    thang_gieng = (tieu_han_view - lunar_month + 1 + hour_chi) % 12
+
+    star_rank = {name: index for index, name in enumerate(CAT_TINH_ORDER + HUNG_TINH_ORDER)}
+    cung = []
+    for position in range(12):
+        name = CUNG_NAMES[(position - menh) % 12]
+        items = stars[position]
+        cung.append({
+            'chi': CHI[position],
+            'can': CAN[cung_can[position]],
+            'ten': name,
+            'khoa': CUNG_KEYS[name],
+            'than': position == than,
+            'dai_van': cuc + 10 * ((direction * (position - menh)) % 12),
+            'tieu_han': CHI[(year_chi + tieu_han_direction * (position - tieu_han_start)) % 12],
+            'trang_sinh': TRANG_SINH[(direction * (position - trang_sinh_start)) % 12],
+            'luu_nguyet': (position - thang_gieng) % 12 + 1,
+            'chinh_tinh': [s for s in items if s['loai'] == 'chinh'],
+            'cat_tinh': sorted([s for s in items if s['loai'] == 'cat'], key=lambda s: star_rank.get(s['ten'], 999)),
+            'hung_tinh': sorted([s for s in items if s['loai'] == 'hung'], key=lambda s: star_rank.get(s['ten'], 999)),
+            'tuan': position in tuan,
+            'triet': position in triet
+        })
+
+    # Mối quan hệ Mệnh - Cục
+    if menh_element == cuc_element:
+        menh_cuc = "Mệnh Cục bình hoà"
+    elif ELEMENT_SINH[cuc_element] == menh_element:
+        menh_cuc = "Cục sinh Mệnh"
+    elif ELEMENT_SINH[menh_element] == cuc_element:
+        menh_cuc = "Mệnh sinh Cục"
+    elif ELEMENT_KHAC[cuc_element] == menh_element:
+        menh_cuc = "Cục khắc Mệnh"
+    else:
+        menh_cuc = "Mệnh khắc Cục"
+
+    than_cung = CUNG_NAMES[(than - menh) % 12]
+    if than == menh:
+        than_cu = "Thân Mệnh đồng cung"
+    elif than_cung == "Phu Thê":
+        than_cu = "Thân cư Thê"
+    else:
+        than_cu = f"Thân cư {than_cung}"
+
+    return {
+        'thong_tin': {
+            'ngay': day,
+            'thang': month,
+            'nam': year,
+            'gio': birth_time,
+            'gioi_tinh': gender,
+            'ngay_am': lunar_day,
+            'thang_am': lunar_month,
+            'nam_am': lunar_year,
+            'thang_nhuan': lunar_leap,
+            'can_chi_nam': f"{CAN[year_can]} {CHI[year_chi]}",
+            'can_chi_thang': f"{CAN[month_can]} {CHI[month_chi]}",
+            'can_chi_ngay': f"{CAN[day_can]} {CHI[day_chi]}",
+            'can_chi_gio': f"{CAN[hour_can]} {CHI[hour_chi]}",
+            'nam_xem': view_year,
+            'can_chi_nam_xem': f"{CAN[view_can]} {CHI[view_chi]}",
+            'tuoi': view_year - lunar_year + 1,
+            'am_duong': f"{'Dương' if is_duong else 'Âm'} {'Nam' if is_male else 'Nữ'}",
+            'ban_menh': ban_menh,
+            'cuc': CUC_NAMES[cuc],
+            'chu_menh': CHU_MENH[menh],
+            'chu_than': CHU_THAN[year_chi],
+            'am_duong_ly': "Âm Dương thuận lý" if year_can % 2 == menh % 2 else "Âm Dương nghịch lý",
+            'menh_cuc': menh_cuc,
+            'than_cu': than_cu,
+            'menh': CHI[menh],
+            'than': CHI[than]
+        },
+        'cung': cung,
+        'tuan': [CHI[position] for position in tuan],
+        'triet': [CHI[position] for position in triet]
+    }
+
+def extract_chart_stars(chart_data):
+    """
+    Rút gọn dữ liệu lá số thành JSON theo từng cung để gửi cho AI thay cho hình ảnh.
+
+    Args:
+        chart_data (dict): Dữ liệu lá số từ compute_tuvi_chart
+
+    Returns:
+        dict: Thông tin chung và các cung (theo khóa 'cung_menh', ...), mỗi cung gồm
+            can chi, đại vận, vòng Tràng Sinh và các sao kèm đắc tính (M/V/Đ/B/H)
+    """
+    def format_stars(stars):
+        return [f"{star['ten']} ({star['dac_tinh']})" if star['dac_tinh'] else star['ten'] for star in stars]
+
+    thong_tin = chart_data['thong_tin']
+    cung_stars = {}
+    for cung in chart_data['cung']:
+        item = {
+            'can_chi': f"{cung['can']} {cung['chi']}",
+            'dai_van': cung['dai_van'],
+            'trang_sinh': cung['trang_sinh'],
+            'chinh_tinh': format_stars(cung['chinh_tinh']),
+            'cat_tinh': format_stars(cung['cat_tinh']),
+            'hung_tinh': format_stars(cung['hung_tinh'])
+        }
+        if cung['than']:
+            item['than'] = True
+        if cung['tuan']:
+            item['tuan'] = True
+        if cung['triet']:
+            item['triet'] = True
+        cung_stars[cung['khoa']] = item
+
+    return {
+        'thong_tin': {key: thong_tin[key] for key in (
+            'ngay_am', 'thang_am', 'nam_am', 'can_chi_nam', 'can_chi_thang', 'can_chi_ngay', 'can_chi_gio',
+            'am_duong', 'ban_menh', 'cuc', 'chu_menh', 'chu_than', 'am_duong_ly', 'menh_cuc', 'than_cu',
+            'nam_xem', 'tuoi'
+        )},
+        'cung': cung_stars
+    }
+
+def get_chart_stars(user_data):
+    """
+    Lấy dữ liệu sao của lá số, an lại từ thông tin ngày sinh nếu chưa có.
+
+    Args:
+        user_data (dict): Thông tin người dùng (ngày, tháng, năm, giờ sinh, giới tính)
+
+    Returns:
+        dict: Dữ liệu sao theo từng cung (xem extract_chart_stars), hoặc None nếu không lập được
+    """
+    if user_data.get('chart_stars'):
+        return user_data['chart_stars']
+
+    try:
+        chart_data = user_data.get('chart_data') or compute_tuvi_chart(
+            int(user_data['day']), int(user_data['month']), int(user_data['year']),
+            user_data['birth_time'], user_data['gender']
+        )
+        chart_stars = extract_chart_stars(chart_data)
+    except Exception as e:
+        logger.warning(f"Không lấy được dữ liệu sao của lá số: {e}")
+        return None
+
+    user_data['chart_stars'] = chart_stars
+    # Lá số đầy đủ an lại được khi cần, không giữ trong phiên khi đã có dữ liệu sao
+    user_data.pop('chart_data', None)
+    return chart_stars
+
+# Vị trí (cột, hàng) của từng địa chi trên lưới 4x4 của lá số
+CHART_GRID_POSITIONS = {
+    5: (0, 0), 6: (1, 0), 7: (2, 0), 8: (3, 0),
+    4: (0, 1), 9: (3, 1),
+    3: (0, 2), 10: (3, 2),
+    2: (0, 3), 1: (1, 3), 0: (2, 3), 11: (3, 3)
+}
+CHART_CELL_WIDTH = 180
+CHART_CELL_HEIGHT = 240
+# Lề trong mỗi ô và cỡ chữ nhỏ nhất khi phải thu nhỏ chữ cho vừa ô
+CHART_CELL_PADDING = 6
+CHART_MIN_FONT_SIZE = 8
+
+# Phần mở rộng file ảnh theo định dạng xuất
+CHART_IMAGE_EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp'}
+
+# Font và khung nền lá số được nạp một lần rồi dùng lại cho mọi lần vẽ
+chart_fonts = {}
+chart_template = None
+chart_render_lock = threading.Lock()
+
+def load_chart_font(size):
+    """Tải font hỗ trợ tiếng Việt để vẽ lá số (có cache theo cỡ chữ), dùng font mặc định nếu không có."""
+    if size in chart_fonts:
+        return chart_fonts[size]
+
+    font = None
+    for font_path in [CHART_FONT_PATH, "DejaVuSans.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"]:
+        if not font_path:
+            continue
+        try:
+            font = ImageFont.truetype(font_path, size)
+            break
+        except Exception:
+            continue
+    if font is None:
+        try:
+            font = ImageFont.load_default(size)
+        except TypeError:
+            # Pillow cũ chỉ có font mặc định một cỡ
+            font = ImageFont.load_default()
+
+    chart_fonts[size] = font
+    return font
+
+def get_chart_template():
+    """Trả về khung nền lá số (lưới 12 cung) đã vẽ sẵn, chỉ vẽ một lần."""
+    global chart_template
+    with chart_render_lock:
+        if chart_template is None:
+            template = Image.new('RGB', (CHART_CELL_WIDTH * 4, CHART_CELL_HEIGHT * 4), color=(236, 236, 228))
+            d = ImageDraw.Draw(template)
+            for col, row in CHART_GRID_POSITIONS.values():
+                x, y = col * CHART_CELL_WIDTH, row * CHART_CELL_HEIGHT
+                d.rectangle([x, y, x + CHART_CELL_WIDTH, y + CHART_CELL_HEIGHT], outline=(90, 90, 90))
+            d.rectangle([CHART_CELL_WIDTH, CHART_CELL_HEIGHT, CHART_CELL_WIDTH * 3, CHART_CELL_HEIGHT * 3],
+                        fill=(248, 248, 240), outline=(90, 90, 90))
+            chart_template = template
+    return chart_template
+
+def fit_chart_text(draw, text, max_width, size, min_size=CHART_MIN_FONT_SIZE):
+    """
+    Chọn cỡ chữ để text vừa max_width điểm ảnh: thu nhỏ dần tới min_size, nếu vẫn không vừa
+    thì cắt bớt và thêm dấu "…".
+
+    Returns:
+        tuple: (text đã cắt nếu cần, font)
+    """
+    for font_size in range(size, min_size - 1, -1):
+        font = load_chart_font(font_size)
+        if draw.textlength(text, font=font) <= max_width:
+            return text, font
+    while text and draw.textlength(text + "…", font=font) > max_width:
+        text = text[:-1]
+    return text.rstrip() + "…", font
+
+def get_chart_line_height(draw, font):
+    """Chiều cao một dòng chữ (tính cả dấu tiếng Việt phía trên và phần chữ thò xuống dưới)."""
+    top, bottom = draw.textbbox((0, 0), "Ấg(Đ)ỵ", font=font)[1::2]
+    return bottom - top + 2
+
+def format_chart_star(star):
+    """Tên sao kèm độ sáng, ví dụ "Thiên Cơ(H)"."""
+    return star['ten'] + (f"({star['dac_tinh']})" if star['dac_tinh'] else "")
+
+def draw_chart_row(draw, left, right, top, left_text, middle_text, right_text, color, size=12):
+    """
+    Vẽ một dòng ba phần trong ô: phần trái sát lề trái, phần phải sát lề phải, phần giữa
+    nằm giữa khoảng còn lại và được thu nhỏ/cắt bớt để không đè lên hai phần kia.
+    """
+    gap = 6
+    left_text, left_font = fit_chart_text(draw, left_text, (right - left) // 3, size)
+    right_text, right_font = fit_chart_text(draw, right_text, (right - left) // 3, size)
+    left_width = draw.textlength(left_text, font=left_font)
+    right_width = draw.textlength(right_text, font=right_font)
+    draw.text((left, top), left_text, fill=color, font=left_font)
+    draw.text((right - right_width, top), right_text, fill=color, font=right_font)
+
+    middle_left, middle_right = left + left_width + gap, right - right_width - gap
+    middle_text, middle_font = fit_chart_text(draw, middle_text, middle_right - middle_left, size)
+    middle_width = draw.textlength(middle_text, font=middle_font)
+    draw.text((middle_left + (middle_right - middle_left - middle_width) / 2, top), middle_text,
+              fill=color, font=middle_font)
+
+def render_tuvi_chart(chart_data, image_format=CHART_IMAGE_FORMAT):
+    """
+    Vẽ lá số tử vi từ dữ liệu an sao, hoàn toàn trong bộ nhớ.
+
+    Args:
+        chart_data (dict): Dữ liệu lá số từ compute_tuvi_chart
+        image_format (str): Định dạng ảnh xuất ra ('JPEG' hoặc 'WEBP')
+
+    Returns:
+        BytesIO: Ảnh lá số đã nén, con trỏ ở đầu buffer
+    """
+    img = get_chart_template().copy()
+    d = ImageDraw.Draw(img)
+
+    # Chữ được đo bằng textlength rồi thu nhỏ/cắt bớt cho vừa ô, không vẽ đè lên nhau hay tràn viền
+    for position, (col, row) in CHART_GRID_POSITIONS.items():
+        cung = chart_data['cung'][position]
+        x, y = col * CHART_CELL_WIDTH, row * CHART_CELL_HEIGHT
+        left, right = x + CHART_CELL_PADDING, x + CHART_CELL_WIDTH - CHART_CELL_PADDING
+
+        # Tiêu đề cung: can chi, tên cung, đại vận
+        title = cung['ten'].upper() + (" <THÂN>" if cung['than'] else "")
+        draw_chart_row(d, left, right, y + 6, f"{cung['can'][0]}.{cung['chi']}", title,
+                       str(cung['dai_van']), (0, 0, 0))
+
+        # Chính tinh
+        line_y = y + 26
+        for star in cung['chinh_tinh']:
+            text, star_font = fit_chart_text(d, format_chart_star(star), right - (x + 40), 14)
+            d.text((x + 40, line_y), text, fill=(160, 0, 0), font=star_font)
+            line_y += 18
+
+        # Cát tinh cột trái, hung tinh cột phải. Ô nhiều sao thì giảm cỡ chữ, nếu vẫn không đủ
+        # chỗ thì dòng cuối của cột ghi số sao còn lại, để không đè lên dòng cuối của ô
+        bottom = y + CHART_CELL_HEIGHT - 18
+        aux_y = max(line_y, y + 70) + 6
+        rows = max(len(cung['cat_tinh']), len(cung['hung_tinh']), 1)
+        for aux_size in range(12, CHART_MIN_FONT_SIZE - 1, -1):
+            line_height = get_chart_line_height(d, load_chart_font(aux_size))
+            if line_height * rows <= bottom - aux_y:
+                break
+        max_rows = max(1, (bottom - aux_y) // line_height)
+        column_width = (right - left) // 2
+        for column, key, color in [(0, 'cat_tinh', (0, 110, 0)), (1, 'hung_tinh', (170, 0, 0))]:
+            texts = [format_chart_star(star) for star in cung[key]]
+            if len(texts) > max_rows:
+                texts = texts[:max_rows - 1] + [f"+{len(texts) - max_rows + 1} sao"]
+            star_y = aux_y
+            for text in texts:
+                text, star_font = fit_chart_text(d, text, column_width - 4, aux_size)
+                d.text((left + column * column_width, star_y), text, fill=color, font=star_font)
+                star_y += line_height
+
+        # Dòng cuối: tiểu hạn, tràng sinh, lưu nguyệt
+        draw_chart_row(d, left, right, bottom, cung['tieu_han'], cung['trang_sinh'],
+                       f"Tháng {cung['luu_nguyet']}", (0, 0, 0))
+
+    # Thông tin chung ở giữa lá số
+    info = chart_data['thong_tin']
+    center_x, center_y = CHART_CELL_WIDTH + 30, CHART_CELL_HEIGHT + 30
+    lines = [
+        "LÁ SỐ TỬ VI",
+        f"Năm: {info['nam']} - {info['can_chi_nam']}",
+        f"Tháng: {info['thang']:02d} ({info['thang_am']}) - {info['can_chi_thang']}",
+        f"Ngày: {info['ngay']:02d} ({info['ngay_am']}) - {info['can_chi_ngay']}",
+        f"Giờ: {info['can_chi_gio']}",
+        f"Năm xem: {info['nam_xem']} - {info['can_chi_nam_xem']} ({info['tuoi']} tuổi)",
+        f"Âm Dương: {info['am_duong']}",
+        f"Mệnh: {info['ban_menh']}",
+        f"Cục: {info['cuc']}",
+        f"Chủ Mệnh: {info['chu_menh']}",
+        f"Chủ Thân: {info['chu_than']}",
+        info['am_duong_ly'],
+        info['menh_cuc'],
+        info['than_cu'],
+        f"Tuần: {' - '.join(chart_data['tuan'])}   Triệt: {' - '.join(chart_data['triet'])}"
+    ]
+    center_width = CHART_CELL_WIDTH * 2 - 60
+    for index, line in enumerate(lines):
+        text, line_font = fit_chart_text(d, line, center_width, 14)
+        d.text((center_x, center_y + index * 24), text, fill=(0, 0, 160), font=line_font)
+
+    # Nén thẳng vào bộ nhớ, không qua file tạm
+    buffer = BytesIO()
+    if image_format == 'WEBP':
+        img.save(buffer, 'WEBP', quality=80, method=4)
+    else:
+        img.save(buffer, 'JPEG', quality=85, optimize=True)
+    buffer.seek(0)
+    return buffer
+
+# Kho ảnh theo nội dung: mỗi ảnh chỉ lưu một lần theo mã SHA-256. Thời gian sửa đổi của file
+# là lần dùng gần nhất, ảnh không được dùng lại quá lâu sẽ bị cleanup_asset_store xóa.
+asset_store_lock = threading.Lock()
+
+def get_asset_path(digest, extension):
+    """Trả về đường dẫn file trong kho ảnh, chia thư mục con theo 4 ký tự đầu của mã băm."""
+    return os.path.join(ASSET_STORE_DIR, digest[:2], digest[2:4], f"{digest}.{extension}")
+
+def store_asset(image_bytes, extension=None):
+    """
+    Lưu ảnh vào kho theo nội dung và đánh dấu ảnh vừa được dùng.
+
+    Ảnh đã có trong kho sẽ không bị ghi lại. Ảnh mới được ghi ra file tạm
+    cùng thư mục rồi đổi tên nên không bao giờ có file ghi dở.
+
+    Args:
+        image_bytes (bytes): Nội dung ảnh
+        extension (str): Phần mở rộng file, mặc định tự nhận dạng từ nội dung
+
+    Returns:
+        str: Đường dẫn file ảnh trong kho
+    """
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    image_path = get_asset_path(digest, extension or get_image_extension(image_bytes))
+
+    with asset_store_lock:
+        if not os.path.exists(image_path):
+            directory = os.path.dirname(image_path)
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(image_bytes)
+                os.replace(temp_path, image_path)
+            except Exception:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            logger.info(f"Đã lưu ảnh mới vào kho: {image_path}")
+        else:
+            # Cập nhật thời gian để việc dọn dẹp tính tuổi từ lần dùng gần nhất
+            os.utime(image_path)
+
+    return image_path
+
+def touch_asset(image_path):
+    """
+    Đánh dấu ảnh đã lưu trước đó (ví dụ đường dẫn giữ trong phiên) vừa được dùng lại.
+
+    Returns:
+        bool: True nếu file ảnh vẫn còn, False nếu đã bị dọn dẹp
+    """
+    with asset_store_lock:
+        try:
+            os.utime(image_path)
+            return True
+        except OSError:
+            return False
+
+def cleanup_asset_store(max_age_seconds):
+    """
+    Xóa các ảnh trong kho không được dùng lại trong max_age_seconds giây.
+
+    Args:
+        max_age_seconds (int): Thời gian tối đa (giây) từ lần dùng gần nhất của ảnh
+
+    Returns:
+        int: Số file đã xóa
+    """
+    if not os.path.exists(ASSET_STORE_DIR):
+        return 0
+
+    deleted_count = 0
+    current_time = time.time()
+    for root, _, filenames in os.walk(ASSET_STORE_DIR):
+        for filename in filenames:
+            file_path = os.path.join(root, filename)
+            with asset_store_lock:
+                try:
+                    file_age = current_time - os.path.getmtime(file_path)
+                    # File tạm còn sót lại do ghi lỗi giữa chừng
+                    if filename.endswith('.tmp'):
+                        if file_age > 3600:
+                            os.remove(file_path)
+                            deleted_count += 1
+                        continue
+                    if file_age > max_age_seconds:
+                        os.remove(file_path)
+                        deleted_count += 1
+                except Exception as e:
+                    logger.warning(f"Không thể xóa file {file_path}: {e}")
+    return deleted_count
+
+def create_native_chart(day, month, year, birth_time, gender, user_id, user_data):
+    """
+    Lập lá số bằng bộ an sao native, lưu ảnh vào kho ảnh và cơ sở dữ liệu.
+
+    Returns:
+        str: Đường dẫn file ảnh lá số
+    """
+    chart_data = user_data.get('chart_data') or compute_tuvi_chart(day, month, year, birth_time, gender)
+    image_buffer = render_tuvi_chart(chart_data)
+    image_bytes = image_buffer.getvalue()
+
+    image_path = store_asset(image_bytes, CHART_IMAGE_EXTENSIONS.get(CHART_IMAGE_FORMAT, 'jpg'))
+
+    # Lưu dữ liệu lá số để dùng lại ở các bước sau
+    user_data['chart_data'] = chart_data
+
+    # Lưu thông tin và ảnh vào cơ sở dữ liệu
+    try:
+        user_data['chart_id'] = save_chart(user_id, user_data, image_bytes)
+    except Exception as db_error:
+        logger.warning(f"Không thể lưu chart vào database: {db_error}")
+
+    logger.info(f"Đã lập lá số native cho user {user_id}: {image_path}")
+    return image_path
+
+def render_chart_asset(user_data):
+    """
+    Vẽ lại ảnh lá số của phiên và lưu vào kho ảnh, không ghi thêm lá số vào cơ sở dữ liệu.
+    Dùng khi lá số đã có nhưng file ảnh đã bị dọn khỏi kho.
+
+    Args:
+        user_data (dict): Thông tin người dùng (ngày, tháng, năm, giờ sinh, giới tính)
+
+    Returns:
+        str: Đường dẫn file ảnh lá số
+    """
+    chart_data = user_data.get('chart_data') or compute_tuvi_chart(
+        int(user_data['day']), int(user_data['month']), int(user_data['year']),
+        user_data['birth_time'], user_data['gender']
+    )
+    image_bytes = render_tuvi_chart(chart_data).getvalue()
+    return store_asset(image_bytes, CHART_IMAGE_EXTENSIONS.get(CHART_IMAGE_FORMAT, 'jpg'))
+
+# Pool trình duyệt Chrome dùng chung cho backend selenium
+driver_pool = queue.Queue()
+driver_pool_lock = threading.Lock()
+driver_pool_stats = {
+    'created': 0,
+    'recycled': 0,
+    'crashed': 0,
+    'aborted': 0,
+    'leases': 0,
+    'waits': 0,
+    'wait_time': 0.0,
+    'total': 0,
+    'in_use': 0
+}
+
+def create_chrome_options():
+    """Tạo cấu hình Chrome headless dùng cho việc lấy lá số."""
+    chrome_options = Options()
+    chrome_options.add_argument("--headless")  # Chạy ẩn
+    chrome_options.add_argument("--no-sandbox")
+    chrome_options.add_argument("--disable-dev-shm-usage")
+    chrome_options.add_argument("--window-size=1920,1080")
+    return chrome_options
+
+# Đường dẫn chromedriver đã xác định, dùng chung cho mọi trình duyệt
+chromedriver_path = None
+chromedriver_lock = threading.Lock()
+
+def resolve_chromedriver_path(download=False):
+    """
+    Xác định đường dẫn chromedriver một lần duy nhất và cache lại.
+
+    Nếu cấu hình CHROMEDRIVER_PATH thì dùng trực tiếp (chế độ offline, không
+    gọi mạng), nếu không thì nhờ webdriver_manager tải/kiểm tra phiên bản. Việc tải
+    chỉ được làm lúc khởi động (prepare_chrome_fallback), không bao giờ trong lúc
+    xử lý yêu cầu của người dùng.
+
+    Args:
+        download (bool): Cho phép webdriver_manager tải chromedriver qua mạng
+
+    Returns:
+        str: Đường dẫn file chromedriver
+    """
+    global chromedriver_path
+    if chromedriver_path:
+        return chromedriver_path
+
+    with chromedriver_lock:
+        if chromedriver_path:
+            return chromedriver_path
+
+        if CHROMEDRIVER_PATH:
+            if not os.path.exists(CHROMEDRIVER_PATH):
+                raise FileNotFoundError(f"Không tìm thấy chromedriver tại {CHROMEDRIVER_PATH}")
+            chromedriver_path = CHROMEDRIVER_PATH
+        elif download:
+            chromedriver_path = ChromeDriverManager().install()
+        else:
+            raise RuntimeError("Chưa có chromedriver (không chuẩn bị được lúc khởi động), không dùng được trình duyệt")
+
+        logger.info(f"Sử dụng chromedriver: {chromedriver_path}")
+        return chromedriver_path
+
+def prepare_chrome_fallback():
+    """
+    Chuẩn bị chromedriver lúc khởi động. Trình duyệt là đường dự phòng cuối cùng của mọi
+    CHART_ENGINE/CHART_SCRAPER nên luôn được chuẩn bị; chỉ khởi động sẵn trình duyệt khi
+    lá số được lấy bằng selenium ngay từ đầu. Không chuẩn bị được thì dự phòng bằng trình
+    duyệt bị tắt thay vì tải chromedriver giữa lúc xử lý yêu cầu.
+
+    Returns:
+        bool: True nếu dùng được trình duyệt
+    """
+    try:
+        resolve_chromedriver_path(download=True)
+    except Exception as e:
+        logger.error(f"Không thể chuẩn bị chromedriver, tắt dự phòng lấy lá số bằng trình duyệt: {e}")
+        return False
+    if CHART_ENGINE == 'selenium' and CHART_SCRAPER != 'http':
+        init_driver_pool()
+    return True
+
+def create_pooled_driver():
+    """
+    Khởi động một trình duyệt Chrome mới cho pool.
+
+    Returns:
+        dict: Thông tin trình duyệt gồm driver, số lần đã dùng và thời điểm tạo
+    """
+    service = Service(resolve_chromedriver_path())
+    driver = webdriver.Chrome(service=service, options=create_chrome_options())
+    with driver_pool_lock:
+        driver_pool_stats['created'] += 1
+    logger.info("Đã khởi động thêm một trình duyệt cho pool")
+    return {'driver': driver, 'uses': 0, 'created_at': time.time()}
+
+def quit_pooled_driver(entry):
+    """Đóng trình duyệt và bỏ khỏi pool."""
+    try:
+        entry['driver'].quit()
+    except Exception as e:
+        logger.warning(f"Lỗi khi đóng trình duyệt: {e}")
+    with driver_pool_lock:
+        driver_pool_stats['total'] -= 1
+
+def reset_pooled_driver(driver):
+    """Đưa trình duyệt về trạng thái sạch: đóng tab thừa, xóa cookie, về trang trắng."""
+    handles = driver.window_handles
+    for handle in handles[1:]:
+        driver.switch_to.window(handle)
+        driver.close()
+    driver.switch_to.window(handles[0])
+    driver.delete_all_cookies()
+    driver.get("about:blank")
+
+def init_driver_pool(size=DRIVER_POOL_SIZE):
+    """
+    Khởi động sẵn các trình duyệt cho pool khi bot chạy.
+
+    Args:
+        size (int): Số trình duyệt cần khởi động sẵn
+    """
+    for _ in range(size):
+        with driver_pool_lock:
+            if driver_pool_stats['total'] >= DRIVER_POOL_SIZE:
+                break
+            driver_pool_stats['total'] += 1
+        try:
+            driver_pool.put(create_pooled_driver())
+        except Exception as e:
+            with driver_pool_lock:
+                driver_pool_stats['total'] -= 1
+            logger.error(f"Không thể khởi động trình duyệt cho pool: {e}")
+            break
+    logger.info(f"Pool trình duyệt sẵn sàng với {driver_pool.qsize()} trình duyệt")
+
+def acquire_chrome_driver(timeout=DRIVER_POOL_TIMEOUT):
+    """
+    Mượn một trình duyệt từ pool, chờ nếu pool đã đầy.
+
+    Args:
+        timeout (int): Thời gian chờ tối đa (giây)
+
+    Returns:
+        dict: Thông tin trình duyệt đã mượn
+    """
+    try:
+        entry = driver_pool.get_nowait()
+    except queue.Empty:
+        entry = None
+
+    if entry is None:
+        # Còn chỗ trong pool thì khởi động thêm, nếu không thì xếp hàng chờ
+        with driver_pool_lock:
+            can_create = driver_pool_stats['total'] < DRIVER_POOL_SIZE
+            if can_create:
+                driver_pool_stats['total'] += 1
+        if can_create:
+            try:
+                entry = create_pooled_driver()
+            except Exception:
+                with driver_pool_lock:
+                    driver_pool_stats['total'] -= 1
+                raise
+        else:
+            wait_start = time.time()
+            try:
+                entry = driver_pool.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError("Hết thời gian chờ trình duyệt rảnh trong pool")
+            with driver_pool_lock:
+                driver_pool_stats['waits'] += 1
+                driver_pool_stats['wait_time'] += time.time() - wait_start
+
+    with driver_pool_lock:
+        driver_pool_stats['leases'] += 1
+        driver_pool_stats['in_use'] += 1
+    entry['uses'] += 1
+    return entry
+
+def release_chrome_driver(entry, broken=False):
+    """
+    Trả trình duyệt về pool, đóng và thay mới nếu bị lỗi, bị đóng do hủy hoặc đã dùng quá nhiều lần.
+
+    Args:
+        entry (dict): Thông tin trình duyệt đã mượn
+        broken (bool): True nếu trình duyệt gặp lỗi trong lúc dùng
+    """
+    with driver_pool_lock:
+        driver_pool_stats['in_use'] -= 1
+
+    if entry.get('aborted'):
+        # Trình duyệt bị đóng khi người dùng /cancel, không tính là lỗi
+        with driver_pool_lock:
+            driver_pool_stats['aborted'] += 1
+        quit_pooled_driver(entry)
+        return
+
+    if not broken and entry['uses'] < DRIVER_MAX_USES:
+        try:
+            reset_pooled_driver(entry['driver'])
+            driver_pool.put(entry)
+            return
+        except Exception as e:
+            logger.warning(f"Không thể làm sạch trình duyệt, sẽ thay mới: {e}")
+            broken = True
+
+    with driver_pool_lock:
+        if broken:
+            driver_pool_stats['crashed'] += 1
+        else:
+            driver_pool_stats['recycled'] += 1
+    quit_pooled_driver(entry)
+
+def abort_chrome_driver(entry):
+    """Đóng ngay trình duyệt đang dùng khi công việc bị hủy, trình duyệt được thay mới lúc trả về pool."""
+    bot_stats['browsers_aborted'] += 1
+    entry['aborted'] = True
+    try:
+        entry['driver'].quit()
+    except Exception as e:
+        logger.warning(f"Lỗi khi đóng trình duyệt của công việc bị hủy: {e}")
+
+def shutdown_driver_pool():
+    """Đóng toàn bộ trình duyệt đang rảnh trong pool."""
+    while True:
+        try:
+            entry = driver_pool.get_nowait()
+        except queue.Empty:
+            break
+        quit_pooled_driver(entry)
+
+# Giờ sinh gửi lên form tuvivietnam.vn (lấy giờ đầu của khoảng giờ)
+HOUR_MAPPING = {
+    "Tý": "00", "Sửu": "02", "Dần": "04", "Mão": "06",
+    "Thìn": "08", "Tỵ": "10", "Ngọ": "12", "Mùi": "14",
+    "Thân": "16", "Dậu": "18", "Tuất": "20", "Hợi": "22",
+    "Không rõ": "12"  # Mặc định là 12 giờ trưa nếu không rõ
+}
+
+# Session HTTP dùng chung (giữ kết nối keep-alive) cho backend http
+http_session = None
+http_session_lock = threading.Lock()
+
+def get_http_session():
+    """Trả về requests.Session dùng chung, tạo mới ở lần gọi đầu tiên."""
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=2)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update({
+                'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36',
+                'Accept-Language': 'vi-VN,vi;q=0.9'
+            })
+            http_session = session
+    return http_session
+
+def parse_tuvi_form(html_content, page_url):
+    """
+    Đọc form an sao trên trang lập lá số: địa chỉ gửi form, các trường trình duyệt sẽ gửi
+    với giá trị mặc định, và tên trường/giá trị ứng với id của từng ô (id mà bản selenium điền).
+
+    Args:
+        html_content (str): HTML trang có form an sao
+        page_url (str): Địa chỉ trang, dùng để tính địa chỉ gửi form
+
+    Returns:
+        dict: {'action': địa chỉ gửi form, 'fields': {tên: giá trị mặc định}, 'ids': {id: (tên, giá trị)}}
+    """
+    soup = BeautifulSoup(html_content, 'html.parser')
+    name_input = soup.find(id='txtHoTen')
+    form = name_input.find_parent('form') if name_input else None
+    if not form:
+        raise ValueError("Trang không có form an sao")
+
+    fields = {}
+    ids = {}
+    for element in form.find_all(['input', 'select', 'textarea']):
+        name = element.get('name')
+        if element.name == 'select':
+            options = element.find_all('option')
+            selected = next((option for option in options if option.has_attr('selected')), options[0] if options else None)
+            value = selected.get('value', selected.get_text()) if selected else ''
+        elif element.name == 'textarea':
+            value = element.get_text()
+        else:
+            value = element.get('value', '')
+        input_type = element.get('type', 'text').lower() if element.name == 'input' else ''
+        if input_type in ('radio', 'checkbox'):
+            value = element.get('value', 'on')
+
+        if element.get('id') and name:
+            ids[element['id']] = (name, value)
+        if not name or element.has_attr('disabled'):
+            continue
+        # Trình duyệt chỉ gửi ô chọn đang được đánh dấu và nút bấm để gửi form
+        if input_type in ('radio', 'checkbox') and not element.has_attr('checked'):
+            continue
+        if input_type in ('submit', 'button', 'image', 'reset', 'file'):
+            if input_type == 'submit' and element.get('value') == 'An sao Tử Vi':
+                fields[name] = value
+            continue
+        fields[name] = value
+
+    return {'action': urljoin(page_url, form.get('action') or page_url), 'fields': fields, 'ids': ids}
+
+def build_tuvi_form_data(day, month, year, birth_time, gender, form):
+    """
+    Tạo dữ liệu form an sao giống như khi điền bằng trình duyệt: các ô được chọn theo id
+    (như bản selenium), tên trường và giá trị lấy từ form thật.
+
+    Args:
+        form (dict): Form an sao đã đọc bằng parse_tuvi_form
+
+    Returns:
+        dict: Các trường form gửi lên trang lập lá số
+    """
+    form_data = dict(form['fields'])
+
+    def set_field(element_id, value=None):
+        if element_id not in form['ids']:
+            raise ValueError(f"Form an sao không có ô {element_id}")
+        name, default_value = form['ids'][element_id]
+        form_data[name] = default_value if value is None else value
+
+    set_field('txtHoTen', "Học Tử Vi Bot")
+    set_field('radNam' if gender == "Nam" else 'radNu')
+    set_field('duong_lich')
+    set_field('inam_duong', str(year))
+    set_field('ithang_duong', f"{month:02d}")
+    set_field('ingay_duong', f"{day:02d}")
+    set_field('gio_duong', HOUR_MAPPING.get(birth_time, "12"))
+    set_field('phut_duong', "00")
+    set_field('selNamXemD', str(datetime.now().year))
+    # Ảnh màu, lưu ảnh, không cảnh báo múi giờ, đồng ý điều khoản
+    set_field('radMau')
+    set_field('radluu')
+    set_field('canhbao_no')
+    set_field('iconfirm1')
+    return form_data
+
+def fetch_tuvi_chart_http(day, month, year, birth_time, gender, user_id, user_data):
+    """
+    Lấy lá số bằng cách đọc form an sao rồi gửi một request POST, không cần trình duyệt.
+
+    Args:
+        day, month, year (int): Ngày sinh dương lịch
+        birth_time (str): Giờ sinh theo địa chi
+        gender (str): Giới tính
+        user_id (int): ID của người dùng
+        user_data (dict): Thông tin người dùng
+
+    Returns:
+        str: Đường dẫn file ảnh lá số
+    """
+    session = get_http_session()
+    # Đọc form mới mỗi lần để có đúng tên trường và các giá trị ẩn (cookie, token) của trang
+    form_page = session.get(TUVI_FORM_URL, timeout=HTTP_TIMEOUT)
+    form_page.raise_for_status()
+    form_page.encoding = form_page.encoding or 'utf-8'
+    form = parse_tuvi_form(form_page.text, form_page.url)
+
+    response = session.post(
+        form['action'],
+        data=build_tuvi_form_data(day, month, year, birth_time, gender, form),
+        headers={'Referer': form_page.url},
+        timeout=HTTP_TIMEOUT
+    )
+    response.raise_for_status()
+    response.encoding = response.encoding or 'utf-8'
+
+    base64_data = find_base64_image(response.text)
+    if not base64_data:
+        raise ValueError("Trang kết quả không có ảnh lá số")
+
+    image_path = save_base64_chart_image(base64_data, user_id, user_data)
+    if not image_path:
+        raise ValueError("Không lưu được ảnh lá số từ trang kết quả")
+
+    logger.info(f"Đã lấy lá số qua HTTP cho user {user_id}: {image_path}")
+    return image_path
+
+def get_tuvi_chart(day, month, year, birth_time, gender, user_id, user_data):
+    """
+    Lấy lá số tử vi dựa trên thông tin ngày sinh.
+    Kiểm tra xem lá số đã tồn tại chưa, nếu có thì tái sử dụng.
+    Các yêu cầu cùng thông tin ngày sinh đến cùng lúc chỉ lập lá số một lần.
+    
+    Returns:
+        tuple: (đường dẫn ảnh/HTML lá số, có phải lá số tái sử dụng không). Đường dẫn là None
+        khi lá số cũ đã có file_id Telegram, ảnh sẽ được đọc từ cơ sở dữ liệu khi cần.
+    """
+    # Kiểm tra xem lá số đã tồn tại chưa
+    existing_chart = check_existing_chart(user_id, day, month, year, birth_time, gender)
+    if existing_chart:
+        chart_id, birth_hash, file_id = existing_chart
+        user_data['chart_id'] = chart_id
+        
+        # Ảnh đã có trên Telegram thì chưa cần đọc ảnh từ cơ sở dữ liệu
+        existing_chart_path = None if file_id else materialize_chart_image(chart_id)
+        if file_id or existing_chart_path:
+            logger.info(f"Tái sử dụng lá số đã tồn tại cho user {user_id}: chart_id {chart_id}")
+            # Cập nhật thống kê
+            bot_stats['charts_reused'] += 1
+            return existing_chart_path, True  # True để đánh dấu đây là lá số tái sử dụng
+    
+    # Tìm trong cache dùng chung, lá số có thể đã được lập cho người dùng khác
+    cache_key = make_chart_cache_key(day, month, year, birth_time, gender)
+    cached_chart_path = get_cached_chart(cache_key, user_id, user_data)
+    if cached_chart_path:
+        bot_stats['charts_reused'] += 1
+        return cached_chart_path, True
+    
+    # Nếu đang có yêu cầu khác lập cùng lá số thì chờ kết quả thay vì lập lại
+    while True:
+        flight, is_leader = join_chart_flight(cache_key)
+        if is_leader:
+            break
+
+        logger.info(f"Lá số {cache_key[:12]} đang được lập, user {user_id} chờ kết quả chung")
+        if not wait_chart_flight(flight):
+            # Yêu cầu đầu tiên chạy quá lâu: bỏ yêu cầu đó để các yêu cầu đang chờ chọn ra
+            # đúng một yêu cầu mới lập lại, thay vì tất cả cùng lập
+            logger.warning(f"Lập lá số {cache_key[:12]} quá {CHART_FLIGHT_TIMEOUT}s, chọn yêu cầu khác lập lại")
+            abandon_chart_flight(cache_key, flight)
+            continue
+
+        if 'result' not in flight:
+            # Yêu cầu đầu tiên bị hủy hoặc gặp lỗi bất ngờ, chọn một yêu cầu khác lập lại
+            logger.warning(f"Yêu cầu lập lá số {cache_key[:12]} trước đó không thành công: {flight.get('error')}")
+            continue
+
+        bot_stats['charts_coalesced'] += 1
+        cached_chart_path = get_cached_chart(cache_key, user_id, user_data)
+        if cached_chart_path:
+            bot_stats['charts_reused'] += 1
+            return cached_chart_path, True
+        # Lá số không vào được cache (ví dụ ảnh báo lỗi), dùng chung kết quả của yêu cầu đầu tiên
+        return flight['result']
+
+    try:
+        flight['result'] = generate_tuvi_chart(day, month, year, birth_time, gender, user_id, user_data, cache_key)
+        return flight['result']
+    except Exception as e:
+        flight['error'] = e
+        raise
+    finally:
+        finish_chart_flight(cache_key, flight)
+
+def join_chart_flight(cache_key):
+    """
+    Đăng ký một yêu cầu lập lá số, gom các yêu cầu trùng thông tin ngày sinh.
+
+    Args:
+        cache_key (str): Khóa cache của lá số
+
+    Returns:
+        tuple: (thông tin yêu cầu đang chạy, True nếu là yêu cầu đầu tiên cần tự lập lá số)
+    """
+    with inflight_charts_lock:
+        flight = inflight_charts.get(cache_key)
+        if flight:
+            flight['waiters'] += 1
+            return flight, False
+        flight = {'event': threading.Event(), 'waiters': 0, 'started_at': time.time()}
+        inflight_charts[cache_key] = flight
+        return flight, True
+
+def wait_chart_flight(flight):
+    """
+    Chờ yêu cầu đầu tiên lập xong lá số, vẫn dừng được khi người dùng /cancel.
+
+    Returns:
+        bool: True nếu đã có kết quả, False nếu quá CHART_FLIGHT_TIMEOUT giây
+    """
+    deadline = time.time() + CHART_FLIGHT_TIMEOUT
+    while not flight['event'].wait(JOB_CANCEL_POLL_INTERVAL):
+        check_task_cancelled()
+        if time.time() >= deadline:
+            return False
+    return True
+
+def abandon_chart_flight(cache_key, flight):
+    """Bỏ một yêu cầu lập lá số chạy quá lâu để lần join_chart_flight tiếp theo chọn yêu cầu mới."""
+    with inflight_charts_lock:
+        if inflight_charts.get(cache_key) is flight:
+            del inflight_charts[cache_key]
+
+def finish_chart_flight(cache_key, flight):
+    """
+    Đánh dấu yêu cầu lập lá số đã xong và đánh thức các yêu cầu đang chờ.
+    Kết quả ('result') hoặc lỗi ('error') được yêu cầu đầu tiên ghi vào flight trước khi gọi hàm này.
+    """
+    with inflight_charts_lock:
+        if inflight_charts.get(cache_key) is flight:
+            del inflight_charts[cache_key]
+    if flight['waiters']:
+        logger.info(f"Lá số {cache_key[:12]} đã lập xong, trả kết quả cho {flight['waiters']} yêu cầu đang chờ")
+    flight['event'].set()
+
+def generate_tuvi_chart(day, month, year, birth_time, gender, user_id, user_data, cache_key):
+    """
+    Lập lá số mới bằng bộ an sao native hoặc lấy từ web, lưu vào cache dùng chung.
+    """
+    try:
+        logger.info(f"Tạo lá số mới cho user {user_id} với thông tin: {day}/{month}/{year}, {birth_time}, {gender}")
+        
+        # Ưu tiên lập lá số bằng bộ an sao native, chỉ dùng trình duyệt khi có lỗi
+        if CHART_ENGINE == 'native':
+            try:
+                image_path = create_native_chart(day, month, year, birth_time, gender, user_id, user_data)
+                store_cached_chart(cache_key, image_path)
+                bot_stats['charts_created'] += 1
+                return image_path, False
+            except Exception as native_error:
+                logger.error(f"Lỗi khi lập lá số native, chuyển sang lấy từ web: {native_error}")
+        
+        # Thông báo đang xử lý
+        logger.info(f"Đang lấy lá số tử vi cho {day}/{month}/{year}, giờ {birth_time}, giới tính {gender}")
+        
+        # Lấy lá số bằng một request HTTP nếu được cấu hình, lỗi thì mới dùng trình duyệt
+        if CHART_SCRAPER == 'http':
+            try:
+                image_path = fetch_tuvi_chart_http(day, month, year, birth_time, gender, user_id, user_data)
+                store_cached_chart(cache_key, image_path)
+                bot_stats['charts_created'] += 1
+                return image_path, False
+            except Exception as http_error:
+                logger.error(f"Lỗi khi lấy lá số qua HTTP, chuyển sang trình duyệt: {http_error}")
+        
+        # Không có chromedriver thì báo lỗi ngay, không tải chromedriver trong lúc xử lý yêu cầu
+        resolve_chromedriver_path()
+        
+        # Chuyển đổi giờ sinh theo định dạng giờ
+        hour = HOUR_MAPPING.get(birth_time, "12")
+        
+        # Gửi thông báo tiến trình
+        processing_msg = bot.send_message(
+            user_id, 
+            "⏳ *Đang lập lá số tử vi...*\n\nĐang khởi tạo trình duyệt...",
+            parse_mode='Markdown'
+        )
+        
+        # Mượn trình duyệt đã khởi động sẵn từ pool
+        driver_entry = acquire_chrome_driver()
+        driver = driver_entry['driver']
+        # /cancel đóng trình duyệt ngay, các lệnh selenium sau đó lỗi và job kết thúc
+        remove_cleanup = add_task_cleanup(lambda: abort_chrome_driver(driver_entry))
+        check_task_cancelled()
+        
+        # Cập nhật tiến trình
+        send_progress_update(user_id, processing_msg.message_id, "Đang truy cập trang web lập lá số...", 10)
+        
+        # Truy cập trang web
+        driver.get("https://tuvivietnam.vn/lasotuvi/")
+        
+        # Đợi trang web tải xong
+        WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located((By.ID, "txtHoTen"))
+        )
+        
+        # Cập nhật tiến trình
+        send_progress_update(user_id, processing_msg.message_id, "Đang điền thông tin vào form...", 30)
+        
+        # Điền thông tin vào form
+        # Họ tên
+        name_input = driver.find_element(By.ID, "txtHoTen")
+        name_input.send_keys("Học Tử Vi Bot")
+        
         # Chọn giới tính
         if gender == "Nam":
             driver.find_element(By.ID, "radNam").click()
         else:
-            driver.find_element(By.ID, "radNu").click()
+            driver.find_element(By.ID, "radNu").click()
+        
+        # Chọn loại lịch (mặc định là dương lịch)
+        driver.find_element(By.ID, "duong_lich").click()
+        
+        # Chọn năm sinh
+        year_select = Select(driver.find_element(By.ID, "inam_duong"))
+        year_select.select_by_value(str(year))
+        
+        # Chọn tháng sinh
+        month_select = Select(driver.find_element(By.ID, "ithang_duong"))
+        month_select.select_by_value(f"{month:02d}")
+        
+        # Chọn ngày sinh
+        day_select = Select(driver.find_element(By.ID, "ingay_duong"))
+        day_select.select_by_value(f"{day:02d}")
+        
+        # Chọn giờ sinh
+        hour_select = Select(driver.find_element(By.ID, "gio_duong"))
+        hour_select.select_by_value(hour)
+        
+        # Chọn phút sinh (mặc định 0)
+        minute_select = Select(driver.find_element(By.ID, "phut_duong"))
+        minute_select.select_by_value("00")
+        
+        # Chọn năm xem hạn (mặc định năm hiện tại)
+        current_year = datetime.now().year
+        year_xem_select = Select(driver.find_element(By.ID, "selNamXemD"))
+        year_xem_select.select_by_value(str(current_year))
+        
+        # Chọn kiểu ảnh màu
+        driver.find_element(By.ID, "radMau").click()
+        
+        # Chọn thời gian lưu ảnh (30 ngày)
+        driver.find_element(By.ID, "radluu").click()
+        
+        # Không cảnh báo múi giờ
+        driver.find_element(By.ID, "canhbao_no").click()
+        
+        # Đảm bảo đánh dấu vào ô đồng ý
+        confirm_checkbox = driver.find_element(By.ID, "iconfirm1")
+        if not confirm_checkbox.is_selected():
+            confirm_checkbox.click()
+        
+        # Cập nhật tiến trình
+        send_progress_update(user_id, processing_msg.message_id, "Đang gửi thông tin và chờ kết quả...", 50)
+        
+        # Lưu số cửa sổ/tab hiện tại
+        current_window_count = len(driver.window_handles)
+        
+        # Submit form
+        submit_button = driver.find_element(By.XPATH, "//input[@value='An sao Tử Vi']")
+        submit_button.click()
+        
+        # Đợi tab mới mở ra
+        WebDriverWait(driver, 20).until(
+            lambda d: len(d.window_handles) > current_window_count
+        )
+        
+        # Chuyển sang tab mới
+        driver.switch_to.window(driver.window_handles[-1])
+        
+        # Cập nhật tiến trình
+        send_progress_update(user_id, processing_msg.message_id, "Đang tải trang kết quả...", 70)
+        
+        # Đợi trang tải xong
+        WebDriverWait(driver, 20).until(
+            EC.presence_of_element_located((By.TAG_NAME, "body"))
+        )
+        
+        # Cập nhật tiến trình
+        send_progress_update(user_id, processing_msg.message_id, "Đang lưu kết quả...", 80)
+        
+        # Lưu HTML của trang kết quả
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        html_path = f"assets/{user_id}_chart_{timestamp}.html"
+        
+        # Tạo thư mục assets nếu chưa tồn tại
+        if not os.path.exists('assets'):
+            os.makedirs('assets')
+        
+        with open(html_path, "w", encoding="utf-8") as f:
+            f.write(driver.page_source)
+        
+        logger.info(f"Đã lưu HTML lá số tử vi: {html_path}")
+        
+        # Cập nhật tiến trình
+        send_progress_update(user_id, processing_msg.message_id, "Đang trích xuất ảnh từ kết quả...", 90)
+        
+        # Tìm và trích xuất ảnh base64 từ HTML
+        image_path = extract_base64_image_from_html(html_path, timestamp, user_id, user_data)
+        if image_path:
+            logger.info(f"Đã trích xuất ảnh lá số tử vi: {image_path}")
+            store_cached_chart(cache_key, image_path)
+        
+        # Trả trình duyệt về pool
+        remove_cleanup()
+        release_chrome_driver(driver_entry)
+        
+        # Cập nhật tiến trình
+        send_progress_update(user_id, processing_msg.message_id, "Hoàn tất! Đang hiển thị kết quả...", 100)
+        
+        # Xóa tin nhắn tiến trình
+        try:
+            bot.delete_message(user_id, processing_msg.message_id)
+        except Exception as e:
+            logger.warning(f"Không thể xóa tin nhắn tiến trình: {e}")
+        
+        # Cập nhật thống kê
+        bot_stats['charts_created'] += 1
+        
+        # Trả về đường dẫn ảnh nếu đã trích xuất được, nếu không thì trả về đường dẫn HTML
+        return (image_path if image_path else html_path), False  # False để đánh dấu đây là lá số mới tạo
+        
+    except Exception as e:
+        # Lỗi do trình duyệt bị đóng khi người dùng hủy không tính là lỗi
+        cancelled = isinstance(e, ChatTaskCancelled) or is_task_cancelled()
+        if 'remove_cleanup' in locals():
+            remove_cleanup()
+        
+        if not cancelled:
+            logger.error(f"Lỗi khi lấy lá số tử vi: {e}")
+            
+            # Cập nhật thống kê lỗi
+            bot_stats['errors'] += 1
+            
+            # Nếu đã mượn trình duyệt, chụp màn hình lỗi
+            try:
+                if 'driver_entry' in locals():
+                    error_screenshot = store_asset(driver.get_screenshot_as_png(), 'png')
+                    logger.info(f"Đã chụp màn hình lỗi: {error_screenshot}")
+            except:
+                pass
+        # Thay trình duyệt mới cho pool
+        if 'driver_entry' in locals():
+            release_chrome_driver(driver_entry, broken=True)
+        
+        # Xóa tin nhắn tiến trình nếu có
+        try:
+            if 'processing_msg' in locals():
+                bot.delete_message(user_id, processing_msg.message_id)
+        except:
+            pass
+        
+        if cancelled:
+            raise ChatTaskCancelled() from e
+        
+        # Tạo ảnh trống với thông tin lỗi
+        img = Image.new('RGB', (800, 600), color=(255, 255, 255))
+        d = ImageDraw.Draw(img)
+        d.text((10, 10), f"Lá số tử vi cho người sinh ngày {day}/{month}/{year}, giờ {birth_time}, giới tính {gender}", fill=(0, 0, 0))
+        d.text((10, 50), f"Có lỗi xảy ra khi lấy lá số tử vi: {str(e)}", fill=(0, 0, 0))
+        d.text((10, 90), "Vui lòng thử lại sau.", fill=(0, 0, 0))
+        buffer = BytesIO()
+        img.save(buffer, 'JPEG')
+        image_path = store_asset(buffer.getvalue(), 'jpg')
+        
+        return image_path, False
+
+def get_provider_latency(provider, kind, percentile):
+    """
+    Tính độ trễ theo phân vị từ các lần gọi thành công gần đây của nhà cung cấp.
+
+    Args:
+        provider (dict): Nhà cung cấp trong llm_providers
+        kind (str): 'full' (chờ toàn bộ phản hồi) hoặc 'stream' (chờ phần đầu tiên)
+        percentile (float): Phân vị cần tính, ví dụ 0.95
+
+    Returns:
+        float: Độ trễ (giây), hoặc None nếu chưa đủ dữ liệu
+    """
+    with llm_providers_lock:
+        samples = sorted(provider['latencies'][kind])
+    if len(samples) < LLM_MIN_SAMPLES:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * percentile))]
+
+def get_provider_order(kind):
+    """
+    Sắp xếp các nhà cung cấp đang hoạt động tốt, nhanh nhất (theo độ trễ trung vị) lên đầu.
+    Nhà cung cấp chưa đủ dữ liệu giữ thứ tự cấu hình và xếp sau các nhà cung cấp đã đo được.
+
+    Returns:
+        list: Các nhà cung cấp có thể gọi
+    """
+    now = time.time()
+    healthy = [provider for provider in llm_providers
+               if provider['api_key'] and provider['disabled_until'] <= now]
+    if not healthy:
+        # Tất cả đang bị tạm ngưng thì vẫn thử, ưu tiên nhà cung cấp sắp hết thời gian ngưng
+        healthy = sorted((provider for provider in llm_providers if provider['api_key']),
+                         key=lambda provider: provider['disabled_until'])
+    median = {provider['name']: get_provider_latency(provider, kind, 0.5) for provider in healthy}
+    return sorted(healthy, key=lambda provider: (median[provider['name']] is None, median[provider['name']] or 0))
+
+def record_provider_result(provider, kind, latency=None, error=None):
+    """Ghi nhận kết quả một lần gọi để cập nhật độ trễ và tình trạng của nhà cung cấp."""
+    with llm_providers_lock:
+        provider['requests'] += 1
+        if error is None:
+            provider['latencies'][kind].append(latency)
+            provider['consecutive_errors'] = 0
+            return
+        provider['errors'] += 1
+        provider['consecutive_errors'] += 1
+        if provider['consecutive_errors'] >= LLM_PROVIDER_MAX_ERRORS:
+            provider['disabled_until'] = time.time() + LLM_PROVIDER_COOLDOWN
+            provider['consecutive_errors'] = 0
+            logger.warning(f"Tạm ngưng nhà cung cấp AI {provider['name']} trong {LLM_PROVIDER_COOLDOWN}s do lỗi liên tiếp")
+
+def call_provider(provider, request, cancelled):
+    """
+    Gọi một nhà cung cấp AI và ghi nhận độ trễ.
+    Nếu yêu cầu đã bị hủy (nhà cung cấp khác trả lời trước) thì đóng luồng stream ngay.
+
+    Args:
+        provider (dict): Nhà cung cấp trong llm_providers
+        request (dict): Tham số của ChatCompletion.create (không gồm model/api_key/api_base)
+        cancelled (threading.Event): Được bật khi kết quả không còn cần nữa
+
+    Returns:
+        Kết quả của ChatCompletion.create
+    """
+    kind = 'stream' if request.get('stream') else 'full'
+    start_time = time.time()
+    try:
+        response = openai.ChatCompletion.create(
+            model=provider['model'],
+            api_key=provider['api_key'],
+            api_base=provider['api_base'],
+            request_timeout=LLM_REQUEST_TIMEOUT,
+            **request
+        )
+    except Exception as e:
+        record_provider_result(provider, kind, error=e)
+        raise
+
+    record_provider_result(provider, kind, latency=time.time() - start_time)
+    if cancelled.is_set() and kind == 'stream':
+        # Bên thua: đóng luồng để ngắt kết nối, không đọc tiếp
+        response.close()
+    return response
+
+def discard_llm_request(future, cancelled, kind):
+    """
+    Bỏ một yêu cầu AI không được chọn: hủy nếu chưa chạy, còn nếu đã có (hoặc sắp có)
+    kết quả stream thì đóng luồng, kể cả khi nó về cùng lúc với bên thắng.
+
+    Args:
+        future (Future): Yêu cầu trong llm_executor
+        cancelled (threading.Event): Cờ hủy của yêu cầu
+        kind (str): 'stream' hoặc 'full'
+    """
+    cancelled.set()
+    if future.cancel() or kind != 'stream':
+        return
+
+    def close_stream(done_future):
+        if done_future.exception() is None:
+            done_future.result().close()
+
+    # Chạy ngay nếu yêu cầu đã xong, hoặc khi nó xong sau này
+    future.add_done_callback(close_stream)
+
+def call_llm(**request):
+    """
+    Gọi AI qua bộ định tuyến nhiều nhà cung cấp (AIRouter, OpenAI, YesCale).
+
+    Yêu cầu được gửi đến nhà cung cấp nhanh nhất đang hoạt động tốt. Nếu quá mốc p95
+    độ trễ của nhà cung cấp đó mà chưa có kết quả, gửi thêm một yêu cầu dự phòng đến
+    nhà cung cấp tiếp theo và dùng kết quả về trước, bên còn lại bị hủy. Khi một nhà
+    cung cấp lỗi, yêu cầu được chuyển ngay sang nhà cung cấp kế tiếp.
+
+    Nếu công việc của luồng hiện tại bị hủy trong lúc chờ, các yêu cầu đang chạy bị bỏ
+    và ChatTaskCancelled được ném ra ngay.
+
+    Args:
+        **request: Tham số của ChatCompletion.create (messages, temperature, max_tokens, stream...)
+
+    Returns:
+        tuple: (kết quả của ChatCompletion.create, nhà cung cấp đã trả lời trước)
+    """
+    kind = 'stream' if request.get('stream') else 'full'
+    task = get_current_task()
+    order = get_provider_order(kind)
+    if not order:
+        raise RuntimeError("Chưa cấu hình API key cho nhà cung cấp AI nào")
+
+    pending = {}
+    next_index = 0
+    hedges = 0
+    last_error = None
+
+    def launch():
+        nonlocal next_index
+        provider = order[next_index]
+        next_index += 1
+        cancelled = threading.Event()
+        future = llm_executor.submit(call_provider, provider, request, cancelled)
+        pending[future] = (provider, cancelled)
+        return provider
+
+    provider = launch()
+    launched_at = time.time()
+    while pending:
+        # Mốc gửi yêu cầu dự phòng: p95 độ trễ của nhà cung cấp vừa gọi
+        hedge_delay = None
+        timeout = None
+        if hedges < LLM_MAX_HEDGES and next_index < len(order):
+            hedge_delay = max(LLM_HEDGE_MIN_DELAY, get_provider_latency(provider, kind, 0.95) or LLM_HEDGE_DEFAULT_DELAY)
+            timeout = max(0, launched_at + hedge_delay - time.time())
+        if task:
+            # Chờ từng đoạn ngắn để dừng ngay khi người dùng hủy
+            timeout = JOB_CANCEL_POLL_INTERVAL if timeout is None else min(timeout, JOB_CANCEL_POLL_INTERVAL)
+
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if task and task['cancelled'].is_set():
+            for other_future, (_, cancelled) in pending.items():
+                discard_llm_request(other_future, cancelled, kind)
+            bot_stats['llm_calls_cancelled'] += 1
+            raise ChatTaskCancelled()
+        if not done:
+            if hedge_delay is None or time.time() < launched_at + hedge_delay:
+                continue
+            hedges += 1
+            bot_stats['llm_hedges'] += 1
+            provider = launch()
+            launched_at = time.time()
+            logger.info(f"Quá {hedge_delay:.1f}s chưa có phản hồi, gửi thêm yêu cầu dự phòng đến {provider['name']}")
+            continue
+
+        for future in done:
+            winner, _ = pending.pop(future)
+            try:
+                response = future.result()
+            except Exception as e:
+                last_error = e
+                logger.warning(f"Nhà cung cấp AI {winner['name']} lỗi: {e}")
+                continue
+
+            # Bỏ các yêu cầu còn lại, gồm cả các yêu cầu cùng về trong done
+            for other_future, (_, cancelled) in pending.items():
+                discard_llm_request(other_future, cancelled, kind)
+            if hedges and winner is not order[0]:
+                bot_stats['llm_hedge_wins'] += 1
+            return response, winner
+
+        # Tất cả yêu cầu đang chạy đều lỗi thì chuyển sang nhà cung cấp tiếp theo
+        if not pending and next_index < len(order):
+            provider = launch()
+            launched_at = time.time()
+
+    raise last_error
+
+# Prompt hệ thống dùng để phân tích lá số. Phiên bản prompt là mã băm của nội dung,
+# nên khi sửa prompt thì các phân tích đã cache tự động không còn được dùng
+ANALYSIS_SYSTEM_PROMPT = """Bạn là người bạn thân thiện, hiểu biết về tử vi Việt Nam. 
+Hãy xem và phân tích lá số tử vi trong hình ảnh một cách đơn giản, dễ hiểu và gần gũi.
+
+Phân tích lá số tử vi theo các cung sau:
+1. Tổng quan: Nhận xét chung về cuộc đời người này
+2. Cung Mệnh: Tính cách, đặc điểm bản thân, vận mệnh chung
+3. Cung Phúc Đức: May mắn, phúc báo, hậu vận
+4. Cung Tài Bạch: Tiền bạc, tài lộc, cách kiếm tiền
+5. Cung Quan Lộc: Sự nghiệp, công danh, địa vị xã hội
+6. Cung Phu Thê: Hôn nhân, người phối ngẫu
+7. Cung Tử Tức: Con cái, mối quan hệ với con
+8. Cung Huynh Đệ: Anh chị em, bạn bè, đồng nghiệp
+9. Cung Điền Trạch: Nhà cửa, bất động sản
+10. Cung Thiên Di: Du lịch, xa quê, cơ hội ở nơi xa
+11. Cung Nô Bộc: Cấp dưới, người giúp việc, đối tác
+12. Cung Tật Ách: Sức khỏe, bệnh tật, tai ương
+
+Hãy trả lời theo định dạng JSON với cấu trúc sau:
+{
+  "tong_quan": "Phân tích tổng quan về lá số",
+  "cung_menh": "Phân tích về cung Mệnh",
+  "cung_phuc_duc": "Phân tích về cung Phúc Đức",
+  "cung_tai_bach": "Phân tích về cung Tài Bạch",
+  "cung_quan_loc": "Phân tích về cung Quan Lộc",
+  "cung_phu_the": "Phân tích về cung Phu Thê",
+  "cung_tu_tuc": "Phân tích về cung Tử Tức",
+  "cung_huynh_de": "Phân tích về cung Huynh Đệ",
+  "cung_dien_trach": "Phân tích về cung Điền Trạch",
+  "cung_thien_di": "Phân tích về cung Thiên Di",
+  "cung_no_boc": "Phân tích về cung Nô Bộc",
+  "cung_tat_ach": "Phân tích về cung Tật Ách"
+}
+
+Mỗi phần phân tích nên ngắn gọn, dễ hiểu, thân thiện và có ít nhất một emoji phù hợp.
+Đừng sử dụng ngôn ngữ quá chuyên môn. Hãy nói chuyện như một người bạn đang chia sẻ.
+Hãy viết bằng tiếng Việt, giọng điệu thân thiện, đơn giản và dễ hiểu."""
+ANALYSIS_PROMPT_VERSION = hashlib.sha256(ANALYSIS_SYSTEM_PROMPT.encode('utf-8')).hexdigest()[:16]
+
+# Prompt cho chế độ 'lazy': lần đầu chỉ lấy tổng quan và tóm tắt lá số, từng cung được hỏi riêng sau
+OVERVIEW_SYSTEM_PROMPT = """Bạn là người bạn thân thiện, hiểu biết về tử vi Việt Nam. 
+Hãy xem lá số tử vi trong hình ảnh và nhận xét chung về cuộc đời người này một cách đơn giản, dễ hiểu và gần gũi.
+
+Hãy trả lời theo định dạng JSON với cấu trúc sau:
+{
+  "tong_quan": "Phân tích tổng quan về lá số",
+  "tom_tat": "Tóm tắt lá số: mỗi cung một dòng, ghi tên cung và các sao trong cung"
+}
+
+Phần tổng quan nên ngắn gọn, thân thiện và có ít nhất một emoji phù hợp.
+Phần tóm tắt chỉ liệt kê, không luận giải, để dùng cho việc xem từng cung sau này.
+Đừng sử dụng ngôn ngữ quá chuyên môn. Hãy viết bằng tiếng Việt."""
+OVERVIEW_PROMPT_VERSION = hashlib.sha256(OVERVIEW_SYSTEM_PROMPT.encode('utf-8')).hexdigest()[:16]
+
+CUNG_SYSTEM_PROMPT = """Bạn là người bạn thân thiện, hiểu biết về tử vi Việt Nam.
+Dựa vào tóm tắt lá số được cung cấp, hãy phân tích riêng một cung theo yêu cầu.
+
+Ý nghĩa các cung:
+- Cung Mệnh: Tính cách, đặc điểm bản thân, vận mệnh chung
+- Cung Phúc Đức: May mắn, phúc báo, hậu vận
+- Cung Tài Bạch: Tiền bạc, tài lộc, cách kiếm tiền
+- Cung Quan Lộc: Sự nghiệp, công danh, địa vị xã hội
+- Cung Phu Thê: Hôn nhân, người phối ngẫu
+- Cung Tử Tức: Con cái, mối quan hệ với con
+- Cung Huynh Đệ: Anh chị em, bạn bè, đồng nghiệp
+- Cung Điền Trạch: Nhà cửa, bất động sản
+- Cung Thiên Di: Du lịch, xa quê, cơ hội ở nơi xa
+- Cung Nô Bộc: Cấp dưới, người giúp việc, đối tác
+- Cung Tật Ách: Sức khỏe, bệnh tật, tai ương
+
+Chỉ trả lời phần phân tích của cung đó (không dùng JSON), ngắn gọn, dễ hiểu, thân thiện và có ít nhất một emoji phù hợp.
+Đừng sử dụng ngôn ngữ quá chuyên môn. Hãy nói chuyện như một người bạn đang chia sẻ, bằng tiếng Việt."""
+
+# Tên hiển thị của các cung theo khóa trong kết quả phân tích
+ANALYSIS_CUNG_NAMES = {
+    "cung_menh": "Cung Mệnh",
+    "cung_phuc_duc": "Cung Phúc Đức",
+    "cung_tai_bach": "Cung Tài Bạch",
+    "cung_quan_loc": "Cung Quan Lộc",
+    "cung_phu_the": "Cung Phu Thê",
+    "cung_tu_tuc": "Cung Tử Tức",
+    "cung_huynh_de": "Cung Huynh Đệ",
+    "cung_dien_trach": "Cung Điền Trạch",
+    "cung_thien_di": "Cung Thiên Di",
+    "cung_no_boc": "Cung Nô Bộc",
+    "cung_tat_ach": "Cung Tật Ách"
+}
+
+# Thêm vào prompt hệ thống khi gửi dữ liệu lá số dạng JSON thay cho hình ảnh
+CHART_JSON_NOTE = """Lá số được gửi dưới dạng JSON thay cho hình ảnh: 'thong_tin' là thông tin chung,
+'cung' gồm 12 cung, mỗi cung có can chi, đại vận, vòng Tràng Sinh và các sao kèm đắc tính
+(M: Miếu, V: Vượng, Đ: Đắc, B: Bình, H: Hãm), sao có tiền tố 'L.' là sao lưu niên."""
+
+def get_cung_prompt_version(cung_key):
+    """Phiên bản prompt của một cung: đổi khi prompt từng cung thay đổi."""
+    return hashlib.sha256(f"{CUNG_SYSTEM_PROMPT}|{cung_key}".encode('utf-8')).hexdigest()[:16]
+
+def get_llm_model_key(provider):
+    """Khóa model của nhà cung cấp AI trong cache phân tích, ví dụ 'OpenAI/gpt-4o-mini'."""
+    return f"{provider['name']}/{provider['model']}"
+
+def get_analysis_cache_models():
+    """
+    Khóa model của các nhà cung cấp AI đang được cấu hình. Phân tích do nhà cung cấp hoặc model
+    không còn trong cấu hình sinh ra sẽ không được dùng lại.
+    """
+    return [get_llm_model_key(provider) for provider in llm_providers if provider['api_key']]
+
+def make_analysis_cache_key(image_hash, prompt_version, model):
+    """Tạo khóa cache phân tích từ mã băm ảnh lá số, phiên bản prompt và khóa model (get_llm_model_key)."""
+    return (image_hash, prompt_version, model)
+
+def find_analysis_cache_memory(image_hash, prompt_version):
+    """Tìm phân tích trong cache bộ nhớ do một trong các nhà cung cấp đang cấu hình sinh ra."""
+    with analysis_cache_lock:
+        for model in get_analysis_cache_models():
+            cache_key = make_analysis_cache_key(image_hash, prompt_version, model)
+            if cache_key in analysis_cache:
+                analysis_cache.move_to_end(cache_key)
+                return dict(analysis_cache[cache_key])
+    return None
+
+def load_analysis_cache_entry(image_hash, prompt_version=ANALYSIS_PROMPT_VERSION):
+    """
+    Tìm phân tích đã lưu của lá số, ưu tiên bộ nhớ rồi mới đến cơ sở dữ liệu.
+
+    Args:
+        image_hash (str): Mã SHA-256 của ảnh lá số
+        prompt_version (str): Phiên bản prompt đã dùng để phân tích
+
+    Returns:
+        dict: Kết quả phân tích theo từng cung, hoặc None nếu chưa có
+    """
+    cached_analysis = find_analysis_cache_memory(image_hash, prompt_version)
+    if cached_analysis:
+        return cached_analysis
+
+    conn = get_db_connection()
+    if not conn:
+        return None
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT model, analysis FROM analyses
+            WHERE image_hash = %s AND prompt_version = %s AND model = ANY(%s)
+            ORDER BY created_at DESC
+            LIMIT 1
+        """, (image_hash, prompt_version, get_analysis_cache_models()))
+        result = cursor.fetchone()
+        cursor.close()
+    except Exception as e:
+        logger.error(f"Lỗi khi đọc cache phân tích: {e}")
+        return None
+    finally:
+        release_db_connection(conn)
+
+    if not result:
+        return None
+
+    model, analysis = result
+    analysis_dict = analysis if isinstance(analysis, dict) else json.loads(analysis)
+    put_analysis_cache_memory(make_analysis_cache_key(image_hash, prompt_version, model), analysis_dict)
+    return dict(analysis_dict)
+
+def put_analysis_cache_memory(cache_key, analysis_dict):
+    """Đưa phân tích vào cache bộ nhớ, bỏ bớt phân tích ít dùng nhất khi đầy."""
+    with analysis_cache_lock:
+        analysis_cache[cache_key] = analysis_dict
+        analysis_cache.move_to_end(cache_key)
+        while len(analysis_cache) > ANALYSIS_CACHE_SIZE:
+            analysis_cache.popitem(last=False)
+
+def store_analysis_cache_entry(image_hash, analysis_dict, prompt_version, model):
+    """
+    Lưu phân tích của lá số vào cache bộ nhớ và bảng analyses.
+
+    Args:
+        image_hash (str): Mã SHA-256 của ảnh lá số
+        analysis_dict (dict): Kết quả phân tích theo từng cung
+        prompt_version (str): Phiên bản prompt đã dùng để phân tích
+        model (str): Khóa model của nhà cung cấp đã trả lời (get_llm_model_key)
+    """
+    cache_key = make_analysis_cache_key(image_hash, prompt_version, model)
+    put_analysis_cache_memory(cache_key, dict(analysis_dict))
+
+    conn = get_db_connection()
+    if not conn:
+        return
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO analyses (image_hash, prompt_version, model, analysis)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (image_hash, prompt_version, model) DO UPDATE
+            SET analysis = EXCLUDED.analysis, created_at = CURRENT_TIMESTAMP
+        """, cache_key + (json.dumps(analysis_dict, ensure_ascii=False),))
+        cursor.close()
+    except Exception as e:
+        logger.error(f"Lỗi khi lưu cache phân tích: {e}")
+    finally:
+        release_db_connection(conn)
+
+# Một trường chuỗi đã đóng trong JSON phân tích: "khóa": "nội dung"
+ANALYSIS_FIELD_PATTERN = re.compile(r'"(\w+)"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+def parse_partial_analysis(analysis_text):
+    """
+    Đọc các trường đã viết xong trong JSON phân tích đang được stream về.
+
+    Args:
+        analysis_text (str): Phần phản hồi đã nhận được
+
+    Returns:
+        dict: Các cung đã có đủ nội dung (trường chưa đóng ngoặc kép sẽ bị bỏ qua)
+    """
+    partial = {}
+    for key, value in ANALYSIS_FIELD_PATTERN.findall(analysis_text):
+        try:
+            partial[key] = json.loads(f'"{value}"')
+        except json.JSONDecodeError:
+            continue
+    return partial
+
+def stream_analysis_completion(messages, on_progress, max_tokens=3000):
+    """
+    Gọi AI ở chế độ stream và báo lại mỗi khi có thêm cung phân tích xong.
+
+    Args:
+        messages (list): Các tin nhắn gửi cho AI
+        on_progress (callable): Hàm nhận dict các cung đã phân tích xong
+        max_tokens (int): Số token tối đa của phản hồi
+
+    Returns:
+        tuple: (toàn bộ nội dung phản hồi, tên model, nhà cung cấp đã trả lời)
+    """
+    response, provider = call_llm(
+        messages=messages,
+        temperature=0.7,
+        max_tokens=max_tokens,
+        stream=True
+    )
+
+    chunks = []
+    model = None
+    completed_keys = set()
+    task = get_current_task()
+    for chunk in response:
+        if task and task['cancelled'].is_set():
+            # Đóng luồng stream để nhà cung cấp dừng sinh tiếp
+            response.close()
+            bot_stats['llm_calls_cancelled'] += 1
+            bot_stats['llm_tokens_saved'] += max(0, max_tokens - len(chunks))
+            raise ChatTaskCancelled()
+        model = model or chunk.get('model')
+        if not chunk.choices:
+            continue
+        content = chunk.choices[0].delta.get('content')
+        if not content:
+            continue
+        chunks.append(content)
+
+        # Chỉ parse lại khi vừa có dấu ngoặc kép, tức là có thể một trường vừa đóng
+        if '"' not in content:
+            continue
+        partial = parse_partial_analysis(''.join(chunks))
+        if set(partial) - completed_keys:
+            completed_keys = set(partial)
+            try:
+                on_progress(partial)
+            except Exception as e:
+                logger.warning(f"Lỗi khi cập nhật phân tích đang stream: {e}")
+
+    return ''.join(chunks), model, provider
+
+def create_cung_markup(analysis_dict=None):
+    """
+    Tạo menu các cung để xem chi tiết.
+
+    Args:
+        analysis_dict (dict, optional): Nếu có, chỉ hiện các cung đã phân tích xong
+
+    Returns:
+        InlineKeyboardMarkup: Menu các cung
+    """
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    cung_buttons = [
+        ("👤 Cung Mệnh", "menh"),
+        ("🙏 Cung Phúc Đức", "phuc_duc"),
+        ("💰 Cung Tài Bạch", "tai_bach"),
+        ("💼 Cung Quan Lộc", "quan_loc"),
+        ("💑 Cung Phu Thê", "phu_the"),
+        ("👶 Cung Tử Tức", "tu_tuc"),
+        ("👥 Cung Huynh Đệ", "huynh_de"),
+        ("🏠 Cung Điền Trạch", "dien_trach"),
+        ("✈️ Cung Thiên Di", "thien_di"),
+        ("👨‍👩‍👧‍👦 Cung Nô Bộc", "no_boc"),
+        ("🏥 Cung Tật Ách", "tat_ach")
+    ]
+    for button_text, callback_data in cung_buttons:
+        if analysis_dict is None or f"cung_{callback_data}" in analysis_dict:
+            markup.add(types.InlineKeyboardButton(button_text, callback_data=f"cung_{callback_data}"))
+    return markup
+
+def check_cung_selection(chat_id, cung_type):
+    """
+    Kiểm tra yêu cầu xem một cung. Nếu cung chưa được phân tích (chế độ 'lazy'), đánh dấu cung
+    đang được phân tích để bỏ qua khi người dùng bấm nhiều lần; gọi release_cung_request khi xong.
+
+    Args:
+        chat_id (int): ID cuộc trò chuyện
+        cung_type (str): callback_data của cung, ví dụ 'cung_menh'
+
+    Returns:
+        tuple: (trạng thái hội thoại, thông báo trả lời nếu không xem được, True nếu cần phân tích cung ngay)
+    """
+    user_data = get_session(chat_id)
+    if not isinstance(user_data, dict) or 'analysis' not in user_data:
+        return user_data, CUNG_NOT_FOUND_MESSAGE, False
+
+    # Cung đã phân tích xong thì xem được ngay, kể cả khi các cung khác vẫn đang stream về
+    analysis_dict = user_data['analysis']
+    if 'analysis_complete' not in user_data and cung_type not in analysis_dict:
+        return user_data, CUNG_PENDING_MESSAGE, False
+    if cung_type in analysis_dict or 'tom_tat' not in analysis_dict:
+        return user_data, None, False
+
+    with cung_requests_lock:
+        if (chat_id, cung_type) in cung_requests_in_progress:
+            return user_data, CUNG_PENDING_MESSAGE, False
+        cung_requests_in_progress.add((chat_id, cung_type))
+    return user_data, None, True
+
+def release_cung_request(chat_id, cung_type):
+    """Bỏ đánh dấu cung đang được phân tích."""
+    with cung_requests_lock:
+        cung_requests_in_progress.discard((chat_id, cung_type))
+
+def store_cung_analysis(chat_id, user_data, cung_type, cung_analysis):
+    """
+    Ghi phân tích cung vừa xong vào phiên nếu phiên còn hiệu lực.
+
+    Returns:
+        bool: False nếu người dùng đã hủy hoặc bắt đầu lại
+    """
+    with get_chat_lock(chat_id):
+        if not resume_session(chat_id, user_data):
+            logger.info(f"Không gửi phân tích {cung_type} cho chat {chat_id} vì người dùng đã hủy hoặc bắt đầu lại")
+            return False
+        user_data['analysis'][cung_type] = cung_analysis
+        return True
+
+def analysis_needs_image(user_data):
+    """
+    Kiểm tra phân tích có cần file ảnh lá số không: chỉ khi ANALYSIS_INPUT='image', hoặc khi
+    không lấy được dữ liệu sao để gửi dạng JSON.
+    """
+    return ANALYSIS_INPUT != 'text' or not get_chart_stars(user_data)
+
+def build_analysis_request(chart_path, user_data):
+    """
+    Chuẩn bị nội dung gửi cho AI để phân tích lá số (dùng chung cho chế độ luồng và asyncio).
+
+    Args:
+        chart_path (str): Đường dẫn đến file lá số (hình ảnh), không cần khi phân tích bằng JSON
+        user_data (dict): Thông tin người dùng
+
+    Returns:
+        dict: Gồm 'messages', 'image_hash', 'prompt_version', 'max_tokens', hoặc 'error' nếu không có lá số
+    """
+    # Chế độ 'text' gửi dữ liệu sao dạng JSON, nhỏ và nhanh hơn nhiều so với ảnh
+    chart_stars = get_chart_stars(user_data) if ANALYSIS_INPUT == 'text' else None
+    if chart_stars:
+        chart_json = json.dumps(chart_stars, ensure_ascii=False, separators=(',', ':'))
+        input_bytes = chart_json.encode('utf-8')
+    else:
+        # Kiểm tra xem file có tồn tại không
+        if not chart_path or not os.path.exists(chart_path):
+            logger.error(f"File không tồn tại: {chart_path}")
+            return {"error": "Không tìm thấy lá số để phân tích. Vui lòng thử lại."}
+        
+        # Đọc file hình ảnh
+        with open(chart_path, 'rb') as img_file:
+            input_bytes = img_file.read()
+    
+    # Mã băm dữ liệu lá số (JSON hoặc ảnh) dùng làm khóa cache cho tổng quan và từng cung
+    image_hash = hashlib.sha256(input_bytes).hexdigest()
+    user_data['image_hash'] = image_hash
+    
+    # Chế độ 'lazy' và 'parallel' chỉ hỏi tổng quan trong lần gọi đầu
+    overview_only = ANALYSIS_MODE in ('lazy', 'parallel')
+    system_prompt = OVERVIEW_SYSTEM_PROMPT if overview_only else ANALYSIS_SYSTEM_PROMPT
+    if chart_stars:
+        system_prompt = f"{system_prompt}\n\n{CHART_JSON_NOTE}"
+    
+    # Lấy thông tin từ user_data
+    day = user_data.get('day', 'Không xác định')
+    month = user_data.get('month', 'Không xác định')
+    year = user_data.get('year', 'Không xác định')
+    birth_time = user_data.get('birth_time', 'Không xác định')
+    gender = user_data.get('gender', 'Không xác định')
+    
+    # Tạo nội dung user prompt đơn giản
+    user_prompt = f"""Xem tử vi cho tui với:
+    - Ngày sinh: {day}/{month}/{year}
+    - Giờ sinh: {birth_time}
+    - Giới tính: {gender}
+    
+    Hình ảnh đính kèm là lá số tử vi của tui. Cảm ơn bạn nhiều!"""
+    
+    if chart_stars:
+        user_prompt = user_prompt.replace("Hình ảnh đính kèm", "Dữ liệu JSON dưới đây")
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"{user_prompt}\n\n{chart_json}"}
+        ]
+    else:
+        # Chuyển ảnh sang base64
+        base64_image = base64.b64encode(input_bytes).decode('utf-8')
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": [
+                {"type": "text", "text": user_prompt},
+                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
+            ]}
+        ]
+    
+    return {
+        'messages': messages,
+        'image_hash': image_hash,
+        'prompt_version': hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()[:16],
+        'max_tokens': 1000 if overview_only else 3000
+    }
+
+def parse_analysis_text(analysis_text):
+    """
+    Chuyển phản hồi của AI (có chứa JSON) thành dict phân tích theo từng cung.
+
+    Returns:
+        dict: Kết quả phân tích, có 'error' và 'raw_analysis' nếu không đọc được JSON
+    """
+    try:
+        # Tìm và trích xuất phần JSON từ phản hồi
+        json_match = re.search(r'({[\s\S]*})', analysis_text)
+        if json_match:
+            analysis_json = json_match.group(1)
+            return json.loads(analysis_json)
+        
+        # Nếu không tìm thấy JSON, tạo dict thủ công
+        analysis_dict = {
+            "tong_quan": "Không thể phân tích tổng quan. Vui lòng thử lại.",
+            "error": "Không thể phân tích theo định dạng JSON. Vui lòng thử lại."
+        }
+        # Thêm phần phân tích thô vào để tham khảo
+        analysis_dict["raw_analysis"] = analysis_text
+        return analysis_dict
+    except json.JSONDecodeError as e:
+        logger.error(f"Lỗi khi phân tích JSON: {e}")
+        # Tạo dict thủ công nếu không thể phân tích JSON
+        return {
+            "tong_quan": "Không thể phân tích tổng quan. Vui lòng thử lại.",
+            "error": f"Lỗi khi phân tích JSON: {str(e)}",
+            "raw_analysis": analysis_text
+        }
+
+def analyze_chart_with_gpt(chart_path, user_data, on_progress=None):
+    """
+    Phân tích lá số tử vi bằng AI thông qua AIRouter.
+    Lá số đã phân tích với cùng prompt và model được lấy lại từ cache, không gọi AI.
+    Ở chế độ 'lazy' chỉ lấy tổng quan và tóm tắt lá số, từng cung được phân tích
+    sau bằng analyze_cung_with_gpt.
+    
+    Args:
+        chart_path (str): Đường dẫn đến file lá số (hình ảnh)
+        user_data (dict): Thông tin người dùng
+        on_progress (callable, optional): Nếu có, phân tích được stream về và hàm này
+            được gọi với dict các cung đã xong mỗi khi có thêm cung mới
+        
+    Returns:
+        dict: Kết quả phân tích theo từng cung
+    """
+    try:
+        request = build_analysis_request(chart_path, user_data)
+        if 'error' in request:
+            return {"error": request['error']}
+        image_hash = request['image_hash']
+        prompt_version = request['prompt_version']
+        
+        # Lá số đã được phân tích thì trả lại kết quả cũ
+        cached_analysis = load_analysis_cache_entry(image_hash, prompt_version)
+        if cached_analysis:
+            bot_stats['analysis_cache_hits'] += 1
+            logger.info(f"Lấy phân tích lá số từ cache: {image_hash[:12]}")
+            if ANALYSIS_MODE == 'parallel':
+                return analyze_all_cung_parallel(cached_analysis, user_data, on_progress)
+            return cached_analysis
+        bot_stats['analysis_cache_misses'] += 1
+        
+        logger.info(f"Đang phân tích lá số cho người sinh ngày {user_data.get('day')}/{user_data.get('month')}/{user_data.get('year')}")
+        
+        # Gọi API để lấy phân tích
+        if on_progress and ANALYSIS_STREAM:
+            # Nhận phân tích theo từng phần để hiển thị sớm phần tổng quan
+            analysis_text, model, provider = stream_analysis_completion(request['messages'], on_progress, request['max_tokens'])
+        else:
+            response, provider = call_llm(
+                messages=request['messages'],
+                temperature=0.7,
+                max_tokens=request['max_tokens']
+            )
+            analysis_text = response.choices[0].message.content
+            model = response.model
+        logger.info(f"{provider['name']} đã phân tích xong lá số, model: {model}")
+        
+        # Chuyển đổi phân tích từ JSON sang dict
+        analysis_dict = parse_analysis_text(analysis_text)
+        
+        # Chỉ lưu cache khi phân tích thành công
+        if 'error' not in analysis_dict:
+            store_analysis_cache_entry(image_hash, analysis_dict, prompt_version, get_llm_model_key(provider))
+        
+        if ANALYSIS_MODE == 'parallel':
+            return analyze_all_cung_parallel(analysis_dict, user_data, on_progress)
+        return analysis_dict
+        
+    except ChatTaskCancelled:
+        raise
+    except Exception as e:
+        logger.error(f"Lỗi khi phân tích lá số: {e}")
+        return {
+            "error": f"Có lỗi xảy ra khi xem tử vi. Bạn thử lại sau nhé! Lỗi: {str(e)}"
+        }
+
+def get_cung_context(cung_key, user_data, analysis_dict):
+    """Dữ liệu lá số gửi kèm khi phân tích một cung: JSON của cung đó nếu có, nếu không thì bản tóm tắt."""
+    chart_stars = user_data.get('chart_stars') if ANALYSIS_INPUT == 'text' else None
+    if chart_stars and cung_key in chart_stars['cung']:
+        return json.dumps({
+            'thong_tin': chart_stars['thong_tin'],
+            cung_key: chart_stars['cung'][cung_key]
+        }, ensure_ascii=False, separators=(',', ':'))
+    return analysis_dict.get('tom_tat', '')
+
+def build_cung_messages(cung_key, user_data, analysis_dict):
+    """Tạo các tin nhắn gửi cho AI để phân tích riêng một cung."""
+    user_prompt = f"""Xem giúp tui {ANALYSIS_CUNG_NAMES.get(cung_key, cung_key)} với:
+- Ngày sinh: {user_data.get('day')}/{user_data.get('month')}/{user_data.get('year')}
+- Giờ sinh: {user_data.get('birth_time')}
+- Giới tính: {user_data.get('gender')}
+
+Tóm tắt lá số:
+{get_cung_context(cung_key, user_data, analysis_dict)}
+
+Nhận xét tổng quan:
+{analysis_dict.get('tong_quan', '')}"""
+    return [
+        {"role": "system", "content": CUNG_SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def analyze_cung_with_gpt(cung_key, user_data, analysis_dict=None):
+    """
+    Phân tích riêng một cung dựa trên tóm tắt lá số (chế độ 'lazy'/'parallel'), có cache theo lá số.
+
+    Args:
+        cung_key (str): Khóa cung, ví dụ 'cung_menh'
+        user_data (dict): Thông tin người dùng, gồm 'image_hash'
+        analysis_dict (dict, optional): Kết quả tổng quan (có 'tom_tat'), mặc định lấy user_data['analysis']
+
+    Returns:
+        str: Phân tích của cung, hoặc None nếu không phân tích được
+    """
+    if analysis_dict is None:
+        analysis_dict = user_data.get('analysis', {})
+    image_hash = user_data.get('image_hash')
+    prompt_version = get_cung_prompt_version(cung_key)
+
+    if image_hash:
+        cached_cung = load_analysis_cache_entry(image_hash, prompt_version)
+        if cached_cung and cung_key in cached_cung:
+            bot_stats['analysis_cache_hits'] += 1
+            return cached_cung[cung_key]
+        bot_stats['analysis_cache_misses'] += 1
+
+    try:
+        with analysis_slots:
+            response, provider = call_llm(
+                messages=build_cung_messages(cung_key, user_data, analysis_dict),
+                temperature=0.7,
+                max_tokens=500
+            )
+        cung_analysis = response.choices[0].message.content.strip()
+    except ChatTaskCancelled:
+        raise
+    except Exception as e:
+        logger.error(f"Lỗi khi phân tích {cung_key}: {e}")
+        return None
+
+    if image_hash and cung_analysis:
+        store_analysis_cache_entry(image_hash, {cung_key: cung_analysis}, prompt_version, get_llm_model_key(provider))
+    return cung_analysis
+
+def analyze_all_cung_parallel(analysis_dict, user_data, on_progress=None):
+    """
+    Phân tích song song tất cả các cung từ kết quả tổng quan và gộp vào cùng một dict.
+    Số yêu cầu chạy cùng lúc bị giới hạn bởi ANALYSIS_CONCURRENCY, cung lỗi được thử lại riêng.
+
+    Args:
+        analysis_dict (dict): Kết quả tổng quan (có 'tong_quan' và 'tom_tat')
+        user_data (dict): Thông tin người dùng, gồm 'image_hash'
+        on_progress (callable, optional): Hàm nhận dict đã gộp mỗi khi có thêm cung xong
+
+    Returns:
+        dict: Kết quả phân tích đủ các cung (cung lỗi sẽ thiếu và được phân tích lại khi người dùng mở)
+    """
+    if 'error' in analysis_dict or 'tom_tat' not in analysis_dict:
+        return analysis_dict
+
+    merged = dict(analysis_dict)
+    task = get_current_task()
+
+    def analyze_with_retry(cung_key):
+        # Các luồng phụ cùng thuộc công việc phân tích, dừng theo khi người dùng hủy
+        set_current_task(task)
+        for attempt in range(ANALYSIS_CUNG_RETRIES + 1):
+            cung_analysis = analyze_cung_with_gpt(cung_key, user_data, analysis_dict)
+            if cung_analysis:
+                return cung_analysis
+            check_task_cancelled()
+            if attempt < ANALYSIS_CUNG_RETRIES:
+                logger.warning(f"Thử lại phân tích {cung_key} (lần {attempt + 1})")
+                time.sleep(1 + attempt)
+        return None
+
+    pending = [cung_key for cung_key in ANALYSIS_CUNG_NAMES if cung_key not in merged]
+    if not pending:
+        return merged
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=len(pending), thread_name_prefix="cung-analysis") as executor:
+        futures = {executor.submit(analyze_with_retry, cung_key): cung_key for cung_key in pending}
+        for future in as_completed(futures):
+            cung_key = futures[future]
+            try:
+                cung_analysis = future.result()
+            except ChatTaskCancelled:
+                continue
+            except Exception as e:
+                logger.error(f"Lỗi khi phân tích song song {cung_key}: {e}")
+                continue
+            if not cung_analysis:
+                continue
+            merged[cung_key] = cung_analysis
+            if on_progress:
+                try:
+                    on_progress(dict(merged))
+                except Exception as e:
+                    logger.warning(f"Lỗi khi cập nhật phân tích đang chạy song song: {e}")
+
+    check_task_cancelled()
+    missing = [cung_key for cung_key in ANALYSIS_CUNG_NAMES if cung_key not in merged]
+    logger.info(f"Đã phân tích song song {len(pending) - len(missing)}/{len(pending)} cung trong {time.time() - start_time:.1f}s")
+    return merged
+
+def format_analysis(analysis_dict, user_data, cung=None):
+    """
+    Định dạng kết quả phân tích từ AIRouter để hiển thị đẹp hơn và thân thiện hơn.
+    
+    Args:
+        analysis_dict (dict): Phân tích từ API dưới dạng dict
+        user_data (dict): Thông tin người dùng
+        cung (str, optional): Tên cung cần hiển thị, nếu None thì hiển thị tổng quan
+        
+    Returns:
+        str: Phân tích đã được định dạng
+    """
+    try:
+        # Kiểm tra lỗi
+        if "error" in analysis_dict and cung != "tong_quan":
+            return f"❌ *Lỗi khi phân tích*\n\n{analysis_dict['error']}"
+        
+        # Lấy thông tin người dùng
+        day = user_data.get('day', 'Không xác định')
+        month = user_data.get('month', 'Không xác định')
+        year = user_data.get('year', 'Không xác định')
+        birth_time = user_data.get('birth_time', 'Không xác định') 
+        gender = user_data.get('gender', 'Không xác định')
+        
+        # Ánh xạ tên cung
+        cung_mapping = {
+            "tong_quan": "Tổng Quan",
+            "cung_menh": "Cung Mệnh",
+            "cung_phuc_duc": "Cung Phúc Đức",
+            "cung_tai_bach": "Cung Tài Bạch",
+            "cung_quan_loc": "Cung Quan Lộc",
+            "cung_phu_the": "Cung Phu Thê",
+            "cung_tu_tuc": "Cung Tử Tức",
+            "cung_huynh_de": "Cung Huynh Đệ",
+            "cung_dien_trach": "Cung Điền Trạch",
+            "cung_thien_di": "Cung Thiên Di",
+            "cung_no_boc": "Cung Nô Bộc",
+            "cung_tat_ach": "Cung Tật Ách"
+        }
+        
+        # Emoji cho từng cung
+        cung_emoji = {
+            "tong_quan": "🔮",
+            "cung_menh": "👤",
+            "cung_phuc_duc": "🙏",
+            "cung_tai_bach": "💰",
+            "cung_quan_loc": "💼",
+            "cung_phu_the": "💑",
+            "cung_tu_tuc": "👶",
+            "cung_huynh_de": "👥",
+            "cung_dien_trach": "🏠",
+            "cung_thien_di": "✈️",
+            "cung_no_boc": "👨‍👩‍👧‍👦",
+            "cung_tat_ach": "🏥"
+        }
         
-        # Chọn loại lịch (mặc định là dương lịch)
-        driver.find_element(By.ID, "duong_lich").click()
+        # Nếu cung được chỉ định, chỉ hiển thị phân tích cho cung đó
+        if cung and cung in analysis_dict:
+            cung_name = cung_mapping.get(cung, cung)
+            cung_content = analysis_dict.get(cung, "Không có thông tin")
+            
+            formatted_text = f"{cung_emoji.get(cung, '✨')} *{cung_name.upper()}* {cung_emoji.get(cung, '✨')}\n\n"
+            formatted_text += f"👤 *Thông tin*: {day}/{month}/{year}, {birth_time}, {gender}\n\n"
+            formatted_text += f"{cung_content}\n\n"
+            
+            return formatted_text
         
-        # Chọn năm sinh
-        year_select = Select(driver.find_element(By.ID, "inam_duong"))
-        year_select.select_by_value(str(year))
+        # Nếu không chỉ định cung, hiển thị tổng quan
+        tong_quan = analysis_dict.get("tong_quan", "Không có thông tin tổng quan")
         
-        # Chọn tháng sinh
-        month_select = Select(driver.find_element(By.ID, "ithang_duong"))
-        month_select.select_by_value(f"{month:02d}")
+        # Tạo lời chào thân thiện
+        greeting = random.choice([
+            "Chào bạn! Đây là tử vi của bạn nè:",
+            "Mình đã xem lá số của bạn rồi đây:",
+            "Tử vi của bạn có nhiều điều thú vị:",
+            "Mình đã phân tích lá số của bạn, cùng xem nhé:",
+            "Đây là những điều mình thấy từ lá số của bạn:"
+        ])
         
-        # Chọn ngày sinh
-        day_select = Select(driver.find_element(By.ID, "ingay_duong"))
-        day_select.select_by_value(f"{day:02d}")
+        formatted_text = f"""🔮 *TỬ VI CỦA BẠN* 🔮
+
+{greeting}
+
+📅 *Thông tin của bạn*
+• Ngày sinh: {day}/{month}/{year}
+• Giờ sinh: {birth_time}
+• Giới tính: {gender}
+
+{tong_quan}
+
+✨ *Chọn một cung để xem chi tiết* ✨
+"""
+        return formatted_text
         
-        # Chọn giờ sinh
-        hour_select = Select(driver.find_element(By.ID, "gio_duong"))
-        hour_select.select_by_value(hour)
+    except Exception as e:
+        logger.error(f"Lỗi khi định dạng phân tích: {e}")
+        if isinstance(analysis_dict, str):
+            return analysis_dict  # Trả về phân tích gốc nếu có lỗi
+        elif isinstance(analysis_dict, dict) and "error" in analysis_dict:
+            return f"❌ *Lỗi khi phân tích*\n\n{analysis_dict['error']}"
+        else:
+            return "Có lỗi xảy ra khi định dạng phân tích. Vui lòng thử lại."
+
+@bot.message_handler(commands=['cancel'])
+@serialize_chat
+def cancel(message):
+    """Hủy hội thoại."""
+    chat_id = message.chat.id
+    
+    # Dừng ngay các việc đang chạy: job lập lá số, trình duyệt, yêu cầu AI
+    cancelled_count = cancel_chat_tasks(chat_id)
+    
+    # Check if user has an active state
+    if chat_id in user_states or cancelled_count:
+        # Clear all user states
+        user_states.pop(chat_id, None)
         
-        # Chọn phút sinh (mặc định 0)
-        minute_select = Select(driver.find_element(By.ID, "phut_duong"))
-        minute_select.select_by_value("00")
+        bot.send_message(
+            chat_id,
+            "❌ *Đã hủy thao tác*\n\nGõ /start để bắt đầu lại hoặc /help để xem hướng dẫn.",
+            parse_mode='Markdown'
+        )
+    else:
+        bot.send_message(
+            chat_id,
+            "ℹ️ *Không có thao tác nào để hủy*\n\nGõ /start để bắt đầu lập lá số tử vi hoặc /help để xem hướng dẫn.",
+            parse_mode='Markdown'
+        )
+
+@bot.message_handler(commands=['help'])
+def help_command(message):
+    """Hiển thị hướng dẫn sử dụng."""
+    chat_id = message.chat.id
+    help_text = (
+        "🔮 *HƯỚNG DẪN SỬ DỤNG BOT TỬ VI* 🔮\n\n"
+        "Bot này giúp bạn lập và phân tích lá số tử vi dựa trên thông tin ngày sinh. Các lệnh cơ bản:\n\n"
+        "• /start - Bắt đầu lập lá số tử vi\n"
+        "• /cancel - Hủy thao tác hiện tại\n"
+        "• /help - Hiển thị hướng dẫn này\n\n"
+        "✨ *Quy trình sử dụng*:\n"
+        "1. Nhập ngày tháng năm sinh (DD/MM/YYYY)\n"
+        "2. Chọn giờ sinh (theo 12 con giáp)\n"
+        "3. Chọn giới tính\n"
+        "4. Đợi bot lập lá số tử vi\n"
+        "5. Chọn 'Phân tích lá số' để nhận được luận giải chi tiết\n\n"
+        "🔍 *Lưu ý*: Để có kết quả chính xác, vui lòng cung cấp thông tin đầy đủ và chính xác."
+    )
+    
+    bot.send_message(
+        chat_id,
+        help_text,
+        parse_mode='Markdown'
+    )
+
+@bot.message_handler(commands=['stats'])
+def stats_command(message):
+    """Hiển thị thống kê sử dụng bot (chỉ dành cho admin)."""
+    chat_id = message.chat.id
+    
+    # Danh sách ID admin (có thể đưa vào biến môi trường)
+    admin_ids = [int(id.strip()) for id in os.getenv('ADMIN_IDS', '').split(',') if id.strip()]
+    
+    # Nếu không có admin nào được cấu hình, cho phép bất kỳ ai xem thống kê
+    if not admin_ids:
+        send_stats_to_admin(chat_id)
+        return
+    
+    # Kiểm tra xem người dùng có phải là admin không
+    if chat_id in admin_ids:
+        send_stats_to_admin(chat_id)
+    else:
+        bot.send_message(
+            chat_id,
+            "⚠️ *Bạn không có quyền xem thống kê*\n\nChỉ admin mới có thể sử dụng lệnh này.",
+            parse_mode='Markdown'
+        )
+
+@bot.message_handler(func=lambda message: True)
+@serialize_chat
+def echo_all(message):
+    """Xử lý các tin nhắn không rõ."""
+    chat_id = message.chat.id
+    if chat_id not in user_states:
+        bot.send_message(
+            chat_id,
+            "🤔 Bot không hiểu yêu cầu của bạn.\n\n"
+            "• Gõ /start để bắt đầu lập lá số tử vi\n"
+            "• Gõ /help để xem hướng dẫn sử dụng",
+            parse_mode='Markdown'
+        )
+    else:
+        bot.send_message(
+            chat_id,
+            "⚠️ Vui lòng làm theo hướng dẫn hoặc gõ /cancel để hủy thao tác hiện tại.",
+            parse_mode='Markdown'
+        )
+
+def get_analysis_chart_path(chat_id, user_data):
+    """
+    Tìm file ảnh lá số để gửi cho AI (chỉ gọi khi analysis_needs_image), lấy lại ảnh nếu
+    file đã bị dọn khỏi kho.
+
+    Args:
+        chat_id (int): ID cuộc trò chuyện
+        user_data (dict): Thông tin người dùng, được cập nhật 'chart_image_path'
+
+    Returns:
+        str: Đường dẫn file ảnh lá số
+    """
+    chart_path = user_data.get('chart_image_path')
+    if chart_path and not touch_asset(chart_path):
+        # Ảnh đã bị dọn khỏi kho do phiên giữ đường dẫn quá lâu, lấy lại ảnh bên dưới
+        logger.info(f"Ảnh lá số {chart_path} không còn trong kho, lấy lại ảnh cho chat {chat_id}")
+        chart_path = None
+        user_data.pop('chart_image_path', None)
+
+    if not chart_path and 'chart_id' in user_data and 'chart_html_path' not in user_data:
+        # Lá số cũ chỉ có file_id, lúc này mới đọc ảnh từ cơ sở dữ liệu
+        chart_path = materialize_chart_image(user_data['chart_id'])
+    if not chart_path:
+        html_path = user_data.get('chart_html_path', '')
+        # Nếu là HTML, thử trích xuất ảnh base64 từ HTML
+        if html_path.endswith('.html') and os.path.exists(html_path):
+            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+            chart_path = extract_base64_image_from_html(html_path, timestamp, chat_id, user_data)
+        # Nếu không trích xuất được (hoặc file đã bị dọn), vẽ lại ảnh bằng Pillow. Lá số đã có
+        # trong lịch sử nên không lưu thêm bản mới
+        if not chart_path:
+            chart_path = render_chart_asset(user_data)
+    user_data['chart_image_path'] = chart_path
+    return chart_path
+
+def get_analysis_session(chat_id):
+    """Trả về trạng thái hội thoại có lá số (đường dẫn ảnh, HTML hoặc ID lá số) để phân tích, hoặc None."""
+    user_data = get_session(chat_id)
+    if isinstance(user_data, dict) and any(key in user_data for key in ('chart_image_path', 'chart_html_path', 'chart_id')):
+        return user_data
+    return None
+
+def prepare_partial_analysis(chat_id, user_data, partial, stream_state):
+    """
+    Ghi phần phân tích đã stream về vào phiên để các cung đã xong xem được ngay, và cho biết
+    có nên sửa tin nhắn đang xử lý thành phần tổng quan không.
+
+    Args:
+        chat_id (int): ID cuộc trò chuyện
+        user_data (dict): Trạng thái hội thoại mà phân tích đang làm việc
+        partial (dict): Các cung đã phân tích xong
+        stream_state (dict): 'last_edit' và 'shown' của tin nhắn đang xử lý
+
+    Returns:
+        tuple: (nội dung, menu các cung) để sửa tin nhắn, hoặc None nếu chưa cần sửa
+    """
+    # Người dùng đã hủy hoặc bắt đầu lại thì không hiện tiếp
+    if not resume_session(chat_id, user_data):
+        return None
+    user_data['analysis'] = partial
+    if 'tong_quan' not in partial:
+        return None
+    # Giới hạn số lần sửa tin nhắn để tránh bị Telegram chặn
+    if stream_state['shown'] and time.time() - stream_state['last_edit'] < ANALYSIS_EDIT_INTERVAL:
+        return None
+    return (format_analysis(partial, user_data) + "\n⏳ _Đang xem tiếp các cung..._",
+            create_cung_markup(None if ANALYSIS_MODE == 'lazy' else partial))
+
+def complete_analysis(chat_id, user_data, analysis_dict, replace_session=False):
+    """
+    Lưu kết quả phân tích vào trạng thái hội thoại để xem các cung sau này.
+
+    Args:
+        chat_id (int): ID cuộc trò chuyện
+        user_data (dict): Trạng thái hội thoại mà phân tích đang làm việc
+        analysis_dict (dict): Kết quả phân tích
+        replace_session (bool): True để thay trạng thái cũ (phân tích lá số từ lịch sử)
+
+    Returns:
+        str: Phân tích tổng quan đã định dạng
+    """
+    user_data['analysis'] = analysis_dict
+    # Đánh dấu rằng người dùng đã hoàn thành phân tích
+    user_data['analysis_complete'] = True
+    if replace_session:
+        set_session(chat_id, user_data)
+    else:
+        resume_session(chat_id, user_data)
+    return format_analysis(analysis_dict, user_data)
+
+def process_analysis(chat_id):
+    """Xử lý phân tích lá số tử vi."""
+    # Phân tích làm việc trên dict trạng thái này, không đọc lại user_states trong lúc chờ AI
+    user_data = get_analysis_session(chat_id)
+    if user_data is None:
+        bot.send_message(
+            chat_id, 
+            CHART_NOT_FOUND_MESSAGE,
+            parse_mode='Markdown'
+        )
+        return
+    
+    # Gửi thông báo đang phân tích
+    processing_msg = bot.send_message(
+        chat_id, 
+        ANALYSIS_PROCESSING_MESSAGE,
+        parse_mode='Markdown'
+    )
+    
+    try:
+        # Phân tích bằng dữ liệu sao (JSON) thì không cần tìm ảnh lá số
+        chart_path = get_analysis_chart_path(chat_id, user_data) if analysis_needs_image(user_data) else None
+        
+        # Trạng thái hiển thị phân tích đang stream về
+        stream_state = {'last_edit': 0, 'shown': False}
+        
+        def show_partial_analysis(partial):
+            """Sửa tin nhắn đang xử lý thành phần tổng quan và các cung đã phân tích xong."""
+            update = prepare_partial_analysis(chat_id, user_data, partial, stream_state)
+            if not update:
+                return
+            text, markup = update
+            bot.edit_message_text(
+                text,
+                chat_id,
+                processing_msg.message_id,
+                reply_markup=markup,
+                parse_mode='Markdown'
+            )
+            stream_state['last_edit'] = time.time()
+            stream_state['shown'] = True
         
-        # Chọn năm xem hạn (mặc định năm hiện tại)
-        current_year = datetime.now().year
-        year_xem_select = Select(driver.find_element(By.ID, "selNamXemD"))
-        year_xem_select.select_by_value(str(current_year))
+        # Phân tích lá số tử vi
+        analysis_dict = analyze_chart_with_gpt(chart_path, user_data, on_progress=show_partial_analysis)
         
-        # Chọn kiểu ảnh màu
-        driver.find_element(By.ID, "radMau").click()
+        # Lưu phân tích vào trạng thái người dùng để sử dụng sau này
+        formatted_analysis = complete_analysis(chat_id, user_data, analysis_dict)
         
-        # Chọn thời gian lưu ảnh (30 ngày)
-        driver.find_element(By.ID, "radluu").click()
+        # Tổng quan đã hiện trong tin nhắn đang xử lý, chỉ cần cập nhật đủ các cung
+        edited = False
+        if stream_state['shown'] and 'error' not in analysis_dict:
+            try:
+                bot.edit_message_text(
+                    formatted_analysis,
+                    chat_id,
+                    processing_msg.message_id,
+                    reply_markup=create_cung_markup(),
+                    parse_mode='Markdown'
+                )
+                edited = True
+            except Exception as e:
+                logger.warning(f"Không thể cập nhật tin nhắn phân tích, gửi tin nhắn mới: {e}")
         
-        # Không cảnh báo múi giờ
-        driver.find_element(By.ID, "canhbao_no").click()
+        if not edited:
+            # Xóa thông báo đang xử lý
+            try:
+                bot.delete_message(chat_id, processing_msg.message_id)
+            except Exception as e:
+                logger.warning(f"Không thể xóa tin nhắn 'đang xử lý': {e}")
+            
+            # Gửi phân tích tổng quan cho người dùng
+            bot.send_message(
+                chat_id, 
+                formatted_analysis, 
+                parse_mode='Markdown'
+            )
+            
+            # Gửi menu các cung
+            bot.send_message(
+                chat_id,
+                CUNG_MENU_MESSAGE,
+                reply_markup=create_cung_markup(),
+                parse_mode='Markdown'
+            )
+        
+        # Cập nhật thống kê
+        bot_stats['analyses_performed'] += 1
+        
+    except ChatTaskCancelled:
+        logger.info(f"Đã dừng phân tích lá số cho chat {chat_id} theo yêu cầu hủy")
+        try:
+            bot.delete_message(chat_id, processing_msg.message_id)
+        except Exception:
+            pass
+        
+    except Exception as e:
+        logger.error(f"Lỗi khi phân tích lá số tử vi: {e}")
+        try:
+            bot.send_message(
+                chat_id,
+                f"❌ *Đã xảy ra lỗi khi phân tích lá số tử vi*\n\nLỗi: {str(e)}\n\nVui lòng thử lại sau.",
+                parse_mode='Markdown'
+            )
+            # Xóa thông báo đang xử lý
+            bot.delete_message(chat_id, processing_msg.message_id)
+        except Exception as delete_error:
+            logger.warning(f"Không thể xóa tin nhắn hoặc gửi thông báo lỗi: {delete_error}")
+        # Cập nhật thống kê lỗi
+        bot_stats['errors'] += 1
+
+def extract_base64_image_from_html(html_path, timestamp, user_id, user_data):
+    """
+    Trích xuất ảnh base64 từ file HTML, lưu file và lưu vào cơ sở dữ liệu
+    
+    Args:
+        html_path (str): Đường dẫn đến file HTML
+        timestamp (str): Timestamp để đặt tên file
+        user_id (int): ID của người dùng
+        user_data (dict): Thông tin người dùng
         
-        # Đảm bảo đánh dấu vào ô đồng ý
-        confirm_checkbox = driver.find_element(By.ID, "iconfirm1")
-        if not confirm_checkbox.is_selected():
-            confirm_checkbox.click()
+    Returns:
+        str: Đường dẫn đến file ảnh đã lưu, hoặc None nếu không thành công
+    """
+    try:
+        # Đọc nội dung file HTML
+        with open(html_path, 'r', encoding='utf-8') as f:
+            html_content = f.read()
         
-        # Cập nhật tiến trình
-        send_progress_update(user_id, processing_msg.message_id, "Đang gửi thông tin và chờ kết quả...", 50)
+        base64_data = find_base64_image(html_content)
+        if not base64_data:
+            logger.error(f"Không thể tìm thấy ảnh base64 trong HTML: {html_path}")
+            return None
         
-        # Lưu số cửa sổ/tab hiện tại
-        current_window_count = len(driver.window_handles)
+        return save_base64_chart_image(base64_data, user_id, user_data)
+    
+    except Exception as e:
+        logger.error(f"Lỗi khi trích xuất ảnh base64: {e}")
+        return None
+
+def find_base64_image(html_content):
+    """
+    Tìm ảnh lá số dạng base64 trong nội dung HTML.
+    
+    Args:
+        html_content (str): Nội dung HTML trang kết quả
         
-        # Submit form
-        submit_button = driver.find_element(By.XPATH, "//input[@value='An sao Tử Vi']")
-        submit_button.click()
+    Returns:
+        str: Chuỗi base64 của ảnh, hoặc None nếu không tìm thấy
+    """
+    # Tìm tất cả các chuỗi data:image/jpeg;base64 hoặc data:image/png;base64
+    pattern = r'data:image/[^;]+;base64,([^"\']+)'
+    matches = re.findall(pattern, html_content)
+    if matches:
+        return matches[0]
+    
+    logger.warning("Không tìm thấy ảnh base64 bằng regex, thử tìm trong thẻ img")
+    
+    # Thử tìm với các pattern khác
+    soup = BeautifulSoup(html_content, 'html.parser')
+    for img in soup.find_all('img'):
+        src = img.get('src', '')
+        if src.startswith('data:image'):
+            # Trích xuất phần base64
+            base64_data = src.split(',')[1] if ',' in src else ''
+            if base64_data:
+                logger.info("Đã tìm thấy ảnh base64 từ thẻ img")
+                return base64_data
+    
+    return None
+
+def save_base64_chart_image(base64_data, user_id, user_data):
+    """
+    Giải mã ảnh lá số base64, lưu file và lưu vào cơ sở dữ liệu
+    
+    Args:
+        base64_data (str): Chuỗi base64 của ảnh
+        user_id (int): ID của người dùng
+        user_data (dict): Thông tin người dùng
         
-        # Đợi tab mới mở ra
-        WebDriverWait(driver, 20).until(
-            lambda d: len(d.window_handles) > current_window_count
-        )
+    Returns:
+        str: Đường dẫn đến file ảnh đã lưu, hoặc None nếu không thành công
+    """
+    try:
+        # Xử lý trường hợp base64 có thể bị hỏng
+        try:
+            image_data = base64.b64decode(base64_data)
+            
+            # Kiểm tra xem ảnh có hợp lệ không trước khi lưu
+            try:
+                with Image.open(BytesIO(image_data)) as img:
+                    # Nếu mở được ảnh, kiểm tra kích thước
+                    width, height = img.size
+                    if width < 10 or height < 10:
+                        logger.warning(f"Ảnh quá nhỏ: {width}x{height}, có thể không hợp lệ")
+                        # Vẫn giữ lại ảnh để kiểm tra
+            except Exception as img_error:
+                logger.error(f"Ảnh không hợp lệ: {img_error}")
+                return None
+            
+            # Lưu ảnh vào kho ảnh
+            image_path = store_asset(image_data)
+        except Exception as decode_error:
+            logger.error(f"Lỗi khi giải mã base64: {decode_error}")
+            return None
         
-        # Chuyển sang tab mới
-        driver.switch_to.window(driver.window_handles[-1])
+        logger.info(f"Đã lưu ảnh từ base64 cho user {user_id}: {image_path}")
         
-        # Cập nhật tiến trình
-        send_progress_update(user_id, processing_msg.message_id, "Đang tải trang kết quả...", 70)
+        # Lưu thông tin và ảnh vào cơ sở dữ liệu
+        try:
+            user_data['chart_id'] = save_chart(user_id, user_data, image_data)
+        except Exception as db_error:
+            logger.warning(f"Không thể lưu chart vào database: {db_error}")
+            # Vẫn tiếp tục vì đã lưu được ảnh
         
-        # Đợi trang tải xong
-        WebDriverWait(driver, 20).until(
-            EC.presence_of_element_located((By.TAG_NAME, "body"))
+        return image_path
+    
+    except Exception as e:
+        logger.error(f"Lỗi khi lưu ảnh lá số base64: {e}")
+        return None
+
+def test_airouter():
+    """
+    Kiểm tra kết nối với AIRouter.
+    """
+    try:
+        logger.info("Kiểm tra kết nối AIRouter...")
+        response = openai.ChatCompletion.create(
+            model="auto",
+            api_key=AIROUTER_API_KEY,
+            api_base=AIROUTER_API_BASE,
+            messages=[
+                {"role": "system", "content": "Bạn là một trợ lý AI hữu ích."},
+                {"role": "user", "content": "Chào bạn, đây là tin nhắn kiểm tra kết nối. Trả lời ngắn gọn."}
+            ],
+            max_tokens=50
         )
+        logger.info(f"Kết nối AIRouter thành công! Model được sử dụng: {response.model}")
+        return True
+    except Exception as e:
+        logger.error(f"Lỗi kết nối AIRouter: {e}")
+        return False
+
+# Thêm hàm dọn dẹp file tạm định kỳ
+def cleanup_temp_files(max_age_days=7):
+    """
+    Dọn dẹp các file tạm thời đã cũ trong thư mục assets
+    
+    Args:
+        max_age_days (int): Số ngày tối đa để giữ file, mặc định là 7 ngày
+    """
+    try:
+        logger.info(f"Bắt đầu dọn dẹp file tạm cũ hơn {max_age_days} ngày")
         
-        # Cập nhật tiến trình
-        send_progress_update(user_id, processing_msg.message_id, "Đang lưu kết quả...", 80)
-        
-        # Lưu HTML của trang kết quả
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        html_path = f"assets/{user_id}_chart_{timestamp}.html"
-        
-        # Tạo thư mục assets nếu chưa tồn tại
+        # Kiểm tra thư mục assets
         if not os.path.exists('assets'):
-            os.makedirs('assets')
-        
-        with open(html_path, "w", encoding="utf-8") as f:
-            f.write(driver.page_source)
+            logger.info("Thư mục assets không tồn tại, không cần dọn dẹp")
+            return
         
-        logger.info(f"Đã lưu HTML lá số tử vi: {html_path}")
+        # Lấy thời gian hiện tại
+        current_time = time.time()
+        max_age_seconds = max_age_days * 24 * 60 * 60
         
-        # Cập nhật tiến trình
-        send_progress_update(user_id, processing_msg.message_id, "Đang trích xuất ảnh từ kết quả...", 90)
+        # Đếm số file đã xóa
+        deleted_count = 0
         
-        # Tìm và trích xuất ảnh base64 từ HTML
-        image_path = extract_base64_image_from_html(html_path, timestamp, user_id, user_data)
-        if image_path:
-            logger.info(f"Đã trích xuất ảnh lá số tử vi: {image_path}")
+        # Duyệt qua tất cả file trong thư mục assets
+        for filename in os.listdir('assets'):
+            file_path = os.path.join('assets', filename)
+            
+            # Bỏ qua nếu là thư mục
+            if os.path.isdir(file_path):
+                continue
+            
+            # Kiểm tra tuổi của file
+            file_age = current_time - os.path.getmtime(file_path)
+            
+            # Xóa file nếu quá cũ hoặc là file tạm (bắt đầu bằng "view_" hoặc "analyze_")
+            if file_age > max_age_seconds or filename.startswith(('view_', 'analyze_')):
+                try:
+                    os.remove(file_path)
+                    deleted_count += 1
+                    logger.debug(f"Đã xóa file cũ: {file_path}")
+                except Exception as e:
+                    logger.warning(f"Không thể xóa file {file_path}: {e}")
         
-        # Đóng trình duyệt
-        driver.quit()
+        # Dọn các ảnh trong kho lâu không được dùng
+        deleted_count += cleanup_asset_store(max_age_seconds)
         
-        # Cập nhật tiến trình
-        send_progress_update(user_id, processing_msg.message_id, "Hoàn tất! Đang hiển thị kết quả...", 100)
+        logger.info(f"Đã dọn dẹp {deleted_count} file tạm cũ")
+    
+    except Exception as e:
+        logger.error(f"Lỗi khi dọn dẹp file tạm: {e}")
+
+def init_runtime(primary=True):
+    """
+    Khởi tạo các thành phần cần cho việc xử lý update trong tiến trình hiện tại.
+
+    Args:
+        primary (bool): Tiến trình chính, chạy thêm các việc chỉ cần làm một lần
+            (dọn dẹp file, tạo bảng, chuyển đổi dữ liệu, kiểm tra AI, báo admin)
+    """
+    # Kiểm tra thư mục
+    if not os.path.exists('assets'):
+        os.makedirs('assets')
         
-        # Xóa tin nhắn tiến trình
+    # Nạp bảng âm lịch tính sẵn
+    load_lunar_table()
+    
+    # Xác định chromedriver một lần và khởi động sẵn trình duyệt khi lấy lá số bằng selenium
+    prepare_chrome_fallback()
+    atexit.register(shutdown_driver_pool)
+    
+    # Khởi động worker lập lá số (chỉ một lần kể cả khi bot khởi động lại)
+    if not any(thread.name.startswith("chart-worker-") for thread in threading.enumerate()):
+        start_chart_workers()
+    
+    # Dọn dẹp và ghi phiên hội thoại định kỳ
+    if not any(thread.name == "session-maintenance" for thread in threading.enumerate()):
+        start_session_maintenance()
+    
+    # Kiểm tra kết nối cơ sở dữ liệu
+    db_conn = get_db_connection()
+    if db_conn:
+        logger.info("Kết nối cơ sở dữ liệu thành công")
+        release_db_connection(db_conn)
+    else:
+        logger.error("Không thể kết nối đến cơ sở dữ liệu")
+    
+    if not primary:
+        return
+    
+    # Dọn dẹp file tạm cũ khi khởi động
+    cleanup_temp_files()
+    
+    # Lên lịch dọn dẹp định kỳ
+    schedule_cleanup()
+    
+    # Khởi tạo cơ sở dữ liệu
+    init_database()
+    
+    # Chuyển dần ảnh base64 cũ sang dạng nhị phân trong nền
+    start_chart_image_migration()
+    
+    # Kiểm tra kết nối AIRouter
+    if test_airouter():
+        logger.info("Kết nối AIRouter thành công, bot sẵn sàng sử dụng AI phân tích")
+    else:
+        logger.warning("Không thể kết nối đến AIRouter, một số chức năng phân tích có thể không hoạt động")
+    
+    # Gửi thông báo khởi động cho admin
+    admin_ids = [int(id.strip()) for id in os.getenv('ADMIN_IDS', '').split(',') if id.strip()]
+    for admin_id in admin_ids:
         try:
-            bot.delete_message(user_id, processing_msg.message_id)
+            bot.send_message(
+                admin_id,
+                f"🚀 *Bot Tử Vi đã khởi động*\n\n⏱ Thời gian: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}",
+                parse_mode='Markdown'
+            )
+        except Exception as e:
+            logger.warning(f"Không thể gửi thông báo khởi động cho admin {admin_id}: {e}")
+
+def get_update_chat_id(update_data):
+    """
+    Lấy ID cuộc trò chuyện từ update Telegram (dạng dict) để chia update theo chat.
+
+    Returns:
+        int: ID cuộc trò chuyện, hoặc update_id nếu update không gắn với chat nào
+    """
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if key in update_data:
+            return update_data[key]['chat']['id']
+    callback_query = update_data.get('callback_query')
+    if callback_query and callback_query.get('message'):
+        return callback_query['message']['chat']['id']
+    for key in ('callback_query', 'inline_query', 'chosen_inline_result', 'my_chat_member', 'chat_member'):
+        if key in update_data and 'from' in update_data[key]:
+            return update_data[key]['from']['id']
+    return update_data.get('update_id', 0)
+
+def dispatch_updates(update_queue):
+    """
+    Lấy update (chuỗi JSON) từ hàng đợi và chạy các handler của bot ngay trong luồng này.
+    Luồng chỉ lấy update tiếp theo khi đã xử lý xong update trước.
+
+    Args:
+        update_queue: Hàng đợi update (queue.Queue hoặc multiprocessing.Queue)
+    """
+    while True:
+        update_json = update_queue.get()
+        try:
+            update = types.Update.de_json(update_json)
+            bot.process_new_updates([update])
+        except Exception as e:
+            logger.error(f"Lỗi khi xử lý update từ webhook: {e}")
+
+def start_update_dispatchers(update_queue):
+    """
+    Chạy WEBHOOK_HANDLERS luồng xử lý update từ cùng một hàng đợi.
+
+    Args:
+        update_queue: Hàng đợi update (queue.Queue hoặc multiprocessing.Queue)
+
+    Returns:
+        list: Các luồng xử lý update
+    """
+    dispatchers = [
+        threading.Thread(target=dispatch_updates, args=(update_queue,), name=f"webhook-dispatcher-{index}", daemon=True)
+        for index in range(WEBHOOK_HANDLERS)
+    ]
+    for dispatcher in dispatchers:
+        dispatcher.start()
+    return dispatchers
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """Nhận update Telegram qua HTTP POST và đưa vào hàng đợi của worker tương ứng."""
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        # Chỉ nhận update có secret token đúng (Telegram gửi kèm trong header)
+        secret_token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not WEBHOOK_SECRET or not hmac.compare_digest(secret_token, WEBHOOK_SECRET):
+            webhook_stats['unauthorized'] += 1
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            update_json = self.rfile.read(length).decode('utf-8')
+            chat_id = get_update_chat_id(json.loads(update_json))
+        except Exception as e:
+            logger.warning(f"Update webhook không hợp lệ: {e}")
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        # Cùng một chat luôn vào cùng một worker để giữ đúng trạng thái hội thoại
+        update_queue = webhook_queues[chat_id % len(webhook_queues)]
+        try:
+            update_queue.put_nowait(update_json)
+        except queue.Full:
+            # Trả lỗi để Telegram gửi lại update sau
+            webhook_stats['rejected'] += 1
+            logger.warning("Hàng đợi webhook đã đầy, từ chối update")
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        webhook_stats['received'] += 1
+        self.send_response(200)
+        self.end_headers()
+
+    def do_GET(self):
+        # Kiểm tra tình trạng server (dùng cho load balancer / healthcheck)
+        body = json.dumps(webhook_stats).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Không ghi log cho từng request
+        pass
+
+def run_webhook_worker(index, update_queue):
+    """
+    Tiến trình worker: khởi tạo bot trong tiến trình này rồi xử lý update từ hàng đợi riêng.
+
+    Args:
+        index (int): Số thứ tự worker, worker 0 chạy thêm các việc chỉ cần làm một lần
+        update_queue (multiprocessing.Queue): Hàng đợi update của worker
+    """
+    init_runtime(primary=index == 0)
+    logger.info(f"Worker webhook {index} đã sẵn sàng")
+    if async_bot:
+        asyncio.run(run_async_bot(update_queue))
+    else:
+        for dispatcher in start_update_dispatchers(update_queue):
+            dispatcher.join()
+
+def run_webhook_server():
+    """
+    Chạy server nhận update Telegram qua webhook.
+
+    Với WEBHOOK_PROCESSES = 1, update được xử lý ngay trong tiến trình này. Với nhiều
+    tiến trình, server chỉ nhận update và chia cho các tiến trình worker theo ID chat.
+    """
+    global webhook_queues
+
+    # Không có secret token thì ai cũng gửi được update giả tới webhook
+    if not WEBHOOK_SECRET:
+        raise SystemExit("Chưa cấu hình WEBHOOK_SECRET, không thể chạy chế độ webhook")
+
+    if WEBHOOK_PROCESSES > 1:
+        webhook_queues = [multiprocessing.Queue(maxsize=WEBHOOK_QUEUE_SIZE) for _ in range(WEBHOOK_PROCESSES)]
+        workers = [
+            multiprocessing.Process(target=run_webhook_worker, args=(index, update_queue), name=f"webhook-worker-{index}")
+            for index, update_queue in enumerate(webhook_queues)
+        ]
+        for worker in workers:
+            worker.start()
+    else:
+        webhook_queues = [queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)]
+        workers = []
+        init_runtime(primary=True)
+        if async_bot:
+            threading.Thread(target=asyncio.run, args=(run_async_bot(webhook_queues[0]),), name="webhook-dispatcher", daemon=True).start()
+        else:
+            start_update_dispatchers(webhook_queues[0])
+
+    # Đăng ký webhook với Telegram (bỏ qua khi thử nghiệm local không có địa chỉ công khai)
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+        logger.info(f"Đã đăng ký webhook: {WEBHOOK_URL}{WEBHOOK_PATH}")
+
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookRequestHandler)
+    logger.info(f"Server webhook đang chạy tại {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH} với {WEBHOOK_PROCESSES} tiến trình xử lý")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        for worker in workers:
+            worker.terminate()
+
+# Chế độ asyncio (BOT_RUNTIME=async): một tiến trình giữ được rất nhiều hội thoại cùng lúc
+# vì các thao tác mạng (Telegram, AI, cơ sở dữ liệu) không chiếm luồng khi chờ.
+# Việc lập và vẽ lá số (CPU, selenium) vẫn chạy trong các worker lập lá số.
+async_bot = AsyncTeleBot(TELEGRAM_TOKEN) if AsyncTeleBot and BOT_RUNTIME == 'async' else None
+async_db_pool = None
+async_http_session = None
+async_analysis_slots = None
+# Khóa theo chat của chế độ asyncio, chia sọc như chat_locks, tạo khi bot bắt đầu chạy
+async_chat_locks = None
+
+def serialize_chat_async(handler):
+    """
+    Bản asyncio của serialize_chat: các update của cùng một chat đổi trạng thái lần lượt,
+    trong khi các chat khác vẫn chạy xen kẽ. Chờ khóa không chặn vòng lặp sự kiện.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update):
+        chat = update.message.chat if isinstance(update, types.CallbackQuery) else update.chat
+        async with async_chat_locks[chat.id % len(async_chat_locks)]:
+            return await handler(update)
+    return wrapper
+
+async def init_async_db_pool():
+    """
+    Tạo pool kết nối asyncpg cho endpoint đầu tiên kết nối được.
+
+    Returns:
+        bool: True nếu tạo được pool
+    """
+    global async_db_pool
+    last_error = None
+    for config in get_db_connection_configs():
+        try:
+            async_db_pool = await asyncpg.create_pool(
+                host=config['host'],
+                port=int(config['port']),
+                database=config['database'],
+                user=config['user'],
+                password=config['password'],
+                min_size=DB_POOL_MIN,
+                max_size=DB_POOL_MAX,
+                timeout=10,
+                # Transaction pooler của Supabase không hỗ trợ prepared statement dùng lại
+                statement_cache_size=0
+            )
         except Exception as e:
-            logger.warning(f"Không thể xóa tin nhắn tiến trình: {e}")
-        
-        # Cập nhật thống kê
-        bot_stats['charts_created'] += 1
-        
-        # Trả về đường dẫn ảnh nếu đã trích xuất được, nếu không thì trả về đường dẫn HTML
-        return (image_path if image_path else html_path), False  # False để đánh dấu đây là lá số mới tạo
-        
+            last_error = e
+            logger.warning(f"asyncpg không thể kết nối đến {config['host']}:{config['port']} - Lỗi: {e}")
+            continue
+        logger.info(f"asyncpg đã kết nối đến cơ sở dữ liệu với host: {config['host']}, pool tối đa {DB_POOL_MAX} kết nối")
+        return True
+
+    logger.error(f"asyncpg không kết nối được cơ sở dữ liệu. Lỗi cuối cùng: {last_error}")
+    return False
+
+async def async_save_user(user):
+    """Lưu thông tin người dùng vào cơ sở dữ liệu (asyncpg)."""
+    if not async_db_pool:
+        return None
+    try:
+        user_db_id = await async_db_pool.fetchval("""
+            INSERT INTO users (telegram_id, first_name, last_name, username)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (telegram_id)
+            DO UPDATE SET
+                first_name = EXCLUDED.first_name,
+                last_name = EXCLUDED.last_name,
+                username = EXCLUDED.username
+            RETURNING id
+        """, user.id, user.first_name, user.last_name, user.username)
+        logger.info(f"Đã lưu thông tin người dùng {user.id}")
+        return user_db_id
     except Exception as e:
-        logger.error(f"Lỗi khi lấy lá số tử vi: {e}")
-        
-        # Cập nhật thống kê lỗi
-        bot_stats['errors'] += 1
-        
-        # Nếu trình duyệt đã được khởi tạo, chụp màn hình lỗi và đóng trình duyệt
-        try:
-            if 'driver' in locals():
-                error_screenshot = f"error_{datetime.now().strftime('%Y%m%d%H%M%S')}.png"
-                driver.save_screenshot(error_screenshot)
-                logger.info(f"Đã chụp màn hình lỗi: {error_screenshot}")
-                driver.quit()
-        except:
-            pass
-        
-        # Xóa tin nhắn tiến trình nếu có
-        try:
-            if 'processing_msg' in locals():
-                bot.delete_message(user_id, processing_msg.message_id)
-        except:
-            pass
-        
-        # Tạo ảnh giả trong trường hợp lỗi
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        image_path = f"assets/{user_id}_chart_{timestamp}.jpg"
-        
-        # Tạo ảnh trống với thông tin lỗi
-        img = Image.new('RGB', (800, 600), color=(255, 255, 255))
-        d = ImageDraw.Draw(img)
-        d.text((10, 10), f"Lá số tử vi cho người sinh ngày {day}/{month}/{year}, giờ {birth_time}, giới tính {gender}", fill=(0, 0, 0))
-        d.text((10, 50), f"Có lỗi xảy ra khi lấy lá số tử vi: {str(e)}", fill=(0, 0, 0))
-        d.text((10, 90), "Vui lòng thử lại sau.", fill=(0, 0, 0))
-        img.save(image_path)
-        
-        return image_path, False
+        logger.error(f"Lỗi khi lưu thông tin người dùng: {e}")
+        return None
 
-def html_to_image(html_path, user_id):
-    """Chuyển đổi file HTML thành ảnh với định dạng tên file theo user_id"""
+async def async_get_user_charts(user_id, limit=5):
+    """Lấy lịch sử lá số tử vi của người dùng (asyncpg)."""
+    if not async_db_pool:
+        return []
     try:
-        # Thiết lập Chrome options
-        chrome_options = Options()
-        chrome_options.add_argument("--headless")
-        chrome_options.add_argument("--no-sandbox")
-        chrome_options.add_argument("--disable-dev-shm-usage")
-        chrome_options.add_argument("--window-size=1920,1080")
-        
-        # Khởi tạo trình duyệt
-        service = Service(ChromeDriverManager().install())
-        driver = webdriver.Chrome(service=service, options=chrome_options)
-        
-        # Mở file HTML
-        driver.get(f"file://{os.path.abspath(html_path)}")
-        
-        # Đợi trang tải xong
-        WebDriverWait(driver, 10).until(
-            EC.presence_of_element_located((By.TAG_NAME, "body"))
-        )
-        
-        # Tăng số lượng lá số cho user_id
-        if user_id not in user_chart_counts:
-            user_chart_counts[user_id] = 1
-        else:
-            user_chart_counts[user_id] += 1
-        
-        # Lưu screenshot theo cấu trúc /assets/{userid}_{số thứ tự}
-        screenshot_path = f"assets/{user_id}_{user_chart_counts[user_id]}.png"
-        
-        driver.save_screenshot(screenshot_path)
-        
-        # Đóng trình duyệt
-        driver.quit()
-        
-        return screenshot_path
-    
+        return await async_db_pool.fetch("""
+            SELECT id, day, month, year, birth_time, gender, created_at
+            FROM charts
+            WHERE user_id = $1
+            ORDER BY created_at DESC
+            LIMIT $2
+        """, user_id, limit)
     except Exception as e:
-        logger.error(f"Lỗi khi chuyển HTML thành ảnh: {e}")
-        raise
+        logger.error(f"Lỗi khi lấy lịch sử lá số tử vi: {e}")
+        return []
 
-def analyze_chart_with_gpt(chart_path, user_data):
+async def async_get_chart_info(chart_id):
     """
-    Phân tích lá số tử vi bằng AI thông qua AIRouter.
-    
+    Lấy thông tin ngày sinh và dữ liệu sao của lá số, không đọc ảnh (asyncpg).
+
+    Returns:
+        dict: Thông tin lá số, hoặc None nếu không tìm thấy
+    """
+    if not async_db_pool:
+        raise Exception("Không thể kết nối đến cơ sở dữ liệu")
+    row = await async_db_pool.fetchrow("""
+        SELECT day, month, year, birth_time, gender, chart_stars
+        FROM charts
+        WHERE id = $1
+    """, chart_id)
+    if not row:
+        return None
+    chart_info = dict(row)
+    if chart_info['chart_stars']:
+        chart_info['chart_stars'] = json.loads(chart_info['chart_stars'])
+    return chart_info
+
+async def async_load_analysis_cache_entry(image_hash, prompt_version=ANALYSIS_PROMPT_VERSION):
+    """Tìm phân tích đã lưu của lá số như load_analysis_cache_entry, đọc cơ sở dữ liệu bằng asyncpg."""
+    cached_analysis = find_analysis_cache_memory(image_hash, prompt_version)
+    if cached_analysis:
+        return cached_analysis
+
+    if not async_db_pool:
+        return None
+    try:
+        row = await async_db_pool.fetchrow("""
+            SELECT model, analysis FROM analyses
+            WHERE image_hash = $1 AND prompt_version = $2 AND model = ANY($3::text[])
+            ORDER BY created_at DESC
+            LIMIT 1
+        """, image_hash, prompt_version, get_analysis_cache_models())
+    except Exception as e:
+        logger.error(f"Lỗi khi đọc cache phân tích: {e}")
+        return None
+
+    if not row:
+        return None
+    analysis_dict = json.loads(row['analysis'])
+    put_analysis_cache_memory(make_analysis_cache_key(image_hash, prompt_version, row['model']), analysis_dict)
+    return dict(analysis_dict)
+
+async def async_store_analysis_cache_entry(image_hash, analysis_dict, prompt_version, model):
+    """Lưu phân tích của lá số như store_analysis_cache_entry, ghi cơ sở dữ liệu bằng asyncpg."""
+    cache_key = make_analysis_cache_key(image_hash, prompt_version, model)
+    put_analysis_cache_memory(cache_key, dict(analysis_dict))
+
+    if not async_db_pool:
+        return
+    try:
+        await async_db_pool.execute("""
+            INSERT INTO analyses (image_hash, prompt_version, model, analysis)
+            VALUES ($1, $2, $3, $4::jsonb)
+            ON CONFLICT (image_hash, prompt_version, model) DO UPDATE
+            SET analysis = EXCLUDED.analysis, created_at = CURRENT_TIMESTAMP
+        """, *cache_key, json.dumps(analysis_dict, ensure_ascii=False))
+    except Exception as e:
+        logger.error(f"Lỗi khi lưu cache phân tích: {e}")
+
+async def async_call_provider(provider, request):
+    """
+    Gọi một nhà cung cấp AI qua aiohttp và ghi nhận độ trễ.
+
     Args:
-        chart_path (str): Đường dẫn đến file lá số (hình ảnh)
-        user_data (dict): Thông tin người dùng
-        
+        provider (dict): Nhà cung cấp trong llm_providers
+        request (dict): Tham số gửi lên /chat/completions (không gồm model)
+
     Returns:
-        dict: Kết quả phân tích theo từng cung
+        dict: Phản hồi JSON, hoặc aiohttp.ClientResponse đang mở nếu request có stream=True
     """
+    kind = 'stream' if request.get('stream') else 'full'
+    start_time = time.time()
+    response = None
     try:
-        # Kiểm tra xem file có tồn tại không
-        if not os.path.exists(chart_path):
-            logger.error(f"File không tồn tại: {chart_path}")
-            return {"error": "Không tìm thấy lá số để phân tích. Vui lòng thử lại."}
-        
-        # Đọc file hình ảnh và chuyển sang base64
-        with open(chart_path, 'rb') as img_file:
-            base64_image = base64.b64encode(img_file.read()).decode('utf-8')
-        
-        # Lấy thông tin từ user_data
-        day = user_data.get('day', 'Không xác định')
-        month = user_data.get('month', 'Không xác định')
-        year = user_data.get('year', 'Không xác định')
-        birth_time = user_data.get('birth_time', 'Không xác định')
-        gender = user_data.get('gender', 'Không xác định')
-        
-        # Chuẩn bị prompt để phân tích tổng quan
-        system_prompt = """Bạn là người bạn thân thiện, hiểu biết về tử vi Việt Nam. 
-        Hãy xem và phân tích lá số tử vi trong hình ảnh một cách đơn giản, dễ hiểu và gần gũi.
-        
-        Phân tích lá số tử vi theo các cung sau:
-        1. Tổng quan: Nhận xét chung về cuộc đời người này
-        2. Cung Mệnh: Tính cách, đặc điểm bản thân, vận mệnh chung
-        3. Cung Phúc Đức: May mắn, phúc báo, hậu vận
-        4. Cung Tài Bạch: Tiền bạc, tài lộc, cách kiếm tiền
-        5. Cung Quan Lộc: Sự nghiệp, công danh, địa vị xã hội
-        6. Cung Phu Thê: Hôn nhân, người phối ngẫu
-        7. Cung Tử Tức: Con cái, mối quan hệ với con
-        8. Cung Huynh Đệ: Anh chị em, bạn bè, đồng nghiệp
-        9. Cung Điền Trạch: Nhà cửa, bất động sản
-        10. Cung Thiên Di: Du lịch, xa quê, cơ hội ở nơi xa
-        11. Cung Nô Bộc: Cấp dưới, người giúp việc, đối tác
-        12. Cung Tật Ách: Sức khỏe, bệnh tật, tai ương
-        
-        Hãy trả lời theo định dạng JSON với cấu trúc sau:
-        {
-          "tong_quan": "Phân tích tổng quan về lá số",
-          "cung_menh": "Phân tích về cung Mệnh",
-          "cung_phuc_duc": "Phân tích về cung Phúc Đức",
-          "cung_tai_bach": "Phân tích về cung Tài Bạch",
-          "cung_quan_loc": "Phân tích về cung Quan Lộc",
-          "cung_phu_the": "Phân tích về cung Phu Thê",
-          "cung_tu_tuc": "Phân tích về cung Tử Tức",
-          "cung_huynh_de": "Phân tích về cung Huynh Đệ",
-          "cung_dien_trach": "Phân tích về cung Điền Trạch",
-          "cung_thien_di": "Phân tích về cung Thiên Di",
-          "cung_no_boc": "Phân tích về cung Nô Bộc",
-          "cung_tat_ach": "Phân tích về cung Tật Ách"
-        }
-        
-        Mỗi phần phân tích nên ngắn gọn, dễ hiểu, thân thiện và có ít nhất một emoji phù hợp.
-        Đừng sử dụng ngôn ngữ quá chuyên môn. Hãy nói chuyện như một người bạn đang chia sẻ.
-        Hãy viết bằng tiếng Việt, giọng điệu thân thiện, đơn giản và dễ hiểu."""
-        
-        # Tạo nội dung user prompt đơn giản
-        user_prompt = f"""Xem tử vi cho tui với:
-        - Ngày sinh: {day}/{month}/{year}
-        - Giờ sinh: {birth_time}
-        - Giới tính: {gender}
-        
-        Hình ảnh đính kèm là lá số tử vi của tui. Cảm ơn bạn nhiều!"""
-        
-        logger.info(f"Đang phân tích lá số cho người sinh ngày {day}/{month}/{year}")
-        
-        # Gọi API để lấy phân tích
-        response = openai.ChatCompletion.create(
-            model="auto",  # AIRouter sẽ tự chọn mô hình phù hợp
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": [
-                    {"type": "text", "text": user_prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-                ]}
-            ],
-            temperature=0.7,
-            max_tokens=3000
+        response = await async_http_session.post(
+            f"{provider['api_base'].rstrip('/')}/chat/completions",
+            json=dict(request, model=provider['model']),
+            headers={'Authorization': f"Bearer {provider['api_key']}"},
+            timeout=aiohttp.ClientTimeout(total=None if kind == 'stream' else LLM_REQUEST_TIMEOUT,
+                                          sock_connect=HTTP_TIMEOUT, sock_read=LLM_REQUEST_TIMEOUT)
         )
-        
-        # Trích xuất phân tích
-        analysis_text = response.choices[0].message.content
-        logger.info(f"AIRouter đã phân tích xong lá số, model: {response.model}")
-        
-        # Chuyển đổi phân tích từ JSON sang dict
-        try:
-            # Tìm và trích xuất phần JSON từ phản hồi
-            json_match = re.search(r'({[\s\S]*})', analysis_text)
-            if json_match:
-                analysis_json = json_match.group(1)
-                analysis_dict = json.loads(analysis_json)
-            else:
-                # Nếu không tìm thấy JSON, tạo dict thủ công
-                analysis_dict = {
-                    "tong_quan": "Không thể phân tích tổng quan. Vui lòng thử lại.",
-                    "error": "Không thể phân tích theo định dạng JSON. Vui lòng thử lại."
-                }
-                # Thêm phần phân tích thô vào để tham khảo
-                analysis_dict["raw_analysis"] = analysis_text
-        except json.JSONDecodeError as e:
-            logger.error(f"Lỗi khi phân tích JSON: {e}")
-            # Tạo dict thủ công nếu không thể phân tích JSON
-            analysis_dict = {
-                "tong_quan": "Không thể phân tích tổng quan. Vui lòng thử lại.",
-                "error": f"Lỗi khi phân tích JSON: {str(e)}",
-                "raw_analysis": analysis_text
-            }
-        
-        return analysis_dict
-        
-    except Exception as e:
-        logger.error(f"Lỗi khi phân tích lá số: {e}")
-        return {
-            "error": f"Có lỗi xảy ra khi xem tử vi. Bạn thử lại sau nhé! Lỗi: {str(e)}"
-        }
+        if response.status != 200:
+            raise RuntimeError(f"HTTP {response.status}: {(await response.text())[:200]}")
+        result = response if kind == 'stream' else await response.json()
+    except BaseException as e:
+        # Gồm cả CancelledError khi bên khác trả lời trước: đóng kết nối ngay
+        if response is not None:
+            response.close()
+        if not isinstance(e, asyncio.CancelledError):
+            record_provider_result(provider, kind, error=e)
+        raise
 
-def format_analysis(analysis_dict, user_data, cung=None):
+    record_provider_result(provider, kind, latency=time.time() - start_time)
+    return result
+
+def discard_llm_task(task):
     """
-    Định dạng kết quả phân tích từ AIRouter để hiển thị đẹp hơn và thân thiện hơn.
-    
+    Bỏ một yêu cầu AI bất đồng bộ không được chọn: hủy nếu còn chạy, đóng kết nối
+    nếu nó đã trả về một luồng stream (về cùng lúc với bên thắng).
+
     Args:
-        analysis_dict (dict): Phân tích từ API dưới dạng dict
-        user_data (dict): Thông tin người dùng
-        cung (str, optional): Tên cung cần hiển thị, nếu None thì hiển thị tổng quan
-        
+        task (asyncio.Task): Yêu cầu do async_call_llm tạo
+    """
+    if not task.done():
+        task.cancel()
+        return
+    if task.cancelled() or task.exception() is not None:
+        return
+    response = task.result()
+    if isinstance(response, aiohttp.ClientResponse):
+        response.close()
+
+async def async_call_llm(**request):
+    """
+    Gọi AI qua bộ định tuyến nhiều nhà cung cấp như call_llm, dùng aiohttp và asyncio.
+
+    Yêu cầu dự phòng được gửi khi quá mốc p95 độ trễ của nhà cung cấp đang gọi, kết quả
+    về trước được dùng và các yêu cầu còn lại bị hủy thật sự (đóng kết nối HTTP).
+
+    Args:
+        **request: Tham số gửi lên /chat/completions (messages, temperature, max_tokens, stream...)
+
     Returns:
-        str: Phân tích đã được định dạng
+        tuple: (phản hồi JSON, hoặc aiohttp.ClientResponse đang mở nếu request có stream=True,
+        nhà cung cấp đã trả lời trước)
     """
+    kind = 'stream' if request.get('stream') else 'full'
+    order = get_provider_order(kind)
+    if not order:
+        raise RuntimeError("Chưa cấu hình API key cho nhà cung cấp AI nào")
+
+    pending = {}
+    next_index = 0
+    hedges = 0
+    last_error = None
+
+    def launch():
+        nonlocal next_index
+        provider = order[next_index]
+        next_index += 1
+        task = asyncio.ensure_future(async_call_provider(provider, request))
+        pending[task] = provider
+        return provider
+
+    provider = launch()
     try:
-        # Kiểm tra lỗi
-        if "error" in analysis_dict and cung != "tong_quan":
-            return f"❌ *Lỗi khi phân tích*\n\n{analysis_dict['error']}"
-        
-        # Lấy thông tin người dùng
-        day = user_data.get('day', 'Không xác định')
-        month = user_data.get('month', 'Không xác định')
-        year = user_data.get('year', 'Không xác định')
-        birth_time = user_data.get('birth_time', 'Không xác định') 
-        gender = user_data.get('gender', 'Không xác định')
-        
-        # Ánh xạ tên cung
-        cung_mapping = {
-            "tong_quan": "Tổng Quan",
-            "cung_menh": "Cung Mệnh",
-            "cung_phuc_duc": "Cung Phúc Đức",
-            "cung_tai_bach": "Cung Tài Bạch",
-            "cung_quan_loc": "Cung Quan Lộc",
-            "cung_phu_the": "Cung Phu Thê",
-            "cung_tu_tuc": "Cung Tử Tức",
-            "cung_huynh_de": "Cung Huynh Đệ",
-            "cung_dien_trach": "Cung Điền Trạch",
-            "cung_thien_di": "Cung Thiên Di",
-            "cung_no_boc": "Cung Nô Bộc",
-            "cung_tat_ach": "Cung Tật Ách"
-        }
-        
-        # Emoji cho từng cung
-        cung_emoji = {
-            "tong_quan": "🔮",
-            "cung_menh": "👤",
-            "cung_phuc_duc": "🙏",
-            "cung_tai_bach": "💰",
-            "cung_quan_loc": "💼",
-            "cung_phu_the": "💑",
-            "cung_tu_tuc": "👶",
-            "cung_huynh_de": "👥",
-            "cung_dien_trach": "🏠",
-            "cung_thien_di": "✈️",
-            "cung_no_boc": "👨‍👩‍👧‍👦",
-            "cung_tat_ach": "🏥"
-        }
-        
-        # Nếu cung được chỉ định, chỉ hiển thị phân tích cho cung đó
-        if cung and cung in analysis_dict:
-            cung_name = cung_mapping.get(cung, cung)
-            cung_content = analysis_dict.get(cung, "Không có thông tin")
-            
-            formatted_text = f"{cung_emoji.get(cung, '✨')} *{cung_name.upper()}* {cung_emoji.get(cung, '✨')}\n\n"
-            formatted_text += f"👤 *Thông tin*: {day}/{month}/{year}, {birth_time}, {gender}\n\n"
-            formatted_text += f"{cung_content}\n\n"
-            
-            return formatted_text
-        
-        # Nếu không chỉ định cung, hiển thị tổng quan
-        tong_quan = analysis_dict.get("tong_quan", "Không có thông tin tổng quan")
-        
-        # Tạo lời chào thân thiện
-        greeting = random.choice([
-            "Chào bạn! Đây là tử vi của bạn nè:",
-            "Mình đã xem lá số của bạn rồi đây:",
-            "Tử vi của bạn có nhiều điều thú vị:",
-            "Mình đã phân tích lá số của bạn, cùng xem nhé:",
-            "Đây là những điều mình thấy từ lá số của bạn:"
-        ])
-        
-        formatted_text = f"""🔮 *TỬ VI CỦA BẠN* 🔮
+        while pending:
+            # Mốc gửi yêu cầu dự phòng: p95 độ trễ của nhà cung cấp vừa gọi
+            hedge_delay = None
+            if hedges < LLM_MAX_HEDGES and next_index < len(order):
+                hedge_delay = max(LLM_HEDGE_MIN_DELAY, get_provider_latency(provider, kind, 0.95) or LLM_HEDGE_DEFAULT_DELAY)
+
+            done, _ = await asyncio.wait(pending, timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedges += 1
+                bot_stats['llm_hedges'] += 1
+                provider = launch()
+                logger.info(f"Quá {hedge_delay:.1f}s chưa có phản hồi, gửi thêm yêu cầu dự phòng đến {provider['name']}")
+                continue
+
+            for task in done:
+                winner = pending.pop(task)
+                try:
+                    response = task.result()
+                except Exception as e:
+                    last_error = e
+                    logger.warning(f"Nhà cung cấp AI {winner['name']} lỗi: {e}")
+                    continue
+
+                if hedges and winner is not order[0]:
+                    bot_stats['llm_hedge_wins'] += 1
+                return response, winner
+
+            # Tất cả yêu cầu đang chạy đều lỗi thì chuyển sang nhà cung cấp tiếp theo
+            if not pending and next_index < len(order):
+                provider = launch()
+    except asyncio.CancelledError:
+        # Người dùng hủy trong lúc chờ: các kết nối đang mở được đóng ở dưới
+        bot_stats['llm_calls_cancelled'] += 1
+        raise
+    finally:
+        # Bỏ các yêu cầu còn lại, gồm cả các yêu cầu cùng về trong done
+        # (kể cả khi chính lời gọi này bị hủy)
+        for task in pending:
+            discard_llm_task(task)
+
+    raise last_error
+
+async def async_stream_analysis_completion(messages, on_progress, max_tokens=3000):
+    """
+    Gọi AI ở chế độ stream như stream_analysis_completion, đọc từng dòng SSE qua aiohttp.
+
+    Args:
+        messages (list): Các tin nhắn gửi cho AI
+        on_progress (coroutine function): Hàm nhận dict các cung đã phân tích xong
+        max_tokens (int): Số token tối đa của phản hồi
+
+    Returns:
+        tuple: (toàn bộ nội dung phản hồi, tên model, nhà cung cấp đã trả lời)
+    """
+    response, provider = await async_call_llm(
+        messages=messages,
+        temperature=0.7,
+        max_tokens=max_tokens,
+        stream=True
+    )
+
+    chunks = []
+    model = None
+    completed_keys = set()
+    try:
+        async for line in response.content:
+            line = line.decode('utf-8').strip()
+            if not line.startswith('data:'):
+                continue
+            data = line[5:].strip()
+            if data == '[DONE]':
+                break
+            chunk = json.loads(data)
+            model = model or chunk.get('model')
+            if not chunk.get('choices'):
+                continue
+            content = chunk['choices'][0].get('delta', {}).get('content')
+            if not content:
+                continue
+            chunks.append(content)
+
+            # Chỉ parse lại khi vừa có dấu ngoặc kép, tức là có thể một trường vừa đóng
+            if '"' not in content:
+                continue
+            partial = parse_partial_analysis(''.join(chunks))
+            if set(partial) - completed_keys:
+                completed_keys = set(partial)
+                try:
+                    await on_progress(partial)
+                except Exception as e:
+                    logger.warning(f"Lỗi khi cập nhật phân tích đang stream: {e}")
+    except asyncio.CancelledError:
+        bot_stats['llm_calls_cancelled'] += 1
+        bot_stats['llm_tokens_saved'] += max(0, max_tokens - len(chunks))
+        raise
+    finally:
+        # Đóng kết nối để nhà cung cấp dừng sinh tiếp khi bị hủy
+        response.close()
 
-{greeting}
+    return ''.join(chunks), model, provider
 
-📅 *Thông tin của bạn*
-• Ngày sinh: {day}/{month}/{year}
-• Giờ sinh: {birth_time}
-• Giới tính: {gender}
+async def async_analyze_cung(cung_key, user_data, analysis_dict=None):
+    """
+    Phân tích riêng một cung như analyze_cung_with_gpt, gọi AI bằng aiohttp.
 
-{tong_quan}
+    Returns:
+        str: Phân tích của cung, hoặc None nếu không phân tích được
+    """
+    if analysis_dict is None:
+        analysis_dict = user_data.get('analysis', {})
+    image_hash = user_data.get('image_hash')
+    prompt_version = get_cung_prompt_version(cung_key)
 
-✨ *Chọn một cung để xem chi tiết* ✨
-"""
-        return formatted_text
-        
+    if image_hash:
+        cached_cung = await async_load_analysis_cache_entry(image_hash, prompt_version)
+        if cached_cung and cung_key in cached_cung:
+            bot_stats['analysis_cache_hits'] += 1
+            return cached_cung[cung_key]
+        bot_stats['analysis_cache_misses'] += 1
+
+    try:
+        async with async_analysis_slots:
+            response, provider = await async_call_llm(
+                messages=build_cung_messages(cung_key, user_data, analysis_dict),
+                temperature=0.7,
+                max_tokens=500
+            )
+        cung_analysis = response['choices'][0]['message']['content'].strip()
     except Exception as e:
-        logger.error(f"Lỗi khi định dạng phân tích: {e}")
-        if isinstance(analysis_dict, str):
-            return analysis_dict  # Trả về phân tích gốc nếu có lỗi
-        elif isinstance(analysis_dict, dict) and "error" in analysis_dict:
-            return f"❌ *Lỗi khi phân tích*\n\n{analysis_dict['error']}"
+        logger.error(f"Lỗi khi phân tích {cung_key}: {e}")
+        return None
+
+    if image_hash and cung_analysis:
+        await async_store_analysis_cache_entry(image_hash, {cung_key: cung_analysis}, prompt_version, get_llm_model_key(provider))
+    return cung_analysis
+
+async def async_analyze_all_cung(analysis_dict, user_data, on_progress=None):
+    """
+    Phân tích đồng thời tất cả các cung như analyze_all_cung_parallel, dùng task asyncio thay cho luồng.
+
+    Returns:
+        dict: Kết quả phân tích đủ các cung (cung lỗi sẽ thiếu và được phân tích lại khi người dùng mở)
+    """
+    if 'error' in analysis_dict or 'tom_tat' not in analysis_dict:
+        return analysis_dict
+
+    merged = dict(analysis_dict)
+
+    async def analyze_with_retry(cung_key):
+        for attempt in range(ANALYSIS_CUNG_RETRIES + 1):
+            cung_analysis = await async_analyze_cung(cung_key, user_data, analysis_dict)
+            if cung_analysis:
+                return cung_key, cung_analysis
+            if attempt < ANALYSIS_CUNG_RETRIES:
+                logger.warning(f"Thử lại phân tích {cung_key} (lần {attempt + 1})")
+                await asyncio.sleep(1 + attempt)
+        return cung_key, None
+
+    pending = [cung_key for cung_key in ANALYSIS_CUNG_NAMES if cung_key not in merged]
+    if not pending:
+        return merged
+
+    start_time = time.time()
+    cung_tasks = [asyncio.ensure_future(analyze_with_retry(cung_key)) for cung_key in pending]
+    try:
+        for task in asyncio.as_completed(cung_tasks):
+            cung_key, cung_analysis = await task
+            if not cung_analysis:
+                continue
+            merged[cung_key] = cung_analysis
+            if on_progress:
+                try:
+                    await on_progress(dict(merged))
+                except Exception as e:
+                    logger.warning(f"Lỗi khi cập nhật phân tích đang chạy song song: {e}")
+    finally:
+        # Khi bị hủy, dừng luôn các cung đang phân tích dở
+        for task in cung_tasks:
+            task.cancel()
+
+    missing = [cung_key for cung_key in ANALYSIS_CUNG_NAMES if cung_key not in merged]
+    logger.info(f"Đã phân tích song song {len(pending) - len(missing)}/{len(pending)} cung trong {time.time() - start_time:.1f}s")
+    return merged
+
+async def async_analyze_chart(user_data, on_progress=None):
+    """
+    Phân tích lá số như analyze_chart_with_gpt (chỉ với ANALYSIS_INPUT='text'), gọi AI bằng aiohttp.
+
+    Args:
+        user_data (dict): Thông tin người dùng
+        on_progress (coroutine function, optional): Hàm nhận dict các cung đã xong khi stream
+
+    Returns:
+        dict: Kết quả phân tích theo từng cung
+    """
+    try:
+        # An sao lá số là việc tính toán, chạy trong luồng riêng để không chặn vòng lặp sự kiện
+        request = await asyncio.to_thread(build_analysis_request, None, user_data)
+        if 'error' in request:
+            return {"error": request['error']}
+        image_hash = request['image_hash']
+        prompt_version = request['prompt_version']
+
+        # Lá số đã được phân tích thì trả lại kết quả cũ
+        cached_analysis = await async_load_analysis_cache_entry(image_hash, prompt_version)
+        if cached_analysis:
+            bot_stats['analysis_cache_hits'] += 1
+            logger.info(f"Lấy phân tích lá số từ cache: {image_hash[:12]}")
+            if ANALYSIS_MODE == 'parallel':
+                return await async_analyze_all_cung(cached_analysis, user_data, on_progress)
+            return cached_analysis
+        bot_stats['analysis_cache_misses'] += 1
+
+        logger.info(f"Đang phân tích lá số cho người sinh ngày {user_data.get('day')}/{user_data.get('month')}/{user_data.get('year')}")
+
+        if on_progress and ANALYSIS_STREAM:
+            analysis_text, model, provider = await async_stream_analysis_completion(request['messages'], on_progress, request['max_tokens'])
         else:
-            return "Có lỗi xảy ra khi định dạng phân tích. Vui lòng thử lại."
+            response, provider = await async_call_llm(
+                messages=request['messages'],
+                temperature=0.7,
+                max_tokens=request['max_tokens']
+            )
+            analysis_text = response['choices'][0]['message']['content']
+            model = response.get('model')
+        logger.info(f"{provider['name']} đã phân tích xong lá số, model: {model}")
 
-@bot.message_handler(commands=['cancel'])
-def cancel(message):
-    """Hủy hội thoại."""
+        analysis_dict = parse_analysis_text(analysis_text)
+
+        # Chỉ lưu cache khi phân tích thành công
+        if 'error' not in analysis_dict:
+            await async_store_analysis_cache_entry(image_hash, analysis_dict, prompt_version, get_llm_model_key(provider))
+
+        if ANALYSIS_MODE == 'parallel':
+            return await async_analyze_all_cung(analysis_dict, user_data, on_progress)
+        return analysis_dict
+
+    except Exception as e:
+        logger.error(f"Lỗi khi phân tích lá số: {e}")
+        return {
+            "error": f"Có lỗi xảy ra khi xem tử vi. Bạn thử lại sau nhé! Lỗi: {str(e)}"
+        }
+
+async def async_answer_callback(call, text=None):
+    """Trả lời callback query, chỉ ghi log nếu không trả lời được."""
+    try:
+        await async_bot.answer_callback_query(call.id, text)
+    except Exception as e:
+        logger.warning(f"Không thể trả lời callback query: {e}")
+
+@serialize_chat_async
+async def async_start(message):
+    """Bắt đầu hội thoại (asyncio)."""
     chat_id = message.chat.id
-    
-    # Check if user has an active state
-    if chat_id in user_states:
-        # Clear all user states
-        del user_states[chat_id]
-        
-        bot.send_message(
-            chat_id,
-            "❌ *Đã hủy thao tác*\n\nGõ /start để bắt đầu lại hoặc /help để xem hướng dẫn.",
-            parse_mode='Markdown'
-        )
+    await asyncio.to_thread(clear_session, chat_id)
+    await async_save_user(message.from_user)
+    await async_bot.send_message(chat_id, WELCOME_MESSAGE, parse_mode='Markdown')
+    await asyncio.to_thread(set_session, chat_id, WAITING_FOR_BIRTH_DATE)
+
+@serialize_chat_async
+async def async_handle_text(message):
+    """Nhận tin nhắn văn bản (asyncio): ngày sinh nếu chat đang chờ nhập ngày sinh, ngược lại như echo_all."""
+    if await asyncio.to_thread(get_session, message.chat.id) == WAITING_FOR_BIRTH_DATE:
+        await async_get_birth_date(message)
     else:
-        bot.send_message(
-            chat_id,
-            "ℹ️ *Không có thao tác nào để hủy*\n\nGõ /start để bắt đầu lập lá số tử vi hoặc /help để xem hướng dẫn.",
-            parse_mode='Markdown'
-        )
+        await run_sync_handler(echo_all, message)
 
-@bot.message_handler(commands=['help'])
-def help_command(message):
-    """Hiển thị hướng dẫn sử dụng."""
+async def async_get_birth_date(message):
+    """Nhận ngày tháng năm sinh và yêu cầu giờ sinh (asyncio)."""
     chat_id = message.chat.id
-    help_text = (
-        "🔮 *HƯỚNG DẪN SỬ DỤNG BOT TỬ VI* 🔮\n\n"
-        "Bot này giúp bạn lập và phân tích lá số tử vi dựa trên thông tin ngày sinh. Các lệnh cơ bản:\n\n"
-        "• /start - Bắt đầu lập lá số tử vi\n"
-        "• /cancel - Hủy thao tác hiện tại\n"
-        "• /help - Hiển thị hướng dẫn này\n\n"
-        "✨ *Quy trình sử dụng*:\n"
-        "1. Nhập ngày tháng năm sinh (DD/MM/YYYY)\n"
-        "2. Chọn giờ sinh (theo 12 con giáp)\n"
-        "3. Chọn giới tính\n"
-        "4. Đợi bot lập lá số tử vi\n"
-        "5. Chọn 'Phân tích lá số' để nhận được luận giải chi tiết\n\n"
-        "🔍 *Lưu ý*: Để có kết quả chính xác, vui lòng cung cấp thông tin đầy đủ và chính xác."
-    )
-    
-    bot.send_message(
-        chat_id,
-        help_text,
-        parse_mode='Markdown'
-    )
+    reply, markup = await asyncio.to_thread(start_birth_time_session, chat_id, message.text)
+    await async_bot.send_message(chat_id, reply, reply_markup=markup, parse_mode='Markdown')
 
-@bot.message_handler(commands=['stats'])
-def stats_command(message):
-    """Hiển thị thống kê sử dụng bot (chỉ dành cho admin)."""
-    chat_id = message.chat.id
-    
-    # Danh sách ID admin (có thể đưa vào biến môi trường)
-    admin_ids = [int(id.strip()) for id in os.getenv('ADMIN_IDS', '').split(',') if id.strip()]
-    
-    # Nếu không có admin nào được cấu hình, cho phép bất kỳ ai xem thống kê
-    if not admin_ids:
-        send_stats_to_admin(chat_id)
+@serialize_chat_async
+async def async_handle_birth_time(call):
+    """Nhận giờ sinh và yêu cầu chọn giới tính (asyncio)."""
+    chat_id = call.message.chat.id
+    birth_time = await asyncio.to_thread(select_birth_time, chat_id, call.data)
+    if birth_time is None:
+        await async_answer_callback(call, EXPIRED_REQUEST_MESSAGE)
         return
-    
-    # Kiểm tra xem người dùng có phải là admin không
-    if chat_id in admin_ids:
-        send_stats_to_admin(chat_id)
-    else:
-        bot.send_message(
-            chat_id,
-            "⚠️ *Bạn không có quyền xem thống kê*\n\nChỉ admin mới có thể sử dụng lệnh này.",
-            parse_mode='Markdown'
-        )
 
-@bot.message_handler(func=lambda message: True)
-def echo_all(message):
-    """Xử lý các tin nhắn không rõ."""
-    chat_id = message.chat.id
-    if chat_id not in user_states:
-        bot.send_message(
-            chat_id,
-            "🤔 Bot không hiểu yêu cầu của bạn.\n\n"
-            "• Gõ /start để bắt đầu lập lá số tử vi\n"
-            "• Gõ /help để xem hướng dẫn sử dụng",
-            parse_mode='Markdown'
-        )
-    else:
-        bot.send_message(
+    try:
+        await async_bot.edit_message_text(
+            f"✅ Bạn đã chọn giờ sinh: *{birth_time}*",
             chat_id,
-            "⚠️ Vui lòng làm theo hướng dẫn hoặc gõ /cancel để hủy thao tác hiện tại.",
+            call.message.message_id,
             parse_mode='Markdown'
         )
+    except Exception as e:
+        logger.warning(f"Không thể cập nhật tin nhắn: {e}")
+        await async_bot.send_message(chat_id, f"✅ Bạn đã chọn giờ sinh: *{birth_time}*", parse_mode='Markdown')
 
-def process_analysis(chat_id):
-    """Xử lý phân tích lá số tử vi."""
-    if chat_id not in user_states:
-        bot.send_message(
-            chat_id, 
-            "❌ *Không tìm thấy lá số tử vi*\n\nVui lòng gõ /start để bắt đầu lại.",
-            parse_mode='Markdown'
-        )
+    await async_bot.send_message(chat_id, GENDER_PROMPT_MESSAGE, reply_markup=create_gender_markup(), parse_mode='Markdown')
+    await async_answer_callback(call)
+
+@serialize_chat_async
+async def async_handle_gender_selection(call):
+    """Nhận giới tính và đưa yêu cầu lập lá số vào hàng đợi của worker lập lá số (asyncio)."""
+    chat_id = call.message.chat.id
+    # Lập và vẽ lá số là việc nặng về CPU/trình duyệt, do các worker lập lá số đảm nhận
+    status, job = await asyncio.to_thread(submit_chart_request, chat_id, call.data)
+    await async_answer_callback(call, {'expired': EXPIRED_REQUEST_MESSAGE, 'duplicate': CHART_DUPLICATE_MESSAGE}.get(status))
+
+    if status == 'overloaded':
+        await async_bot.send_message(chat_id, CHART_OVERLOADED_MESSAGE, parse_mode='Markdown')
+    elif status == 'queued':
+        position_message = format_queue_position(job)
+        if position_message:
+            await async_bot.send_message(chat_id, position_message, parse_mode='Markdown')
+
+async def async_handle_analysis_callbacks(call):
+    """Xử lý nút phân tích / hủy phân tích (asyncio)."""
+    chat_id = call.message.chat.id
+
+    if call.data == "analyze":
+        if not claim_chat_analysis(chat_id):
+            await async_answer_callback(call, ANALYSIS_DUPLICATE_MESSAGE)
+            return
+        await async_answer_callback(call)
+        task = begin_chat_task(chat_id, 'analysis', asyncio.current_task())
+        try:
+            await async_process_analysis(chat_id)
+        except asyncio.CancelledError:
+            if not task['cancelled'].is_set():
+                raise
+            logger.info(f"Đã dừng phân tích lá số cho chat {chat_id} theo yêu cầu hủy")
+        finally:
+            end_chat_task(task)
+            release_chat_analysis(chat_id)
+    elif call.data == "cancel_analysis":
+        await async_answer_callback(call)
+        # Đóng trình duyệt, luồng stream... có thể chặn nên chạy trong luồng riêng
+        await asyncio.to_thread(cancel_chat_analysis, chat_id)
+        await async_bot.send_message(chat_id, ANALYSIS_CANCELLED_MESSAGE, parse_mode='Markdown')
+
+async def async_process_analysis(chat_id):
+    """Xử lý phân tích lá số tử vi (asyncio), hiện dần tổng quan và các cung khi AI stream về."""
+    user_data = await asyncio.to_thread(get_analysis_session, chat_id)
+    if user_data is None:
+        await async_bot.send_message(chat_id, CHART_NOT_FOUND_MESSAGE, parse_mode='Markdown')
         return
-    
-    # Kiểm tra xem có đường dẫn ảnh hoặc HTML không
-    if 'chart_image_path' not in user_states[chat_id] and 'chart_html_path' not in user_states[chat_id]:
-        bot.send_message(
-            chat_id, 
-            "❌ *Không tìm thấy lá số tử vi*\n\nVui lòng gõ /start để bắt đầu lại.",
-            parse_mode='Markdown'
-        )
+
+    # Phân tích bằng ảnh cần đọc và chuyển đổi file ảnh, dùng luồng xử lý đồng bộ
+    if ANALYSIS_INPUT != 'text':
+        await asyncio.to_thread(process_analysis, chat_id)
         return
-    
-    # Gửi thông báo đang phân tích
-    processing_msg = bot.send_message(
-        chat_id, 
-        "⏳ *Đang xem tử vi cho bạn...*\n\nChờ mình một chút nhé, mình đang xem lá số của bạn...",
-        parse_mode='Markdown'
-    )
-    
+
+    processing_msg = await async_bot.send_message(chat_id, ANALYSIS_PROCESSING_MESSAGE, parse_mode='Markdown')
+
+    stream_state = {'last_edit': 0, 'shown': False}
+
+    async def show_partial_analysis(partial):
+        """Sửa tin nhắn đang xử lý thành phần tổng quan và các cung đã phân tích xong."""
+        update = await asyncio.to_thread(prepare_partial_analysis, chat_id, user_data, partial, stream_state)
+        if not update:
+            return
+        text, markup = update
+        await async_bot.edit_message_text(text, chat_id, processing_msg.message_id,
+                                          reply_markup=markup, parse_mode='Markdown')
+        stream_state['last_edit'] = time.time()
+        stream_state['shown'] = True
+
     try:
-        # Lấy đường dẫn ảnh hoặc HTML từ trạng thái người dùng
-        if 'chart_image_path' in user_states[chat_id]:
-            chart_path = user_states[chat_id]['chart_image_path']
-        else:
-            chart_path = user_states[chat_id]['chart_html_path']
-            # Nếu là HTML, chuyển đổi thành ảnh
-            if chart_path.endswith('.html'):
-                # Thử trích xuất ảnh base64 từ HTML
-                timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-                image_path = extract_base64_image_from_html(chart_path, timestamp, chat_id, user_states[chat_id])
-                if image_path:
-                    chart_path = image_path
-                else:
-                    # Nếu không trích xuất được, chuyển HTML thành ảnh
-                    chart_path = html_to_image(chart_path, chat_id)
-                user_states[chat_id]['chart_image_path'] = chart_path
-        
-        # Phân tích lá số tử vi
-        analysis_dict = analyze_chart_with_gpt(chart_path, user_states[chat_id])
-        
-        # Lưu phân tích vào trạng thái người dùng để sử dụng sau này
-        user_states[chat_id]['analysis'] = analysis_dict
-        
-        # Đánh dấu rằng người dùng đã hoàn thành phân tích
-        user_states[chat_id]['analysis_complete'] = True
-        
-        # Xóa thông báo đang xử lý
+        analysis_dict = await async_analyze_chart(user_data, on_progress=show_partial_analysis)
+        formatted_analysis = await asyncio.to_thread(complete_analysis, chat_id, user_data, analysis_dict)
+
+        # Tổng quan đã hiện trong tin nhắn đang xử lý, chỉ cần cập nhật đủ các cung
+        edited = False
+        if stream_state['shown'] and 'error' not in analysis_dict:
+            try:
+                await async_bot.edit_message_text(formatted_analysis, chat_id, processing_msg.message_id,
+                                                  reply_markup=create_cung_markup(), parse_mode='Markdown')
+                edited = True
+            except Exception as e:
+                logger.warning(f"Không thể cập nhật tin nhắn phân tích, gửi tin nhắn mới: {e}")
+
+        if not edited:
+            try:
+                await async_bot.delete_message(chat_id, processing_msg.message_id)
+            except Exception as e:
+                logger.warning(f"Không thể xóa tin nhắn 'đang xử lý': {e}")
+            await async_bot.send_message(chat_id, formatted_analysis, parse_mode='Markdown')
+            await async_bot.send_message(chat_id, CUNG_MENU_MESSAGE, reply_markup=create_cung_markup(), parse_mode='Markdown')
+
+        bot_stats['analyses_performed'] += 1
+
+    except asyncio.CancelledError:
         try:
-            bot.delete_message(chat_id, processing_msg.message_id)
-        except Exception as e:
-            logger.warning(f"Không thể xóa tin nhắn 'đang xử lý': {e}")
-        
-        # Định dạng phân tích tổng quan
-        formatted_analysis = format_analysis(analysis_dict, user_states[chat_id])
-        
-        # Gửi phân tích tổng quan cho người dùng
-        bot.send_message(
-            chat_id, 
-            formatted_analysis, 
-            parse_mode='Markdown'
-        )
-        
-        # Tạo menu các cung
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        
-        # Thêm các nút cho từng cung
-        cung_buttons = [
-            ("👤 Cung Mệnh", "menh"),
-            ("🙏 Cung Phúc Đức", "phuc_duc"),
-            ("💰 Cung Tài Bạch", "tai_bach"),
-            ("💼 Cung Quan Lộc", "quan_loc"),
-            ("💑 Cung Phu Thê", "phu_the"),
-            ("👶 Cung Tử Tức", "tu_tuc"),
-            ("👥 Cung Huynh Đệ", "huynh_de"),
-            ("🏠 Cung Điền Trạch", "dien_trach"),
-            ("✈️ Cung Thiên Di", "thien_di"),
-            ("👨‍👩‍👧‍👦 Cung Nô Bộc", "no_boc"),
-            ("🏥 Cung Tật Ách", "tat_ach")
-        ]
-        
-        # Thêm các nút vào markup
-        for button_text, callback_data in cung_buttons:
-            markup.add(types.InlineKeyboardButton(button_text, callback_data=f"cung_{callback_data}"))
-        
-        # Gửi menu các cung
-        bot.send_message(
-            chat_id,
-            "👇 *Chọn một cung để xem chi tiết:*",
-            reply_markup=markup,
-            parse_mode='Markdown'
-        )
-        
-        # Cập nhật thống kê
+            await async_bot.delete_message(chat_id, processing_msg.message_id)
+        except Exception:
+            pass
+        raise
+
+    except Exception as e:
+        logger.error(f"Lỗi khi phân tích lá số tử vi: {e}")
+        try:
+            await async_bot.send_message(
+                chat_id,
+                f"❌ *Đã xảy ra lỗi khi phân tích lá số tử vi*\n\nLỗi: {str(e)}\n\nVui lòng thử lại sau.",
+                parse_mode='Markdown'
+            )
+            await async_bot.delete_message(chat_id, processing_msg.message_id)
+        except Exception as delete_error:
+            logger.warning(f"Không thể xóa tin nhắn hoặc gửi thông báo lỗi: {delete_error}")
+        bot_stats['errors'] += 1
+
+async def async_handle_cung_selection(call):
+    """Hiển thị phân tích một cung, phân tích ngay nếu cung chưa có (asyncio)."""
+    chat_id = call.message.chat.id
+    cung_type = call.data
+    user_data, answer, needs_analysis = await asyncio.to_thread(check_cung_selection, chat_id, cung_type)
+    if answer:
+        await async_answer_callback(call, answer)
+        return
+
+    if needs_analysis:
+        await async_answer_callback(call, CUNG_PROCESSING_MESSAGE)
+        task = begin_chat_task(chat_id, 'cung', asyncio.current_task())
+        try:
+            await async_bot.send_chat_action(chat_id, 'typing')
+            cung_analysis = await async_analyze_cung(cung_type, user_data)
+        except asyncio.CancelledError:
+            if not task['cancelled'].is_set():
+                raise
+            return
+        finally:
+            end_chat_task(task)
+            release_cung_request(chat_id, cung_type)
+
+        if not cung_analysis:
+            await async_bot.send_message(chat_id, CUNG_FAILED_MESSAGE, parse_mode='Markdown')
+            return
+        if not await asyncio.to_thread(store_cung_analysis, chat_id, user_data, cung_type, cung_analysis):
+            return
+    else:
+        await async_answer_callback(call)
+
+    await async_bot.send_message(
+        chat_id,
+        format_analysis(user_data['analysis'], user_data, cung=cung_type),
+        parse_mode='Markdown'
+    )
+
+async def async_history_command(message):
+    """Hiển thị lịch sử lá số tử vi của người dùng (asyncio)."""
+    chat_id = message.chat.id
+    charts = await async_get_user_charts(chat_id)
+    if not charts:
+        await async_bot.send_message(chat_id, HISTORY_EMPTY_MESSAGE, parse_mode='Markdown')
+        return
+
+    history_message, markup = format_history(charts)
+    await async_bot.send_message(chat_id, history_message, reply_markup=markup, parse_mode='Markdown')
+
+async def async_handle_analyze_chart(call):
+    """Phân tích lá số từ lịch sử (asyncio), dùng dữ liệu sao nên không cần đọc ảnh."""
+    if ANALYSIS_INPUT != 'text':
+        await run_sync_handler(handle_analyze_chart, call)
+        return
+
+    chat_id = call.message.chat.id
+    chart_id = int(call.data.split("_")[2])
+    await async_answer_callback(call)
+    processing_msg = await async_bot.send_message(chat_id, HISTORY_PROCESSING_MESSAGE, parse_mode='Markdown')
+
+    try:
+        chart_info = await async_get_chart_info(chart_id)
+        if not chart_info:
+            await async_bot.send_message(chat_id, HISTORY_NOT_FOUND_MESSAGE, parse_mode='Markdown')
+            await async_bot.delete_message(chat_id, processing_msg.message_id)
+            return
+
+        user_data = new_session_state(**chart_info, chart_id=chart_id)
+        task = begin_chat_task(chat_id, 'analysis', asyncio.current_task())
+        try:
+            analysis_dict = await async_analyze_chart(user_data)
+        except asyncio.CancelledError:
+            if not task['cancelled'].is_set():
+                raise
+            logger.info(f"Đã dừng phân tích lá số {chart_id} cho chat {chat_id} theo yêu cầu hủy")
+            await async_bot.delete_message(chat_id, processing_msg.message_id)
+            return
+        finally:
+            end_chat_task(task)
+        formatted_analysis = await asyncio.to_thread(complete_analysis, chat_id, user_data, analysis_dict, replace_session=True)
+
+        await async_bot.delete_message(chat_id, processing_msg.message_id)
+        await async_bot.send_message(chat_id, formatted_analysis, parse_mode='Markdown')
+        await async_bot.send_message(chat_id, CUNG_MENU_MESSAGE, reply_markup=create_cung_markup(), parse_mode='Markdown')
         bot_stats['analyses_performed'] += 1
-        
+
     except Exception as e:
         logger.error(f"Lỗi khi phân tích lá số tử vi: {e}")
+        await async_bot.send_message(chat_id, HISTORY_ERROR_MESSAGE, parse_mode='Markdown')
         try:
-            bot.send_message(
-                chat_id,
-                f"❌ *Đã xảy ra lỗi khi phân tích lá số tử vi*\n\nLỗi: {str(e)}\n\nVui lòng thử lại sau.",
-                parse_mode='Markdown'
-            )
-            # Xóa thông báo đang xử lý
-            bot.delete_message(chat_id, processing_msg.message_id)
-        except Exception as delete_error:
-            logger.warning(f"Không thể xóa tin nhắn hoặc gửi thông báo lỗi: {delete_error}")
-        # Cập nhật thống kê lỗi
+            await async_bot.delete_message(chat_id, processing_msg.message_id)
+        except Exception:
+            pass
         bot_stats['errors'] += 1
 
-def extract_base64_image_from_html(html_path, timestamp, user_id, user_data):
+async def run_sync_handler(handler, update):
     """
-    Trích xuất ảnh base64 từ file HTML, lưu file và lưu vào cơ sở dữ liệu
-    
+    Chạy handler đồng bộ (gửi ảnh, thống kê...) trong luồng riêng để không chặn vòng lặp sự kiện.
+
     Args:
-        html_path (str): Đường dẫn đến file HTML
-        timestamp (str): Timestamp để đặt tên file
-        user_id (int): ID của người dùng
-        user_data (dict): Thông tin người dùng
-        
-    Returns:
-        str: Đường dẫn đến file ảnh đã lưu, hoặc None nếu không thành công
+        handler (callable): Handler của TeleBot đồng bộ
+        update: Message hoặc CallbackQuery
     """
     try:
-        # Đọc nội dung file HTML
-        with open(html_path, 'r', encoding='utf-8') as f:
-            html_content = f.read()
-        
-        # Tìm tất cả các chuỗi data:image/jpeg;base64 hoặc data:image/png;base64
-        pattern = r'data:image/[^;]+;base64,([^"\']+)'
-        matches = re.findall(pattern, html_content)
-        
-        if not matches:
-            logger.warning(f"Không tìm thấy ảnh base64 trong HTML: {html_path}")
-            
-            # Thử tìm với các pattern khác
-            soup = BeautifulSoup(html_content, 'html.parser')
-            img_tags = soup.find_all('img')
-            
-            if img_tags:
-                for img in img_tags:
-                    src = img.get('src', '')
-                    if src.startswith('data:image'):
-                        # Trích xuất phần base64
-                        base64_data = src.split(',')[1] if ',' in src else ''
-                        if base64_data:
-                            matches = [base64_data]
-                            logger.info("Đã tìm thấy ảnh base64 từ thẻ img")
-                            break
-            
-            if not matches:
-                logger.error("Không thể tìm thấy ảnh base64 trong HTML sau khi thử nhiều cách")
-                return None
-        
-        # Tăng số lượng lá số cho user_id
-        if user_id not in user_chart_counts:
-            user_chart_counts[user_id] = 1
-        else:
-            user_chart_counts[user_id] += 1
-        
-        # Lưu ảnh vào file
-        image_path = f"assets/{user_id}_{user_chart_counts[user_id]}.jpg"
-        
-        # Đảm bảo thư mục assets tồn tại
-        if not os.path.exists('assets'):
-            os.makedirs('assets')
-        
-        # Xử lý trường hợp base64 có thể bị hỏng
-        try:
-            image_data = base64.b64decode(matches[0])
-            with open(image_path, 'wb') as f:
-                f.write(image_data)
-            
-            # Kiểm tra xem file ảnh có hợp lệ không
-            try:
-                with Image.open(image_path) as img:
-                    # Nếu mở được ảnh, kiểm tra kích thước
-                    width, height = img.size
-                    if width < 10 or height < 10:
-                        logger.warning(f"Ảnh quá nhỏ: {width}x{height}, có thể không hợp lệ")
-                        # Vẫn giữ lại ảnh để kiểm tra
-            except Exception as img_error:
-                logger.error(f"Ảnh không hợp lệ: {img_error}")
-                # Xóa file ảnh không hợp lệ
-                os.remove(image_path)
-                return None
-        except Exception as decode_error:
-            logger.error(f"Lỗi khi giải mã base64: {decode_error}")
-            return None
-        
-        logger.info(f"Đã lưu ảnh từ base64 cho user {user_id}: {image_path}")
-        
-        # Lưu thông tin và base64 vào cơ sở dữ liệu
-        try:
-            save_chart(user_id, user_data, matches[0])
-        except Exception as db_error:
-            logger.warning(f"Không thể lưu chart vào database: {db_error}")
-            # Vẫn tiếp tục vì đã lưu được ảnh
-        
-        return image_path
-    
+        await asyncio.to_thread(handler, update)
     except Exception as e:
-        logger.error(f"Lỗi khi trích xuất ảnh base64: {e}")
-        return None
+        logger.error(f"Lỗi khi chạy handler {handler.__name__}: {e}")
 
-def test_airouter():
+def register_async_handlers():
     """
-    Kiểm tra kết nối với AIRouter.
+    Đăng ký handler cho async_bot theo cùng thứ tự ưu tiên với bot đồng bộ.
+    Handler chưa có bản asyncio (gửi ảnh, thống kê...) được chạy trong luồng riêng.
     """
-    try:
-        logger.info("Kiểm tra kết nối AIRouter...")
-        response = openai.ChatCompletion.create(
-            model="auto",
-            messages=[
-                {"role": "system", "content": "Bạn là một trợ lý AI hữu ích."},
-                {"role": "user", "content": "Chào bạn, đây là tin nhắn kiểm tra kết nối. Trả lời ngắn gọn."}
-            ],
-            max_tokens=50
-        )
-        logger.info(f"Kết nối AIRouter thành công! Model được sử dụng: {response.model}")
-        return True
-    except Exception as e:
-        logger.error(f"Lỗi kết nối AIRouter: {e}")
-        return False
+    def sync_handler(handler):
+        # Handler có serialize_chat cũng được bọc serialize_chat_async khi đăng ký ở dưới
+        async def run(update):
+            await run_sync_handler(handler, update)
+        return run
 
-# Thêm hàm dọn dẹp file tạm định kỳ
-def cleanup_temp_files(max_age_days=7):
+    async_bot.register_message_handler(async_start, commands=['start'])
+    async_bot.register_message_handler(serialize_chat_async(sync_handler(cancel)), commands=['cancel'])
+    async_bot.register_message_handler(sync_handler(help_command), commands=['help'])
+    async_bot.register_message_handler(sync_handler(stats_command), commands=['stats'])
+    async_bot.register_message_handler(async_history_command, commands=['history'])
+    # Trạng thái hội thoại được đọc trong handler (luồng riêng), không đọc trong bộ lọc trên vòng lặp sự kiện
+    async_bot.register_message_handler(async_handle_text, func=lambda message: True)
+
+    async_bot.register_callback_query_handler(
+        async_handle_analysis_callbacks, func=lambda call: call.data in ["analyze", "cancel_analysis"])
+    async_bot.register_callback_query_handler(async_handle_gender_selection, func=lambda call: call.data in ["male", "female"])
+    async_bot.register_callback_query_handler(async_handle_birth_time, func=lambda call: call.data in BIRTH_TIME_MAPPING)
+    async_bot.register_callback_query_handler(sync_handler(handle_view_chart), func=lambda call: call.data.startswith("view_chart_"))
+    async_bot.register_callback_query_handler(async_handle_analyze_chart, func=lambda call: call.data.startswith("analyze_chart_"))
+    async_bot.register_callback_query_handler(async_handle_cung_selection, func=lambda call: call.data.startswith('cung_'))
+    async_bot.register_callback_query_handler(serialize_chat_async(sync_handler(handle_other_callbacks)), func=lambda call: True)
+
+async def dispatch_updates_async(update_queue):
     """
-    Dọn dẹp các file tạm thời đã cũ trong thư mục assets
-    
+    Lấy update (chuỗi JSON) từ hàng đợi webhook và xử lý đồng thời bằng async_bot,
+    tối đa WEBHOOK_ASYNC_HANDLERS update cùng lúc.
+
     Args:
-        max_age_days (int): Số ngày tối đa để giữ file, mặc định là 7 ngày
+        update_queue: Hàng đợi update (queue.Queue hoặc multiprocessing.Queue)
+    """
+    handler_slots = asyncio.Semaphore(WEBHOOK_ASYNC_HANDLERS)
+    # Giữ tham chiếu tới các task đang chạy để chúng không bị thu gom giữa chừng
+    running_tasks = set()
+
+    def finish_update(task):
+        running_tasks.discard(task)
+        handler_slots.release()
+        if not task.cancelled() and task.exception():
+            logger.error(f"Lỗi khi xử lý update từ webhook: {task.exception()}")
+
+    while True:
+        # Chỉ lấy update khỏi hàng đợi khi còn chỗ xử lý
+        await handler_slots.acquire()
+        # Chỉ một luồng chờ hàng đợi, việc xử lý update không chiếm luồng
+        update_json = await asyncio.to_thread(update_queue.get)
+        try:
+            update = types.Update.de_json(update_json)
+        except Exception as e:
+            logger.error(f"Update webhook không hợp lệ: {e}")
+            handler_slots.release()
+            continue
+        task = asyncio.create_task(async_bot.process_new_updates([update]))
+        running_tasks.add(task)
+        task.add_done_callback(finish_update)
+
+async def run_async_bot(update_queue=None):
     """
+    Chạy bot trên asyncio: mở phiên aiohttp và pool asyncpg rồi nhận update.
+
+    Args:
+        update_queue: Hàng đợi update của server webhook, None để dùng polling
+    """
+    global async_http_session, async_analysis_slots, async_chat_locks
+    async_http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=ANALYSIS_CONCURRENCY * 4 + HTTP_POOL_SIZE))
+    async_analysis_slots = asyncio.Semaphore(ANALYSIS_CONCURRENCY)
+    async_chat_locks = [asyncio.Lock() for _ in range(CHAT_LOCK_STRIPES)]
+    await init_async_db_pool()
+    register_async_handlers()
+
     try:
-        logger.info(f"Bắt đầu dọn dẹp file tạm cũ hơn {max_age_days} ngày")
-        
-        # Kiểm tra thư mục assets
-        if not os.path.exists('assets'):
-            logger.info("Thư mục assets không tồn tại, không cần dọn dẹp")
-            return
-        
-        # Lấy thời gian hiện tại
-        current_time = time.time()
-        max_age_seconds = max_age_days * 24 * 60 * 60
-        
-        # Đếm số file đã xóa
-        deleted_count = 0
-        
-        # Duyệt qua tất cả file trong thư mục assets
-        for filename in os.listdir('assets'):
-            file_path = os.path.join('assets', filename)
-            
-            # Bỏ qua nếu là thư mục
-            if os.path.isdir(file_path):
-                continue
-            
-            # Kiểm tra tuổi của file
-            file_age = current_time - os.path.getmtime(file_path)
-            
-            # Xóa file nếu quá cũ hoặc là file tạm (bắt đầu bằng "view_" hoặc "analyze_")
-            if file_age > max_age_seconds or filename.startswith(('view_', 'analyze_')):
-                try:
-                    os.remove(file_path)
-                    deleted_count += 1
-                    logger.debug(f"Đã xóa file cũ: {file_path}")
-                except Exception as e:
-                    logger.warning(f"Không thể xóa file {file_path}: {e}")
-        
-        logger.info(f"Đã dọn dẹp {deleted_count} file tạm cũ")
-    
-    except Exception as e:
-        logger.error(f"Lỗi khi dọn dẹp file tạm: {e}")
+        if update_queue is not None:
+            await dispatch_updates_async(update_queue)
+        else:
+            logger.info("Bot đang khởi động ở chế độ polling (asyncio)...")
+            await async_bot.delete_webhook()
+            await async_bot.infinity_polling()
+    finally:
+        await async_http_session.close()
+        if async_db_pool:
+            await async_db_pool.close()
+        await async_bot.close_session()
 
 def main():
     """
@@ -1472,50 +6310,41 @@ def main():
             'charts_created': 0,
             'charts_reused': 0,
             'analyses_performed': 0,
+            'chart_cache_hits': 0,
+            'chart_cache_misses': 0,
+            'charts_coalesced': 0,
+            'chart_jobs_rejected': 0,
+            'photos_uploaded': 0,
+            'photos_resent': 0,
+            'analysis_cache_hits': 0,
+            'analysis_cache_misses': 0,
+            'llm_hedges': 0,
+            'llm_hedge_wins': 0,
+            'jobs_cancelled': 0,
+            'browsers_aborted': 0,
+            'llm_calls_cancelled': 0,
+            'llm_tokens_saved': 0,
             'errors': 0
         }
         
-        # Kiểm tra thư mục
-        if not os.path.exists('assets'):
-            os.makedirs('assets')
-            
-        # Dọn dẹp file tạm cũ khi khởi động
-        cleanup_temp_files()
-        
-        # Lên lịch dọn dẹp định kỳ
-        schedule_cleanup()
+        if BOT_RUNTIME == 'async' and not async_bot:
+            logger.error("Chưa cài aiohttp, asyncpg hoặc telebot bản có AsyncTeleBot, chuyển sang chế độ luồng")
         
-        # Kiểm tra kết nối cơ sở dữ liệu
-        db_conn = get_db_connection()
-        if db_conn:
-            logger.info("Kết nối cơ sở dữ liệu thành công")
-            db_conn.close()
-        else:
-            logger.error("Không thể kết nối đến cơ sở dữ liệu")
-        
-        # Khởi tạo cơ sở dữ liệu
-        init_database()
+        # Chế độ webhook tự khởi tạo trong từng tiến trình xử lý update
+        if BOT_MODE == 'webhook':
+            logger.info("Bot đang khởi động ở chế độ webhook...")
+            run_webhook_server()
+            return
         
-        # Kiểm tra kết nối AIRouter
-        if test_airouter():
-            logger.info("Kết nối AIRouter thành công, bot sẵn sàng sử dụng AI phân tích")
-        else:
-            logger.warning("Không thể kết nối đến AIRouter, một số chức năng phân tích có thể không hoạt động")
+        init_runtime(primary=True)
         
-        # Gửi thông báo khởi động cho admin
-        admin_ids = [int(id.strip()) for id in os.getenv('ADMIN_IDS', '').split(',') if id.strip()]
-        for admin_id in admin_ids:
-            try:
-                bot.send_message(
-                    admin_id,
-                    f"🚀 *Bot Tử Vi đã khởi động*\n\n⏱ Thời gian: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}",
-                    parse_mode='Markdown'
-                )
-            except Exception as e:
-                logger.warning(f"Không thể gửi thông báo khởi động cho admin {admin_id}: {e}")
+        if async_bot:
+            asyncio.run(run_async_bot())
+            return
         
-        # Khởi động bot
-        logger.info("Bot đang khởi động...")
+        # Khởi động bot (chế độ polling, dùng khi phát triển)
+        logger.info("Bot đang khởi động ở chế độ polling...")
+        bot.remove_webhook()
         bot.polling(none_stop=True)
         
     except Exception as e:
@@ -1551,19 +6380,33 @@ def save_user(user):
         return None
     finally:
         cursor.close()
-        conn.close()
+        release_db_connection(conn)
+
+def save_chart(user_id, chart_data, image_bytes, cache_key=None):
+    """
+    Lưu lá số tử vi và hình ảnh (dạng nhị phân) vào cơ sở dữ liệu.
 
-def save_chart(user_id, chart_data, base64_image):
-    """Lưu lá số tử vi và hình ảnh base64 vào cơ sở dữ liệu"""
+    Nếu có cache_key và ảnh đã nằm trong bảng chart_cache, dòng lịch sử chỉ giữ khóa tới ảnh
+    dùng chung thay vì chép lại ảnh (xem get_chart_image, materialize_chart_image).
+    """
+    chart_stars = get_chart_stars(chart_data)
+    
     conn = get_db_connection()
     if not conn:
         return False
     
     try:
         cursor = conn.cursor()
+        shared_image = False
+        if cache_key:
+            cursor.execute("""
+                SELECT 1 FROM chart_cache
+                WHERE cache_key = %s AND (chart_blob IS NOT NULL OR chart_image IS NOT NULL)
+            """, (cache_key,))
+            shared_image = cursor.fetchone() is not None
         cursor.execute("""
-            INSERT INTO charts (user_id, day, month, year, birth_time, gender, chart_image)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            INSERT INTO charts (user_id, day, month, year, birth_time, gender, birth_hash, chart_blob, chart_meta, chart_stars, cache_key)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
             RETURNING id
         """, (
             user_id, 
@@ -1572,7 +6415,12 @@ def save_chart(user_id, chart_data, base64_image):
             chart_data['year'], 
             chart_data['birth_time'], 
             chart_data['gender'], 
-            base64_image
+            make_birth_hash(chart_data['day'], chart_data['month'], chart_data['year'],
+                            chart_data['birth_time'], chart_data['gender']),
+            None if shared_image else psycopg2.Binary(image_bytes),
+            json.dumps(get_image_metadata(image_bytes)),
+            json.dumps(chart_stars, ensure_ascii=False) if chart_stars else None,
+            cache_key if shared_image else None
         ))
         
         result = cursor.fetchone()
@@ -1583,7 +6431,7 @@ def save_chart(user_id, chart_data, base64_image):
         return None
     finally:
         cursor.close()
-        conn.close()
+        release_db_connection(conn)
 
 def get_user_charts(user_id, limit=5):
     """Lấy lịch sử lá số tử vi của người dùng"""
@@ -1607,10 +6455,10 @@ def get_user_charts(user_id, limit=5):
         return []
     finally:
         cursor.close()
-        conn.close()
+        release_db_connection(conn)
 
 def get_chart_image(chart_id):
-    """Lấy hình ảnh lá số tử vi từ ID"""
+    """Lấy hình ảnh lá số tử vi (dạng bytes) từ ID"""
     conn = get_db_connection()
     if not conn:
         return None
@@ -1618,21 +6466,179 @@ def get_chart_image(chart_id):
     try:
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT chart_image
-            FROM charts
-            WHERE id = %s
+            SELECT COALESCE(c.chart_blob, cc.chart_blob), COALESCE(c.chart_image, cc.chart_image)
+            FROM charts c
+            LEFT JOIN chart_cache cc ON cc.cache_key = c.cache_key
+            WHERE c.id = %s
         """, (chart_id,))
         
         result = cursor.fetchone()
-        return result[0] if result else None
+        return decode_chart_image(result[0], result[1]) if result else None
     except Exception as e:
         logger.error(f"Lỗi khi lấy hình ảnh lá số tử vi: {e}")
         return None
     finally:
         cursor.close()
-        conn.close()
+        release_db_connection(conn)
+
+def get_image_metadata(image_bytes):
+    """
+    Đọc thông tin cơ bản của ảnh lá số để lưu cùng dữ liệu nhị phân.
+
+    Returns:
+        dict: Kiểu MIME, kích thước ảnh và dung lượng (byte)
+    """
+    metadata = {'mime': f"image/{'jpeg' if get_image_extension(image_bytes) == 'jpg' else get_image_extension(image_bytes)}",
+                'size': len(image_bytes)}
+    try:
+        with Image.open(BytesIO(image_bytes)) as img:
+            metadata['mime'] = Image.MIME.get(img.format, metadata['mime'])
+            metadata['width'], metadata['height'] = img.size
+    except Exception as e:
+        logger.warning(f"Không đọc được thông tin ảnh lá số: {e}")
+    return metadata
+
+def decode_chart_image(chart_blob, chart_image=None):
+    """
+    Lấy nội dung ảnh lá số từ cột nhị phân, hoặc từ cột base64 cũ nếu chưa chuyển đổi.
+
+    Args:
+        chart_blob: Giá trị cột chart_blob (BYTEA)
+        chart_image (str): Giá trị cột chart_image (base64) của dữ liệu cũ
+
+    Returns:
+        bytes: Nội dung ảnh, hoặc None nếu không có
+    """
+    if chart_blob:
+        return bytes(chart_blob)
+    if not chart_image:
+        return None
+    base64_data = chart_image.split(',', 1)[1] if chart_image.startswith('data:image') else chart_image
+    try:
+        # validate=True để chuỗi không phải base64 (ví dụ đường dẫn file cũ) báo lỗi thay vì ra byte rác
+        image_bytes = base64.b64decode(''.join(base64_data.split()), validate=True)
+    except Exception as e:
+        logger.warning(f"Không giải mã được ảnh lá số base64: {e}")
+        return None
+    if not is_image_bytes(image_bytes):
+        logger.warning("Dữ liệu base64 của lá số không phải ảnh JPEG/PNG")
+        return None
+    return image_bytes
+
+def is_image_bytes(image_bytes):
+    """Kiểm tra nội dung có phải ảnh JPEG, PNG hoặc WebP không (theo các byte đầu file)."""
+    return (
+        image_bytes[:3] == b'\xff\xd8\xff'
+        or image_bytes[:8] == b'\x89PNG\r\n\x1a\n'
+        or (image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP')
+    )
+
+def migrate_chart_images(table, key_column, batch_size=CHART_MIGRATION_BATCH_SIZE, pause=CHART_MIGRATION_PAUSE):
+    """
+    Chuyển ảnh base64 cũ sang cột nhị phân theo từng đợt nhỏ, không khóa cả bảng.
+
+    Mỗi dòng được cập nhật riêng với điều kiện chart_blob IS NULL nên có thể
+    chạy song song với bot và chạy lại nhiều lần mà không sao. Dòng có chart_image
+    không giải mã được thành ảnh (ví dụ đường dẫn file của dữ liệu rất cũ) được giữ nguyên.
+
+    Args:
+        table (str): Bảng cần chuyển đổi ('charts' hoặc 'chart_cache')
+        key_column (str): Cột khóa chính của bảng
+        batch_size (int): Số dòng mỗi đợt
+        pause (float): Thời gian nghỉ giữa các đợt (giây)
+
+    Returns:
+        int: Số dòng đã chuyển đổi
+    """
+    migrated = 0
+    skipped = 0
+    last_key = None
+    while True:
+        conn = get_db_connection()
+        if not conn:
+            logger.warning(f"Tạm dừng chuyển đổi ảnh bảng {table} vì không kết nối được cơ sở dữ liệu")
+            return migrated
+
+        try:
+            cursor = conn.cursor()
+            if last_key is None:
+                cursor.execute(f"""
+                    SELECT {key_column}, chart_image FROM {table}
+                    WHERE chart_blob IS NULL AND chart_image IS NOT NULL
+                    ORDER BY {key_column} LIMIT %s
+                """, (batch_size,))
+            else:
+                cursor.execute(f"""
+                    SELECT {key_column}, chart_image FROM {table}
+                    WHERE chart_blob IS NULL AND chart_image IS NOT NULL AND {key_column} > %s
+                    ORDER BY {key_column} LIMIT %s
+                """, (last_key, batch_size))
+            rows = cursor.fetchall()
+
+            for key, chart_image in rows:
+                last_key = key
+                image_bytes = decode_chart_image(None, chart_image)
+                if not image_bytes:
+                    skipped += 1
+                    continue
+                cursor.execute(f"""
+                    UPDATE {table}
+                    SET chart_blob = %s, chart_meta = %s, chart_image = NULL
+                    WHERE {key_column} = %s AND chart_blob IS NULL
+                """, (psycopg2.Binary(image_bytes), json.dumps(get_image_metadata(image_bytes)), key))
+                migrated += cursor.rowcount
+            cursor.close()
+        except Exception as e:
+            logger.error(f"Lỗi khi chuyển đổi ảnh bảng {table}: {e}")
+            return migrated
+        finally:
+            release_db_connection(conn)
+
+        if len(rows) < batch_size:
+            break
+        time.sleep(pause)
+
+    if migrated:
+        logger.info(f"Đã chuyển {migrated} ảnh lá số của bảng {table} sang dạng nhị phân")
+    if skipped:
+        logger.warning(f"Giữ nguyên {skipped} dòng của bảng {table} có chart_image không phải ảnh base64")
+    return migrated
+
+def start_chart_image_migration():
+    """Chạy việc chuyển đổi ảnh base64 cũ trong luồng nền."""
+    def run_migration():
+        backfill_birth_hashes()
+        migrate_chart_images('charts', 'id')
+        migrate_chart_images('chart_cache', 'cache_key')
+
+    thread = threading.Thread(target=run_migration, name="chart-image-migration", daemon=True)
+    thread.start()
 
 @bot.message_handler(commands=['history'])
+def format_history(charts):
+    """
+    Tạo tin nhắn lịch sử lá số kèm nút xem lại từng lá số.
+
+    Args:
+        charts (list): Các lá số của get_user_charts / async_get_user_charts
+
+    Returns:
+        tuple: (tin nhắn, InlineKeyboardMarkup)
+    """
+    history_message = "📜 *LỊCH SỬ LÁ SỐ TỬ VI CỦA BẠN*\n\n"
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    for i, chart in enumerate(charts, 1):
+        date_created = chart['created_at'].strftime("%d/%m/%Y %H:%M")
+        history_message += f"{i}. Ngày sinh: {chart['day']}/{chart['month']}/{chart['year']}, "\
+                          f"Giờ sinh: {chart['birth_time']}, "\
+                          f"Giới tính: {chart['gender']}\n"\
+                          f"   Ngày lập: {date_created}\n\n"
+        markup.add(types.InlineKeyboardButton(
+            f"Xem lại lá số {i}", 
+            callback_data=f"view_chart_{chart['id']}"
+        ))
+    return history_message, markup
+
 def history_command(message):
     """Hiển thị lịch sử lá số tử vi của người dùng."""
     chat_id = message.chat.id
@@ -1643,31 +6649,12 @@ def history_command(message):
     if not charts:
         bot.send_message(
             chat_id,
-            "🔍 *Bạn chưa có lá số tử vi nào*\n\n"
-            "Gõ /start để bắt đầu lập lá số mới.",
+            HISTORY_EMPTY_MESSAGE,
             parse_mode='Markdown'
         )
         return
     
-    # Tạo thông báo lịch sử
-    history_message = "📜 *LỊCH SỬ LÁ SỐ TỬ VI CỦA BẠN*\n\n"
-    
-    for i, chart in enumerate(charts, 1):
-        date_created = chart['created_at'].strftime("%d/%m/%Y %H:%M")
-        history_message += f"{i}. Ngày sinh: {chart['day']}/{chart['month']}/{chart['year']}, "\
-                          f"Giờ sinh: {chart['birth_time']}, "\
-                          f"Giới tính: {chart['gender']}\n"\
-                          f"   Ngày lập: {date_created}\n\n"
-    
-    # Tạo inline keyboard để xem lại các lá số
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    
-    for i, chart in enumerate(charts, 1):
-        markup.add(types.InlineKeyboardButton(
-            f"Xem lại lá số {i}", 
-            callback_data=f"view_chart_{chart['id']}"
-        ))
-    
+    history_message, markup = format_history(charts)
     bot.send_message(
         chat_id,
         history_message,
@@ -1679,41 +6666,29 @@ def history_command(message):
 def handle_view_chart(call):
     """Xử lý yêu cầu xem lại lá số tử vi."""
     chat_id = call.message.chat.id
-    chart_id = int(call.data.split("_")[2])
-    
-    # Lấy hình ảnh lá số
-    base64_image = get_chart_image(chart_id)
-    
-    if not base64_image:
-        bot.send_message(
-            chat_id,
-            "❌ *Không tìm thấy lá số tử vi*",
-            parse_mode='Markdown'
-        )
-        return
+    chart_id = int(call.data.split("_")[2])
     
-    # Lưu ảnh vào thư mục assets thay vì tạo file tạm
-    image_path = f"assets/view_{chat_id}_{chart_id}.jpg"
-    with open(image_path, 'wb') as f:
-        f.write(base64.b64decode(base64_image))
+    def load_chart_photo():
+        # Chỉ đọc ảnh từ cơ sở dữ liệu khi không gửi lại được bằng file_id
+        return get_chart_image(chart_id)
     
     # Gửi ảnh cho người dùng
-    with open(image_path, 'rb') as photo:
-        bot.send_photo(
+    try:
+        send_chart_photo(
             chat_id,
-            photo,
-            caption="✨ *Lá số tử vi của bạn*",
-            reply_markup=types.InlineKeyboardMarkup().add(
+            load_chart_photo,
+            "✨ *Lá số tử vi của bạn*",
+            types.InlineKeyboardMarkup().add(
                 types.InlineKeyboardButton("🔮 Phân tích lá số", callback_data=f"analyze_chart_{chart_id}")
             ),
+            chart_id=chart_id
+        )
+    except ValueError:
+        bot.send_message(
+            chat_id,
+            "❌ *Không tìm thấy lá số tử vi*",
             parse_mode='Markdown'
         )
-    
-    # Xóa file sau khi sử dụng
-    try:
-        os.remove(image_path)
-    except Exception as e:
-        logger.warning(f"Không thể xóa file {image_path}: {e}")
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("analyze_chart_"))
 def handle_analyze_chart(call):
@@ -1724,64 +6699,66 @@ def handle_analyze_chart(call):
     # Gửi thông báo đang phân tích
     processing_msg = bot.send_message(
         chat_id, 
-        "⏳ *Đang phân tích lá số tử vi...*\n\nVui lòng đợi trong giây lát, quá trình này có thể mất 30-60 giây.",
+        HISTORY_PROCESSING_MESSAGE,
         parse_mode='Markdown'
     )
     
     try:
         # Lấy thông tin lá số từ cơ sở dữ liệu
         conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute("""
-            SELECT day, month, year, birth_time, gender, chart_image
-            FROM charts
-            WHERE id = %s
-        """, (chart_id,))
-        
-        chart_data = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        if not conn:
+            raise Exception("Không thể kết nối đến cơ sở dữ liệu")
+        try:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            cursor.execute("""
+                SELECT day, month, year, birth_time, gender, chart_stars
+                FROM charts
+                WHERE id = %s
+            """, (chart_id,))
+            
+            chart_data = cursor.fetchone()
+            cursor.close()
+        finally:
+            release_db_connection(conn)
         
         if not chart_data:
             bot.send_message(
                 chat_id,
-                "❌ *Không tìm thấy lá số tử vi*",
+                HISTORY_NOT_FOUND_MESSAGE,
                 parse_mode='Markdown'
             )
             bot.delete_message(chat_id, processing_msg.message_id)
             return
         
-        # Lưu ảnh vào thư mục assets thay vì tạo file tạm
-        image_path = f"assets/analyze_{chat_id}_{chart_id}.jpg"
-        with open(image_path, 'wb') as f:
-            f.write(base64.b64decode(chart_data['chart_image']))
+        user_data = new_session_state(
+            day=chart_data['day'],
+            month=chart_data['month'],
+            year=chart_data['year'],
+            birth_time=chart_data['birth_time'],
+            gender=chart_data['gender'],
+            chart_id=chart_id,
+            chart_stars=chart_data['chart_stars']
+        )
         
-        # Phân tích lá số
-        analysis_dict = analyze_chart_with_gpt(image_path, chart_data)
+        # Chỉ đọc ảnh từ cơ sở dữ liệu khi phân tích bằng ảnh
+        image_path = None
+        if analysis_needs_image(user_data):
+            image_path = materialize_chart_image(chart_id)
+            user_data['chart_image_path'] = image_path
         
-        # Lưu phân tích vào trạng thái người dùng để sử dụng sau này
-        # Xóa trạng thái cũ nếu có
-        if chat_id in user_states:
-            del user_states[chat_id]
-            
-        # Tạo trạng thái mới với phân tích
-        user_states[chat_id] = {
-            'day': chart_data['day'],
-            'month': chart_data['month'],
-            'year': chart_data['year'],
-            'birth_time': chart_data['birth_time'],
-            'gender': chart_data['gender'],
-            'chart_image_path': image_path,
-            'analysis': analysis_dict,
-            'analysis_complete': True
-        }
+        # Phân tích lá số (có thể hủy bằng /cancel). build_analysis_request ghi 'image_hash' vào user_data
+        task = begin_chat_task(chat_id, 'analysis')
+        try:
+            analysis_dict = analyze_chart_with_gpt(image_path, user_data)
+        finally:
+            end_chat_task(task)
+        
+        # Lưu phân tích vào trạng thái người dùng để sử dụng sau này (thay trạng thái cũ nếu có)
+        formatted_analysis = complete_analysis(chat_id, user_data, analysis_dict, replace_session=True)
         
         # Xóa thông báo đang xử lý
         bot.delete_message(chat_id, processing_msg.message_id)
         
-        # Định dạng phân tích
-        formatted_analysis = format_analysis(analysis_dict, user_states[chat_id])
-        
         # Gửi phân tích cho người dùng
         bot.send_message(
             chat_id,
@@ -1789,44 +6766,29 @@ def handle_analyze_chart(call):
             parse_mode='Markdown'
         )
         
-        # Tạo menu các cung
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        
-        # Thêm các nút cho từng cung
-        cung_buttons = [
-            ("👤 Cung Mệnh", "menh"),
-            ("🙏 Cung Phúc Đức", "phuc_duc"),
-            ("💰 Cung Tài Bạch", "tai_bach"),
-            ("💼 Cung Quan Lộc", "quan_loc"),
-            ("💑 Cung Phu Thê", "phu_the"),
-            ("👶 Cung Tử Tức", "tu_tuc"),
-            ("👥 Cung Huynh Đệ", "huynh_de"),
-            ("🏠 Cung Điền Trạch", "dien_trach"),
-            ("✈️ Cung Thiên Di", "thien_di"),
-            ("👨‍👩‍👧‍👦 Cung Nô Bộc", "no_boc"),
-            ("🏥 Cung Tật Ách", "tat_ach")
-        ]
-        
-        # Thêm các nút vào markup
-        for button_text, callback_data in cung_buttons:
-            markup.add(types.InlineKeyboardButton(button_text, callback_data=f"cung_{callback_data}"))
-        
         # Gửi menu các cung
         bot.send_message(
             chat_id,
-            "👇 *Chọn một cung để xem chi tiết:*",
-            reply_markup=markup,
+            CUNG_MENU_MESSAGE,
+            reply_markup=create_cung_markup(),
             parse_mode='Markdown'
         )
         
         # Cập nhật thống kê
         bot_stats['analyses_performed'] += 1
         
+    except ChatTaskCancelled:
+        logger.info(f"Đã dừng phân tích lá số {chart_id} cho chat {chat_id} theo yêu cầu hủy")
+        try:
+            bot.delete_message(chat_id, processing_msg.message_id)
+        except:
+            pass
+        
     except Exception as e:
         logger.error(f"Lỗi khi phân tích lá số tử vi: {e}")
         bot.send_message(
             chat_id,
-            "❌ *Đã xảy ra lỗi khi phân tích lá số tử vi*\n\nVui lòng thử lại sau.",
+            HISTORY_ERROR_MESSAGE,
             parse_mode='Markdown'
         )
         # Xóa thông báo đang xử lý
@@ -1837,19 +6799,13 @@ def handle_analyze_chart(call):
         
         # Cập nhật thống kê lỗi
         bot_stats['errors'] += 1
-    
-    finally:
-        # Xóa file sau khi sử dụng
-        try:
-            if 'image_path' in locals() and os.path.exists(image_path):
-                os.remove(image_path)
-        except Exception as e:
-            logger.warning(f"Không thể xóa file {image_path}: {e}")
+
 
 def check_existing_chart(user_id, day, month, year, birth_time, gender):
     """
     Kiểm tra xem lá số với thông tin tương tự đã tồn tại trong cơ sở dữ liệu chưa.
-    
+    Chỉ đọc các cột nhỏ qua index (user_id, birth_hash), không đọc ảnh.
+
     Args:
         user_id (int): ID của người dùng
         day (int): Ngày sinh
@@ -1857,72 +6813,450 @@ def check_existing_chart(user_id, day, month, year, birth_time, gender):
         year (int): Năm sinh
         birth_time (str): Giờ sinh
         gender (str): Giới tính
-        
+
     Returns:
-        tuple: (chart_exists, chart_path, chart_id) - Trạng thái tồn tại, đường dẫn và ID của lá số
+        tuple: (chart_id, birth_hash, telegram_file_id) của lá số mới nhất, hoặc None nếu chưa có
     """
     try:
         # Kết nối đến cơ sở dữ liệu
         conn = get_db_connection()
         if not conn:
             logger.warning("Không thể kết nối đến cơ sở dữ liệu để kiểm tra lá số tồn tại")
-            return False, None, None
-        
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        # Tìm kiếm lá số với thông tin tương tự
-        cursor.execute("""
-            SELECT id, chart_image FROM charts 
-            WHERE user_id = %s AND day = %s AND month = %s AND year = %s 
-            AND birth_time = %s AND gender = %s
-            ORDER BY created_at DESC LIMIT 1
-        """, (user_id, day, month, year, birth_time, gender))
-        
-        result = cursor.fetchone()
-        conn.close()
-        
+            return None
+
+        birth_hash = make_birth_hash(day, month, year, birth_time, gender)
+        try:
+            cursor = conn.cursor()
+
+            # Tìm kiếm lá số với thông tin tương tự
+            cursor.execute("""
+                SELECT id, birth_hash, telegram_file_id FROM charts
+                WHERE user_id = %s AND birth_hash = %s
+                ORDER BY created_at DESC LIMIT 1
+            """, (user_id, birth_hash))
+
+            result = cursor.fetchone()
+            cursor.close()
+        finally:
+            release_db_connection(conn)
+
         if result:
             logger.info(f"Đã tìm thấy lá số tồn tại cho user {user_id} với thông tin: {day}/{month}/{year}, {birth_time}, {gender}")
-            
-            # Kiểm tra xem có đường dẫn hình ảnh không
-            chart_id = result['id']
-            chart_image = result['chart_image']
-            
-            # Nếu chart_image là base64, cần lưu lại thành file
-            if chart_image and (chart_image.startswith('data:image') or len(chart_image) > 200):
-                # Đây là base64, cần lưu thành file
-                image_path = f"assets/{user_id}_{chart_id}.jpg"
-                
-                # Kiểm tra xem file đã tồn tại chưa
-                if not os.path.exists(image_path):
-                    # Trích xuất phần base64 thực sự
-                    if ',' in chart_image:
-                        base64_data = chart_image.split(',')[1]
-                    else:
-                        base64_data = chart_image
-                    
-                    # Lưu thành file
-                    with open(image_path, 'wb') as f:
-                        f.write(base64.b64decode(base64_data))
-                    
-                    logger.info(f"Đã lưu lại hình ảnh lá số từ base64 cho user {user_id}: {image_path}")
-                
-                return True, image_path, chart_id
-            
-            # Nếu chart_image là đường dẫn file
-            elif chart_image and os.path.exists(chart_image):
-                return True, chart_image, chart_id
-            
-            # Nếu không có hình ảnh hoặc không tìm thấy file
-            else:
-                logger.warning(f"Không tìm thấy hình ảnh lá số cho chart_id {chart_id}")
-                return False, None, None
-        
-        return False, None, None
-        
+            return result[0], result[1], result[2]
+
+        return None
+
     except Exception as e:
         logger.error(f"Lỗi khi kiểm tra lá số tồn tại: {e}")
-        return False, None, None
+        return None
+
+def materialize_chart_image(chart_id):
+    """
+    Đọc ảnh lá số từ cơ sở dữ liệu và lưu vào kho ảnh, chỉ gọi khi thực sự cần file ảnh.
+
+    Args:
+        chart_id (int): ID lá số trong bảng charts
+
+    Returns:
+        str: Đường dẫn file ảnh lá số, hoặc None nếu không có ảnh
+    """
+    conn = get_db_connection()
+    if not conn:
+        return None
+
+    try:
+        cursor = conn.cursor()
+        # Lá số lấy từ cache dùng chung đọc ảnh trong chart_cache
+        cursor.execute("""
+            SELECT COALESCE(c.chart_blob, cc.chart_blob), COALESCE(c.chart_image, cc.chart_image)
+            FROM charts c
+            LEFT JOIN chart_cache cc ON cc.cache_key = c.cache_key
+            WHERE c.id = %s
+        """, (chart_id,))
+        result = cursor.fetchone()
+        cursor.close()
+    except Exception as e:
+        logger.error(f"Lỗi khi đọc ảnh lá số {chart_id}: {e}")
+        return None
+    finally:
+        release_db_connection(conn)
+
+    if not result:
+        return None
+    chart_blob, chart_image = result
+
+    # Dữ liệu rất cũ lưu đường dẫn file thay vì ảnh
+    if not chart_blob and chart_image and len(chart_image) <= 200 and os.path.exists(chart_image):
+        return chart_image
+
+    image_bytes = decode_chart_image(chart_blob, chart_image)
+    if not image_bytes:
+        logger.warning(f"Không tìm thấy hình ảnh lá số cho chart_id {chart_id}")
+        return None
+
+    # Lưu vào kho ảnh (không ghi lại nếu ảnh đã có)
+    return store_asset(image_bytes)
+
+def make_birth_hash(day, month, year, birth_time, gender):
+    """
+    Tạo mã băm thông tin ngày sinh dùng cho cột charts.birth_hash.
+    backfill_birth_hashes cũng dùng hàm này để lá số cũ và mới được chuẩn hóa giống nhau.
+
+    Returns:
+        str: Mã SHA-256 dạng hex
+    """
+    normalized = f"{int(day)}|{int(month)}|{int(year)}|{birth_time.strip()}|{gender.strip()}"
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+def backfill_birth_hashes(batch_size=CHART_MIGRATION_BATCH_SIZE, pause=CHART_MIGRATION_PAUSE):
+    """
+    Tính birth_hash cho các lá số cũ theo từng đợt nhỏ, không khóa cả bảng.
+
+    Mã băm được tính bằng make_birth_hash chứ không bằng SQL, vì btrim() của Postgres chỉ bỏ
+    dấu cách còn str.strip() bỏ mọi khoảng trắng (tab, NBSP...), khiến hai bên lệch nhau.
+
+    Args:
+        batch_size (int): Số dòng mỗi đợt
+        pause (float): Thời gian nghỉ giữa các đợt (giây)
+
+    Returns:
+        int: Số dòng đã cập nhật
+    """
+    updated = 0
+    last_id = 0
+    while True:
+        conn = get_db_connection()
+        if not conn:
+            return updated
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, day, month, year, birth_time, gender FROM charts
+                WHERE birth_hash IS NULL AND id > %s
+                ORDER BY id LIMIT %s
+            """, (last_id, batch_size))
+            rows = cursor.fetchall()
+
+            for chart_id, day, month, year, birth_time, gender in rows:
+                last_id = chart_id
+                cursor.execute("""
+                    UPDATE charts SET birth_hash = %s
+                    WHERE id = %s AND birth_hash IS NULL
+                """, (make_birth_hash(day, month, year, birth_time, gender), chart_id))
+                updated += cursor.rowcount
+            cursor.close()
+        except Exception as e:
+            logger.error(f"Lỗi khi tính birth_hash cho lá số cũ: {e}")
+            return updated
+        finally:
+            release_db_connection(conn)
+
+        if len(rows) < batch_size:
+            break
+        time.sleep(pause)
+
+    if updated:
+        logger.info(f"Đã tính birth_hash cho {updated} lá số cũ")
+    return updated
+
+def make_chart_cache_key(day, month, year, birth_time, gender, view_year=None):
+    """
+    Tạo khóa cache cho lá số từ thông tin ngày sinh đã chuẩn hóa.
+
+    Lá số chỉ phụ thuộc vào ngày giờ sinh, giới tính và năm xem nên
+    mọi người dùng có cùng thông tin sẽ dùng chung một khóa.
+
+    Returns:
+        str: Mã SHA-256 của bộ thông tin ngày sinh
+    """
+    if view_year is None:
+        view_year = datetime.now().year
+    normalized = f"{int(day)}|{int(month)}|{int(year)}|{birth_time.strip()}|{gender.strip()}|{int(view_year)}"
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+def get_image_extension(image_bytes):
+    """Xác định phần mở rộng file từ nội dung ảnh."""
+    if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+        return 'webp'
+    if image_bytes[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    return 'jpg'
+
+def load_chart_cache_entry(cache_key):
+    """
+    Tìm ảnh lá số trong cache, ưu tiên bộ nhớ rồi mới đến cơ sở dữ liệu.
+
+    Args:
+        cache_key (str): Khóa cache của lá số
+
+    Returns:
+        bytes: Nội dung ảnh lá số, hoặc None nếu chưa có
+    """
+    with chart_cache_lock:
+        if cache_key in chart_cache:
+            chart_cache.move_to_end(cache_key)
+            return chart_cache[cache_key]
+
+    conn = get_db_connection()
+    if not conn:
+        return None
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT chart_blob, chart_image FROM chart_cache WHERE cache_key = %s", (cache_key,))
+        result = cursor.fetchone()
+        cursor.close()
+    except Exception as e:
+        logger.error(f"Lỗi khi đọc cache lá số: {e}")
+        return None
+    finally:
+        release_db_connection(conn)
+
+    image_bytes = decode_chart_image(result[0], result[1]) if result else None
+    if not image_bytes:
+        return None
+
+    put_chart_cache_memory(cache_key, image_bytes)
+    return image_bytes
+
+def put_chart_cache_memory(cache_key, image_bytes):
+    """Đưa ảnh lá số vào cache bộ nhớ, bỏ bớt lá số ít dùng nhất khi đầy."""
+    with chart_cache_lock:
+        chart_cache[cache_key] = image_bytes
+        chart_cache.move_to_end(cache_key)
+        while len(chart_cache) > CHART_CACHE_SIZE:
+            chart_cache.popitem(last=False)
+
+def get_cached_chart(cache_key, user_id, user_data):
+    """
+    Lấy lá số từ cache dùng chung và ghi vào lịch sử của người dùng hiện tại
+    (dòng lịch sử chỉ tham chiếu ảnh trong chart_cache).
+
+    Args:
+        cache_key (str): Khóa cache của lá số
+        user_id (int): ID của người dùng
+        user_data (dict): Thông tin người dùng
+
+    Returns:
+        str: Đường dẫn file ảnh lá số của người dùng, hoặc None nếu cache chưa có
+    """
+    image_bytes = load_chart_cache_entry(cache_key)
+    if not image_bytes:
+        bot_stats['chart_cache_misses'] += 1
+        return None
+
+    bot_stats['chart_cache_hits'] += 1
+
+    image_path = store_asset(image_bytes)
+
+    # Lưu vào lịch sử lá số của người dùng
+    try:
+        user_data['chart_id'] = save_chart(user_id, user_data, image_bytes, cache_key)
+    except Exception as db_error:
+        logger.warning(f"Không thể lưu chart vào database: {db_error}")
+
+    logger.info(f"Lấy lá số từ cache dùng chung cho user {user_id}: {image_path}")
+    return image_path
+
+def store_cached_chart(cache_key, image_path):
+    """
+    Lưu ảnh lá số vừa tạo vào cache bộ nhớ và cache trong cơ sở dữ liệu.
+
+    Args:
+        cache_key (str): Khóa cache của lá số
+        image_path (str): Đường dẫn file ảnh lá số
+    """
+    try:
+        with open(image_path, 'rb') as f:
+            image_bytes = f.read()
+    except Exception as e:
+        logger.warning(f"Không thể đọc ảnh lá số để lưu cache: {e}")
+        return
+
+    put_chart_cache_memory(cache_key, image_bytes)
+
+    conn = get_db_connection()
+    if not conn:
+        return
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO chart_cache (cache_key, chart_blob, chart_meta)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (cache_key) DO NOTHING
+        """, (cache_key, psycopg2.Binary(image_bytes), json.dumps(get_image_metadata(image_bytes))))
+        cursor.close()
+    except Exception as e:
+        logger.error(f"Lỗi khi lưu cache lá số: {e}")
+    finally:
+        release_db_connection(conn)
+
+def get_telegram_file_id(chart_id=None, cache_key=None):
+    """
+    Tìm file_id Telegram của ảnh lá số đã gửi trước đó (bộ nhớ trước, cơ sở dữ liệu sau).
+
+    Args:
+        chart_id (int): ID lá số trong bảng charts
+        cache_key (str): Khóa cache dùng chung của lá số
+
+    Returns:
+        str: file_id của ảnh, hoặc None nếu chưa từng gửi
+    """
+    memory_keys = [key for key in (f"chart_{chart_id}" if chart_id else None, cache_key) if key]
+    with telegram_file_ids_lock:
+        for key in memory_keys:
+            if key in telegram_file_ids:
+                telegram_file_ids.move_to_end(key)
+                return telegram_file_ids[key]
+
+    conn = get_db_connection()
+    if not conn:
+        return None
+
+    try:
+        cursor = conn.cursor()
+        file_id = None
+        if chart_id:
+            cursor.execute("SELECT telegram_file_id FROM charts WHERE id = %s", (chart_id,))
+            result = cursor.fetchone()
+            file_id = result[0] if result else None
+        if not file_id and cache_key:
+            cursor.execute("SELECT telegram_file_id FROM chart_cache WHERE cache_key = %s", (cache_key,))
+            result = cursor.fetchone()
+            file_id = result[0] if result else None
+        cursor.close()
+    except Exception as e:
+        logger.error(f"Lỗi khi đọc file_id của lá số: {e}")
+        return None
+    finally:
+        release_db_connection(conn)
+
+    if file_id:
+        for key in memory_keys:
+            put_telegram_file_id_memory(key, file_id)
+    return file_id
+
+def put_telegram_file_id_memory(key, file_id):
+    """Đưa file_id vào cache bộ nhớ, bỏ bớt file_id ít dùng nhất khi đầy."""
+    with telegram_file_ids_lock:
+        telegram_file_ids[key] = file_id
+        telegram_file_ids.move_to_end(key)
+        while len(telegram_file_ids) > TELEGRAM_FILE_ID_CACHE_SIZE:
+            telegram_file_ids.popitem(last=False)
+
+def save_telegram_file_id(file_id, chart_id=None, cache_key=None):
+    """
+    Lưu file_id Telegram của ảnh lá số vào bộ nhớ và cơ sở dữ liệu.
+
+    Args:
+        file_id (str): file_id Telegram trả về sau khi gửi ảnh
+        chart_id (int): ID lá số trong bảng charts
+        cache_key (str): Khóa cache dùng chung của lá số
+    """
+    if chart_id:
+        put_telegram_file_id_memory(f"chart_{chart_id}", file_id)
+    if cache_key:
+        put_telegram_file_id_memory(cache_key, file_id)
+
+    conn = get_db_connection()
+    if not conn:
+        return
+
+    try:
+        cursor = conn.cursor()
+        if chart_id:
+            cursor.execute("UPDATE charts SET telegram_file_id = %s WHERE id = %s", (file_id, chart_id))
+        if cache_key:
+            cursor.execute("UPDATE chart_cache SET telegram_file_id = %s WHERE cache_key = %s", (file_id, cache_key))
+        cursor.close()
+    except Exception as e:
+        logger.error(f"Lỗi khi lưu file_id của lá số: {e}")
+    finally:
+        release_db_connection(conn)
+
+def forget_telegram_file_id(file_id, chart_id=None, cache_key=None):
+    """
+    Bỏ file_id đã lưu trong bộ nhớ và cơ sở dữ liệu khi Telegram không còn nhận nó.
+
+    Chỉ xóa khi giá trị đang lưu vẫn là file_id cũ, để không xóa mất file_id mới
+    do một yêu cầu khác vừa upload lại ảnh.
+
+    Args:
+        file_id (str): file_id bị Telegram từ chối
+        chart_id (int): ID lá số trong bảng charts
+        cache_key (str): Khóa cache dùng chung của lá số
+    """
+    with telegram_file_ids_lock:
+        for key in (f"chart_{chart_id}" if chart_id else None, cache_key):
+            if key and telegram_file_ids.get(key) == file_id:
+                del telegram_file_ids[key]
+
+    conn = get_db_connection()
+    if not conn:
+        return
+
+    try:
+        cursor = conn.cursor()
+        if chart_id:
+            cursor.execute("""
+                UPDATE charts SET telegram_file_id = NULL
+                WHERE id = %s AND telegram_file_id = %s
+            """, (chart_id, file_id))
+        if cache_key:
+            cursor.execute("""
+                UPDATE chart_cache SET telegram_file_id = NULL
+                WHERE cache_key = %s AND telegram_file_id = %s
+            """, (cache_key, file_id))
+        cursor.close()
+    except Exception as e:
+        logger.error(f"Lỗi khi xóa file_id cũ của lá số: {e}")
+    finally:
+        release_db_connection(conn)
+
+def send_chart_photo(chat_id, photo, caption, reply_markup, chart_id=None, cache_key=None):
+    """
+    Gửi ảnh lá số, ưu tiên gửi lại bằng file_id để không phải upload lại.
+
+    Args:
+        chat_id (int): ID cuộc trò chuyện
+        photo (str|bytes|callable): Đường dẫn file ảnh, nội dung ảnh, hoặc hàm trả về một trong hai
+            (chỉ được gọi khi phải upload)
+        caption (str): Chú thích ảnh
+        reply_markup: Bàn phím đi kèm ảnh
+        chart_id (int): ID lá số trong bảng charts
+        cache_key (str): Khóa cache dùng chung của lá số
+
+    Returns:
+        Message: Tin nhắn ảnh đã gửi
+    """
+    file_id = get_telegram_file_id(chart_id, cache_key)
+    if file_id:
+        try:
+            message = bot.send_photo(chat_id, file_id, caption=caption, reply_markup=reply_markup, parse_mode='Markdown')
+            bot_stats['photos_resent'] += 1
+            return message
+        except telebot.apihelper.ApiTelegramException as e:
+            logger.warning(f"Telegram không nhận file_id cũ của lá số, gửi lại ảnh: {e}")
+            forget_telegram_file_id(file_id, chart_id, cache_key)
+
+    if callable(photo):
+        photo = photo()
+    if not photo:
+        raise ValueError("Không có ảnh lá số để gửi")
+
+    if isinstance(photo, bytes):
+        message = bot.send_photo(chat_id, BytesIO(photo), caption=caption, reply_markup=reply_markup, parse_mode='Markdown')
+    else:
+        with open(photo, 'rb') as f:
+            message = bot.send_photo(chat_id, f, caption=caption, reply_markup=reply_markup, parse_mode='Markdown')
+    bot_stats['photos_uploaded'] += 1
+
+    # Lưu file_id của ảnh lớn nhất để lần sau gửi lại không cần upload
+    if message and message.photo:
+        save_telegram_file_id(message.photo[-1].file_id, chart_id, cache_key)
+    return message
 
 def schedule_cleanup():
     """Lên lịch dọn dẹp file tạm định kỳ"""
@@ -1999,26 +7333,43 @@ def handle_cung_selection(call):
     cung_type = call.data  # This will be like 'cung_menh', 'cung_tai_bach', etc.
     
     # Kiểm tra xem người dùng có dữ liệu phân tích không
-    if chat_id not in user_states or 'analysis' not in user_states[chat_id]:
+    user_data, answer, needs_analysis = check_cung_selection(chat_id, cung_type)
+    if answer:
         try:
-            bot.answer_callback_query(call.id, "Không tìm thấy dữ liệu phân tích. Vui lòng tạo lá số mới.")
+            bot.answer_callback_query(call.id, answer)
         except Exception as e:
             logger.warning(f"Không thể trả lời callback query: {e}")
         return
     
-    # Kiểm tra xem người dùng đã hoàn thành phân tích chưa
-    if 'analysis_complete' not in user_states[chat_id]:
+    # Chế độ 'lazy': cung chưa được phân tích thì phân tích ngay lần đầu mở
+    if needs_analysis:
         try:
-            bot.answer_callback_query(call.id, "Vui lòng chờ phân tích hoàn tất trước khi xem chi tiết.")
+            bot.answer_callback_query(call.id, CUNG_PROCESSING_MESSAGE)
+            bot.send_chat_action(chat_id, 'typing')
         except Exception as e:
             logger.warning(f"Không thể trả lời callback query: {e}")
-        return
-    
-    # Lấy dữ liệu phân tích từ trạng thái người dùng
-    analysis_dict = user_states[chat_id]['analysis']
+        
+        task = begin_chat_task(chat_id, 'cung')
+        try:
+            cung_analysis = analyze_cung_with_gpt(cung_type, user_data)
+        except ChatTaskCancelled:
+            return
+        finally:
+            end_chat_task(task)
+            release_cung_request(chat_id, cung_type)
+        
+        if not cung_analysis:
+            bot.send_message(
+                chat_id,
+                CUNG_FAILED_MESSAGE,
+                parse_mode='Markdown'
+            )
+            return
+        if not store_cung_analysis(chat_id, user_data, cung_type, cung_analysis):
+            return
     
     # Định dạng phân tích cho cung cụ thể
-    formatted_analysis = format_analysis(analysis_dict, user_states[chat_id], cung=cung_type)
+    formatted_analysis = format_analysis(user_data['analysis'], user_data, cung=cung_type)
     
     # Gửi phân tích cho người dùng
     bot.send_message(
@@ -2033,5 +7384,8 @@ def handle_cung_selection(call):
     except Exception as e:
         logger.warning(f"Không thể trả lời callback query: {e}")
 
+# Handler dự phòng phải đăng ký sau cùng vì telebot chọn handler khớp đầu tiên
+bot.register_callback_query_handler(handle_other_callbacks, func=lambda call: True)
+
 if __name__ == "__main__":
     main() 
\ No newline at end of file
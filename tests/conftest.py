@@ -0,0 +1,59 @@
+import os
+import sys
+
+import pytest
+
+# bot.py tạo TeleBot ngay khi import nên cần một token (không gọi tới Telegram trong test)
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:TEST')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeCursor:
+    """Con trỏ psycopg2 giả: mỗi câu lệnh được chuyển cho handler(sql, params), handler trả về các dòng kết quả."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.rows = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        result = self.handler(' '.join(sql.split()), params)
+        if isinstance(result, int):
+            self.rows, self.rowcount = [], result
+        else:
+            self.rows = list(result or [])
+            self.rowcount = len(self.rows)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, handler):
+        self.handler = handler
+        self.autocommit = True
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self.handler)
+
+
+@pytest.fixture
+def install_fake_db(monkeypatch):
+    """
+    Thay cơ sở dữ liệu của bot bằng handler(sql, params). Handler trả về danh sách dòng
+    cho SELECT, hoặc số dòng bị ảnh hưởng (int) cho UPDATE/INSERT.
+    """
+    import bot
+
+    def install(handler):
+        monkeypatch.setattr(bot, 'get_db_connection', lambda: FakeConnection(handler))
+        monkeypatch.setattr(bot, 'release_db_connection', lambda conn: None)
+
+    return install
@@ -0,0 +1,52 @@
+"""Cache phân tích: khóa theo nhà cung cấp và model đã trả lời."""
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def providers(monkeypatch):
+    providers = [
+        bot.create_llm_provider('AIRouter', 'http://airouter', 'key', 'auto'),
+        bot.create_llm_provider('OpenAI', 'http://openai', 'key', 'gpt-4o-mini'),
+    ]
+    monkeypatch.setattr(bot, 'llm_providers', providers)
+    monkeypatch.setattr(bot, 'analysis_cache', OrderedDict())
+    monkeypatch.setattr(bot, 'get_db_connection', lambda: None)
+    return providers
+
+
+def fake_llm(provider, content):
+    response = SimpleNamespace(
+        model=provider['model'],
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))]
+    )
+    return lambda **request: (response, provider)
+
+
+def test_cache_key_follows_answering_provider(providers):
+    bot.store_analysis_cache_entry('a' * 64, {'tom_tat': 'x'}, 'v1', bot.get_llm_model_key(providers[1]))
+    assert ('a' * 64, 'v1', 'OpenAI/gpt-4o-mini') in bot.analysis_cache
+    assert bot.load_analysis_cache_entry('a' * 64, 'v1') == {'tom_tat': 'x'}
+
+
+def test_changed_model_misses_cache(providers):
+    bot.store_analysis_cache_entry('a' * 64, {'tom_tat': 'x'}, 'v1', bot.get_llm_model_key(providers[1]))
+    providers[1]['model'] = 'gpt-4o'
+    assert bot.load_analysis_cache_entry('a' * 64, 'v1') is None
+
+
+def test_cung_analysis_cached_under_fallback_provider(providers, monkeypatch):
+    monkeypatch.setattr(bot, 'build_cung_messages', lambda cung_key, user_data, analysis_dict: [])
+    monkeypatch.setattr(bot, 'call_llm', fake_llm(providers[1], 'Cung Mệnh tốt'))
+    user_data = {'image_hash': 'b' * 64, 'analysis': {'tom_tat': 'x'}}
+
+    assert bot.analyze_cung_with_gpt('cung_menh', user_data) == 'Cung Mệnh tốt'
+    prompt_version = bot.get_cung_prompt_version('cung_menh')
+    assert ('b' * 64, prompt_version, 'OpenAI/gpt-4o-mini') in bot.analysis_cache
+
+    monkeypatch.setattr(bot, 'call_llm', lambda **request: pytest.fail('phải dùng cache'))
+    assert bot.analyze_cung_with_gpt('cung_menh', user_data) == 'Cung Mệnh tốt'
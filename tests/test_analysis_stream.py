@@ -0,0 +1,72 @@
+"""Phân tích đang stream về: đọc dần các cung đã viết xong trong JSON chưa trọn vẹn."""
+import json
+
+import pytest
+
+import bot
+
+
+class Chunk(dict):
+    __getattr__ = dict.__getitem__
+
+
+def make_chunk(content):
+    return Chunk(model='gpt-test', choices=[Chunk(delta=Chunk(content=content))])
+
+
+class FakeStream:
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.closed = False
+
+    def __iter__(self):
+        return (make_chunk(piece) for piece in self.pieces)
+
+    def close(self):
+        self.closed = True
+
+
+ANALYSIS = {
+    'tong_quan': 'Lá số "Tử Phủ" đồng cung',
+    'cung_menh': 'Mệnh vững\nTài tốt',
+    'cung_tai_bach': 'Tiền vào đều',
+}
+
+
+def test_truncated_json_yields_only_closed_fields():
+    text = json.dumps(ANALYSIS, ensure_ascii=False)
+    cut = text.index('Tiền vào') + 4
+    partial = bot.parse_partial_analysis(text[:cut])
+
+    assert partial == {'tong_quan': ANALYSIS['tong_quan'], 'cung_menh': ANALYSIS['cung_menh']}
+    assert bot.parse_partial_analysis(text[:text.index('Mệnh')]) == {'tong_quan': ANALYSIS['tong_quan']}
+    assert bot.parse_partial_analysis(text) == ANALYSIS
+
+
+def test_stream_reports_each_palace_once_as_it_completes(monkeypatch):
+    text = json.dumps(ANALYSIS, ensure_ascii=False)
+    pieces = [text[i:i + 7] for i in range(0, len(text), 7)]
+    provider = bot.create_llm_provider('AIRouter', 'http://airouter', 'key', 'auto')
+    monkeypatch.setattr(bot, 'call_llm', lambda **request: (FakeStream(pieces), provider))
+    progress = []
+
+    full_text, model, answered_by = bot.stream_analysis_completion([], lambda partial: progress.append(dict(partial)))
+
+    assert full_text == text and model == 'gpt-test' and answered_by is provider
+    assert [list(partial) for partial in progress] == [
+        ['tong_quan'], ['tong_quan', 'cung_menh'], ['tong_quan', 'cung_menh', 'cung_tai_bach']
+    ]
+    assert progress[-1] == ANALYSIS
+
+
+def test_cancelled_stream_is_closed(monkeypatch):
+    stream = FakeStream(['{"tong_quan": "', 'Tốt"}'])
+    monkeypatch.setattr(bot, 'call_llm', lambda **request: (stream, None))
+    task = bot.begin_chat_task(99, 'analysis')
+    task['cancelled'].set()
+    try:
+        with pytest.raises(bot.ChatTaskCancelled):
+            bot.stream_analysis_completion([], lambda partial: None)
+    finally:
+        bot.end_chat_task(task)
+    assert stream.closed
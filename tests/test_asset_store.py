@@ -0,0 +1,42 @@
+"""Kho ảnh theo nội dung: ghi một lần, dọn các ảnh lâu không được dùng."""
+import os
+import time
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def asset_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, 'ASSET_STORE_DIR', str(tmp_path))
+    return tmp_path
+
+
+def make_old(path, age):
+    old = time.time() - age
+    os.utime(path, (old, old))
+
+
+def test_store_asset_deduplicates(asset_dir):
+    first = bot.store_asset(b'\xff\xd8\xff image', 'jpg')
+    second = bot.store_asset(b'\xff\xd8\xff image', 'jpg')
+    assert first == second
+    assert sum(len(files) for _, _, files in os.walk(asset_dir)) == 1
+
+
+def test_cleanup_removes_only_unused_assets(asset_dir):
+    unused = bot.store_asset(b'unused', 'jpg')
+    reused = bot.store_asset(b'reused', 'jpg')
+    touched = bot.store_asset(b'touched', 'jpg')
+    for path in (unused, reused, touched):
+        make_old(path, 3600)
+
+    # Lưu lại cùng nội dung hoặc dùng lại đường dẫn cũ đều tính là vừa dùng
+    bot.store_asset(b'reused', 'jpg')
+    assert bot.touch_asset(touched)
+
+    assert bot.cleanup_asset_store(600) == 1
+    assert not os.path.exists(unused)
+    assert os.path.exists(reused) and os.path.exists(touched)
+    assert not bot.touch_asset(unused)
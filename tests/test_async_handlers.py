@@ -0,0 +1,283 @@
+"""Handler của chế độ asyncio: trạng thái hội thoại được đọc/ghi ngoài vòng lặp sự kiện, dùng chung logic với handler đồng bộ."""
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+CHAT_ID = 91
+
+
+class LoopCheckedStore(bot.SessionStore):
+    """SessionStore ghi lại mọi lần được đọc/ghi ngay trên vòng lặp sự kiện."""
+
+    def __init__(self):
+        super().__init__('memory')
+        self.on_loop = []
+
+    def check(self, name):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.on_loop.append(name)
+
+    def __getitem__(self, chat_id):
+        self.check('get')
+        return super().__getitem__(chat_id)
+
+    def __setitem__(self, chat_id, state):
+        self.check('set')
+        super().__setitem__(chat_id, state)
+
+    def __delitem__(self, chat_id):
+        self.check('delete')
+        super().__delitem__(chat_id)
+
+
+class FakeAsyncBot:
+    def __init__(self):
+        self.sent = []
+        self.edited = []
+        self.answers = []
+        self.deleted = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text, kwargs.get('reply_markup')))
+        return SimpleNamespace(message_id=len(self.sent))
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self.edited.append((chat_id, text))
+
+    async def delete_message(self, chat_id, message_id):
+        self.deleted.append(message_id)
+
+    async def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self.answers.append(text)
+
+    async def send_chat_action(self, chat_id, action):
+        pass
+
+
+@pytest.fixture
+def async_env(monkeypatch):
+    store = LoopCheckedStore()
+    fake_bot = FakeAsyncBot()
+    monkeypatch.setattr(bot, 'user_states', store)
+    monkeypatch.setattr(bot, 'async_bot', fake_bot)
+    monkeypatch.setattr(bot, 'async_chat_locks', [asyncio.Lock() for _ in range(4)])
+
+    async def async_save_user(user):
+        pass
+
+    monkeypatch.setattr(bot, 'async_save_user', async_save_user)
+    return SimpleNamespace(store=store, bot=fake_bot)
+
+
+def message(text, chat_id=CHAT_ID):
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), from_user=None, text=text)
+
+
+def callback(data, chat_id=CHAT_ID):
+    call = bot.types.CallbackQuery.__new__(bot.types.CallbackQuery)
+    call.id = data
+    call.data = data
+    call.message = SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=1)
+    return call
+
+
+def test_conversation_runs_session_access_off_the_loop(async_env, monkeypatch):
+    jobs = []
+
+    def enqueue_chart_job(chat_id):
+        jobs.append(bot.user_states.get(chat_id))
+        return {'position': 1, 'workers_busy': 0}
+
+    monkeypatch.setattr(bot, 'enqueue_chart_job', enqueue_chart_job)
+
+    async def run():
+        await bot.async_start(message('/start'))
+        await bot.async_handle_text(message('15/08/1990'))
+        await bot.async_handle_birth_time(callback('ty'))
+        await bot.async_handle_gender_selection(callback('male'))
+
+    try:
+        asyncio.run(run())
+        state = bot.user_states.get(CHAT_ID)
+    finally:
+        bot.charts_in_progress.discard(CHAT_ID)
+
+    assert async_env.store.on_loop == []
+    assert (state['day'], state['month'], state['year']) == (15, 8, 1990)
+    assert state['birth_time'] == 'Tý'
+    assert state['gender'] == 'Nam'
+    assert jobs == [state]
+    texts = [text for _, text, _ in async_env.bot.sent]
+    assert texts[0] == bot.WELCOME_MESSAGE
+    assert texts[-1] == bot.GENDER_PROMPT_MESSAGE
+
+
+def test_expired_birth_time_is_rejected(async_env):
+    asyncio.run(bot.async_handle_birth_time(callback('ty')))
+
+    assert async_env.bot.answers == [bot.EXPIRED_REQUEST_MESSAGE]
+    assert async_env.store.on_loop == []
+
+
+def test_cancel_analysis_runs_off_the_loop(async_env, monkeypatch):
+    cancelled_on_loop = []
+
+    def cancel_chat_tasks(chat_id):
+        try:
+            asyncio.get_running_loop()
+            cancelled_on_loop.append(True)
+        except RuntimeError:
+            cancelled_on_loop.append(False)
+        return 1
+
+    monkeypatch.setattr(bot, 'cancel_chat_tasks', cancel_chat_tasks)
+    async_env.store[CHAT_ID] = bot.new_session_state(chart_id=1)
+
+    asyncio.run(bot.async_handle_analysis_callbacks(callback('cancel_analysis')))
+
+    assert cancelled_on_loop == [False]
+    assert bot.user_states.get(CHAT_ID) is None
+    assert async_env.store.on_loop == []
+    assert async_env.bot.sent[-1][1] == bot.ANALYSIS_CANCELLED_MESSAGE
+
+
+def test_analysis_streams_and_is_stored(async_env, monkeypatch):
+    monkeypatch.setattr(bot, 'ANALYSIS_INPUT', 'text')
+    monkeypatch.setattr(bot, 'ANALYSIS_MODE', 'single')
+    user_data = bot.new_session_state(day=15, month=8, year=1990, birth_time='Tý', gender='Nam', chart_id=1)
+    async_env.store[CHAT_ID] = user_data
+
+    async def async_analyze_chart(user_data, on_progress=None):
+        await on_progress({'tong_quan': 'Tốt'})
+        return {'tong_quan': 'Tốt', 'tom_tat': 'x', 'cung_menh': 'Mệnh tốt'}
+
+    monkeypatch.setattr(bot, 'async_analyze_chart', async_analyze_chart)
+    async_env.store.on_loop.clear()
+
+    asyncio.run(bot.async_handle_analysis_callbacks(callback('analyze')))
+
+    assert async_env.store.on_loop == []
+    assert user_data['analysis_complete']
+    assert user_data['analysis']['cung_menh'] == 'Mệnh tốt'
+    assert len(async_env.bot.edited) == 2
+    assert CHAT_ID not in bot.analyses_in_progress
+
+
+def test_lazy_cung_is_analyzed_once_off_the_loop(async_env, monkeypatch):
+    calls = []
+
+    async def async_analyze_cung(cung_key, user_data, analysis_dict=None):
+        calls.append(cung_key)
+        return 'Mệnh tốt'
+
+    monkeypatch.setattr(bot, 'async_analyze_cung', async_analyze_cung)
+    user_data = bot.new_session_state(day=15, month=8, year=1990, birth_time='Tý', gender='Nam',
+                                      analysis={'tong_quan': 'Tốt', 'tom_tat': 'x'}, analysis_complete=True)
+    async_env.store[CHAT_ID] = user_data
+    async_env.store.on_loop.clear()
+
+    async def run():
+        await bot.async_handle_cung_selection(callback('cung_menh'))
+        await bot.async_handle_cung_selection(callback('cung_menh'))
+
+    asyncio.run(run())
+
+    assert async_env.store.on_loop == []
+    assert calls == ['cung_menh']
+    assert user_data['analysis']['cung_menh'] == 'Mệnh tốt'
+    assert len(async_env.bot.sent) == 2
+    assert (CHAT_ID, 'cung_menh') not in bot.cung_requests_in_progress
+
+
+def test_history_matches_threaded_handler(async_env, monkeypatch):
+    charts = [{'id': 7, 'day': 15, 'month': 8, 'year': 1990, 'birth_time': 'Tý', 'gender': 'Nam',
+               'created_at': datetime(2024, 1, 2, 3, 4)}]
+
+    async def async_get_user_charts(user_id, limit=5):
+        return charts
+
+    monkeypatch.setattr(bot, 'async_get_user_charts', async_get_user_charts)
+    monkeypatch.setattr(bot, 'get_user_charts', lambda user_id, limit=5: charts)
+    sync_sent = []
+    monkeypatch.setattr(bot.bot, 'send_message',
+                        lambda chat_id, text, reply_markup=None, **kwargs: sync_sent.append((chat_id, text, reply_markup)))
+
+    asyncio.run(bot.async_history_command(message('/history')))
+    bot.history_command(message('/history'))
+
+    (_, async_text, async_markup), = async_env.bot.sent
+    (_, sync_text, sync_markup), = sync_sent
+    assert async_text == sync_text
+    assert async_markup.to_dict() == sync_markup.to_dict()
+    assert 'view_chart_7' in str(async_markup.to_dict())
+
+
+def test_updates_of_the_same_chat_are_serialized(async_env, monkeypatch):
+    active = {}
+    overlaps = []
+
+    async def edit_message_text(text, chat_id, message_id, **kwargs):
+        active[chat_id] = active.get(chat_id, 0) + 1
+        overlaps.append((chat_id, active[chat_id], sum(active.values())))
+        await asyncio.sleep(0.05)
+        active[chat_id] -= 1
+
+    monkeypatch.setattr(async_env.bot, 'edit_message_text', edit_message_text)
+    other_chat = CHAT_ID + 1
+    for chat_id in (CHAT_ID, other_chat):
+        async_env.store[chat_id] = bot.new_session_state(state=bot.WAITING_FOR_BIRTH_TIME, day=1, month=1, year=1990)
+
+    async def run():
+        await asyncio.gather(
+            bot.async_handle_birth_time(callback('ty')),
+            bot.async_handle_birth_time(callback('suu')),
+            bot.async_handle_birth_time(callback('dan', other_chat)),
+        )
+
+    asyncio.run(run())
+
+    # Cùng một chat chạy lần lượt, chat khác vẫn chạy xen kẽ
+    assert all(per_chat == 1 for _, per_chat, _ in overlaps)
+    assert any(total == 2 for _, _, total in overlaps)
+    assert async_env.store[CHAT_ID]['birth_time'] == 'Sửu'
+    assert async_env.store[other_chat]['birth_time'] == 'Dần'
+
+
+def test_start_waits_for_the_running_update_of_the_chat(async_env, monkeypatch):
+    order = []
+    monkeypatch.setattr(bot, 'enqueue_chart_job', lambda chat_id: {'position': 1, 'workers_busy': 0})
+    async_env.store[CHAT_ID] = bot.new_session_state(state=bot.WAITING_FOR_BIRTH_TIME, day=1, month=1, year=1990)
+
+    async def answer_callback_query(callback_query_id, text=None, **kwargs):
+        order.append('gender')
+        await asyncio.sleep(0.05)
+        order.append('gender done')
+
+    monkeypatch.setattr(async_env.bot, 'answer_callback_query', answer_callback_query)
+
+    async def send_message(chat_id, text, **kwargs):
+        order.append('start')
+        return SimpleNamespace(message_id=1)
+
+    monkeypatch.setattr(async_env.bot, 'send_message', send_message)
+
+    async def run():
+        await asyncio.gather(
+            bot.async_handle_gender_selection(callback('male')),
+            bot.async_start(message('/start')),
+        )
+
+    try:
+        asyncio.run(run())
+    finally:
+        bot.charts_in_progress.discard(CHAT_ID)
+
+    assert order == ['gender', 'gender done', 'start']
+    assert async_env.store[CHAT_ID] == bot.WAITING_FOR_BIRTH_DATE
@@ -0,0 +1,50 @@
+"""birth_hash của lá số cũ được tính giống hệt lá số mới (make_birth_hash)."""
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def charts(install_fake_db):
+    rows = {}
+
+    def handle(sql, params):
+        if sql.startswith('SELECT'):
+            last_id, limit = params
+            pending = [row for row in rows.values() if row['birth_hash'] is None and row['id'] > last_id]
+            return [
+                (row['id'], row['day'], row['month'], row['year'], row['birth_time'], row['gender'])
+                for row in sorted(pending, key=lambda row: row['id'])[:limit]
+            ]
+        birth_hash, chart_id = params
+        row = rows[chart_id]
+        if row['birth_hash'] is not None:
+            return 0
+        row['birth_hash'] = birth_hash
+        return 1
+
+    install_fake_db(handle)
+    return rows
+
+
+def add_chart(rows, chart_id, birth_time, gender):
+    rows[chart_id] = {'id': chart_id, 'day': 5, 'month': 7, 'year': 1990,
+                      'birth_time': birth_time, 'gender': gender, 'birth_hash': None}
+
+
+def test_backfill_matches_make_birth_hash_for_any_whitespace(charts):
+    add_chart(charts, 1, ' Tý (23h-1h)\t', 'Nam ')
+    add_chart(charts, 2, 'Tý (23h-1h)', 'Nam')
+    add_chart(charts, 3, 'Sửu (1h-3h)', ' Nữ ')
+
+    assert bot.backfill_birth_hashes(batch_size=2, pause=0) == 3
+    expected = bot.make_birth_hash(5, 7, 1990, 'Tý (23h-1h)', 'Nam')
+    assert charts[1]['birth_hash'] == charts[2]['birth_hash'] == expected
+    assert charts[3]['birth_hash'] == bot.make_birth_hash(5, 7, 1990, 'Sửu (1h-3h)', 'Nữ')
+
+
+def test_backfill_keeps_existing_hashes(charts):
+    add_chart(charts, 1, 'Tý (23h-1h)', 'Nam')
+    charts[1]['birth_hash'] = 'x' * 64
+    assert bot.backfill_birth_hashes(batch_size=2, pause=0) == 0
+    assert charts[1]['birth_hash'] == 'x' * 64
@@ -0,0 +1,50 @@
+"""Cache lá số dùng chung: lịch sử của người dùng khác chỉ tham chiếu ảnh, không chép lại ảnh."""
+from collections import OrderedDict
+
+import pytest
+
+import bot
+
+CACHE_KEY = 'c' * 64
+
+
+@pytest.fixture
+def shared_chart(install_fake_db, monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, 'ASSET_STORE_DIR', str(tmp_path))
+    monkeypatch.setattr(bot, 'chart_cache', OrderedDict({CACHE_KEY: b'\xff\xd8\xff shared chart'}))
+    db = {'cached': True, 'inserts': []}
+
+    def handle(sql, params):
+        if sql.startswith('SELECT 1 FROM chart_cache'):
+            return [(1,)] if db['cached'] else []
+        if sql.startswith('INSERT INTO charts'):
+            db['inserts'].append(params)
+            return [(len(db['inserts']),)]
+        return []
+
+    install_fake_db(handle)
+    return db
+
+
+def user_data():
+    return {'day': 15, 'month': 8, 'year': 1990, 'birth_time': bot.BIRTH_TIME_MAPPING['ty'], 'gender': 'Nam'}
+
+
+def test_cache_hit_stores_reference_not_blob(shared_chart):
+    for user_id in (1, 2):
+        state = user_data()
+        assert bot.get_cached_chart(CACHE_KEY, user_id, state)
+        assert state['chart_id'] == user_id
+
+    for params in shared_chart['inserts']:
+        chart_blob, cache_key = params[7], params[10]
+        assert chart_blob is None and cache_key == CACHE_KEY
+
+
+def test_blob_is_kept_when_shared_row_is_missing(shared_chart):
+    shared_chart['cached'] = False
+    assert bot.get_cached_chart(CACHE_KEY, 1, user_data())
+
+    params = shared_chart['inserts'][0]
+    assert bytes(params[7].adapted) == b'\xff\xd8\xff shared chart'
+    assert params[10] is None
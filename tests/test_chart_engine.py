@@ -0,0 +1,78 @@
+"""
+So khớp bộ an sao native (compute_tuvi_chart) với các lá số mẫu lấy từ tuvivietnam.vn trong assets/.
+
+Trang HTML lưu trong assets/ chỉ chứa lá số dạng ảnh, nên nội dung từng ảnh được chép tay
+vào tests/fixtures/reference_charts.json (sao, đắc tính, đại vận, Tràng Sinh, Tuần/Triệt và
+thông tin chung). Tên sao viết theo chính tả của bot ("Kình Dương", "Hỏa Tinh"), trang web
+viết "Kinh Dương", "Hoả Tinh".
+"""
+import glob
+import hashlib
+import json
+import os
+
+import pytest
+
+import bot
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ASSETS_DIR = os.path.join(ROOT_DIR, 'assets')
+
+with open(os.path.join(os.path.dirname(__file__), 'fixtures', 'reference_charts.json'), encoding='utf-8') as f:
+    REFERENCE_CHARTS = json.load(f)
+
+
+def format_stars(stars):
+    return [f"{star['ten']} ({star['dac_tinh']})" if star['dac_tinh'] else star['ten'] for star in stars]
+
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+@pytest.fixture(scope='module', params=sorted(REFERENCE_CHARTS))
+def reference(request):
+    expected = REFERENCE_CHARTS[request.param]
+    chart_input = expected['input']
+    chart_data = bot.compute_tuvi_chart(
+        chart_input['day'], chart_input['month'], chart_input['year'],
+        chart_input['birth_time'], chart_input['gender'], view_year=chart_input['view_year']
+    )
+    return request.param, expected, chart_data
+
+
+def test_every_asset_chart_has_reference():
+    # Ảnh trùng nội dung với một lá số đã chép (ví dụ ảnh gửi lại) được tính là đã có
+    transcribed = {file_digest(os.path.join(ASSETS_DIR, name)) for name in REFERENCE_CHARTS}
+    for path in glob.glob(os.path.join(ASSETS_DIR, '*.jpg')):
+        assert os.path.basename(path) in REFERENCE_CHARTS or file_digest(path) in transcribed, path
+
+
+def test_thong_tin(reference):
+    name, expected, chart_data = reference
+    for key, value in expected['thong_tin'].items():
+        assert chart_data['thong_tin'][key] == value, f"{name}: {key}"
+
+
+def test_tuan_triet(reference):
+    name, expected, chart_data = reference
+    assert chart_data['tuan'] == expected['tuan'], name
+    assert chart_data['triet'] == expected['triet'], name
+
+
+@pytest.mark.parametrize('chi', bot.CHI)
+def test_cung(reference, chi):
+    name, expected, chart_data = reference
+    expected_cung = expected['cung'][chi]
+    cung = next(item for item in chart_data['cung'] if item['chi'] == chi)
+    where = f"{name} cung {chi}"
+
+    assert cung['can'] == expected_cung['can'], where
+    assert cung['ten'] == expected_cung['ten'], where
+    assert cung['dai_van'] == expected_cung['dai_van'], where
+    assert cung['trang_sinh'] == expected_cung['trang_sinh'], where
+    assert format_stars(cung['chinh_tinh']) == expected_cung['chinh_tinh'], where
+    # Thứ tự sao phụ trên trang web phụ thuộc cách chia cột nên chỉ so tập hợp sao
+    assert sorted(format_stars(cung['cat_tinh'])) == expected_cung['cat_tinh'], where
+    assert sorted(format_stars(cung['hung_tinh'])) == expected_cung['hung_tinh'], where
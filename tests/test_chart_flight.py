@@ -0,0 +1,85 @@
+"""Gom các yêu cầu lập cùng một lá số: chỉ một yêu cầu lập, các yêu cầu khác dùng chung kết quả."""
+import threading
+import time
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def flight_env(monkeypatch):
+    monkeypatch.setattr(bot, 'check_existing_chart', lambda *args: None)
+    monkeypatch.setattr(bot, 'get_cached_chart', lambda *args: None)
+    monkeypatch.setattr(bot, 'JOB_CANCEL_POLL_INTERVAL', 0.01)
+    bot.inflight_charts.clear()
+    yield
+    bot.inflight_charts.clear()
+
+
+def run_concurrent(count):
+    results, errors = [], []
+
+    def worker(i):
+        try:
+            results.append(bot.get_tuvi_chart(1, 1, 1990, 'Tý', 'Nam', i, {}))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results, errors
+
+
+def test_waiters_share_leader_result(flight_env, monkeypatch):
+    calls = []
+
+    def generate(*args):
+        calls.append(args)
+        time.sleep(0.2)
+        return 'chart.jpg', False
+
+    monkeypatch.setattr(bot, 'generate_tuvi_chart', generate)
+    results, errors = run_concurrent(5)
+    assert not errors
+    assert len(calls) == 1
+    assert results == [('chart.jpg', False)] * 5
+
+
+def test_failed_leader_elects_single_new_leader(flight_env, monkeypatch):
+    calls = []
+
+    def generate(*args):
+        calls.append(args)
+        time.sleep(0.2)
+        if len(calls) == 1:
+            raise RuntimeError('trình duyệt lỗi')
+        return 'chart.jpg', False
+
+    monkeypatch.setattr(bot, 'generate_tuvi_chart', generate)
+    results, errors = run_concurrent(5)
+    assert len(errors) == 1
+    assert len(calls) == 2
+    assert results == [('chart.jpg', False)] * 4
+
+
+def test_slow_leader_is_replaced_by_single_new_leader(flight_env, monkeypatch):
+    monkeypatch.setattr(bot, 'CHART_FLIGHT_TIMEOUT', 0.1)
+    calls = []
+    lock = threading.Lock()
+
+    def generate(*args):
+        with lock:
+            calls.append(args)
+            first = len(calls) == 1
+        time.sleep(0.5 if first else 0.05)
+        return 'chart.jpg', False
+
+    monkeypatch.setattr(bot, 'generate_tuvi_chart', generate)
+    results, errors = run_concurrent(5)
+    assert not errors
+    assert len(calls) == 2
+    assert len(results) == 5
@@ -0,0 +1,48 @@
+"""Đọc và chuyển đổi ảnh lá số base64 cũ sang cột nhị phân."""
+import base64
+from io import BytesIO
+
+from PIL import Image
+
+import bot
+
+
+def make_jpeg():
+    buffer = BytesIO()
+    Image.new('RGB', (20, 20), 'white').save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def test_decode_chart_image_accepts_base64_images():
+    jpeg = make_jpeg()
+    encoded = base64.b64encode(jpeg).decode()
+    assert bot.decode_chart_image(None, encoded) == jpeg
+    assert bot.decode_chart_image(None, 'data:image/jpeg;base64,' + encoded) == jpeg
+    assert bot.decode_chart_image(b'blob', encoded) == b'blob'
+
+
+def test_decode_chart_image_rejects_paths_and_non_images():
+    # b64decode không kiểm tra sẽ biến đường dẫn này thành byte rác
+    assert bot.decode_chart_image(None, 'assets/5479175202_chart_20250313120816.html') is None
+    assert bot.decode_chart_image(None, 'assets/5479175202_1.jpg') is None
+    assert bot.decode_chart_image(None, base64.b64encode(b'not an image').decode()) is None
+
+
+def test_migration_leaves_non_image_rows_untouched(install_fake_db):
+    rows = [
+        (1, 'assets/123_chart_20250311225634.html'),
+        (2, base64.b64encode(make_jpeg()).decode()),
+        (3, 'assets/123_1.jpg'),
+    ]
+    updates = []
+
+    def handle(sql, params):
+        if sql.startswith('UPDATE'):
+            updates.append(params[-1])
+            return 1
+        return rows
+
+    install_fake_db(handle)
+
+    assert bot.migrate_chart_images('charts', 'id', batch_size=10) == 1
+    assert updates == [2]
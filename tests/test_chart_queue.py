@@ -0,0 +1,51 @@
+"""Hàng đợi lập lá số: job bị hủy trả chỗ ngay và worker bỏ qua job đó."""
+import queue
+import threading
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def chart_queue(monkeypatch):
+    monkeypatch.setattr(bot, 'CHART_QUEUE_SIZE', 2)
+    monkeypatch.setattr(bot, 'chart_job_queue', queue.Queue())
+    monkeypatch.setattr(bot, 'chart_jobs', {})
+    return bot.chart_job_queue
+
+
+def test_full_queue_rejects_new_jobs(chart_queue):
+    assert bot.enqueue_chart_job(1)
+    assert bot.enqueue_chart_job(2)
+    assert bot.enqueue_chart_job(3) is None
+
+
+def test_cancel_frees_queue_slot_immediately(chart_queue):
+    assert bot.enqueue_chart_job(1)
+    assert bot.enqueue_chart_job(2)
+    assert bot.cancel_chat_tasks(1) == 1
+    assert bot.count_queued_chart_jobs() == 1
+    job = bot.enqueue_chart_job(3)
+    assert job and job['position'] == 2
+
+
+def test_worker_skips_cancelled_job(chart_queue, monkeypatch):
+    processed = []
+    monkeypatch.setattr(bot, 'process_tuvi_chart', lambda chat_id, user_data: processed.append(chat_id))
+    for chat_id in (1, 2):
+        bot.enqueue_chart_job(chat_id)
+    bot.cancel_chat_tasks(1)
+    bot.enqueue_chart_job(3)
+
+    threading.Thread(target=bot.chart_worker, daemon=True).start()
+    chart_queue.join()
+    assert processed == [2, 3]
+    assert not bot.chart_jobs
+
+
+def test_burst_of_cancels_never_overloads(chart_queue):
+    for _ in range(10):
+        assert bot.enqueue_chart_job(1)
+        bot.cancel_chat_tasks(1)
+    assert bot.count_queued_chart_jobs() == 0
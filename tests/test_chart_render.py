@@ -0,0 +1,86 @@
+"""Vẽ lá số: mọi dòng chữ nằm gọn trong ô của nó và không đè lên nhau."""
+import itertools
+
+import pytest
+from PIL import ImageDraw
+
+import bot
+
+REFERENCE_CHARTS = [
+    (12, 5, 1998, 'Tuất', 'Nữ'),
+    (11, 3, 2025, 'Ngọ', 'Nữ'),
+    (29, 9, 1994, 'Ngọ', 'Nam'),
+    (23, 4, 1992, 'Hợi', 'Nam'),
+]
+
+
+class RecordingDraw(ImageDraw.ImageDraw):
+    """ImageDraw ghi lại khung bao của từng dòng chữ được vẽ."""
+    boxes = []
+
+    def text(self, xy, text, *args, **kwargs):
+        self.boxes.append((text, self.textbbox(xy, text, font=kwargs.get('font'))))
+        return super().text(xy, text, *args, **kwargs)
+
+
+@pytest.fixture
+def drawn_boxes(monkeypatch):
+    RecordingDraw.boxes = []
+    monkeypatch.setattr(bot.ImageDraw, 'Draw', lambda image: RecordingDraw(image))
+    return RecordingDraw.boxes
+
+
+def cell_of(box):
+    x0, y0 = box[0], box[1]
+    return int(x0 // bot.CHART_CELL_WIDTH), int(y0 // bot.CHART_CELL_HEIGHT)
+
+
+def overlaps(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def crowded_chart():
+    # Lá số giả với tên dài và nhiều sao nhất có thể trong một ô
+    chart = bot.compute_tuvi_chart(*REFERENCE_CHARTS[0], view_year=2025)
+    star = {'ten': 'Thiên Quan Quý Nhân Phụ Tá', 'dac_tinh': 'Đ'}
+    for cung in chart['cung']:
+        cung['ten'] = 'Tài Bạch Tử Tức'
+        cung['than'] = True
+        cung['dai_van'] = 106
+        cung['trang_sinh'] = 'Trường Sinh'
+        cung['luu_nguyet'] = 10
+        cung['chinh_tinh'] = [star, star]
+        cung['cat_tinh'] = [star] * 14
+        cung['hung_tinh'] = [star] * 14
+    return chart
+
+
+@pytest.mark.parametrize('chart', [
+    *[pytest.param(args, id='/'.join(map(str, args))) for args in REFERENCE_CHARTS],
+    pytest.param(None, id='crowded'),
+])
+def test_cell_text_fits_without_overlap(drawn_boxes, chart):
+    chart_data = crowded_chart() if chart is None else bot.compute_tuvi_chart(*chart, view_year=2025)
+    bot.render_tuvi_chart(chart_data)
+
+    cells = {}
+    for text, box in drawn_boxes:
+        col, row = cell_of(box)
+        if (col, row) not in bot.CHART_GRID_POSITIONS.values():
+            continue
+        x, y = col * bot.CHART_CELL_WIDTH, row * bot.CHART_CELL_HEIGHT
+        assert x < box[0] and box[2] < x + bot.CHART_CELL_WIDTH, text
+        assert y < box[1] and box[3] < y + bot.CHART_CELL_HEIGHT, text
+        cells.setdefault((col, row), []).append((text, box))
+
+    assert len(cells) == 12
+    for items in cells.values():
+        for (text_a, box_a), (text_b, box_b) in itertools.combinations(items, 2):
+            assert not overlaps(box_a, box_b), (text_a, text_b)
+
+
+def test_fit_chart_text_truncates_when_too_long():
+    draw = ImageDraw.Draw(bot.get_chart_template().copy())
+    text, font = bot.fit_chart_text(draw, 'Thiên Quan Quý Nhân ' * 5, 80, 12)
+    assert text.endswith('…')
+    assert draw.textlength(text, font=font) <= 80
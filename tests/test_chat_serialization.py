@@ -0,0 +1,202 @@
+"""Khóa theo chat: các update của cùng một chat đổi trạng thái lần lượt, không mất bước nào."""
+import logging
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+CHATS = range(1, 21)
+workers_started = False
+
+
+class ErrorLogs(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+@pytest.fixture
+def chat_env(monkeypatch):
+    global workers_started
+    for name in ('send_message', 'edit_message_text', 'delete_message', 'answer_callback_query'):
+        monkeypatch.setattr(bot.bot, name, lambda *args, **kwargs: SimpleNamespace(message_id=1))
+    monkeypatch.setattr(bot, 'save_user', lambda user: None)
+    monkeypatch.setattr(bot, 'send_chart_photo', lambda *args, **kwargs: None)
+    charts = []
+
+    def get_tuvi_chart(day, month, year, birth_time, gender, user_id, user_data):
+        charts.append(user_id)
+        time.sleep(random.random() * 0.02)
+        user_data['chart_id'] = user_id
+        return f'/tmp/chart_{user_id}.jpg', False
+
+    monkeypatch.setattr(bot, 'get_tuvi_chart', get_tuvi_chart)
+    errors = ErrorLogs()
+    bot.logger.addHandler(errors)
+    if not workers_started:
+        bot.start_chart_workers(4)
+        workers_started = True
+    for chat_id in CHATS:
+        bot.user_states.pop(chat_id, None)
+    yield SimpleNamespace(charts=charts, errors=errors.messages)
+    bot.logger.removeHandler(errors)
+    for chat_id in CHATS:
+        bot.user_states.pop(chat_id, None)
+
+
+def message(chat_id, text):
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), text=text, from_user=None)
+
+
+def callback(chat_id, data):
+    call = bot.types.CallbackQuery.__new__(bot.types.CallbackQuery)
+    call.id = f'{chat_id}-{data}'
+    call.data = data
+    call.message = SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=1)
+    return call
+
+
+def run_threads(targets):
+    threads = [threading.Thread(target=target) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+
+def fill_birth_info(chat_id):
+    bot.start(message(chat_id, '/start'))
+    bot.get_birth_date(message(chat_id, '01/02/1990'))
+    bot.handle_birth_time(callback(chat_id, 'ty'))
+
+
+def test_same_chat_updates_never_interleave():
+    active, max_active = {}, {}
+    guard = threading.Lock()
+
+    @bot.serialize_chat
+    def increment(update):
+        chat_id = update.chat.id
+        with guard:
+            active[chat_id] = active.get(chat_id, 0) + 1
+            max_active[chat_id] = max(max_active.get(chat_id, 0), active[chat_id])
+        state = bot.user_states.get(chat_id) or {'count': 0}
+        time.sleep(0.001)
+        bot.user_states[chat_id] = {'count': state['count'] + 1}
+        with guard:
+            active[chat_id] -= 1
+
+    try:
+        run_threads([lambda c=chat_id: increment(message(c, 'x')) for chat_id in CHATS for _ in range(25)])
+        for chat_id in CHATS:
+            assert bot.user_states[chat_id]['count'] == 25
+            assert max_active[chat_id] == 1
+    finally:
+        for chat_id in CHATS:
+            bot.user_states.pop(chat_id, None)
+
+
+def test_other_chats_are_not_blocked():
+    entered, release = threading.Event(), threading.Event()
+
+    @bot.serialize_chat
+    def slow(update):
+        entered.set()
+        release.wait(5)
+
+    @bot.serialize_chat
+    def fast(update):
+        return update.chat.id
+
+    thread = threading.Thread(target=slow, args=(message(1, 'x'),))
+    thread.start()
+    try:
+        assert entered.wait(5)
+        assert fast(message(2, 'x')) == 2
+    finally:
+        release.set()
+        thread.join(5)
+
+
+def test_duplicate_clicks_build_one_chart_per_chat(chat_env):
+    def flow(chat_id):
+        fill_birth_info(chat_id)
+        run_threads([lambda: bot.handle_gender_selection(callback(chat_id, 'male')) for _ in range(4)])
+
+    run_threads([lambda c=chat_id: flow(c) for chat_id in CHATS])
+    bot.chart_job_queue.join()
+
+    assert not chat_env.errors
+    assert sorted(chat_env.charts) == list(CHATS)
+    for chat_id in CHATS:
+        state = bot.user_states[chat_id]
+        assert 'state' not in state
+        assert state['gender'] == 'Nam'
+        assert state['birth_time'] == bot.BIRTH_TIME_MAPPING['ty']
+        assert state['chart_image_path'] == f'/tmp/chart_{chat_id}.jpg'
+    assert not bot.charts_in_progress.intersection(CHATS)
+
+
+def test_cancel_is_not_undone_by_running_job(chat_env):
+    def flow(chat_id):
+        fill_birth_info(chat_id)
+        run_threads([
+            lambda: bot.handle_gender_selection(callback(chat_id, 'male')),
+            lambda: (time.sleep(random.random() * 0.02), bot.cancel(message(chat_id, '/cancel'))),
+        ])
+
+    run_threads([lambda c=chat_id: flow(c) for chat_id in CHATS])
+    bot.chart_job_queue.join()
+
+    assert not chat_env.errors
+    for chat_id in CHATS:
+        assert chat_id not in bot.user_states
+    assert not bot.charts_in_progress.intersection(CHATS)
+    with bot.chart_jobs_lock:
+        assert not [job for job in bot.chart_jobs.values() if job['chat_id'] in CHATS]
+
+
+def test_restart_during_job_drops_its_result(chat_env, monkeypatch):
+    chat_id = CHATS[0]
+    sent = []
+    monkeypatch.setattr(bot, 'send_chart_photo', lambda *args, **kwargs: sent.append(args))
+
+    def restart_while_building(day, month, year, birth_time, gender, user_id, user_data):
+        bot.start(message(chat_id, '/start'))
+        return f'/tmp/chart_{user_id}.jpg', False
+
+    monkeypatch.setattr(bot, 'get_tuvi_chart', restart_while_building)
+    fill_birth_info(chat_id)
+    user_data = bot.user_states[chat_id]
+    user_data['gender'] = 'Nam'
+    bot.process_tuvi_chart(chat_id, user_data)
+
+    assert not chat_env.errors
+    assert not sent
+    assert 'chart_image_path' not in user_data
+    assert bot.user_states[chat_id] == bot.WAITING_FOR_BIRTH_DATE
+
+
+def test_restart_during_cung_analysis_drops_its_result(chat_env, monkeypatch):
+    chat_id = CHATS[0]
+    formatted = []
+    monkeypatch.setattr(bot, 'format_analysis', lambda *args, **kwargs: formatted.append(args) or '')
+
+    def restart_while_analyzing(cung_key, user_data):
+        bot.start(message(chat_id, '/start'))
+        return 'Cung Mệnh tốt'
+
+    monkeypatch.setattr(bot, 'analyze_cung_with_gpt', restart_while_analyzing)
+    user_data = bot.new_session_state(analysis={'tom_tat': 'x'}, analysis_complete=True)
+    bot.user_states[chat_id] = user_data
+    bot.handle_cung_selection(callback(chat_id, 'cung_menh'))
+
+    assert not formatted
+    assert 'cung_menh' not in user_data['analysis']
@@ -0,0 +1,126 @@
+"""Phân tích từng cung: phân tích khi người dùng mở (lazy) và phân tích song song (parallel)."""
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+CHAT_ID = 77
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    provider = bot.create_llm_provider('AIRouter', 'http://airouter', 'key', 'auto')
+    monkeypatch.setattr(bot, 'llm_providers', [provider])
+    monkeypatch.setattr(bot, 'analysis_cache', OrderedDict())
+    monkeypatch.setattr(bot, 'get_db_connection', lambda: None)
+    monkeypatch.setattr(bot, 'build_cung_messages', lambda cung_key, user_data, analysis_dict: cung_key)
+    calls = []
+
+    def call_llm(messages, **request):
+        calls.append(messages)
+        content = f'Phân tích {messages}'
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))]), provider
+
+    monkeypatch.setattr(bot, 'call_llm', call_llm)
+    return calls
+
+
+def cung_call(data):
+    call = bot.types.CallbackQuery.__new__(bot.types.CallbackQuery)
+    call.id = data
+    call.data = data
+    call.message = SimpleNamespace(chat=SimpleNamespace(id=CHAT_ID), message_id=1)
+    return call
+
+
+def test_palace_is_analyzed_on_first_open_and_cached(llm, monkeypatch):
+    sent = []
+    monkeypatch.setattr(bot.bot, 'send_message', lambda chat_id, text, **kwargs: sent.append(text))
+    for name in ('answer_callback_query', 'send_chat_action'):
+        monkeypatch.setattr(bot.bot, name, lambda *args, **kwargs: None)
+    user_data = bot.new_session_state(image_hash='d' * 64, analysis={'tong_quan': 'Tốt', 'tom_tat': 'x'},
+                                      analysis_complete=True)
+    bot.user_states[CHAT_ID] = user_data
+    try:
+        bot.handle_cung_selection(cung_call('cung_menh'))
+        bot.handle_cung_selection(cung_call('cung_menh'))
+    finally:
+        bot.user_states.pop(CHAT_ID, None)
+
+    assert llm == ['cung_menh']
+    assert user_data['analysis']['cung_menh'] == 'Phân tích cung_menh'
+    assert len(sent) == 2
+
+    # Người dùng khác có cùng lá số dùng lại kết quả đã lưu, không gọi AI nữa
+    other = {'image_hash': 'd' * 64, 'analysis': {'tom_tat': 'x'}}
+    assert bot.analyze_cung_with_gpt('cung_menh', other) == 'Phân tích cung_menh'
+    assert llm == ['cung_menh']
+
+
+def test_failed_palace_is_not_cached(llm, monkeypatch):
+    monkeypatch.setattr(bot, 'call_llm', lambda **request: (_ for _ in ()).throw(TimeoutError('AI chậm')))
+    user_data = {'image_hash': 'e' * 64, 'analysis': {'tom_tat': 'x'}}
+    assert bot.analyze_cung_with_gpt('cung_menh', user_data) is None
+    assert not bot.analysis_cache
+
+
+def test_parallel_fan_out_stays_within_concurrency(llm, monkeypatch):
+    monkeypatch.setattr(bot, 'ANALYSIS_CONCURRENCY', 3)
+    monkeypatch.setattr(bot, 'analysis_slots', threading.BoundedSemaphore(3))
+    monkeypatch.setattr(bot, 'ANALYSIS_CUNG_RETRIES', 1)
+    sleep = time.sleep
+    monkeypatch.setattr(bot.time, 'sleep', lambda seconds: None)
+    guard = threading.Lock()
+    state = {'active': 0, 'max_active': 0, 'failed': False}
+    calls = []
+    provider = bot.llm_providers[0]
+
+    def call_llm(messages, **request):
+        with guard:
+            calls.append(messages)
+            state['active'] += 1
+            state['max_active'] = max(state['max_active'], state['active'])
+            fail = messages == 'cung_tai_bach' and not state['failed']
+            state['failed'] = state['failed'] or fail
+        sleep(0.02)
+        with guard:
+            state['active'] -= 1
+        if fail:
+            raise TimeoutError('AI chậm')
+        content = f'Phân tích {messages}'
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))]), provider
+
+    monkeypatch.setattr(bot, 'call_llm', call_llm)
+    progress = []
+    overview = {'tong_quan': 'Tốt', 'tom_tat': 'x', 'cung_menh': 'Đã có'}
+    merged = bot.analyze_all_cung_parallel(overview, {'image_hash': 'f' * 64}, progress.append)
+
+    assert state['max_active'] == 3
+    assert set(merged) == set(overview) | set(bot.ANALYSIS_CUNG_NAMES)
+    assert merged['cung_menh'] == 'Đã có'
+    # Chỉ cung lỗi được gọi lại, các cung khác gọi đúng một lần
+    assert calls.count('cung_tai_bach') == 2
+    assert sorted(set(calls)) == sorted(set(bot.ANALYSIS_CUNG_NAMES) - {'cung_menh'})
+    assert len(calls) == len(bot.ANALYSIS_CUNG_NAMES)
+    assert len(progress) == len(bot.ANALYSIS_CUNG_NAMES) - 1
+
+
+def test_palace_failing_every_retry_is_left_out(llm, monkeypatch):
+    monkeypatch.setattr(bot.time, 'sleep', lambda seconds: None)
+    provider = bot.llm_providers[0]
+
+    def call_llm(messages, **request):
+        if messages == 'cung_no_boc':
+            raise TimeoutError('AI chậm')
+        content = f'Phân tích {messages}'
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))]), provider
+
+    monkeypatch.setattr(bot, 'call_llm', call_llm)
+    merged = bot.analyze_all_cung_parallel({'tong_quan': 'Tốt', 'tom_tat': 'x'}, {'image_hash': 'f' * 64})
+
+    assert 'cung_no_boc' not in merged
+    assert set(merged) == {'tong_quan', 'tom_tat'} | (set(bot.ANALYSIS_CUNG_NAMES) - {'cung_no_boc'})
@@ -0,0 +1,112 @@
+"""Failover của pool kết nối Postgres: pool cũ chỉ đóng khi các kết nối đang mượn được trả hết."""
+import threading
+
+import pytest
+
+import bot
+
+
+class FakeConnection:
+    def __init__(self, host):
+        self.host = host
+        self.closed = 0
+        self.autocommit = False
+
+    def close(self):
+        self.closed = 1
+
+
+class FakePool:
+    created = []
+
+    def __init__(self, minconn, maxconn, host, **kwargs):
+        # Kết nối endpoint mới không được chặn các luồng đang dùng cơ sở dữ liệu
+        assert not bot.db_pool_lock.locked()
+        if host == 'down':
+            raise bot.psycopg2.OperationalError('connection refused')
+        self.host = host
+        self.idle = []
+        self.closed_all = False
+        FakePool.created.append(self)
+
+    def getconn(self):
+        assert not self.closed_all
+        return self.idle.pop() if self.idle else FakeConnection(self.host)
+
+    def putconn(self, conn, close=False):
+        if close:
+            conn.close()
+        else:
+            self.idle.append(conn)
+
+    def closeall(self):
+        self.closed_all = True
+        for conn in self.idle:
+            conn.close()
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    FakePool.created = []
+    hosts = ['primary', 'replica']
+    monkeypatch.setattr(bot.psycopg2.pool, 'ThreadedConnectionPool', FakePool)
+    monkeypatch.setattr(bot, 'get_db_connection_configs', lambda: [
+        {'host': host, 'port': 5432, 'database': 'db', 'user': 'u', 'password': 'p'} for host in hosts
+    ])
+    monkeypatch.setattr(bot, 'db_pool', None)
+    monkeypatch.setattr(bot, 'db_endpoint_index', 0)
+    monkeypatch.setattr(bot, 'db_consecutive_errors', 0)
+    monkeypatch.setattr(bot, 'db_failover_running', False)
+    monkeypatch.setattr(bot, 'db_connection_info', {})
+    monkeypatch.setattr(bot, 'db_pool_leases', {})
+    monkeypatch.setattr(bot, 'retired_db_pools', set())
+    monkeypatch.setattr(bot, 'db_pool_slots', threading.BoundedSemaphore(bot.DB_POOL_MAX))
+    monkeypatch.setattr(bot, 'db_pool_stats', dict(bot.db_pool_stats))
+    return hosts
+
+
+def fail_over():
+    for _ in range(bot.DB_FAILOVER_ERRORS):
+        bot.report_db_error()
+
+
+def test_failover_keeps_checked_out_connections_open(fake_db):
+    in_flight = bot.get_db_connection()
+    idle = bot.get_db_connection()
+    bot.release_db_connection(idle)
+    old_pool = bot.db_pool
+
+    fail_over()
+
+    assert bot.db_pool is not old_pool and bot.db_pool.host == 'replica'
+    # Kết nối đang chạy truy vấn trên pool cũ không bị đóng giữa chừng
+    assert not in_flight.closed
+    assert not old_pool.closed_all
+    assert bot.get_db_connection().host == 'replica'
+
+    bot.release_db_connection(in_flight)
+    assert in_flight.closed
+    assert old_pool.closed_all
+    assert old_pool not in bot.retired_db_pools
+
+
+def test_failover_closes_idle_pool_immediately(fake_db):
+    bot.release_db_connection(bot.get_db_connection())
+    old_pool = bot.db_pool
+
+    fail_over()
+
+    assert old_pool.closed_all
+    assert bot.db_pool_stats['failovers'] == 1
+
+
+def test_failover_skips_unreachable_endpoint(fake_db):
+    fake_db[1] = 'down'
+    bot.release_db_connection(bot.get_db_connection())
+    old_pool = bot.db_pool
+
+    fail_over()
+
+    # Không kết nối được endpoint dự phòng thì quay lại endpoint đầu tiên
+    assert bot.db_pool is not old_pool and bot.db_pool.host == 'primary'
+    assert [pool.host for pool in FakePool.created] == ['primary', 'primary']
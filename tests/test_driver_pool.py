@@ -0,0 +1,150 @@
+"""Pool trình duyệt Chrome và chromedriver: chuẩn bị lúc khởi động, không gọi mạng trong lúc xử lý yêu cầu."""
+import pytest
+
+import bot
+
+
+class FailingDriverManager:
+    def install(self):
+        raise OSError('không có mạng')
+
+
+@pytest.fixture
+def no_chromedriver(monkeypatch):
+    monkeypatch.setattr(bot, 'chromedriver_path', None)
+    monkeypatch.setattr(bot, 'CHROMEDRIVER_PATH', None)
+    installs = []
+
+    class RecordingDriverManager:
+        def install(self):
+            installs.append(True)
+            return '/opt/chromedriver'
+
+    monkeypatch.setattr(bot, 'ChromeDriverManager', RecordingDriverManager)
+    return installs
+
+
+def test_request_never_downloads_chromedriver(no_chromedriver):
+    with pytest.raises(RuntimeError):
+        bot.create_pooled_driver()
+    assert not no_chromedriver
+
+
+@pytest.mark.parametrize('engine, scraper', [('native', 'selenium'), ('native', 'http'), ('selenium', 'http')])
+def test_startup_prepares_fallback_for_every_engine(no_chromedriver, monkeypatch, engine, scraper):
+    monkeypatch.setattr(bot, 'CHART_ENGINE', engine)
+    monkeypatch.setattr(bot, 'CHART_SCRAPER', scraper)
+    monkeypatch.setattr(bot, 'init_driver_pool', lambda: pytest.fail('chỉ khởi động sẵn trình duyệt cho selenium'))
+
+    assert bot.prepare_chrome_fallback()
+    assert no_chromedriver == [True]
+    assert bot.resolve_chromedriver_path() == '/opt/chromedriver'
+
+
+def test_startup_failure_disables_fallback(no_chromedriver, monkeypatch):
+    monkeypatch.setattr(bot, 'ChromeDriverManager', FailingDriverManager)
+    assert not bot.prepare_chrome_fallback()
+    with pytest.raises(RuntimeError):
+        bot.resolve_chromedriver_path()
+
+
+class FakeDriver:
+    def __init__(self, path):
+        self.path = path
+        self.handles = ['main']
+        self.cookies = True
+        self.url = None
+        self.quit_count = 0
+        self.fail_reset = False
+        self.switch_to = self
+
+    @property
+    def window_handles(self):
+        if self.fail_reset:
+            raise OSError('chrome not reachable')
+        return list(self.handles)
+
+    def window(self, handle):
+        self.current = handle
+
+    def close(self):
+        self.handles.remove(self.current)
+
+    def delete_all_cookies(self):
+        self.cookies = False
+
+    def get(self, url):
+        self.url = url
+
+    def quit(self):
+        self.quit_count += 1
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    drivers = []
+
+    def chrome(service, options):
+        drivers.append(FakeDriver(service))
+        return drivers[-1]
+
+    monkeypatch.setattr(bot, 'chromedriver_path', '/opt/chromedriver')
+    monkeypatch.setattr(bot, 'Service', lambda path: path)
+    monkeypatch.setattr(bot.webdriver, 'Chrome', chrome)
+    monkeypatch.setattr(bot, 'driver_pool', bot.queue.Queue())
+    monkeypatch.setattr(bot, 'driver_pool_stats', {key: 0 for key in bot.driver_pool_stats})
+    monkeypatch.setattr(bot, 'DRIVER_POOL_SIZE', 1)
+    monkeypatch.setattr(bot, 'DRIVER_MAX_USES', 3)
+    return drivers
+
+
+def test_released_driver_is_reset_and_leased_again(pool):
+    entry = bot.acquire_chrome_driver(timeout=1)
+    entry['driver'].handles.append('popup')
+    bot.release_chrome_driver(entry)
+
+    again = bot.acquire_chrome_driver(timeout=1)
+    assert again is entry and len(pool) == 1
+    assert again['driver'].handles == ['main']
+    assert not again['driver'].cookies and again['driver'].url == 'about:blank'
+    assert bot.driver_pool_stats['leases'] == 2 and bot.driver_pool_stats['in_use'] == 1
+
+
+def test_driver_is_recycled_after_max_uses(pool):
+    for _ in range(3):
+        entry = bot.acquire_chrome_driver(timeout=1)
+        bot.release_chrome_driver(entry)
+
+    assert pool[0].quit_count == 1
+    assert bot.driver_pool_stats['recycled'] == 1 and bot.driver_pool_stats['total'] == 0
+    assert bot.acquire_chrome_driver(timeout=1)['driver'] is pool[1]
+
+
+def test_crashed_driver_is_replaced(pool):
+    entry = bot.acquire_chrome_driver(timeout=1)
+    entry['driver'].fail_reset = True
+    bot.release_chrome_driver(entry)
+
+    assert bot.driver_pool_stats['crashed'] == 1 and pool[0].quit_count == 1
+    assert bot.acquire_chrome_driver(timeout=1)['driver'] is pool[1]
+
+
+def test_full_pool_waits_for_a_free_driver(pool):
+    entry = bot.acquire_chrome_driver(timeout=1)
+    with pytest.raises(TimeoutError):
+        bot.acquire_chrome_driver(timeout=0.05)
+
+    releaser = bot.threading.Timer(0.05, bot.release_chrome_driver, args=(entry,))
+    releaser.start()
+    assert bot.acquire_chrome_driver(timeout=5) is entry
+    assert bot.driver_pool_stats['waits'] == 1
+
+
+def test_cancelled_driver_is_counted_as_aborted(pool):
+    entry = bot.acquire_chrome_driver(timeout=1)
+    bot.abort_chrome_driver(entry)
+    bot.release_chrome_driver(entry, broken=True)
+
+    assert bot.driver_pool_stats['aborted'] == 1
+    assert bot.driver_pool_stats['crashed'] == 0
+    assert bot.driver_pool_stats['total'] == 0 and bot.driver_pool.empty()
@@ -0,0 +1,228 @@
+"""Bộ định tuyến AI: gửi dự phòng (hedging), chuyển nhà cung cấp khi lỗi và tạm ngưng, chạy trên máy chủ HTTP giả cục bộ."""
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import bot
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Chế độ async chỉ cần aiohttp cho phần gọi AI
+requires_aiohttp = pytest.mark.skipif(aiohttp is None, reason='Chưa cài aiohttp')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server.requests.append(body)
+        time.sleep(server.delay)
+        if server.status != 200:
+            self.send_response(server.status)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({'error': {'message': 'lỗi giả', 'type': 'server_error'}}).encode())
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps({
+            'id': 'chatcmpl-1',
+            'object': 'chat.completion',
+            'model': body['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': server.reply}}],
+        }).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stand_in(reply, delay=0, status=200):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.reply = reply
+    server.delay = delay
+    server.status = status
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def stand_ins(monkeypatch):
+    servers = []
+
+    def configure(*specs):
+        providers = []
+        for name, options in specs:
+            server = start_stand_in(name, **options)
+            servers.append(server)
+            providers.append(bot.create_llm_provider(name, f'http://127.0.0.1:{server.server_port}/v1', 'key', f'{name}-model'))
+        monkeypatch.setattr(bot, 'llm_providers', providers)
+        return providers, servers
+
+    monkeypatch.setattr(bot, 'LLM_HEDGE_MIN_DELAY', 0.2)
+    monkeypatch.setattr(bot, 'LLM_HEDGE_DEFAULT_DELAY', 0.2)
+    monkeypatch.setattr(bot, 'LLM_REQUEST_TIMEOUT', 10)
+    for key in ('llm_hedges', 'llm_hedge_wins', 'llm_calls_cancelled'):
+        monkeypatch.setitem(bot.bot_stats, key, 0)
+    yield configure
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def ask(**request):
+    response, provider = bot.call_llm(messages=[{'role': 'user', 'content': 'Xin chào'}], **request)
+    return response.choices[0].message.content, provider['name']
+
+
+def test_fast_provider_answers_without_hedging(stand_ins):
+    providers, servers = stand_ins(('primary', {}), ('backup', {}))
+
+    assert ask() == ('primary', 'primary')
+    assert servers[0].requests[0]['model'] == 'primary-model'
+    assert servers[1].requests == []
+    assert bot.bot_stats['llm_hedges'] == 0
+    assert len(providers[0]['latencies']['full']) == 1
+
+
+def test_slow_provider_is_hedged_and_backup_wins(stand_ins):
+    providers, servers = stand_ins(('primary', {'delay': 1.5}), ('backup', {}))
+
+    start = time.time()
+    assert ask() == ('backup', 'backup')
+    assert time.time() - start < 1.2
+    assert len(servers[0].requests) == 1
+    assert len(servers[1].requests) == 1
+    assert bot.bot_stats['llm_hedges'] == 1
+    assert bot.bot_stats['llm_hedge_wins'] == 1
+
+
+def test_failed_provider_fails_over_to_next(stand_ins):
+    providers, servers = stand_ins(('primary', {'status': 500}), ('backup', {}))
+
+    assert ask() == ('backup', 'backup')
+    assert providers[0]['errors'] == 1
+    assert providers[0]['consecutive_errors'] == 1
+    assert bot.bot_stats['llm_hedges'] == 0
+
+
+def test_all_providers_failing_raises_last_error(stand_ins):
+    stand_ins(('primary', {'status': 500}), ('backup', {'status': 503}))
+
+    with pytest.raises(Exception):
+        ask()
+
+
+def test_provider_is_put_in_cooldown_after_consecutive_errors(stand_ins, monkeypatch):
+    monkeypatch.setattr(bot, 'LLM_PROVIDER_MAX_ERRORS', 2)
+    monkeypatch.setattr(bot, 'LLM_PROVIDER_COOLDOWN', 60)
+    providers, servers = stand_ins(('primary', {'status': 500}), ('backup', {}))
+
+    for _ in range(2):
+        assert ask() == ('backup', 'backup')
+    assert providers[0]['disabled_until'] > time.time() + 50
+    assert bot.get_provider_order('full') == [providers[1]]
+
+    # Trong thời gian tạm ngưng, nhà cung cấp lỗi không còn nhận yêu cầu
+    servers[0].requests.clear()
+    assert ask() == ('backup', 'backup')
+    assert servers[0].requests == []
+
+
+class FakeStream:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_losing_stream_that_already_arrived_is_closed():
+    # Bên thua đã trả về luồng stream cùng lúc với bên thắng
+    future = Future()
+    future.set_result(FakeStream())
+    cancelled = threading.Event()
+
+    bot.discard_llm_request(future, cancelled, 'stream')
+
+    assert cancelled.is_set()
+    assert future.result().closed
+
+
+def test_losing_stream_that_arrives_later_is_closed():
+    future = Future()
+    future.set_running_or_notify_cancel()
+    bot.discard_llm_request(future, threading.Event(), 'stream')
+
+    stream = FakeStream()
+    future.set_result(stream)
+    assert stream.closed
+
+
+def test_losing_request_that_has_not_started_is_cancelled():
+    future = Future()
+    bot.discard_llm_request(future, threading.Event(), 'stream')
+
+    assert future.cancelled()
+
+
+@requires_aiohttp
+def test_async_router_hedges_and_fails_over(stand_ins, monkeypatch):
+    providers, servers = stand_ins(('broken', {'status': 500}), ('slow', {'delay': 1.5}), ('fast', {}))
+    # Nhà cung cấp lỗi đứng đầu, nhà cung cấp chậm được gọi khi chuyển tiếp, nhà cung cấp nhanh là dự phòng
+    monkeypatch.setattr(bot, 'LLM_MAX_HEDGES', 1)
+    monkeypatch.setattr(bot, 'aiohttp', aiohttp)
+
+    async def run():
+        session = aiohttp.ClientSession()
+        monkeypatch.setattr(bot, 'async_http_session', session)
+        try:
+            return await bot.async_call_llm(messages=[{'role': 'user', 'content': 'Xin chào'}])
+        finally:
+            await session.close()
+
+    response, provider = asyncio.run(run())
+
+    assert response['choices'][0]['message']['content'] == 'fast'
+    assert provider['name'] == 'fast'
+    assert providers[0]['errors'] == 1
+    assert bot.bot_stats['llm_hedges'] == 1
+    assert bot.bot_stats['llm_hedge_wins'] == 1
+
+
+@requires_aiohttp
+def test_async_losing_stream_in_same_done_set_is_closed(monkeypatch):
+    monkeypatch.setattr(bot, 'aiohttp', aiohttp)
+    closed = []
+
+    class FakeResponse(aiohttp.ClientResponse):
+        def __init__(self):
+            pass
+
+        def close(self):
+            closed.append(self)
+
+    async def run():
+        response = FakeResponse()
+
+        async def finished():
+            return response
+
+        task = asyncio.ensure_future(finished())
+        await task
+        bot.discard_llm_task(task)
+        return response
+
+    response = asyncio.run(run())
+    assert closed == [response]
@@ -0,0 +1,43 @@
+"""Bảng âm lịch tính sẵn 1900-2100: tra bảng cho cùng kết quả với công thức thiên văn."""
+import os
+import random
+from datetime import date, timedelta
+
+import pytest
+
+import bot
+
+TABLE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'lunar_table.bin')
+
+
+@pytest.fixture
+def loaded_table(monkeypatch):
+    monkeypatch.setattr(bot, 'lunar_table', None)
+    monkeypatch.setattr(bot, 'lunar_table_start_jd', None)
+    assert bot.load_lunar_table(TABLE_PATH)
+    return bot.lunar_table
+
+
+def sample_dates():
+    first, last = date(1900, 1, 1), date(2100, 12, 31)
+    rng = random.Random(2100)
+    dates = [first, last, date(2000, 2, 29), date(2023, 3, 22), date(2023, 4, 19)]
+    dates += [first + timedelta(days=rng.randrange((last - first).days + 1)) for _ in range(500)]
+    return dates
+
+
+def test_lookups_match_astronomical_formula(loaded_table):
+    for day in sample_dates():
+        assert bot.convert_solar_to_lunar(day.day, day.month, day.year) == \
+            bot.calculate_solar_to_lunar(day.day, day.month, day.year), day
+
+
+def test_records_use_only_lunar_fields(loaded_table):
+    assert len(loaded_table) == (date(2100, 12, 31) - date(1900, 1, 1)).days + 1
+    assert all(record >> 18 == 0 for record in loaded_table)
+
+
+def test_build_reproduces_shipped_table(tmp_path):
+    path = bot.build_lunar_table(str(tmp_path / 'lunar_table.bin'))
+    with open(path, 'rb') as built, open(TABLE_PATH, 'rb') as shipped:
+        assert built.read() == shipped.read()
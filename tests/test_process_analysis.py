@@ -0,0 +1,91 @@
+"""Phân tích lá số trong phiên: chỉ lấy ảnh khi thật sự cần và không lưu thêm lá số."""
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+CHAT_ID = 42
+
+
+@pytest.fixture
+def analysis_env(monkeypatch, tmp_path):
+    for name in ('send_message', 'edit_message_text', 'delete_message'):
+        monkeypatch.setattr(bot.bot, name, lambda *args, **kwargs: SimpleNamespace(message_id=1))
+    monkeypatch.setattr(bot, 'ASSET_STORE_DIR', str(tmp_path))
+    monkeypatch.setattr(bot, 'save_chart', lambda *args: pytest.fail('không được lưu thêm lá số'))
+    monkeypatch.setattr(bot, 'materialize_chart_image', lambda chart_id: None)
+    analyzed = []
+
+    def analyze_chart_with_gpt(chart_path, user_data, on_progress=None):
+        analyzed.append(chart_path)
+        return {'tong_quan': 'Tốt'}
+
+    monkeypatch.setattr(bot, 'analyze_chart_with_gpt', analyze_chart_with_gpt)
+    user_data = bot.new_session_state(
+        day=15, month=8, year=1990, birth_time=bot.BIRTH_TIME_MAPPING['ty'], gender='Nam',
+        chart_id=7, chart_image_path=str(tmp_path / 'da_bi_don.jpg')
+    )
+    bot.user_states[CHAT_ID] = user_data
+    yield SimpleNamespace(user_data=user_data, analyzed=analyzed)
+    bot.user_states.pop(CHAT_ID, None)
+
+
+def test_missing_image_is_rerendered_without_new_chart_row(analysis_env, monkeypatch):
+    monkeypatch.setattr(bot, 'ANALYSIS_INPUT', 'image')
+    bot.process_analysis(CHAT_ID)
+
+    chart_path = analysis_env.analyzed[0]
+    assert chart_path and bot.touch_asset(chart_path)
+    assert analysis_env.user_data['chart_id'] == 7
+    assert analysis_env.user_data['analysis_complete']
+
+
+def test_text_input_never_resolves_the_image(analysis_env, monkeypatch):
+    monkeypatch.setattr(bot, 'ANALYSIS_INPUT', 'text')
+    for name in ('touch_asset', 'materialize_chart_image', 'render_chart_asset'):
+        monkeypatch.setattr(bot, name, lambda *args, name=name: pytest.fail(f'{name} không được gọi'))
+    bot.process_analysis(CHAT_ID)
+
+    assert analysis_env.analyzed == [None]
+    assert analysis_env.user_data['chart_stars']
+    assert analysis_env.user_data['analysis_complete']
+
+
+def history_call(chart_id):
+    call = bot.types.CallbackQuery.__new__(bot.types.CallbackQuery)
+    call.id = 'history'
+    call.data = f'analyze_chart_{chart_id}'
+    call.message = SimpleNamespace(chat=SimpleNamespace(id=CHAT_ID), message_id=1)
+    return call
+
+
+def test_history_analysis_reads_only_birth_fields(analysis_env, install_fake_db, monkeypatch):
+    monkeypatch.setattr(bot, 'ANALYSIS_INPUT', 'text')
+    monkeypatch.setattr(bot, 'materialize_chart_image', lambda chart_id: pytest.fail('không cần ảnh'))
+    queries = []
+
+    def handle(sql, params):
+        queries.append(sql)
+        return [{'day': 1, 'month': 2, 'year': 1991, 'birth_time': bot.BIRTH_TIME_MAPPING['ty'],
+                 'gender': 'Nữ', 'chart_stars': None}]
+
+    install_fake_db(handle)
+    bot.handle_analyze_chart(history_call(9))
+
+    assert 'chart_blob' not in queries[0] and 'chart_image' not in queries[0]
+    assert analysis_env.analyzed == [None]
+    user_data = bot.user_states[CHAT_ID]
+    assert user_data['chart_id'] == 9 and user_data['chart_stars']
+    assert user_data['analysis'] == {'tong_quan': 'Tốt'}
+
+
+def test_history_analysis_materializes_image_in_image_mode(analysis_env, install_fake_db, monkeypatch):
+    monkeypatch.setattr(bot, 'ANALYSIS_INPUT', 'image')
+    monkeypatch.setattr(bot, 'materialize_chart_image', lambda chart_id: f'/tmp/chart_{chart_id}.jpg')
+    install_fake_db(lambda sql, params: [{'day': 1, 'month': 2, 'year': 1991, 'birth_time': 'Tý',
+                                          'gender': 'Nữ', 'chart_stars': None}])
+    bot.handle_analyze_chart(history_call(9))
+
+    assert analysis_env.analyzed == ['/tmp/chart_9.jpg']
+    assert bot.user_states[CHAT_ID]['chart_image_path'] == '/tmp/chart_9.jpg'
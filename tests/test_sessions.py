@@ -0,0 +1,107 @@
+"""Phiên hội thoại: job nhận ra phiên của mình theo session_id kể cả khi SessionStore bỏ hoặc tải lại phiên."""
+import threading
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, 'SESSION_DB_PATH', str(tmp_path / 'sessions.db'))
+    session_store = bot.SessionStore('sqlite', ttl=3600, max_entries=1)
+    monkeypatch.setattr(bot, 'user_states', session_store)
+    return session_store
+
+
+def test_evicted_session_is_resumed(store):
+    user_data = bot.new_session_state(day=1, month=2, year=1990, birth_time='Tý', gender='Nam')
+    store[1] = user_data
+    # Chat khác làm phiên của chat 1 bị đẩy khỏi bộ nhớ (LRU)
+    store[2] = bot.new_session_state(day=3, month=4, year=1991)
+
+    assert bot.resume_session(1, user_data)
+    assert store[1] is user_data
+
+
+def test_reloaded_session_is_same_session(store):
+    user_data = bot.new_session_state(day=1, month=2, year=1990)
+    store[1] = user_data
+    store.maintain()
+    store[2] = {}
+
+    reloaded = store[1]
+    assert reloaded is not user_data
+    assert bot.is_current_session(1, user_data)
+    assert bot.resume_session(1, user_data)
+    assert store[1] is user_data
+
+
+def test_restarted_session_is_stale(store):
+    user_data = bot.new_session_state(day=1, month=2, year=1990)
+    store[1] = user_data
+
+    store[1] = bot.WAITING_FOR_BIRTH_DATE
+    assert not bot.resume_session(1, user_data)
+
+    store[1] = bot.new_session_state(day=5, month=6, year=1992)
+    assert not bot.is_current_session(1, user_data)
+    assert not bot.resume_session(1, user_data)
+
+
+def test_compact_session_does_not_touch_live_state():
+    state = bot.new_session_state(day=1, chart_data={'cung': []}, chart_stars={'cung': {}})
+    record = bot.compact_session(state)
+    assert 'chart_data' in state
+    assert 'chart_data' not in record and 'session_id' in record
+
+
+def test_session_being_edited_survives_byte_cap(store, monkeypatch):
+    store.max_entries = 10
+    store.max_bytes = 1
+    store[1] = bot.new_session_state(day=1, month=2, year=1990)
+    store[2] = bot.new_session_state(day=3, month=4, year=1991)
+
+    compact_session = bot.compact_session
+    busy = {1}
+
+    def compact_or_busy(state):
+        if state.get('day') in busy:
+            # Handler đang sửa dở phiên của chat 1
+            raise RuntimeError('dictionary changed size during iteration')
+        return compact_session(state)
+
+    monkeypatch.setattr(bot, 'compact_session', compact_or_busy)
+    store.maintain()
+    assert 1 in store.sessions and 2 not in store.sessions
+
+    busy.clear()
+    store.maintain()
+    assert 1 not in store.sessions
+
+    reloaded = bot.SessionStore('sqlite', ttl=3600)
+    assert reloaded[1]['day'] == 1 and reloaded[2]['day'] == 3
+
+
+def test_eviction_writes_outside_store_lock(store, monkeypatch):
+    persist_sessions = store.persist_sessions
+    lock_free = []
+
+    def check_lock(records):
+        def try_lock():
+            acquired = store.lock.acquire(timeout=0)
+            if acquired:
+                store.lock.release()
+            lock_free.append(acquired)
+
+        thread = threading.Thread(target=try_lock)
+        thread.start()
+        thread.join()
+        persist_sessions(records)
+
+    monkeypatch.setattr(store, 'persist_sessions', check_lock)
+    store[1] = bot.new_session_state(day=1, month=2, year=1990)
+    store[2] = bot.new_session_state(day=3, month=4, year=1991)
+
+    assert lock_free == [True]
+    assert store[1]['day'] == 1
@@ -0,0 +1,64 @@
+"""file_id Telegram của ảnh lá số: LRU có giới hạn và xóa file_id cũ khỏi cơ sở dữ liệu."""
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def tables(install_fake_db, monkeypatch):
+    tables = {'charts': {}, 'chart_cache': {}}
+
+    def handle(sql, params):
+        table = 'charts' if sql.startswith('UPDATE charts') else 'chart_cache'
+        if 'NULL' in sql:
+            key, file_id = params
+            if tables[table].get(key) == file_id:
+                tables[table][key] = None
+        else:
+            file_id, key = params
+            tables[table][key] = file_id
+        return 1
+
+    monkeypatch.setattr(bot, 'telegram_file_ids', OrderedDict())
+    install_fake_db(handle)
+    return tables
+
+
+def test_memory_cache_is_bounded_lru(tables, monkeypatch):
+    monkeypatch.setattr(bot, 'TELEGRAM_FILE_ID_CACHE_SIZE', 2)
+    bot.save_telegram_file_id('f1', chart_id=1)
+    bot.save_telegram_file_id('f2', chart_id=2)
+    assert bot.get_telegram_file_id(chart_id=1) == 'f1'
+    bot.save_telegram_file_id('f3', chart_id=3)
+    assert list(bot.telegram_file_ids) == ['chart_1', 'chart_3']
+
+
+def test_rejected_file_id_is_cleared_from_db(tables, monkeypatch):
+    bot.save_telegram_file_id('stale', chart_id=1, cache_key='k')
+    uploads = []
+
+    def send_photo(chat_id, photo, **kwargs):
+        if photo == 'stale':
+            raise bot.telebot.apihelper.ApiTelegramException(
+                'sendPhoto', None, {'error_code': 400, 'description': 'wrong file identifier'})
+        # file_id cũ đã bị xóa khỏi cơ sở dữ liệu trước khi upload lại
+        assert tables['charts'][1] is None and tables['chart_cache']['k'] is None
+        uploads.append(photo)
+        return SimpleNamespace(photo=[SimpleNamespace(file_id='fresh')])
+
+    monkeypatch.setattr(bot.bot, 'send_photo', send_photo)
+    bot.send_chart_photo(1, b'image', 'caption', None, chart_id=1, cache_key='k')
+
+    assert len(uploads) == 1
+    assert tables['charts'][1] == 'fresh'
+    assert tables['chart_cache']['k'] == 'fresh'
+
+
+def test_forget_keeps_newer_file_id(tables):
+    bot.save_telegram_file_id('fresh', chart_id=1)
+    bot.forget_telegram_file_id('stale', chart_id=1)
+    assert tables['charts'][1] == 'fresh'
+    assert bot.get_telegram_file_id(chart_id=1) == 'fresh'
@@ -0,0 +1,129 @@
+"""Lấy lá số qua HTTP: đọc form an sao và gửi đúng các trường như trình duyệt."""
+import base64
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs
+
+import pytest
+from PIL import Image
+
+import bot
+
+# Bản thu nhỏ form an sao: id giống trang thật (bản selenium điền theo id), tên trường cố ý
+# khác id để kiểm tra dữ liệu gửi đi lấy tên từ form chứ không lấy từ id
+FORM_HTML = """
+<html><body>
+<form id="loginForm" action="#" method="post"><input name="login_email" id="login_email"></form>
+<form action="/lasotuvi/ansaotuvi/" method="post" target="_blank">
+  <input type="hidden" name="_wpnonce" value="abc123">
+  <input type="text" id="txtHoTen" name="hoten">
+  <input type="radio" id="radNam" name="gioitinh" value="1" checked>
+  <input type="radio" id="radNu" name="gioitinh" value="0">
+  <input type="radio" id="am_lich" name="loailich" value="0">
+  <input type="radio" id="duong_lich" name="loailich" value="1" checked>
+  <select id="inam_duong" name="namsinh"><option value="1990">1990</option><option value="1998">1998</option></select>
+  <select id="ithang_duong" name="thangsinh"><option value="01">1</option><option value="05">5</option></select>
+  <select id="ingay_duong" name="ngaysinh"><option value="01">1</option><option value="12">12</option></select>
+  <select id="gio_duong" name="giosinh"><option value="00">0</option><option value="20">20</option></select>
+  <select id="phut_duong" name="phutsinh"><option value="00">0</option></select>
+  <select id="selNamXemD" name="namxem"><option value="2025" selected>2025</option></select>
+  <input type="radio" id="radMau" name="mauanh" value="mau">
+  <input type="radio" id="radDen" name="mauanh" value="den" checked>
+  <input type="radio" id="radluu" name="luuanh" value="30">
+  <input type="radio" id="canhbao_no" name="canhbao" value="khong">
+  <input type="checkbox" id="iconfirm1" name="dongy" value="yes">
+  <input type="button" name="xem" value="Xem thử">
+  <input type="submit" name="btnAnSao" value="An sao Tử Vi">
+</form>
+</body></html>
+"""
+
+
+def make_result_page():
+    buffer = BytesIO()
+    Image.new('RGB', (20, 20), 'white').save(buffer, 'JPEG')
+    data = base64.b64encode(buffer.getvalue()).decode('ascii')
+    return f'<html><body><img src="data:image/jpeg;base64,{data}"></body></html>'
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Server giả lập trang lập lá số: GET trả form, POST ghi lại các trường được gửi."""
+    posts = []
+
+    def do_GET(self):
+        self.reply(FORM_HTML)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        self.posts.append((self.path, {name: values[0] for name, values in parse_qs(body).items()}))
+        self.reply(make_result_page())
+
+    def reply(self, html):
+        body = html.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in(monkeypatch, tmp_path):
+    StandInHandler.posts = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv('NO_PROXY', '127.0.0.1')
+    monkeypatch.setattr(bot, 'TUVI_FORM_URL', f'http://127.0.0.1:{server.server_address[1]}/lasotuvi/')
+    monkeypatch.setattr(bot, 'ASSET_STORE_DIR', str(tmp_path))
+    monkeypatch.setattr(bot, 'save_chart', lambda user_id, chart_data, image_bytes: 1)
+    yield StandInHandler.posts
+    server.shutdown()
+    server.server_close()
+
+
+def test_parse_form_reads_names_from_markup():
+    form = bot.parse_tuvi_form(FORM_HTML, 'https://tuvivietnam.vn/lasotuvi/')
+    assert form['action'] == 'https://tuvivietnam.vn/lasotuvi/ansaotuvi/'
+    assert form['ids']['radNu'] == ('gioitinh', '0')
+    assert form['fields'] == {
+        '_wpnonce': 'abc123', 'hoten': '', 'gioitinh': '1', 'loailich': '1', 'namsinh': '1990',
+        'thangsinh': '01', 'ngaysinh': '01', 'giosinh': '00', 'phutsinh': '00', 'namxem': '2025',
+        'mauanh': 'den', 'btnAnSao': 'An sao Tử Vi'
+    }
+
+
+def test_parse_form_without_chart_form_fails():
+    with pytest.raises(ValueError):
+        bot.parse_tuvi_form('<form><input name="s"></form>', 'https://tuvivietnam.vn/')
+
+
+def test_fetch_posts_browser_fields(stand_in):
+    user_data = {}
+    image_path = bot.fetch_tuvi_chart_http(12, 5, 1998, 'Tuất', 'Nữ', 42, user_data)
+
+    assert image_path and user_data['chart_id'] == 1
+    assert len(stand_in) == 1
+    path, fields = stand_in[0]
+    assert path == '/lasotuvi/ansaotuvi/'
+    assert fields == {
+        '_wpnonce': 'abc123',
+        'hoten': 'Học Tử Vi Bot',
+        'gioitinh': '0',
+        'loailich': '1',
+        'namsinh': '1998',
+        'thangsinh': '05',
+        'ngaysinh': '12',
+        'giosinh': bot.HOUR_MAPPING['Tuất'],
+        'phutsinh': '00',
+        'namxem': str(bot.datetime.now().year),
+        'mauanh': 'mau',
+        'luuanh': '30',
+        'canhbao': 'khong',
+        'dongy': 'yes',
+        'btnAnSao': 'An sao Tử Vi',
+    }
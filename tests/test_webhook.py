@@ -0,0 +1,91 @@
+"""Webhook: chỉ nhận update có secret token và trả 503 khi không còn chỗ xử lý."""
+import asyncio
+import http.client
+import queue
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import bot
+
+UPDATE = '{"update_id": 1, "message": {"message_id": 1, "date": 0, "chat": {"id": 7, "type": "private"}, "text": "hi"}}'
+
+
+@pytest.fixture
+def webhook_server(monkeypatch):
+    monkeypatch.setattr(bot, 'WEBHOOK_SECRET', 'secret')
+    server = ThreadingHTTPServer(('127.0.0.1', 0), bot.WebhookRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post_update(server, secret='secret'):
+    conn = http.client.HTTPConnection(*server.server_address, timeout=5)
+    conn.request('POST', bot.WEBHOOK_PATH, UPDATE, {'X-Telegram-Bot-Api-Secret-Token': secret})
+    status = conn.getresponse().status
+    conn.close()
+    return status
+
+
+def test_busy_dispatcher_leaves_updates_queued(webhook_server, monkeypatch):
+    monkeypatch.setattr(bot, 'WEBHOOK_HANDLERS', 1)
+    update_queue = queue.Queue(maxsize=1)
+    monkeypatch.setattr(bot, 'webhook_queues', [update_queue])
+    started, release = threading.Event(), threading.Event()
+
+    def process_new_updates(updates):
+        started.set()
+        release.wait(5)
+
+    monkeypatch.setattr(bot.bot, 'process_new_updates', process_new_updates)
+    bot.start_update_dispatchers(update_queue)
+    try:
+        assert post_update(webhook_server) == 200
+        assert started.wait(5)
+        # Handler duy nhất đang bận: update thứ hai nằm trong hàng đợi, update thứ ba bị từ chối
+        assert post_update(webhook_server) == 200
+        assert post_update(webhook_server) == 503
+        assert update_queue.qsize() == 1
+    finally:
+        release.set()
+
+
+def test_wrong_or_missing_secret_is_rejected(webhook_server, monkeypatch):
+    monkeypatch.setattr(bot, 'webhook_queues', [queue.Queue()])
+    assert post_update(webhook_server, secret='') == 403
+    assert post_update(webhook_server, secret='wrong') == 403
+    monkeypatch.setattr(bot, 'WEBHOOK_SECRET', '')
+    assert post_update(webhook_server, secret='') == 403
+
+
+def test_webhook_mode_requires_secret(monkeypatch):
+    monkeypatch.setattr(bot, 'WEBHOOK_SECRET', '')
+    with pytest.raises(SystemExit):
+        bot.run_webhook_server()
+
+
+def test_async_dispatch_limits_running_handlers(monkeypatch):
+    monkeypatch.setattr(bot, 'WEBHOOK_ASYNC_HANDLERS', 2)
+    update_queue = queue.Queue()
+    for _ in range(5):
+        update_queue.put(UPDATE)
+    running = []
+
+    class FakeAsyncBot:
+        async def process_new_updates(self, updates):
+            running.append(updates)
+            await asyncio.sleep(10)
+
+    monkeypatch.setattr(bot, 'async_bot', FakeAsyncBot())
+
+    async def run():
+        dispatcher = asyncio.create_task(bot.dispatch_updates_async(update_queue))
+        await asyncio.sleep(0.3)
+        dispatcher.cancel()
+
+    asyncio.run(run())
+    assert len(running) == 2
+    assert update_queue.qsize() == 3